@@ -0,0 +1,120 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Compares deleting an unpacked tree of many small files with shutil.rmtree, against the parallel tree deletion that
+# cleanup uses. Also shows how long cleanup actually holds things up for, before the deletion carries on in the
+# background
+#
+# Usage:
+#   python benchmarks/bench_delete.py --files 200000
+#   python benchmarks/bench_delete.py --work-dir /var/tmp   # Measures the disk that unpacking normally happens on
+
+import os
+import shutil
+import tempfile
+import time
+
+import click
+
+from clamav_large_archive_scanner.lib import tree_delete
+
+
+def _generate_tree(root: str, num_files: int, files_per_dir: int, file_size: int):
+    data = os.urandom(file_size)
+    for i in range(num_files):
+        dir_path = os.path.join(root, f'dir_{i // files_per_dir // files_per_dir}', f'dir_{i // files_per_dir}')
+        if i % files_per_dir == 0:
+            os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f'file_{i}'), 'wb') as f:
+            f.write(data)
+
+    # Start from everything being on disk, not just in the page cache
+    os.sync()
+
+
+def _time_rmtree(tree: str) -> tuple[float, float]:
+    start = time.perf_counter()
+    shutil.rmtree(tree)
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+def _time_tree_delete(tree: str, jobs: int) -> tuple[float, float]:
+    deleter = tree_delete.TreeDeleter(max_jobs=jobs)
+
+    start = time.perf_counter()
+    deleter.delete(tree)
+    handed_off = time.perf_counter() - start
+    stats = deleter.wait()
+    elapsed = time.perf_counter() - start
+
+    if stats.num_errors > 0:
+        raise click.ClickException(f'Got {stats.num_errors} errors deleting {tree}: {stats.errors[0]}')
+
+    return handed_off, elapsed
+
+
+@click.command()
+@click.option('--work-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Where to generate the trees, which should be on the disk being measured '
+                   '(default: the system temp dir)')
+@click.option('--files', 'num_files', type=click.IntRange(min=1), default=100000, show_default=True,
+              help='Number of files to generate')
+@click.option('--files-per-dir', type=click.IntRange(min=1), default=100, show_default=True,
+              help='Number of files in each directory')
+@click.option('--file-size', type=click.IntRange(min=0), default=4096, show_default=True,
+              help='Size of each generated file, in bytes')
+@click.option('--jobs', type=click.IntRange(min=1), default=tree_delete.MAX_DELETE_JOBS, show_default=True,
+              help='Number of threads for the parallel deletion')
+@click.option('--rounds', type=click.IntRange(min=1), default=3, show_default=True, help='Number of timed rounds')
+def main(work_dir, num_files, files_per_dir, file_size, jobs, rounds):
+    deleters = {
+        'rmtree': _time_rmtree,
+        'parallel': lambda tree: _time_tree_delete(tree, jobs),
+    }
+
+    click.echo(f'Deleting a tree of {num_files} files, {files_per_dir} per dir, best of {rounds} rounds')
+    with tempfile.TemporaryDirectory(prefix='bench_delete_', dir=work_dir) as tmp_dir:
+        for name, delete in deleters.items():
+            handed_off_times = []
+            times = []
+            for i in range(rounds):
+                tree = os.path.join(tmp_dir, f'tree_{i}')
+                _generate_tree(tree, num_files, files_per_dir, file_size)
+
+                handed_off, elapsed = delete(tree)
+                handed_off_times.append(handed_off)
+                times.append(elapsed)
+
+            best = min(times)
+            click.echo(f'{name + ":":<10}{best:.3f}s ({num_files / best:.0f} files/s), '
+                       f'blocked the caller for {min(handed_off_times):.3f}s')
+
+
+if __name__ == '__main__':
+    main()
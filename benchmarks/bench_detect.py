@@ -0,0 +1,157 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Compares filetype detection using libmagic for everything against the header sniffer in file_data
+#
+# Usage:
+#   python benchmarks/bench_detect.py                  # Generates a tree of mixed files in a temp dir
+#   python benchmarks/bench_detect.py --path /some/dir # Uses an existing tree instead
+
+import io
+import os
+import random
+import struct
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import click
+import magic
+
+from clamav_large_archive_scanner.lib import discovery, file_data
+
+
+def _make_tar() -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        member = tarfile.TarInfo('a.txt')
+        member.size = 4
+        tar.addfile(member, io.BytesIO(b'data'))
+    return buf.getvalue()
+
+
+def _make_tgz() -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        member = tarfile.TarInfo('a.txt')
+        member.size = 4
+        tar.addfile(member, io.BytesIO(b'data'))
+    return buf.getvalue()
+
+
+def _make_zip() -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as a_zip:
+        a_zip.writestr('a.txt', 'data')
+    return buf.getvalue()
+
+
+def _make_iso() -> bytes:
+    iso = bytearray(40 * 1024)
+    iso[32768:32775] = b'\x01CD001\x01'
+    return bytes(iso)
+
+
+SAMPLE_MAKERS = [
+    lambda: _make_tar(),
+    lambda: _make_tgz(),
+    lambda: _make_zip(),
+    lambda: _make_iso(),
+    lambda: b'KDMV' + struct.pack('<I', 1) + bytes(504),
+    lambda: b'QFI\xfb' + struct.pack('>I', 3) + bytes(504),
+    # The bulk of any real unpacked tree is stuff that isn't an archive
+    lambda: random.randbytes(4096),
+    lambda: b'some plain text\n' * 256,
+    lambda: b'#!/bin/sh\necho hello\n',
+    lambda: b'\x7fELF' + random.randbytes(4092),
+]
+
+
+def _generate_tree(root: str, num_files: int):
+    for i in range(num_files):
+        sub_dir = os.path.join(root, f'dir_{i % 32}')
+        os.makedirs(sub_dir, exist_ok=True)
+        with open(os.path.join(sub_dir, f'file_{i}'), 'wb') as f:
+            f.write(random.choice(SAMPLE_MAKERS)())
+
+
+def _detect_libmagic(path: str) -> file_data.FileType:
+    return file_data._get_filetype(magic.from_file(path, mime=False))
+
+
+def _detect_sniff(path: str, file_stat: os.stat_result) -> file_data.FileType:
+    return file_data.file_meta_from_stat(path, file_stat).filetype
+
+
+def _run(root: str, rounds: int):
+    files = list(discovery.iter_files(root, 0))
+    click.echo(f'Detecting {len(files)} files under {root}, best of {rounds} rounds')
+
+    libmagic_times = []
+    sniff_times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        libmagic_types = [_detect_libmagic(path) for path, _ in files]
+        libmagic_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        sniff_types = [_detect_sniff(path, file_stat) for path, file_stat in files]
+        sniff_times.append(time.perf_counter() - start)
+
+    best_libmagic = min(libmagic_times)
+    best_sniff = min(sniff_times)
+    click.echo(f'libmagic: {best_libmagic:.3f}s ({best_libmagic / len(files) * 1e6:.1f} us/file)')
+    click.echo(f'sniff:    {best_sniff:.3f}s ({best_sniff / len(files) * 1e6:.1f} us/file)')
+    click.echo(f'speedup:  {best_libmagic / best_sniff:.1f}x')
+
+    # Only a difference if libmagic got it wrong, or the sniffer did
+    mismatches = [(path, a, b) for (path, _), a, b in zip(files, libmagic_types, sniff_types) if a != b]
+    click.echo(f'{len(mismatches)} files detected differently')
+    for path, libmagic_type, sniff_type in mismatches[:10]:
+        click.echo(f'  {path}: libmagic={libmagic_type.get_filetype_short()} sniff={sniff_type.get_filetype_short()}')
+
+
+@click.command()
+@click.option('--path', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Existing directory tree to detect, instead of a generated one')
+@click.option('--files', 'num_files', type=click.IntRange(min=1), default=20000, show_default=True,
+              help='Number of files to generate')
+@click.option('--rounds', type=click.IntRange(min=1), default=3, show_default=True, help='Number of timed rounds')
+def main(path, num_files, rounds):
+    if path is not None:
+        _run(path, rounds)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='bench_detect_') as root:
+        _generate_tree(root, num_files)
+        _run(root, rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Compares unpacking an uncompressed tar with tarfile as is, against copying the members straight out of the archive
+# with copy_file_range (or sendfile), the same as unpack does
+#
+# Usage:
+#   python benchmarks/bench_extract.py                          # Generates a tar of a few big files in a temp dir
+#   python benchmarks/bench_extract.py --path /some/archive.tar # Uses an existing tar instead
+
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+import click
+
+from clamav_large_archive_scanner.lib import unpack
+
+_WRITE_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def _generate_tar(tar_path: str, num_files: int, file_size: int):
+    with tempfile.TemporaryDirectory(prefix='bench_extract_src_') as src_dir:
+        with tarfile.open(tar_path, 'w') as tar:
+            for i in range(num_files):
+                file_path = os.path.join(src_dir, f'file_{i}')
+                with open(file_path, 'wb') as f:
+                    remaining = file_size
+                    while remaining > 0:
+                        f.write(os.urandom(min(remaining, _WRITE_CHUNK_SIZE)))
+                        remaining -= _WRITE_CHUNK_SIZE
+                tar.add(file_path, arcname=f'file_{i}')
+                os.remove(file_path)
+
+
+def _extract(tar_class, tar_path: str, dest_dir: str):
+    with tar_class.open(tar_path) as tar:
+        tar.extractall(dest_dir)
+
+    # Timed up to the point that everything is on disk, not just in the page cache
+    os.sync()
+
+
+def _run(tar_path: str, work_dir: str, rounds: int):
+    tar_size = os.path.getsize(tar_path)
+    click.echo(f'Unpacking {tar_path} ({tar_size / (1024 ** 2):.0f} MiB) into {work_dir}, best of {rounds} rounds')
+
+    extractors = {
+        'tarfile': tarfile.TarFile,
+        'zero copy': unpack._ReadableTarFile,
+    }
+
+    for name, tar_class in extractors.items():
+        times = []
+        cpu_times = []
+        for i in range(rounds):
+            dest_dir = os.path.join(work_dir, f'unpacked_{i}')
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            _extract(tar_class, tar_path, dest_dir)
+            cpu_times.append(time.process_time() - cpu_start)
+            times.append(time.perf_counter() - start)
+            shutil.rmtree(dest_dir)
+
+        best = min(times)
+        cpu_per_gib = min(cpu_times) / (tar_size / (1024 ** 3))
+        click.echo(f'{name + ":":<11}{best:.3f}s ({tar_size / best / (1024 ** 2):.0f} MiB/s), '
+                   f'{cpu_per_gib:.2f}s of CPU per GiB')
+
+
+@click.command()
+@click.option('--path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Existing uncompressed tar to unpack, instead of a generated one')
+@click.option('--work-dir', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Where to generate the tar and unpack it, which should be on the disk being measured '
+                   '(default: the system temp dir)')
+@click.option('--files', 'num_files', type=click.IntRange(min=1), default=4, show_default=True,
+              help='Number of files to generate')
+@click.option('--file-size', type=click.IntRange(min=1), default=256 * 1024 * 1024, show_default=True,
+              help='Size of each generated file, in bytes')
+@click.option('--rounds', type=click.IntRange(min=1), default=3, show_default=True, help='Number of timed rounds')
+def main(path, work_dir, num_files, file_size, rounds):
+    with tempfile.TemporaryDirectory(prefix='bench_extract_', dir=work_dir) as tmp_dir:
+        if path is None:
+            path = os.path.join(tmp_dir, 'generated.tar')
+            _generate_tar(path, num_files, file_size)
+
+        _run(path, tmp_dir, rounds)
+
+
+if __name__ == '__main__':
+    main()
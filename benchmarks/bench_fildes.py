@@ -0,0 +1,114 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Compares clamd scanning a tree of many small files by path, against being passed the open files with FILDES
+# Path scans need the tree to be readable by clamd, FILDES doesn't, so the generated tree is made readable by everyone
+#
+# Usage:
+#   python benchmarks/bench_fildes.py --clamd-socket /run/clamav/clamd.ctl                  # Generates a tree
+#   python benchmarks/bench_fildes.py --clamd-socket /run/clamav/clamd.ctl --path /some/dir # Uses an existing tree
+
+import os
+import random
+import tempfile
+import time
+
+import click
+
+from clamav_large_archive_scanner.lib import clamd, discovery
+
+
+def _generate_tree(root: str, num_files: int, file_size: int):
+    os.chmod(root, 0o755)
+    for i in range(num_files):
+        sub_dir = os.path.join(root, f'dir_{i % 32}')
+        os.makedirs(sub_dir, mode=0o755, exist_ok=True)
+        file_path = os.path.join(sub_dir, f'file_{i}')
+        with open(file_path, 'wb') as f:
+            f.write(random.randbytes(file_size))
+        os.chmod(file_path, 0o644)
+
+
+def _scan_path(client: clamd.ClamdClient, command: str, root: str) -> int:
+    if command == 'MULTISCAN':
+        reply = client.multiscan(root)
+    else:
+        reply = client.contscan(root)
+    return clamd.reply_to_rv(reply)
+
+
+def _scan_fildes(client: clamd.ClamdClient, root: str, max_in_flight: int) -> int:
+    paths = (path for path, _ in discovery.iter_files(root, 0))
+    return clamd.reply_to_rv(client.fildes_scan(paths, max_in_flight))
+
+
+def _run(clamd_socket: str, root: str, rounds: int, max_in_flight: int):
+    num_files = sum(1 for _ in discovery.iter_files(root, 0))
+    click.echo(f'Scanning {num_files} files under {root} through {clamd_socket}, best of {rounds} rounds')
+
+    client = clamd.ClamdClient(clamd_socket)
+    scanners = {
+        'MULTISCAN': lambda: _scan_path(client, 'MULTISCAN', root),
+        'CONTSCAN': lambda: _scan_path(client, 'CONTSCAN', root),
+        'FILDES': lambda: _scan_fildes(client, root, max_in_flight),
+    }
+
+    for name, a_scanner in scanners.items():
+        times = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            rv = a_scanner()
+            times.append(time.perf_counter() - start)
+
+        best = min(times)
+        click.echo(f'{name + ":":<11}{best:.3f}s ({best / num_files * 1e6:.1f} us/file), clamdscan rv {rv}')
+
+
+@click.command()
+@click.option('--clamd-socket', required=True, envvar='CLAMD_SOCKET', help="Path to clamd's LocalSocket")
+@click.option('--path', type=click.Path(exists=True, file_okay=False, resolve_path=True), default=None,
+              help='Existing directory tree to scan, instead of a generated one')
+@click.option('--files', 'num_files', type=click.IntRange(min=1), default=20000, show_default=True,
+              help='Number of files to generate')
+@click.option('--file-size', type=click.IntRange(min=1), default=4096, show_default=True,
+              help='Size of each generated file, in bytes')
+@click.option('--rounds', type=click.IntRange(min=1), default=3, show_default=True, help='Number of timed rounds')
+@click.option('--max-in-flight', type=click.IntRange(min=1), default=clamd.FILDES_MAX_IN_FLIGHT, show_default=True,
+              help='Number of FILDES commands waiting on a reply at once')
+def main(clamd_socket, path, num_files, file_size, rounds, max_in_flight):
+    if path is not None:
+        _run(clamd_socket, path, rounds, max_in_flight)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='bench_fildes_') as root:
+        _generate_tree(root, num_files, file_size)
+        _run(clamd_socket, root, rounds, max_in_flight)
+
+
+if __name__ == '__main__':
+    main()
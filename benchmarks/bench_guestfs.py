@@ -0,0 +1,123 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Compares reading every file of a VMDK or QCOW2 image through a FUSE mount of a libguestfs appliance (what clamd does
+# when scanning the unpacked directory), against reading them through the libguestfs API, the same as --stream does
+# Needs the libguestfs python bindings, and FUSE
+#
+# Usage:
+#   python benchmarks/bench_guestfs.py --path /some/disk.qcow2
+
+import os
+import tempfile
+import time
+
+import click
+
+from clamav_large_archive_scanner.lib import guestfs_appliance, mount_tools
+
+
+def _read_fuse(image_path: str, read_size: int):
+    """
+    :return: The number of files and bytes read, and the seconds it took, including launching the appliance
+    """
+    num_files = 0
+    num_bytes = 0
+
+    with tempfile.TemporaryDirectory(prefix='bench_guestfs_') as mount_point:
+        start = time.perf_counter()
+        guestfs_appliance.mount_image(image_path, mount_point)
+        try:
+            for dir_path, _, file_names in os.walk(mount_point):
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    if not os.path.isfile(file_path) or os.path.islink(file_path):
+                        continue
+
+                    with open(file_path, 'rb', buffering=0) as f:
+                        while True:
+                            data = f.read(read_size)
+                            if not data:
+                                break
+                            num_bytes += len(data)
+                    num_files += 1
+            seconds = time.perf_counter() - start
+        finally:
+            mount_tools.umount_guestfs_partition(mount_point)
+
+    return num_files, num_bytes, seconds
+
+
+def _read_api(image_path: str):
+    num_files = 0
+    num_bytes = 0
+
+    start = time.perf_counter()
+    with guestfs_appliance.GuestFSImage(image_path) as image:
+        for path, size in image.iter_files():
+            reader = image.open(path, size)
+            while True:
+                data = reader.read()
+                if not data:
+                    break
+                num_bytes += len(data)
+            num_files += 1
+        seconds = time.perf_counter() - start
+
+    return num_files, num_bytes, seconds
+
+
+@click.command()
+@click.option('--path', type=click.Path(exists=True, dir_okay=False), required=True,
+              help='VMDK or QCOW2 image to read every file of')
+@click.option('--fuse-read-size', type=click.IntRange(min=1), default=128 * 1024, show_default=True,
+              help='Size of each read through the FUSE mount, clamd mostly makes small reads')
+@click.option('--rounds', type=click.IntRange(min=1), default=3, show_default=True, help='Number of timed rounds')
+@click.option('--fixed-appliance', type=click.Path(exists=True, file_okay=False), default=None,
+              help='Directory with a fixed libguestfs appliance in it')
+def main(path, fuse_read_size, rounds, fixed_appliance):
+    if not guestfs_appliance.is_available():
+        raise click.ClickException('The libguestfs python bindings are not installed')
+
+    guestfs_appliance.use_appliance(fixed_appliance)
+    click.echo(f'Reading every file in {path}, best of {rounds} rounds (including the appliance launch)')
+
+    readers = {
+        'fuse': lambda: _read_fuse(path, fuse_read_size),
+        'api': lambda: _read_api(path),
+    }
+
+    for name, reader in readers.items():
+        results = [reader() for _ in range(rounds)]
+        num_files, num_bytes, best = min(results, key=lambda x: x[2])
+        click.echo(f'{name + ":":<6}{num_files} files, {num_bytes / (1024 ** 2):.0f} MiB in {best:.3f}s '
+                   f'({num_bytes / best / (1024 ** 2):.0f} MiB/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# A small client for clamd's socket protocol, so that we don't need to start a clamdscan process for every scan
+# See `man clamd` for the full command reference
+
+import os
+import select
+import socket
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
+
+# clamd accepts commands prefixed with 'z' (NUL terminated) or 'n' (newline terminated)
+# The reply is terminated the same way as the command
+NULL_TERMINATED = 'z'
+NEWLINE_TERMINATED = 'n'
+
+_TERMINATORS = {
+    NULL_TERMINATED: b'\0',
+    NEWLINE_TERMINATED: b'\n',
+}
+
+INSTREAM_CHUNK_SIZE = 1024 * 1024  # 1MiB
+_CHUNK_LENGTH_SIZE = 4
+_RECV_SIZE = 64 * 1024
+
+# How many FILDES commands can be waiting on a reply at once, within a session
+# clamd stops reading commands once its own queue is full, so we have to keep reading replies as we go
+FILDES_MAX_IN_FLIGHT = 32
+
+# Reply suffixes, as per the clamd man page
+REPLY_OK = ' OK'
+REPLY_FOUND = ' FOUND'
+REPLY_ERROR = ' ERROR'
+
+# Return codes, these match what clamdscan returns
+RV_CLEAN = 0
+RV_VIRUS = 1
+RV_ERROR = 2
+
+
+def parse_address(address: str) -> Tuple[int, object]:
+    """
+    :param address: Either a path to clamd's LocalSocket, or HOST:PORT of its TCPSocket.
+                    The unix:// and tcp:// prefixes are also accepted.
+    :return: A tuple of the socket family and the address to connect to
+    """
+
+    if address.startswith('unix://'):
+        return socket.AF_UNIX, address[len('unix://'):]
+
+    if address.startswith('tcp://'):
+        address = address[len('tcp://'):]
+    elif address.startswith('/') or ':' not in address:
+        return socket.AF_UNIX, address
+
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise ClamdException(f'Invalid clamd TCP address: {address}')
+
+    return socket.AF_INET, (host.strip('[]') or 'localhost', int(port))
+
+
+def reply_to_rv(reply_lines: List[str]) -> int:
+    """
+    :param reply_lines: The reply from a scan command, split into lines
+    :return: The equivalent clamdscan return code, virus > error > clean
+    """
+
+    if any(line.endswith(REPLY_FOUND) for line in reply_lines):
+        return RV_VIRUS
+
+    if any(line.endswith(REPLY_ERROR) for line in reply_lines):
+        return RV_ERROR
+
+    # An empty reply means that clamd went away mid-scan
+    if len(reply_lines) == 0:
+        return RV_ERROR
+
+    return RV_CLEAN
+
+
+class ClamdClient:
+    def __init__(self, address: str, terminator: str = NULL_TERMINATED, timeout: float = None):
+        self.address = address
+        self.family, self.sock_address = parse_address(address)
+
+        if terminator not in _TERMINATORS:
+            raise ClamdException(f'Unknown command terminator: {terminator}')
+
+        self.terminator = terminator
+        self.timeout = timeout  # None means no timeout, scans of huge trees can take hours
+
+        # The connection currently in use, kept around so that another thread can abort it
+        self._active_sock = None  # type: socket.socket | None
+        self._aborted = False
+        self._lock = threading.Lock()
+
+    def abort(self) -> None:
+        """
+        Abort the command in flight (if any) from another thread, the blocked call will raise a ClamdException
+        clamd stops scanning once it notices that the client has gone away
+        """
+
+        with self._lock:
+            self._aborted = True
+            if self._active_sock is not None:
+                try:
+                    self._active_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _connect(self) -> socket.socket:
+        with self._lock:
+            if self._aborted:
+                raise ClamdException(f'Connection to clamd at {self.address} was aborted')
+
+        try:
+            if self.family == socket.AF_UNIX:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                sock.connect(self.sock_address)
+            else:
+                sock = socket.create_connection(self.sock_address, timeout=self.timeout)
+        except OSError as e:
+            raise ClamdException(f'Unable to connect to clamd at {self.address}: {e}')
+
+        with self._lock:
+            self._active_sock = sock
+            if self._aborted:
+                sock.shutdown(socket.SHUT_RDWR)
+
+        return sock
+
+    def _close(self, sock: socket.socket) -> None:
+        with self._lock:
+            self._active_sock = None
+        sock.close()
+
+    def _encode_command(self, command: str) -> bytes:
+        return f'{self.terminator}{command}'.encode() + _TERMINATORS[self.terminator]
+
+    def _read_reply(self, sock: socket.socket) -> List[str]:
+        # Outside of sessions, clamd closes the connection once the whole reply has been sent
+        chunks = []
+        while True:
+            chunk = sock.recv(_RECV_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        if self._aborted:
+            raise ClamdException(f'Connection to clamd at {self.address} was aborted')
+
+        reply = b''.join(chunks).decode(errors='replace')
+        return [line for line in reply.split(_TERMINATORS[self.terminator].decode()) if line != '']
+
+    def _send_command(self, command: str, payload: bytes = b'') -> List[str]:
+        sock = self._connect()
+        try:
+            sock.sendall(self._encode_command(command) + payload)
+            return self._read_reply(sock)
+        except OSError as e:
+            raise ClamdException(f'Lost connection to clamd at {self.address}: {e}')
+        finally:
+            self._close(sock)
+
+    def ping(self) -> bool:
+        return self._send_command('PING') == ['PONG']
+
+    def version(self) -> str:
+        return '\n'.join(self._send_command('VERSION'))
+
+    # The scan commands below all return the reply lines, see reply_to_rv to turn them into a return code
+
+    def scan(self, path: str) -> List[str]:
+        # Stops scanning at the first virus found
+        return self._send_command(f'SCAN {path}')
+
+    def contscan(self, path: str) -> List[str]:
+        return self._send_command(f'CONTSCAN {path}')
+
+    def multiscan(self, path: str) -> List[str]:
+        return self._send_command(f'MULTISCAN {path}')
+
+    def allmatchscan(self, path: str) -> List[str]:
+        return self._send_command(f'ALLMATCHSCAN {path}')
+
+    def _read_session_reply(self, sock: socket.socket, buffered: bytearray, pending: Dict[int, str]) -> str:
+        """
+        Reads the next reply in an IDSESSION, which can be for any of the commands still pending
+        :return: The reply, with the path of the file it is for in place of the descriptor
+        """
+        terminator = _TERMINATORS[self.terminator]
+
+        while terminator not in buffered:
+            chunk = sock.recv(_RECV_SIZE)
+            if not chunk:
+                if self._aborted:
+                    raise ClamdException(f'Connection to clamd at {self.address} was aborted')
+                raise ClamdException(f'clamd at {self.address} closed the session early')
+            buffered += chunk
+
+        end = buffered.index(terminator)
+        reply = buffered[:end].decode(errors='replace')
+        del buffered[:end + 1]
+
+        # Replies are prefixed with the ID of the command, and then the descriptor, IE '2: fd[10]: OK'
+        request_id, _, result = reply.partition(': ')
+        if not request_id.isdigit() or int(request_id) not in pending:
+            raise ClamdException(f'Unexpected reply from clamd at {self.address}: {reply}')
+
+        path = pending.pop(int(request_id))
+        if result.startswith('fd['):
+            result = result.partition(': ')[2]
+
+        return f'{path}: {result}'
+
+    def fildes_scan(self, paths: Iterable[str], max_in_flight: int = FILDES_MAX_IN_FLIGHT) -> List[str]:
+        """
+        Opens every file here, and passes the descriptors to clamd in a single IDSESSION
+        clamd never needs to be able to get at the files by itself, but this only works over a LocalSocket
+        :return: A reply line per file, with its path instead of its descriptor
+        """
+
+        if self.family != socket.AF_UNIX:
+            raise ClamdException(f'Unable to pass files to clamd at {self.address}, it needs to be a LocalSocket')
+
+        replies = []
+        pending = {}  # type: Dict[int, str]
+        buffered = bytearray()
+        next_id = 1
+
+        sock = self._connect()
+        try:
+            sock.sendall(self._encode_command('IDSESSION'))
+
+            for path in paths:
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError as e:
+                    # Same as clamd would say if it couldn't open it
+                    replies.append(f'{path}: {e.strerror}. ERROR')
+                    continue
+
+                # clamd gets its own copy of the descriptor, ours can be closed as soon as it has been sent
+                try:
+                    sock.sendall(self._encode_command('FILDES'))
+                    socket.send_fds(sock, [b'\0'], [fd])
+                finally:
+                    os.close(fd)
+
+                pending[next_id] = path
+                next_id += 1
+
+                while len(pending) >= max_in_flight:
+                    replies.append(self._read_session_reply(sock, buffered, pending))
+
+            sock.sendall(self._encode_command('END'))
+            while len(pending) > 0:
+                replies.append(self._read_session_reply(sock, buffered, pending))
+        except OSError as e:
+            raise ClamdException(f'Lost connection to clamd at {self.address}: {e}')
+        finally:
+            self._close(sock)
+
+        return replies
+
+    def instream(self, fileobj, chunk_size: int = INSTREAM_CHUNK_SIZE) -> List[str]:
+        """
+        Streams the contents of a file-like object to clamd
+        Every chunk is prefixed by its length as a 4 byte big-endian int, and the stream ends with a 0 length chunk
+        If fileobj has readinto, every chunk is read into the same buffer, right after its length, and sent from there
+        """
+
+        # One buffer for the whole stream, rather than a new bytes object (and a copy of it) for every chunk
+        buffer = memoryview(bytearray(_CHUNK_LENGTH_SIZE + chunk_size))
+        chunk_view = buffer[_CHUNK_LENGTH_SIZE:]
+        readinto = getattr(fileobj, 'readinto', None)
+
+        sock = self._connect()
+        try:
+            try:
+                sock.sendall(self._encode_command('INSTREAM'))
+                while True:
+                    if readinto is not None:
+                        chunk_len = readinto(chunk_view)
+                    else:
+                        chunk = fileobj.read(chunk_size)
+                        chunk_len = len(chunk)
+                        chunk_view[:chunk_len] = chunk
+
+                    if not chunk_len:
+                        break
+
+                    buffer[:_CHUNK_LENGTH_SIZE] = chunk_len.to_bytes(_CHUNK_LENGTH_SIZE, 'big')
+                    sock.sendall(buffer[:_CHUNK_LENGTH_SIZE + chunk_len])
+
+                sock.sendall((0).to_bytes(_CHUNK_LENGTH_SIZE, 'big'))
+            except BrokenPipeError:
+                # clamd hangs up early when StreamMaxLength is exceeded, but it still tells us why
+                pass
+
+            return self._read_reply(sock)
+        except OSError as e:
+            raise ClamdException(f'Lost connection to clamd at {self.address}: {e}')
+        finally:
+            self._close(sock)
+
+    def _sendfile_all(self, sock: socket.socket, fd: int, offset: int, size: int) -> None:
+        while size > 0:
+            try:
+                sent = os.sendfile(sock.fileno(), fd, offset, size)
+            except BlockingIOError:
+                # Sockets with a timeout are non-blocking underneath, wait until there's room to send more
+                _, writable, _ = select.select([], [sock], [], self.timeout)
+                if not writable:
+                    raise socket.timeout(f'Timed out sending to clamd at {self.address}')
+                continue
+
+            if sent == 0:
+                raise ClamdException(f'Reached the end of the file with {size} bytes left to send')
+
+            offset += sent
+            size -= sent
+
+    def instream_fd(self, fd: int, offset: int, size: int, chunk_size: int = INSTREAM_CHUNK_SIZE) -> List[str]:
+        """
+        Same as instream, but for size bytes of an open file starting at offset, which never get copied into python
+        The kernel sends them straight from the page cache with sendfile, and the position of fd is left alone
+        """
+
+        sock = self._connect()
+        try:
+            try:
+                sock.sendall(self._encode_command('INSTREAM'))
+                while size > 0:
+                    chunk_len = min(size, chunk_size)
+                    sock.sendall(chunk_len.to_bytes(_CHUNK_LENGTH_SIZE, 'big'))
+                    self._sendfile_all(sock, fd, offset, chunk_len)
+                    offset += chunk_len
+                    size -= chunk_len
+
+                sock.sendall((0).to_bytes(_CHUNK_LENGTH_SIZE, 'big'))
+            except BrokenPipeError:
+                # clamd hangs up early when StreamMaxLength is exceeded, but it still tells us why
+                pass
+
+            return self._read_reply(sock)
+        except OSError as e:
+            raise ClamdException(f'Lost connection to clamd at {self.address}: {e}')
+        finally:
+            self._close(sock)
@@ -27,65 +27,103 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import click
+import humanize
 
 import clamav_large_archive_scanner.lib.mount_tools as mount_tools
 import clamav_large_archive_scanner.lib.tmp_files as tmp_files
+import clamav_large_archive_scanner.lib.tree_delete as tree_delete
 from clamav_large_archive_scanner.lib import fast_log
 from clamav_large_archive_scanner.lib.exceptions import MountException
+from clamav_large_archive_scanner.lib.contexts import UnpackContext
 from clamav_large_archive_scanner.lib.file_data import FileType
+from clamav_large_archive_scanner.lib.mount_tools import MountTable
+
+# Partitions of a guestmount'ed image are un-mounted this many at a time
+MAX_PARALLEL_UMOUNTS = 8
 
 
 class BaseCleanupHandler:
-    def __init__(self, path: str):
+    def __init__(self, path: str, mount_table: Optional[MountTable] = None):
         self.path = path
+        # Shared by every handler in a cleanup pass, so the mount table is only read once
+        self._mount_table = mount_table
+
+    @property
+    def mount_table(self) -> MountTable:
+        if self._mount_table is None:
+            self._mount_table = mount_tools.read_mount_table()
+        return self._mount_table
+
+    def _delete(self) -> None:
+        # Moved out of the way straight away, and deleted in the background
+        tree_delete.delete_tree(self.path)
+        tmp_files.forget_tmp_dir(self.path)
 
     def cleanup(self) -> None:
         fast_log.debug(f'Cleaning up {self.path} by deleting it.')
-        shutil.rmtree(path=self.path, ignore_errors=True)
+        self._delete()
 
 
 class TarCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mount_table: Optional[MountTable] = None):
+        super().__init__(path, mount_table)
 
 
 class ZipCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mount_table: Optional[MountTable] = None):
+        super().__init__(path, mount_table)
 
 
 class IsoCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mount_table: Optional[MountTable] = None):
+        super().__init__(path, mount_table)
 
     def cleanup(self) -> None:
-        fast_log.debug(f'Cleaning up {self.path} by un-mounting it.')
-        try:
-            mount_tools.umount_iso(self.path)
-        except MountException as e:
-            raise click.FileError(filename=self.path, hint=f'Unable to un-mount from {self.path}')
+        # Most ISOs are copied out of the image instead, only those that had to be mounted need un-mounting
+        if mount_tools.is_mount_point(self.path, self.mount_table):
+            fast_log.debug(f'Cleaning up {self.path} by un-mounting it.')
+            try:
+                mount_tools.umount_iso(self.path)
+            except MountException as e:
+                raise click.FileError(filename=self.path, hint=f'Unable to un-mount from {self.path}')
+        else:
+            fast_log.debug(f'Cleaning up {self.path} by deleting it.')
 
-        shutil.rmtree(path=self.path, ignore_errors=True)
+        self._delete()
 
 
 # Handles VMDK and QCOW2
 class GuestFSCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mount_table: Optional[MountTable] = None):
+        super().__init__(path, mount_table)
 
     def cleanup(self) -> None:
         fast_log.debug(f'Cleaning up {self.path} by un-mounting it all underlying partitions')
 
-        # Find all mount-points in the directory
-        dirs = mount_tools.list_top_level_dirs(self.path)
+        if mount_tools.is_mount_point(self.path, self.mount_table):
+            # Every partition is served from the one appliance, un-mounting it shuts the appliance down
+            dirs = [self.path]
+        else:
+            # Mounted one partition at a time by guestmount, find all mount-points in the directory
+            dirs = mount_tools.list_top_level_dirs(self.path)
         all_success = True
 
-        for a_dir in dirs:
-            try:
+        # Each guestunmount waits for its appliance to shut down, so they're all shut down at once
+        with ThreadPoolExecutor(max_workers=max(1, min(len(dirs), MAX_PARALLEL_UMOUNTS)),
+                                thread_name_prefix='guestunmount') as umount_pool:
+            futures = {}
+            for a_dir in dirs:
                 fast_log.debug(f'Un-mounting {a_dir}')
-                mount_tools.umount_guestfs_partition(a_dir)
+                futures[a_dir] = umount_pool.submit(mount_tools.umount_guestfs_partition, a_dir, self.mount_table)
+
+        for a_dir, future in futures.items():
+            try:
+                future.result()
             except MountException as e:
                 fast_log.warn(f'Unable to unmount {a_dir}, continuing anyway')
                 fast_log.warn(f'Got the following mount error: {e}')
@@ -93,14 +131,14 @@ class GuestFSCleanupHandler(BaseCleanupHandler):
                 continue
 
         if all_success:
-            shutil.rmtree(path=self.path, ignore_errors=True)
+            self._delete()
         else:
             fast_log.warn('Unable to un-mount all partitions')
 
 
 class TarGzCleanupHandler(BaseCleanupHandler):
-    def __init__(self, path: str):
-        super().__init__(path)
+    def __init__(self, path: str, mount_table: Optional[MountTable] = None):
+        super().__init__(path, mount_table)
 
 
 FILETYPE_HANDLERS = {
@@ -119,24 +157,28 @@ def _cleanup_file(filepath: str, only_one: bool, tmp_dir: str) -> None:
         fast_log.debug(f'No associated directories found for {filepath}')
         return
 
+    # Read once for the whole pass, rather than once per directory or partition
+    mount_table = mount_tools.read_mount_table()
+
     if only_one:
         fast_log.debug(f'Found an associated directory for {filepath}')
-        cleanup_path(files[0])
+        cleanup_path(files[0], mount_table)
     else:
         fast_log.debug(f'Found {len(files)} associated directories for {filepath}')
+        # Anything unpacked from inside of a dir comes first, so it's un-mounted before whatever it's mounted from
         for file in files:
             fast_log.debug(f'Cleaning up {file}')
-            cleanup_path(file)
+            cleanup_path(file, mount_table)
 
 
-def cleanup_path(filepath: str) -> None:
+def cleanup_path(filepath: str, mount_table: Optional[MountTable] = None) -> None:
     filetype = tmp_files.determine_tmp_dir_filetype(filepath)
 
     if filetype not in FILETYPE_HANDLERS.keys():
         raise click.BadParameter(f'Unhandled file type: {filetype}')
 
     handler_class = FILETYPE_HANDLERS[filetype]
-    handler = handler_class(filepath)
+    handler = handler_class(filepath, mount_table)
     handler.cleanup()
 
 
@@ -146,3 +188,94 @@ def cleanup_file(filepath: str, tmp_dir: str) -> None:
 
 def cleanup_recursive(filepath: str, tmp_dir: str) -> None:
     _cleanup_file(filepath, only_one=False, tmp_dir=tmp_dir)
+
+
+def cleanup_ctx(u_ctx: UnpackContext) -> None:
+    """
+    Cleans up a single unpacked context, rather than everything associated with a file
+    """
+    filetype = u_ctx.file_meta.filetype
+
+    # Directories given to us are not ours to delete, and anything else we don't know how to clean up is left
+    # for the final cleanup pass
+    if u_ctx.unpacked_dir_location is None or filetype not in FILETYPE_HANDLERS.keys():
+        return
+
+    fast_log.debug(f'Cleaning up {u_ctx}')
+    try:
+        FILETYPE_HANDLERS[filetype](u_ctx.unpacked_dir_location).cleanup()
+    except click.FileError as e:
+        fast_log.warn(f'Unable to clean up {u_ctx} early, will try again at the end: {e}')
+        return
+
+    # Cleaning up early is only worth it if the space is actually free by the time the next archive is unpacked,
+    # rather than sitting in the trash behind every other delete
+    tree_delete.wait_for_delete(u_ctx.unpacked_dir_location)
+
+
+class EagerCleaner:
+    """
+    Cleans up every unpacked context as soon as it, and every context unpacked from it, has been scanned
+    This keeps the temp space used down to what is actually still needed, instead of the whole unpacked tree
+
+    Each context is held by its own scan, by the search for archives inside of it, and by every context unpacked from
+    it, since those may still be reading from (or be mounted from) a file inside of it
+    """
+
+    def __init__(self, tmp_dir: str):
+        self.tmp_dir = tmp_dir
+        self._lock = threading.Lock()
+        self._holds = {}  # type: dict[UnpackContext, int]
+
+        self._baseline_usage = self._tmp_usage()
+        self.peak_usage = 0
+
+    def _tmp_usage(self) -> int:
+        # This covers everything on the filesystem holding tmp_dir, which is what actually fills up
+        return shutil.disk_usage(self.tmp_dir).used
+
+    def _record_usage(self) -> None:
+        usage = self._tmp_usage() - self._baseline_usage
+        with self._lock:
+            self.peak_usage = max(self.peak_usage, usage)
+
+    def unpacked(self, u_ctx: UnpackContext) -> None:
+        """
+        Must be called before the context is handed to the scanner
+        """
+        with self._lock:
+            # One hold for the scan, one for the search for nested archives
+            self._holds[u_ctx] = 2
+            if u_ctx.parent_ctx in self._holds:
+                self._holds[u_ctx.parent_ctx] += 1
+
+        self._record_usage()
+
+    def scanned(self, u_ctx: UnpackContext) -> None:
+        self._release(u_ctx)
+
+    def inspected(self, u_ctx: UnpackContext) -> None:
+        """
+        Called once every archive inside the context has been found and unpacked
+        """
+        self._release(u_ctx)
+
+    def _release(self, u_ctx: UnpackContext) -> None:
+        while u_ctx is not None:
+            with self._lock:
+                if u_ctx not in self._holds:
+                    return
+
+                self._holds[u_ctx] -= 1
+                if self._holds[u_ctx] > 0:
+                    return
+
+                del self._holds[u_ctx]
+
+            cleanup_ctx(u_ctx)
+
+            # Now that this one is gone, its parent might be done as well
+            u_ctx = u_ctx.parent_ctx
+
+    def log_peak_usage(self) -> None:
+        fast_log.info(f'Peak temp usage in {self.tmp_dir}: {humanize.naturalsize(self.peak_usage, binary=True)}')
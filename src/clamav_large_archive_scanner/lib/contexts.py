@@ -42,12 +42,43 @@ class UnpackContext:
         self.unpacked_dir_location = None  # type: str | None
         self.parent_ctx = parent_ctx  # type: UnpackContext | None
 
+        # Nice filenames of other archives with the exact same content, which weren't unpacked and share this one's results
+        self.aliases = []  # type: list[str]
+
+    def all_aliases(self) -> 'list[str]':
+        """
+        :return: The aliases of this archive, plus where it is inside the aliases of every archive that it's in, which
+                 have the exact same content too, and so weren't unpacked either
+        """
+        aliases = list(self.aliases)
+        if self.parent_ctx is not None:
+            # Everything after the parent's nice filename, starting with the ::
+            suffix = self.nice_filename()[len(self.parent_ctx.nice_filename()):]
+            aliases += [parent_alias + suffix for parent_alias in self.parent_ctx.all_aliases()]
+
+        return aliases
+
+    def root_ctx(self):
+        u_ctx = self
+        while u_ctx.parent_ctx is not None:
+            u_ctx = u_ctx.parent_ctx
+        return u_ctx
+
     def create_tmp_dir(self):
-        self.unpacked_dir_location = tmp_files.make_temp_dir(self.file_meta, self.enclosing_tmp_dir)
+        root_meta = self.root_ctx().file_meta
+        parent_dir = self.parent_ctx.unpacked_dir_location if self.parent_ctx is not None else None
+
+        self.unpacked_dir_location = tmp_files.make_temp_dir(self.file_meta, self.enclosing_tmp_dir,
+                                                             root_path=(root_meta.root_meta or root_meta).path,
+                                                             parent_dir=parent_dir)
 
     def cleanup_tmp(self):
         if self.unpacked_dir_location is not None:
             shutil.rmtree(self.unpacked_dir_location, ignore_errors=True)
+            tmp_files.forget_tmp_dir(self.unpacked_dir_location)
+
+            # Anything needing a temp dir after this gets a new one, from create_tmp_dir
+            self.unpacked_dir_location = None
 
     @staticmethod
     def _strip_tmp(u_ctx, path: str) -> str:
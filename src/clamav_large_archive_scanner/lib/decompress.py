@@ -0,0 +1,289 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Decompresses gzip streams on a separate thread from whatever is reading them (IE tarfile), so that both can run at
+# the same time. If a faster decompressor is installed, the actual decompression is done by it, in its own process
+
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from typing import Iterator, List, Optional
+
+import humanize
+
+from clamav_large_archive_scanner.lib import fast_log
+
+DECOMPRESSOR_AUTO = 'auto'
+DECOMPRESSOR_PYTHON = 'python'
+
+# In the order that auto tries them. igzip (from ISA-L) is the fastest at decompressing a single gzip stream, pigz
+# can't split up decompression but does do the reading, writing and checksumming on threads of their own
+EXTERNAL_DECOMPRESSORS = {
+    'igzip': ['igzip', '-d', '-c'],
+    'pigz': ['pigz', '-d', '-c'],
+}
+
+DECOMPRESSOR_CHOICES = [DECOMPRESSOR_AUTO] + list(EXTERNAL_DECOMPRESSORS.keys()) + [DECOMPRESSOR_PYTHON]
+
+CHUNK_SIZE = 1024 * 1024  # 1MiB
+
+# Double buffering, the decompressor can fill one buffer while the reader is still working through the other
+NUM_BUFFERS = 2
+
+# Lets a blocked decompressor thread notice that the reader has gone away
+_PUT_TIMEOUT_SECONDS = 0.1
+
+# Set through use_decompressor, for as long as a command is running
+_decompressor = DECOMPRESSOR_AUTO
+
+
+def is_available(decompressor: str) -> bool:
+    if decompressor in EXTERNAL_DECOMPRESSORS:
+        return shutil.which(EXTERNAL_DECOMPRESSORS[decompressor][0]) is not None
+
+    return decompressor in (DECOMPRESSOR_AUTO, DECOMPRESSOR_PYTHON)
+
+
+def use_decompressor(decompressor: str) -> None:
+    """
+    Makes every gzip stream opened from now on use the given decompressor
+    :param decompressor: One of DECOMPRESSOR_CHOICES, auto picks the first external decompressor that is on the PATH
+    """
+    global _decompressor
+    _decompressor = decompressor
+
+
+def decompressor() -> str:
+    return _decompressor
+
+
+def resolve_decompressor(decompressor: str) -> str:
+    if decompressor != DECOMPRESSOR_AUTO:
+        return decompressor
+
+    for name in EXTERNAL_DECOMPRESSORS.keys():
+        if is_available(name):
+            return name
+
+    return DECOMPRESSOR_PYTHON
+
+
+def _python_chunks(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        data = b''
+
+        while True:
+            if not data:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+
+            # Capped, a small chunk of the right data can decompress into something huge
+            chunk = decompressor.decompress(data, CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+
+            if decompressor.eof:
+                # Files can have more than one gzip member back to back, and be padded with zeroes at the end
+                # Everything past the end of this member is in unused_data, including what was in unconsumed_tail
+                data = decompressor.unused_data.lstrip(b'\0')
+                if not data:
+                    data = f.read(CHUNK_SIZE).lstrip(b'\0')
+                    if not data:
+                        return
+                decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+
+        if not decompressor.eof:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+class GzipStream:
+    """
+    A read-only file object with the decompressed contents of a gzip file
+    Decompression runs ahead of the reader, on its own thread, and in its own process for external decompressors
+    """
+
+    def __init__(self, path: str, decompressor: Optional[str] = None):
+        self.path = path
+        self.decompressor = resolve_decompressor(decompressor or _decompressor)
+
+        self._buffers = queue.Queue(maxsize=NUM_BUFFERS)
+        self._buffer = b''
+        self._pos = 0
+        self._done = False
+        self._closed = threading.Event()
+        self._error = None  # type: BaseException | None
+        self._process = None  # type: subprocess.Popen | None
+
+        # For working out which side is holding up the other
+        self.bytes_decompressed = 0
+        self.bytes_read = 0
+        self._decompress_seconds = 0.0
+        self._read_seconds = 0.0
+        self._read_started = None  # type: float | None
+
+        self._thread = threading.Thread(target=self._decompress, name=f'gunzip-{self.decompressor}', daemon=True)
+        self._thread.start()
+
+    def _external_chunks(self) -> Iterator[bytes]:
+        args = EXTERNAL_DECOMPRESSORS[self.decompressor] + [self.path]
+
+        # stderr goes to a file, as a pipe that nobody reads until stdout is done would fill up, and block it for good
+        with tempfile.TemporaryFile() as stderr_file:
+            self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                             stderr=stderr_file)
+            try:
+                while True:
+                    chunk = self._process.stdout.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+                rv = self._process.wait()
+            finally:
+                # If we were closed early, IE the reader stopped before the end, it would otherwise keep running
+                if self._process.poll() is None:
+                    self._process.kill()
+                self._process.stdout.close()
+                self._process.wait()
+
+            if rv != 0:
+                stderr_file.seek(0)
+                stderr = stderr_file.read().decode(errors='replace').strip()
+                raise OSError(f'{self.decompressor} was unable to decompress {self.path}: {stderr}')
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._buffers.put(item, timeout=_PUT_TIMEOUT_SECONDS)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _decompress(self) -> None:
+        if self.decompressor == DECOMPRESSOR_PYTHON:
+            chunks = _python_chunks(self.path)
+        else:
+            chunks = self._external_chunks()
+
+        try:
+            started = time.monotonic()
+            for chunk in chunks:
+                self._decompress_seconds += time.monotonic() - started
+                self.bytes_decompressed += len(chunk)
+
+                # Time spent waiting on the reader doesn't count
+                if not self._put(chunk):
+                    return
+                started = time.monotonic()
+
+            self._decompress_seconds += time.monotonic() - started
+        except BaseException as e:
+            self._error = e
+        finally:
+            chunks.close()
+            self._put(None)
+
+    def _next_buffer(self) -> bool:
+        waiting = time.monotonic()
+        buffer = self._buffers.get()
+        now = time.monotonic()
+
+        if self._read_started is None:
+            self._read_started = now
+        else:
+            # Time spent waiting on the decompressor doesn't count
+            self._read_seconds -= now - waiting
+
+        if buffer is None:
+            self._done = True
+            if self._error is not None:
+                raise OSError(f'Unable to decompress {self.path}: {self._error}') from self._error
+            return False
+
+        self._buffer = buffer
+        self._pos = 0
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []  # type: List[bytes]
+        remaining = size
+
+        while remaining != 0:
+            if self._pos >= len(self._buffer):
+                if self._done or not self._next_buffer():
+                    break
+
+            end = len(self._buffer) if remaining < 0 else min(len(self._buffer), self._pos + remaining)
+            chunks.append(self._buffer[self._pos:end])
+            if remaining > 0:
+                remaining -= end - self._pos
+            self.bytes_read += end - self._pos
+            self._pos = end
+
+        return b''.join(chunks)
+
+    def _log_throughput(self) -> None:
+        read_seconds = self._read_seconds + (time.monotonic() - self._read_started)
+        decompress_rate = self.bytes_decompressed / max(self._decompress_seconds, 1e-9)
+        read_rate = self.bytes_read / max(read_seconds, 1e-9)
+        slower = 'decompression' if decompress_rate < read_rate else 'unpacking'
+
+        fast_log.info(f'Decompressed {humanize.naturalsize(self.bytes_decompressed, binary=True)} of {self.path} '
+                      f'with {self.decompressor}: decompression ran at '
+                      f'{humanize.naturalsize(decompress_rate, binary=True)}/s, unpacking at '
+                      f'{humanize.naturalsize(read_rate, binary=True)}/s, {slower} is the bottleneck')
+
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
+
+        # Readers like tarfile can stop before the end, once they have found what they were looking for
+        if self._read_started is not None and self._error is None:
+            self._log_throughput()
+
+        self._closed.set()
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+
+        # The decompressor process is reaped by the thread, on its way out
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
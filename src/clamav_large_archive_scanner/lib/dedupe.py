@@ -0,0 +1,124 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Finds archives with identical content, so that only the first copy needs to be unpacked and scanned
+# Hashing every archive in full would mean reading all of them an extra time, so archives are first told apart by their
+# size and a few sampled blocks, and only hashed in full when those match
+
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.contexts import UnpackContext
+
+SAMPLE_BLOCK_SIZE = 64 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _sampled_fingerprint(path: str, size: int) -> Tuple[int, bytes]:
+    """
+    :return: The size, plus a hash of the first, middle and last blocks of the file
+    """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for offset in sorted({0, max(0, size // 2 - SAMPLE_BLOCK_SIZE // 2), max(0, size - SAMPLE_BLOCK_SIZE)}):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_BLOCK_SIZE))
+
+    return size, digest.digest()
+
+
+def _full_hash(path: str) -> bytes:
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.digest()
+
+
+class _Original:
+    def __init__(self, u_ctx: UnpackContext):
+        self.u_ctx = u_ctx
+        self.full_hash = None  # type: bytes | None
+
+    def get_full_hash(self) -> bytes:
+        # Only worked out once something else with the same sampled fingerprint shows up
+        if self.full_hash is None:
+            self.full_hash = _full_hash(self.u_ctx.file_meta.path)
+        return self.full_hash
+
+
+class ArchiveDeduper:
+    def __init__(self):
+        self._originals = {}  # type: Dict[Tuple[int, bytes], List[_Original]]
+        self.num_duplicates = 0
+        self.bytes_saved = 0
+
+    def find_original(self, u_ctx: UnpackContext) -> Optional[UnpackContext]:
+        """
+        Checks whether an archive with the same content as u_ctx has been seen before
+        u_ctx has to still be readable, and not unpacked yet. If it has no original, it becomes one
+        :return: The context of the first archive with the same content, or None if there isn't one
+        """
+        path = u_ctx.file_meta.path
+        size = u_ctx.file_meta.size_raw
+
+        try:
+            fingerprint = _sampled_fingerprint(path, size)
+            candidates = self._originals.setdefault(fingerprint, [])
+            original = _Original(u_ctx)
+
+            if len(candidates) > 0:
+                original.full_hash = _full_hash(path)
+        except OSError as e:
+            fast_log.debug(f'Unable to fingerprint {path}, treating it as unique: {e}')
+            return None
+
+        for candidate in candidates:
+            try:
+                candidate_hash = candidate.get_full_hash()
+            except OSError as e:
+                # IE it was already cleaned up, so it can't be compared against anymore
+                fast_log.debug(f'Unable to hash {candidate.u_ctx.file_meta.path}, skipping it: {e}')
+                continue
+
+            if candidate_hash == original.full_hash:
+                self.num_duplicates += 1
+                self.bytes_saved += size
+                return candidate.u_ctx
+
+        candidates.append(original)
+        return None
+
+    def forget(self, u_ctx: UnpackContext) -> None:
+        """
+        Stops u_ctx from being treated as an original, IE because it couldn't be unpacked after all
+        """
+        for candidates in self._originals.values():
+            candidates[:] = [x for x in candidates if x.u_ctx is not u_ctx]
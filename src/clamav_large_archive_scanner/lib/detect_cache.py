@@ -0,0 +1,230 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# An on disk cache of filetype detection results, so that files that haven't changed since the last run don't need to
+# be opened again. Entries are keyed by the identity of the inode, and evicted least recently used first
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+from clamav_large_archive_scanner.lib import fast_log
+
+DEFAULT_MAX_ENTRIES = 500000
+
+# Changes are only written every so often, instead of once per file
+COMMIT_INTERVAL = 1000
+COMMIT_SECONDS = 5
+
+# How long to wait for another process that is using the same cache
+LOCK_TIMEOUT_SECONDS = 5
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS detect_cache (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        ctime_ns INTEGER NOT NULL,
+        filetype TEXT NOT NULL,
+        desc TEXT,
+        last_used INTEGER NOT NULL,
+        PRIMARY KEY (dev, ino, size, mtime_ns, ctime_ns)
+    );
+    CREATE INDEX IF NOT EXISTS detect_cache_last_used ON detect_cache (last_used);
+'''
+
+
+def _key(file_stat: os.stat_result) -> Tuple[int, int, int, int, int]:
+    # mtime can be set to anything (tar does it when extracting), so a new file that reuses the inode of a deleted one
+    # can look identical to it. ctime can't be set, which makes that impossible
+    return file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns
+
+
+class DetectCache:
+    """
+    Safe to use from multiple threads, and from multiple processes sharing the same cache file
+    If anything goes wrong with the database, the cache disables itself and detection carries on without it
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+        # Changes are kept here until they're written, in a single short transaction, so that the database is never
+        # left locked while detection carries on. Other processes using the same cache would have to wait for it
+        self._pending_puts = {}  # type: dict[Tuple[int, int, int, int, int], Tuple[str, Optional[str], int]]
+        self._pending_used = {}  # type: dict[Tuple[int, int, int, int, int], int]
+        self._last_write = time.monotonic()
+
+        # A counter is enough to order entries by when they were last used, it just has to keep going up between runs
+        self._clock = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=LOCK_TIMEOUT_SECONDS, check_same_thread=False)
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(_SCHEMA)
+            self._clock = self._db.execute('SELECT COALESCE(MAX(last_used), 0) FROM detect_cache').fetchone()[0]
+        except sqlite3.Error:
+            self._db.close()
+            raise
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _disable(self, e: sqlite3.Error) -> None:
+        fast_log.warn(f'Unable to use the detection cache at {self.path}, continuing without it: {e}')
+        self._db.close()
+        self._db = None
+        self._pending_puts.clear()
+        self._pending_used.clear()
+
+    def _changed(self) -> None:
+        num_pending = len(self._pending_puts) + len(self._pending_used)
+        if num_pending >= COMMIT_INTERVAL or time.monotonic() - self._last_write >= COMMIT_SECONDS:
+            self._write()
+
+    def _write(self) -> None:
+        """
+        Writes out every pending change, and evicts whatever no longer fits
+        :raises sqlite3.Error: If the database can't be written to
+        """
+        puts = [key + value for key, value in self._pending_puts.items()]
+        used = [(last_used,) + key for key, last_used in self._pending_used.items()]
+        self._pending_puts.clear()
+        self._pending_used.clear()
+        self._last_write = time.monotonic()
+
+        if not puts and not used:
+            return
+
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO detect_cache '
+                                 '(dev, ino, size, mtime_ns, ctime_ns, filetype, desc, last_used) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', puts)
+            self._db.executemany('UPDATE detect_cache SET last_used=MAX(last_used, ?) '
+                                 'WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=?', used)
+
+            # Every time, rather than only when closing, as a long running serve may never close it
+            if puts:
+                self._evict()
+
+    def flush(self) -> None:
+        """
+        Writes out every pending change now, IE once a command is done
+        """
+        with self._lock:
+            if self._db is None:
+                return
+
+            try:
+                self._write()
+            except sqlite3.Error as e:
+                self._disable(e)
+
+    def get(self, file_stat: os.stat_result) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        :return: The short filetype name and description stored for the file, or None if it isn't cached
+        """
+        key = _key(file_stat)
+
+        with self._lock:
+            if self._db is None:
+                return None
+
+            try:
+                pending = self._pending_puts.get(key)
+                if pending is not None:
+                    row = pending[:2]
+                else:
+                    row = self._db.execute('SELECT filetype, desc FROM detect_cache '
+                                           'WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=?',
+                                           key).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+
+                self.hits += 1
+
+                # Only in memory for now, a hit shouldn't have to wait for other processes to be done writing
+                if pending is not None:
+                    self._pending_puts[key] = pending[:2] + (self._tick(),)
+                else:
+                    self._pending_used[key] = self._tick()
+                self._changed()
+            except sqlite3.Error as e:
+                self._disable(e)
+                return None
+
+        return row[0], row[1]
+
+    def put(self, file_stat: os.stat_result, filetype_short: str, desc: Optional[str]) -> None:
+        key = _key(file_stat)
+
+        with self._lock:
+            if self._db is None:
+                return
+
+            self._pending_puts[key] = (filetype_short, desc, self._tick())
+            self._pending_used.pop(key, None)
+            try:
+                self._changed()
+            except sqlite3.Error as e:
+                self._disable(e)
+
+    def _evict(self) -> None:
+        num_entries = self._db.execute('SELECT COUNT(*) FROM detect_cache').fetchone()[0]
+        if num_entries <= self.max_entries:
+            return
+
+        fast_log.debug(f'Evicting {num_entries - self.max_entries} entries from the detection cache')
+        self._db.execute('DELETE FROM detect_cache WHERE rowid IN '
+                         '(SELECT rowid FROM detect_cache ORDER BY last_used LIMIT ?)',
+                         (num_entries - self.max_entries,))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is None:
+                return
+
+            fast_log.debug(f'Detection cache at {self.path}: {self.hits} hits, {self.misses} misses')
+            try:
+                self._write()
+            except sqlite3.Error as e:
+                fast_log.warn(f'Unable to save the detection cache at {self.path}: {e}')
+            finally:
+                self._db.close()
+                self._db = None
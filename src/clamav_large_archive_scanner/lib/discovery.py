@@ -0,0 +1,84 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Finds the files inside an unpacked archive that are worth looking at more closely
+# This is a lot cheaper than calling file_meta_from_path on everything, since the size check only needs the stat
+# result that os.scandir already gives us, so small files never get opened at all
+
+import os
+from typing import Iterator, Tuple
+
+from clamav_large_archive_scanner.lib.fast_log import trace
+
+
+def iter_files(root: str, min_file_size: int) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Walks root the same way os.walk does (top down, not following symlinks), with each directory sorted by name
+    :param root: Directory to walk
+    :param min_file_size: Files smaller than this are skipped
+    :return: The path and lstat result of every regular file under root that is at least min_file_size
+    """
+
+    dirs_to_walk = [root]
+
+    while len(dirs_to_walk) > 0:
+        a_dir = dirs_to_walk.pop()
+        trace(f'Looking at {a_dir}')
+
+        try:
+            # Sorted, so that the same tree is always walked in the same order, whatever the filesystem
+            with os.scandir(a_dir) as it:
+                entries = sorted(it, key=lambda x: x.name)
+        except OSError as e:
+            trace(f'Unable to list {a_dir}: {e}')
+            continue
+
+        sub_dirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                    continue
+
+                # Symlinks, devices, sockets and the like are never archives we can unpack
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+
+                # One lstat per file, the d_type from the directory listing is enough for the checks above
+                entry_stat = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                trace(f'Unable to stat {entry.path}: {e}')
+                continue
+
+            if entry_stat.st_size < min_file_size:
+                continue
+
+            yield entry.path, entry_stat
+
+        # Reversed, so that sub directories get walked in the order they were listed
+        dirs_to_walk.extend(reversed(sub_dirs))
@@ -32,3 +32,15 @@ class MountException(BaseException):
 
 class ArchiveException(Exception):
     tmp_path = ""
+
+
+class ClamdException(Exception):
+    pass
+
+
+class IsoException(Exception):
+    pass
+
+
+class JobException(Exception):
+    pass
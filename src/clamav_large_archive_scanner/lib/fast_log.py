@@ -27,6 +27,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from pathlib import Path
+from typing import Optional
 
 from fastlogging import LogInit, Logger, INFO, DEBUG
 
@@ -58,6 +59,16 @@ def log_start(enable_verbose: bool, enable_trace: bool, trace_file_path: str = L
         info(f'Trace logging enabled, logging to {trace_file_path}')
 
 
+def console_verbose() -> Optional[bool]:
+    """
+    :return: If console logging was started with enable_verbose, or None if it wasn't started at all
+    """
+    if not _console_logger:
+        return None
+
+    return _log_level == DEBUG
+
+
 def trace(msg: str):
     global _trace_logger
 
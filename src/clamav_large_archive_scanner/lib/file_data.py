@@ -28,12 +28,16 @@
 
 import os
 import stat
+import threading
 from enum import Enum
 from textwrap import dedent
+from typing import Optional
 
 import humanize
 import magic
 
+from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
 
 class FileType(Enum):
     # OVA and TAR both magic out to TAR
@@ -55,22 +59,75 @@ class FileType(Enum):
         return self.value[1]
 
 
+FILETYPES_BY_SHORT = {x.get_filetype_short(): x for x in FileType}
+
+
+# Set through use_detect_cache, for as long as a command is running
+_detect_cache = None  # type: DetectCache | None
+
+
+def use_detect_cache(cache: Optional[DetectCache]) -> None:
+    """
+    Makes all detection consult the given cache before opening a file, and store what it finds there
+    Pass None to stop using a cache
+    """
+    global _detect_cache
+    _detect_cache = cache
+
+
+def get_detect_cache() -> Optional[DetectCache]:
+    """
+    Returns the cache set with use_detect_cache, if any
+    """
+    return _detect_cache
+
+
+# libmagic handles can't be shared between threads, so every thread that does detection gets its own
+_magic_handles = threading.local()
+
+
+def _magic_handle() -> magic.Magic:
+    handle = getattr(_magic_handles, 'handle', None)
+    if handle is None:
+        handle = magic.Magic(mime=False)
+        _magic_handles.handle = handle
+
+    return handle
+
+
+def _magic_from_file(path: str) -> str:
+    return _magic_handle().from_file(path)
+
+
 # A data class to store metadata, plus some pretty printing
 class FileMetadata:
     def __init__(self):
         self.path = ''
-        self.desc = ''
+        self._desc = ''  # type: str | None
         self.size_raw = 0
         self.filetype = FileType.UNKNOWN
         self.root_meta = None
 
+    @property
+    def desc(self) -> str:
+        # When the filetype came from sniffing the header, libmagic is only asked for the description if it's needed
+        if self._desc is None:
+            self._desc = _magic_from_file(self.path)
+        return self._desc
+
+    @desc.setter
+    def desc(self, value: 'str | None'):
+        self._desc = value
+
     def get_filename(self) -> str:
         return os.path.basename(self.path)
 
     def __str__(self):
+        # Only a description that is already known, this is for logging, which isn't worth a call to libmagic
+        desc = self._desc if self._desc is not None else 'Not looked up'
         return dedent(f'''\
                 Path: {self.path} 
-                Description: {self.desc}
+                Description: {desc}
                 Size: {humanize.naturalsize(self.size_raw, binary=True)}
                 Filetype: {self.filetype.get_filetype_short()}''')
 
@@ -97,6 +154,125 @@ def _get_filetype(desc) -> FileType:
         return FileType.UNKNOWN
 
 
+# Everything _sniff_filetype needs is in the first block of the file, except for the ISO 9660 volume descriptor
+SNIFF_HEAD_SIZE = 512
+
+QCOW_MAGIC = b'QFI\xfb'
+# libmagic only calls sparse extents 'VMware4 disk image', a descriptor on its own is just text
+VMDK_SPARSE_MAGIC = b'KDMV'
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+ZIP_EMPTY_MAGIC = b'PK\x05\x06'
+TAR_MAGIC_OFFSET = 257
+TAR_MAGIC = b'ustar'
+ISO_MAGIC_OFFSET = 32769
+ISO_MAGIC = b'CD001'
+
+# How much of the start of a file filetype_from_buffer needs to see
+SNIFF_BUFFER_SIZE = ISO_MAGIC_OFFSET + len(ISO_MAGIC)
+
+# libmagic reports these zips as documents/packages rather than 'Zip archive data', which means they aren't unpacked
+# They're recognized by the name of the first member, so leave them to libmagic to keep the same behavior
+ZIP_CONTAINER_FIRST_MEMBERS = (b'mimetype', b'[Content_Types].xml', b'_rels/', b'docProps/', b'META-INF/')
+
+
+def _sniff_zip(head: bytes) -> 'FileType | None':
+    # Local file header: the name length is at offset 26, and the name itself starts at 30
+    name_len = int.from_bytes(head[26:28], 'little')
+    first_member = head[30:30 + name_len]
+    if first_member.startswith(ZIP_CONTAINER_FIRST_MEMBERS):
+        return None
+
+    return FileType.ZIP
+
+
+def _sniff_head(head: bytes) -> 'FileType | None':
+    """
+    Checks for every signature that is in the first SNIFF_HEAD_SIZE bytes, which is all of them except for ISO 9660
+    :return: The filetype, UNKNOWN if there's no signature, or None if the header isn't conclusive
+    """
+    if head.startswith(QCOW_MAGIC):
+        # Version 1 is 'QEMU QCOW Image', which we don't handle
+        if int.from_bytes(head[4:8], 'big') >= 2:
+            return FileType.QCOW2
+        return FileType.UNKNOWN
+    if head.startswith(VMDK_SPARSE_MAGIC):
+        return FileType.VMDK
+    if head.startswith(GZIP_MAGIC):
+        return FileType.TARGZ
+    if head.startswith(ZIP_MAGIC):
+        return _sniff_zip(head)
+    if head.startswith(ZIP_EMPTY_MAGIC):
+        return FileType.ZIP
+    if head[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + len(TAR_MAGIC)] == TAR_MAGIC:
+        return FileType.TAR
+
+    return FileType.UNKNOWN
+
+
+def _sniff_filetype(path: str) -> 'FileType | None':
+    """
+    Figures out the filetype from the handful of header bytes that each supported format needs
+    A file without any of the signatures is UNKNOWN, since those are also what libmagic goes by for these formats
+    :return: The filetype, or None if the header isn't conclusive and libmagic should decide
+    """
+    try:
+        with open(path, 'rb') as f:
+            filetype = _sniff_head(f.read(SNIFF_HEAD_SIZE))
+            if filetype != FileType.UNKNOWN:
+                return filetype
+
+            f.seek(ISO_MAGIC_OFFSET)
+            if f.read(len(ISO_MAGIC)) == ISO_MAGIC:
+                return FileType.ISO
+    except OSError:
+        # Let libmagic deal with it, same as before
+        return None
+
+    # This includes old style (pre-POSIX) tars, which libmagic doesn't call 'POSIX tar archive' either
+    return FileType.UNKNOWN
+
+
+def filetype_from_buffer(data: bytes) -> FileType:
+    """
+    Same detection as for files on disk, but for the start of something that isn't, IE a member of an archive
+    :param data: At least the first SNIFF_BUFFER_SIZE bytes, unless that's all there is
+    """
+    filetype = _sniff_head(data[:SNIFF_HEAD_SIZE])
+
+    if filetype is None:
+        return _get_filetype(_magic_handle().from_buffer(data))
+
+    if filetype == FileType.UNKNOWN and data[ISO_MAGIC_OFFSET:SNIFF_BUFFER_SIZE] == ISO_MAGIC:
+        return FileType.ISO
+
+    return filetype
+
+
+def _detect_filetype(file_meta: FileMetadata, file_stat: os.stat_result):
+    cache = _detect_cache
+    if cache is not None:
+        cached = cache.get(file_stat)
+        if cached is not None:
+            file_meta.filetype = FILETYPES_BY_SHORT.get(cached[0], FileType.UNKNOWN)
+            # The description may not have been needed when the entry was made, in which case it's looked up on first use
+            file_meta.desc = cached[1]
+            return
+
+    filetype = _sniff_filetype(file_meta.path)
+
+    if filetype is None:
+        file_meta.desc = _magic_from_file(file_meta.path)
+        file_meta.filetype = _get_filetype(file_meta.desc)
+    else:
+        file_meta.filetype = filetype
+        # Looked up on first use
+        file_meta.desc = None
+
+    if cache is not None:
+        cache.put(file_stat, file_meta.filetype.get_filetype_short(), file_meta._desc)
+
+
 def _is_regular_file(path: str) -> bool:
     s = os.lstat(path).st_mode
     return stat.S_ISREG(s)
@@ -119,12 +295,24 @@ def file_meta_from_path(path: str) -> 'FileMetadata':
             rv.desc = UNKNOWN_DESC
             return rv
 
-        rv.desc = magic.from_file(path, mime=False)
         rv.size_raw = os.path.getsize(path)
-        rv.filetype = _get_filetype(rv.desc)
+        _detect_filetype(rv, os.lstat(path))
 
     else:
         rv.filetype = FileType.DOES_NOT_EXIST
         rv.desc = DNE_DESC
 
     return rv
+
+
+def file_meta_from_stat(path: str, file_stat: os.stat_result) -> 'FileMetadata':
+    """
+    Same as file_meta_from_path, but for a file that has already been lstat'd (IE by os.scandir)
+    Skips all the existence and type checks, the caller has to make sure that path is a regular file
+    """
+    rv = FileMetadata()
+    rv.path = path
+    rv.size_raw = file_stat.st_size
+    _detect_filetype(rv, file_stat)
+
+    return rv
@@ -0,0 +1,353 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Serves every filesystem in a VM disk image from a single libguestfs appliance
+# guestmount boots an appliance of its own for every partition, which takes seconds each time. Here the image is
+# inspected once, every filesystem in it is mounted inside the one appliance, and they're all exposed through a single
+# FUSE mount, with a directory for each. Like guestmount, the appliance is run by a process of its own, which keeps
+# serving (IE after the unpack command exits) until the directory is un-mounted
+#
+# Files can also be read through the API directly, without any mount at all. FUSE is slow at the many small reads that
+# clamd makes, while here every read is a single large pread inside the appliance
+#
+# Needs the libguestfs python bindings (python3-guestfs on Debian and Ubuntu, python3-libguestfs on Fedora)
+
+import json
+import os
+import posixpath
+import stat
+import subprocess
+import sys
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import click
+
+from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.exceptions import MountException
+
+# What list_filesystems reports for things that have no filesystem that can be mounted
+UNMOUNTABLE_FILESYSTEMS = ('unknown', 'swap')
+
+# The most pread can return in one call, a single message can't be more than somewhere between 2MiB and 4MiB
+READ_SIZE = 2 * 1024 * 1024 - 64 * 1024
+
+# Names given to a single lstatnslist call, which has the same limit on its reply
+_LSTAT_BATCH_SIZE = 1000
+
+# How much of the list of files that find0 downloads is read at a time
+_FILE_LIST_READ_SIZE = 64 * 1024
+
+# Set through use_appliance, for as long as a command is running
+_fixed_appliance = None  # type: str | None
+_cache_dir = None  # type: str | None
+
+
+def is_available() -> bool:
+    try:
+        import guestfs  # noqa: F401
+    except ImportError:
+        return False
+
+    return True
+
+
+def use_appliance(fixed_appliance: Optional[str] = None, cache_dir: Optional[str] = None) -> None:
+    """
+    Makes every appliance launched from now on use these settings, so that the appliance is only ever built once
+    :param fixed_appliance: Directory with a prebuilt (fixed) appliance in it, so that supermin never has to build one
+    :param cache_dir: Where supermin keeps the appliance it builds, so that every run sharing it reuses the same one
+    """
+    global _fixed_appliance, _cache_dir
+    _fixed_appliance = fixed_appliance
+    _cache_dir = cache_dir
+
+
+def appliance_settings() -> Tuple[Optional[str], Optional[str]]:
+    """
+    :return: The fixed appliance and cache dir, as given to use_appliance
+    """
+    return _fixed_appliance, _cache_dir
+
+
+def partition_dir_name(partition: str) -> str:
+    # Same as guestmount'ed partitions, most partitions contain the "/" character
+    return partition.replace('/', '++')
+
+
+def mount_image(image_path: str, mount_point: str) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Launches an appliance for image_path, and mounts every filesystem in it under mount_point
+    :return: The partitions that were mounted, and the error for every one that couldn't be
+    :raises MountException: If the appliance couldn't be launched, or mount_point couldn't be mounted
+    """
+    cmd = [sys.executable, '-m', __name__, image_path, mount_point]
+    if _fixed_appliance is not None:
+        cmd += ['--fixed-appliance', _fixed_appliance]
+    if _cache_dir is not None:
+        cmd += ['--cache-dir', _cache_dir]
+
+    # stderr goes to a file, so that whatever it says before reporting can go along with any error. It stops writing to
+    # it once it has reported, as it may keep running for a long time after that
+    with tempfile.TemporaryFile() as stderr_file:
+        # In a session of its own, so that it isn't taken down along with us
+        server = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr_file,
+                                  start_new_session=True, text=True)
+
+        # Reported as soon as everything is mounted, or launching failed
+        with server.stdout:
+            status_line = server.stdout.readline()
+
+        if not status_line:
+            error = f'Appliance for {image_path} exited with {server.wait()} before mounting anything'
+            raise MountException(_with_stderr(error, stderr_file))
+
+        try:
+            status = json.loads(status_line)
+            if 'error' not in status:
+                return status['mounted'], status['failed']
+
+            error = status['error']
+        except (ValueError, TypeError, KeyError):
+            # Whatever it is, it isn't going to report anything else
+            error = f'Appliance for {image_path} reported something unexpected: {status_line.strip()}'
+            server.kill()
+
+        server.wait()
+        raise MountException(_with_stderr(error, stderr_file))
+
+
+def _with_stderr(error: str, stderr_file) -> str:
+    stderr_file.seek(0)
+    stderr = stderr_file.read().decode(errors='replace').strip()
+    if not stderr:
+        return error
+
+    return f'{error}, the appliance said: {stderr}'
+
+
+def _mount_filesystems(g) -> Tuple[List[str], Dict[str, str]]:
+    mounted = []
+    failed = {}
+
+    for partition, fs_type in sorted(g.list_filesystems().items()):
+        if fs_type in UNMOUNTABLE_FILESYSTEMS:
+            continue
+
+        # Nothing is mounted at / inside the appliance, so each partition gets a mount point of its own there
+        inner_dir = '/' + partition_dir_name(partition)
+        g.mkmountpoint(inner_dir)
+        try:
+            g.mount_ro(partition, inner_dir)
+        except RuntimeError as e:
+            g.rmmountpoint(inner_dir)
+            failed[partition] = str(e)
+            continue
+
+        mounted.append(partition)
+
+    return mounted, failed
+
+
+def _launch(image_path: str, fixed_appliance: Optional[str], cache_dir: Optional[str]):
+    """
+    :return: A handle for an appliance with image_path attached and launched
+    :raises RuntimeError: If the appliance couldn't be launched
+    """
+    import guestfs
+
+    g = guestfs.GuestFS(python_return_dict=True)
+    try:
+        if fixed_appliance is not None:
+            g.set_path(fixed_appliance)
+        if cache_dir is not None:
+            g.set_cachedir(cache_dir)
+
+        g.add_drive_opts(image_path, readonly=1)
+        g.launch()
+    except RuntimeError:
+        g.close()
+        raise
+
+    return g
+
+
+class GuestFSImage:
+    """
+    An image with every filesystem in it mounted inside an appliance of our own, to be read through the API
+    :raises MountException: If the appliance couldn't be launched
+    """
+
+    def __init__(self, image_path: str):
+        try:
+            self._g = _launch(image_path, _fixed_appliance, _cache_dir)
+        except RuntimeError as e:
+            raise MountException(str(e))
+
+        try:
+            self.mounted, self.failed = _mount_filesystems(self._g)
+        except RuntimeError as e:
+            self.close()
+            raise MountException(str(e))
+
+    def close(self) -> None:
+        self._g.shutdown()
+        self._g.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _lstat_files(self, dir_path: Optional[str], names: List[str]) -> Iterator[Tuple[str, int]]:
+        if not names:
+            return
+
+        for name, stat_result in zip(names, self._g.lstatnslist(dir_path, names)):
+            # Links, directories and devices don't have any content of their own
+            if stat.S_ISREG(stat_result['st_mode']):
+                yield posixpath.join(dir_path, name), stat_result['st_size']
+
+    def _iter_paths(self, top_dir: str) -> Iterator[str]:
+        # find returns everything in a single reply, which is too large for a filesystem with many files in it
+        # find0 downloads the list into a local file instead, which is then read a chunk at a time
+        with tempfile.TemporaryDirectory(prefix='clam_unpacker_guestfs_') as list_dir:
+            list_path = os.path.join(list_dir, 'files')
+            self._g.find0(top_dir, list_path)
+
+            with open(list_path, 'rb') as f:
+                leftover = b''
+                while True:
+                    chunk = f.read(_FILE_LIST_READ_SIZE)
+                    if not chunk:
+                        break
+
+                    # Every name ends with a NUL, so the last one in a chunk may not be complete yet
+                    relative_paths = (leftover + chunk).split(b'\0')
+                    leftover = relative_paths.pop()
+
+                    for relative_path in relative_paths:
+                        try:
+                            yield posixpath.join(top_dir, relative_path.decode('utf-8'))
+                        except UnicodeDecodeError:
+                            # The API only takes UTF-8 paths, so there is no way to read it
+                            fast_log.warn(f'Skipping {top_dir}/{relative_path!r}, its name is not UTF-8')
+
+    def iter_files(self) -> Iterator[Tuple[str, int]]:
+        """
+        :return: The path inside the appliance, and size, of every regular file in every mounted filesystem
+        """
+        for partition in self.mounted:
+            # find lists everything in a directory one after the other, apart from the contents of its subdirectories
+            # So their stats are fetched a batch at a time, for each run of names in the same directory
+            batch_dir = None  # type: str | None
+            names = []  # type: List[str]
+            for path in self._iter_paths('/' + partition_dir_name(partition)):
+                dir_path, name = posixpath.split(path)
+                if dir_path != batch_dir or len(names) >= _LSTAT_BATCH_SIZE:
+                    yield from self._lstat_files(batch_dir, names)
+                    batch_dir, names = dir_path, []
+
+                names.append(name)
+
+            yield from self._lstat_files(batch_dir, names)
+
+    def open(self, path: str, size: int) -> 'GuestFSFileReader':
+        return GuestFSFileReader(self._g, path, size)
+
+
+class GuestFSFileReader:
+    """
+    Reads a file from inside the appliance, READ_SIZE at a time at most
+    """
+
+    def __init__(self, g, path: str, size: int):
+        self._g = g
+        self._path = path
+        self._size = size
+        self._offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self._size - self._offset
+        if size < 0 or size > remaining:
+            size = remaining
+
+        size = min(size, READ_SIZE)
+        if size <= 0:
+            return b''
+
+        try:
+            data = self._g.pread(self._path, size, self._offset)
+        except RuntimeError as e:
+            raise OSError(f'Unable to read {self._path}: {e}')
+
+        self._offset += len(data)
+        return data
+
+
+def _report(status: Dict) -> None:
+    print(json.dumps(status), flush=True)
+    sys.stdout.close()
+
+    # Nobody is listening anymore, and a file would keep growing for as long as we're running
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stderr.fileno())
+    os.close(devnull)
+
+
+@click.command()
+@click.argument('image_path')
+@click.argument('mount_point')
+@click.option('--fixed-appliance', default=None)
+@click.option('--cache-dir', default=None)
+def serve(image_path, mount_point, fixed_appliance, cache_dir):
+    try:
+        g = _launch(image_path, fixed_appliance, cache_dir)
+    except RuntimeError as e:
+        _report({'error': str(e)})
+        sys.exit(1)
+
+    try:
+        mounted, failed = _mount_filesystems(g)
+        g.mount_local(mount_point, readonly=True, options='allow_other')
+    except RuntimeError as e:
+        _report({'error': str(e)})
+        g.close()
+        sys.exit(1)
+
+    _report({'mounted': mounted, 'failed': failed})
+
+    # Until mount_point is un-mounted
+    g.mount_local_run()
+    g.shutdown()
+    g.close()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,414 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Reads the directory tree of an ISO 9660 image, so that the files in it can be copied or streamed straight out of the
+# image, without a loop mount (and so without root, or a free loop device)
+#
+# Names come from Rock Ridge if the image has it, otherwise from the Joliet tree, otherwise from the plain ISO 9660
+# names, mapped the same way the kernel does by default. Images that are really UDF (IE most DVDs) are left to mount,
+# since the ISO 9660 side of those usually only has a README telling you to use UDF.
+# See ECMA-119 for the on disk format, and IEEE P1282 (SUSP and RRIP) for Rock Ridge
+
+import os
+import struct
+from typing import Iterator, List, Optional, Set, Tuple
+
+from clamav_large_archive_scanner.lib.exceptions import IsoException
+from clamav_large_archive_scanner.lib.fast_log import trace
+
+SECTOR_SIZE = 2048
+_FIRST_DESCRIPTOR_SECTOR = 16
+
+# Plenty for any real image, this is only here to stop a corrupt one from sending us off reading forever
+_MAX_DESCRIPTORS = 64
+
+_VD_PRIMARY = 1
+_VD_SUPPLEMENTARY = 2
+_VD_TERMINATOR = 255
+_VD_ID = b'CD001'
+
+# Escape sequences that mark a supplementary descriptor as Joliet, for UCS-2 levels 1 to 3
+_JOLIET_ESCAPES = (b'%/@', b'%/C', b'%/E')
+
+# UDF's volume recognition sequence comes after the ISO 9660 descriptors
+_UDF_NSR_IDS = (b'NSR02', b'NSR03')
+_UDF_VRS_IDS = (b'BEA01', b'TEA01', b'BOOT2', b'CDW02') + _UDF_NSR_IDS
+
+# Directory record layout
+_DR_MIN_SIZE = 34
+_DR_FLAG_DIRECTORY = 0x02
+_DR_FLAG_ASSOCIATED = 0x04
+_DR_FLAG_MULTI_EXTENT = 0x80
+
+# Rock Ridge
+_SUSP_SP_CHECK = b'\xbe\xef'
+_RR_NM_CONTINUE = 0x01
+_RR_NM_CURRENT = 0x02
+_RR_NM_PARENT = 0x04
+
+# Most directories are a few sectors, the biggest real ones are still well under this
+_MAX_DIR_SIZE = 64 * 1024 * 1024
+
+
+class IsoEntry:
+    def __init__(self, path: str, is_dir: bool, size: int, extents: List[Tuple[int, int]]):
+        # Relative to the root of the image, '/' separated
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+
+        # Byte offset into the image and length of every part of the file, in order
+        self.extents = extents
+
+    def __str__(self):
+        return f'{self.path} ({self.size} bytes in {len(self.extents)} extent(s))'
+
+
+class _DirRecord:
+    def __init__(self, data: bytes, block_size: int):
+        self.extent_offset = struct.unpack_from('<I', data, 2)[0] * block_size
+        self.data_length = struct.unpack_from('<I', data, 10)[0]
+        self.flags = data[25]
+        self.interleaved = data[26] != 0 or data[27] != 0
+
+        name_len = data[32]
+        self.raw_name = data[33:33 + name_len]
+
+        # The system use area (Rock Ridge) comes after the name, which is padded to an even length
+        system_use_start = 33 + name_len + (1 - name_len % 2)
+        self.system_use = data[system_use_start:]
+
+    @property
+    def is_dir(self) -> bool:
+        return self.flags & _DR_FLAG_DIRECTORY != 0
+
+    @property
+    def is_self_or_parent(self) -> bool:
+        return self.raw_name in (b'\x00', b'\x01')
+
+
+class _RockRidge:
+    """
+    What matters to us from a directory record's Rock Ridge entries
+    """
+
+    def __init__(self):
+        self.name = None  # type: str | None
+        self.is_symlink = False
+        self.is_relocated = False
+        self.child_link = None  # type: int | None
+
+
+def _mapped_iso_name(raw_name: bytes) -> str:
+    # Same as the kernel's default map=normal: version dropped, trailing dot dropped, and lower case
+    name = raw_name.decode('ascii', errors='replace')
+    name = name.split(';', 1)[0]
+    if name.endswith('.'):
+        name = name[:-1]
+
+    return name.lower()
+
+
+def _joliet_name(raw_name: bytes) -> str:
+    name = raw_name.decode('utf-16-be', errors='replace')
+    return name.split(';', 1)[0]
+
+
+def _safe_name(name: str) -> Optional[str]:
+    """
+    :return: name, as something that can't get out of the directory it is unpacked into, or None if there's no hope
+    """
+    name = name.replace('/', '_').replace('\x00', '_')
+    if name in ('', '.', '..'):
+        return None
+
+    return name
+
+
+class IsoImage:
+    """
+    An ISO 9660 image, read through fd with pread so that its position doesn't matter, and other readers don't mind
+    :raises IsoException: If it's not an ISO 9660 image, or the ISO 9660 side of it isn't the one worth reading
+    """
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.has_udf = False
+        self.has_joliet = False
+        self.has_rock_ridge = False
+
+        self._block_size = SECTOR_SIZE
+        self._root = None  # type: _DirRecord | None
+        self._joliet_root = None  # type: _DirRecord | None
+        self._susp_skip = 0
+
+        self._read_descriptors()
+        self._check_rock_ridge()
+
+        if self.has_udf:
+            raise IsoException('Image has a UDF filesystem, which the ISO 9660 one only stands in for')
+
+    def _pread(self, size: int, offset: int) -> bytes:
+        data = os.pread(self.fd, size, offset)
+        if len(data) != size:
+            raise IsoException(f'Image ends early, wanted {size} bytes at {offset}')
+        return data
+
+    def _read_descriptors(self) -> None:
+        sector = _FIRST_DESCRIPTOR_SECTOR
+        terminated = False
+
+        for _ in range(_MAX_DESCRIPTORS):
+            try:
+                descriptor = self._pread(SECTOR_SIZE, sector * SECTOR_SIZE)
+            except IsoException:
+                break
+            sector += 1
+
+            descriptor_type, descriptor_id = descriptor[0], descriptor[1:6]
+
+            if descriptor_id in _UDF_VRS_IDS:
+                self.has_udf = self.has_udf or descriptor_id in _UDF_NSR_IDS
+                continue
+
+            if descriptor_id != _VD_ID or terminated:
+                break
+
+            if descriptor_type == _VD_PRIMARY and self._root is None:
+                self._block_size = struct.unpack_from('<H', descriptor, 128)[0]
+                self._root = _DirRecord(descriptor[156:156 + _DR_MIN_SIZE], self._block_size)
+            elif descriptor_type == _VD_SUPPLEMENTARY and descriptor[88:91] in _JOLIET_ESCAPES:
+                self._joliet_root = _DirRecord(descriptor[156:156 + _DR_MIN_SIZE], self._block_size)
+                self.has_joliet = True
+            elif descriptor_type == _VD_TERMINATOR:
+                # UDF's recognition sequence, if there is one, is right after this
+                terminated = True
+
+        if self._root is None:
+            raise IsoException('No primary volume descriptor found')
+
+        if self._block_size == 0 or self._block_size % 512 != 0:
+            raise IsoException(f'Invalid logical block size: {self._block_size}')
+
+    def _check_rock_ridge(self) -> None:
+        # Rock Ridge is announced by a SUSP 'SP' entry in the root directory's own '.' record
+        for record in self._dir_records(self._root):
+            system_use = record.system_use
+            if (record.raw_name == b'\x00' and len(system_use) >= 7 and system_use[:2] == b'SP' and
+                    system_use[4:6] == _SUSP_SP_CHECK):
+                self.has_rock_ridge = True
+                self._susp_skip = system_use[6]
+            return
+
+    def _dir_records(self, a_dir: _DirRecord) -> Iterator[_DirRecord]:
+        if a_dir.data_length > _MAX_DIR_SIZE:
+            raise IsoException(f'Directory at {a_dir.extent_offset} is too big: {a_dir.data_length} bytes')
+
+        data = self._pread(a_dir.data_length, a_dir.extent_offset)
+        pos = 0
+        while pos < len(data):
+            record_len = data[pos]
+
+            # Records never cross a sector boundary, the rest of the sector is zero padding
+            if record_len == 0:
+                pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+
+            if record_len < _DR_MIN_SIZE or pos + record_len > len(data):
+                raise IsoException(f'Corrupt directory record at {a_dir.extent_offset + pos}')
+
+            yield _DirRecord(data[pos:pos + record_len], self._block_size)
+            pos += record_len
+
+    def _susp_entries(self, system_use: bytes) -> Iterator[Tuple[bytes, bytes]]:
+        areas = [system_use[self._susp_skip:]]
+        num_continuations = 0
+
+        while len(areas) > 0:
+            area = areas.pop()
+            pos = 0
+            while pos + 4 <= len(area):
+                signature, entry_len = area[pos:pos + 2], area[pos + 2]
+                if entry_len < 4 or pos + entry_len > len(area):
+                    break
+
+                entry = area[pos:pos + entry_len]
+                pos += entry_len
+
+                if signature == b'ST':
+                    break
+
+                if signature == b'CE' and entry_len >= 28 and num_continuations < _MAX_DESCRIPTORS:
+                    # The rest of the entries are somewhere else
+                    block, offset, length = struct.unpack_from('<I4xI4xI', entry, 4)
+                    areas.append(self._pread(length, block * self._block_size + offset))
+                    num_continuations += 1
+                    continue
+
+                yield signature, entry
+
+    def _rock_ridge(self, record: _DirRecord) -> _RockRidge:
+        rock_ridge = _RockRidge()
+        name_parts = []
+
+        for signature, entry in self._susp_entries(record.system_use):
+            if signature == b'NM' and len(entry) >= 5:
+                flags = entry[4]
+                if flags & (_RR_NM_CURRENT | _RR_NM_PARENT):
+                    continue
+                name_parts.append(entry[5:])
+                if not flags & _RR_NM_CONTINUE:
+                    rock_ridge.name = b''.join(name_parts).decode(errors='surrogateescape')
+            elif signature == b'SL':
+                rock_ridge.is_symlink = True
+            elif signature == b'RE':
+                rock_ridge.is_relocated = True
+            elif signature == b'CL' and len(entry) >= 8:
+                rock_ridge.child_link = struct.unpack_from('<I', entry, 4)[0]
+
+        return rock_ridge
+
+    def _relocated_dir(self, block: int) -> _DirRecord:
+        # A directory moved elsewhere to get around the depth limit, its own '.' record has the real size
+        parent = _DirRecord(b'\x00' * _DR_MIN_SIZE, self._block_size)
+        parent.extent_offset = block * self._block_size
+        parent.data_length = SECTOR_SIZE
+        for record in self._dir_records(parent):
+            return record
+
+        raise IsoException(f'Relocated directory at block {block} is empty')
+
+    def _walk_dir(self, a_dir: _DirRecord, dir_path: str, joliet: bool,
+                  visited: Set[int]) -> Iterator[IsoEntry]:
+        if a_dir.extent_offset in visited:
+            trace(f'Already been through the directory at {a_dir.extent_offset}, skipping it')
+            return
+        visited.add(a_dir.extent_offset)
+
+        # Files bigger than 4GiB are split over several records with the same name, one per extent
+        pending = None  # type: IsoEntry | None
+        sub_dirs = []  # type: List[Tuple[_DirRecord, str]]
+
+        for record in self._dir_records(a_dir):
+            if record.is_self_or_parent or record.flags & _DR_FLAG_ASSOCIATED:
+                continue
+
+            if record.interleaved:
+                raise IsoException('Interleaved files are not supported')
+
+            rock_ridge = self._rock_ridge(record) if self.has_rock_ridge else _RockRidge()
+            if rock_ridge.is_relocated or rock_ridge.is_symlink:
+                continue
+
+            if rock_ridge.name is not None:
+                name = rock_ridge.name
+            elif joliet:
+                name = _joliet_name(record.raw_name)
+            else:
+                name = _mapped_iso_name(record.raw_name)
+
+            name = _safe_name(name)
+            if name is None:
+                trace(f'Skipping an entry with an unusable name in {dir_path or "/"}')
+                continue
+
+            path = f'{dir_path}/{name}' if dir_path else name
+
+            if rock_ridge.child_link is not None:
+                sub_dirs.append((self._relocated_dir(rock_ridge.child_link), path))
+                continue
+
+            if record.is_dir:
+                sub_dirs.append((record, path))
+                continue
+
+            if pending is not None and pending.path == path:
+                pending.extents.append((record.extent_offset, record.data_length))
+                pending.size += record.data_length
+            else:
+                pending = IsoEntry(path, False, record.data_length, [(record.extent_offset, record.data_length)])
+
+            if not record.flags & _DR_FLAG_MULTI_EXTENT:
+                yield pending
+                pending = None
+
+        for sub_dir, path in sub_dirs:
+            yield IsoEntry(path, True, 0, [])
+            yield from self._walk_dir(sub_dir, path, joliet, visited)
+
+    def walk(self) -> Iterator[IsoEntry]:
+        """
+        :return: Every directory and regular file in the image, each directory before anything in it
+        """
+        joliet = not self.has_rock_ridge and self._joliet_root is not None
+        root = self._joliet_root if joliet else self._root
+
+        yield from self._walk_dir(root, '', joliet, set())
+
+
+class IsoFileReader:
+    """
+    Reads a file out of the image, across all of its extents
+    """
+
+    def __init__(self, fd: int, entry: IsoEntry):
+        self._fd = fd
+        self._extents = list(entry.extents)
+        self._extent_pos = 0
+
+    def readinto(self, buffer) -> int:
+        while len(self._extents) > 0:
+            offset, length = self._extents[0]
+            if self._extent_pos < length:
+                break
+            self._extents.pop(0)
+            self._extent_pos = 0
+        else:
+            return 0
+
+        offset, length = self._extents[0]
+        num_read = os.preadv(self._fd, [memoryview(buffer)[:length - self._extent_pos]], offset + self._extent_pos)
+        if num_read == 0:
+            raise IsoException(f'Image ends early, in the middle of a file at {offset}')
+
+        self._extent_pos += num_read
+        return num_read
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = sum(length for _, length in self._extents) - self._extent_pos
+
+        buffer = bytearray(size)
+        num_read = 0
+        while num_read < size:
+            chunk_len = self.readinto(memoryview(buffer)[num_read:])
+            if chunk_len == 0:
+                break
+            num_read += chunk_len
+
+        return bytes(buffer[:num_read])
@@ -28,11 +28,106 @@
 
 # This mainly exists to make UT and Mocks easier to write, but it also makes the code a bit more readable
 import os
+import re
 import subprocess
+from typing import Optional
 
 from clamav_large_archive_scanner.lib.exceptions import MountException
 from clamav_large_archive_scanner.lib.fast_log import trace
 
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+# Spaces, tabs, newlines and backslashes in mountinfo paths are written as octal escapes, e.g. \040
+_MOUNTINFO_ESCAPE = re.compile(rb'\\([0-7]{3})')
+
+
+class MountEntry:
+    def __init__(self, mount_point: str, fs_type: str, source: str):
+        self.mount_point = mount_point
+        self.fs_type = fs_type
+        self.source = source
+
+    def is_fuse(self) -> bool:
+        # guestmount shows up as plain "fuse", anything that sets a subtype as "fuse.<subtype>"
+        return self.fs_type == 'fuse' or self.fs_type.startswith('fuse.')
+
+    def __repr__(self):
+        return f'MountEntry({self.mount_point!r}, {self.fs_type!r}, {self.source!r})'
+
+
+class MountTable:
+    """
+    A snapshot of the mount table, indexed by mount point
+    Read it once with read_mount_table() and look up as many mount points in it as needed
+    """
+
+    def __init__(self, entries: Optional[list[MountEntry]]):
+        # None means the mount table couldn't be read, and each lookup has to go to the filesystem instead
+        self._entries = None  # type: Optional[dict[str, MountEntry]]
+        if entries is not None:
+            # Mounts stacked on the same mount point are listed in order, so the last one is the one that's visible
+            self._entries = {x.mount_point: x for x in entries}
+
+    @staticmethod
+    def _key(path: str) -> str:
+        # The kernel lists canonical paths, so resolve any symlinks in the parent dirs
+        # The path itself is left alone, since stat'ing a dead FUSE mount can hang
+        path = os.path.abspath(path)
+        return os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+
+    def get(self, path: str) -> Optional[MountEntry]:
+        if self._entries is None:
+            return None
+        return self._entries.get(self._key(path))
+
+    def is_mounted(self, path: str) -> bool:
+        if self._entries is None:
+            return os.path.ismount(path)
+        return self._key(path) in self._entries
+
+    def is_fuse_mount(self, path: str) -> bool:
+        if self._entries is None:
+            return os.path.ismount(path)
+        entry = self.get(path)
+        return entry is not None and entry.is_fuse()
+
+
+def _unescape_mountinfo(field: bytes) -> str:
+    return os.fsdecode(_MOUNTINFO_ESCAPE.sub(lambda m: bytes([int(m.group(1), 8)]), field))
+
+
+def parse_mountinfo(data: bytes) -> MountTable:
+    """
+    Parses the contents of /proc/<pid>/mountinfo, see proc(5)
+    36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue
+    """
+    entries = []
+    for line in data.split(b'\n'):
+        fields = line.split(b' ')
+        # A variable number of optional fields come before the separator
+        try:
+            separator = fields.index(b'-', 6)
+        except ValueError:
+            continue
+
+        if len(fields) < separator + 3:
+            continue
+
+        entries.append(MountEntry(mount_point=_unescape_mountinfo(fields[4]),
+                                  fs_type=_unescape_mountinfo(fields[separator + 1]),
+                                  source=_unescape_mountinfo(fields[separator + 2])))
+
+    return MountTable(entries)
+
+
+def read_mount_table() -> MountTable:
+    try:
+        with open(MOUNTINFO_PATH, 'rb') as mountinfo:
+            return parse_mountinfo(mountinfo.read())
+    except OSError as e:
+        trace(f'Unable to read {MOUNTINFO_PATH}, checking each mount point instead: {e}')
+        return MountTable(None)
+
 
 def enumerate_guestfs_partitions(file_path: str) -> list[str]:
     result = subprocess.run(['virt-filesystems', '-a', file_path], capture_output=True, text=True)
@@ -44,16 +139,6 @@ def enumerate_guestfs_partitions(file_path: str) -> list[str]:
     return partitions
 
 
-def _check_fuse_mounts() -> list[str]:
-    result = subprocess.run(['mount', '-t', 'fuse'], capture_output=True, text=True)
-    if result.returncode != 0:
-        trace(f'Unable to enumerate fuse mounts: {result.stderr}')
-        return []
-
-    mounts = [x for x in result.stdout.split('\n') if x != '']
-    return mounts
-
-
 def mount_guestfs_partition(archive_path: str, partition: str, parent_tmp_dir: str) -> str:
     # Make a dir for the partition inside the mount_parent_dir
     # most partitions though, will contain the "/" character, so we need to replace it
@@ -81,11 +166,12 @@ def mount_iso(file_path: str, mount_point: str) -> None:
         raise MountException(combined_output)
 
 
-def umount_guestfs_partition(directory: str) -> None:
-    # Check to see if it still mounted
-    fuse_mounts = _check_fuse_mounts()
+def umount_guestfs_partition(directory: str, mount_table: Optional[MountTable] = None) -> None:
+    if mount_table is None:
+        mount_table = read_mount_table()
 
-    if not any(directory in m for m in fuse_mounts):
+    # Check to see if it still mounted
+    if not mount_table.is_fuse_mount(directory):
         trace(f'Partition {directory} is not mounted, skipping umount')
         return
 
@@ -96,6 +182,13 @@ def umount_guestfs_partition(directory: str) -> None:
         raise MountException(combined_output)
 
 
+def is_mount_point(path: str, mount_table: Optional[MountTable] = None) -> bool:
+    if mount_table is None:
+        mount_table = read_mount_table()
+
+    return mount_table.is_mounted(path)
+
+
 def umount_iso(mount_point: str) -> None:
     result = subprocess.run(['umount', mount_point], capture_output=True)
     if result.returncode != 0:
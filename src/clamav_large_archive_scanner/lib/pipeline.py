@@ -0,0 +1,115 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Lets one stage of work (e.g. unpacking) run ahead of the next one (e.g. scanning)
+# The producer runs on its own thread, and hands items over through a bounded queue, so that it can never get
+# more than max_pending items ahead of the consumer
+
+import queue
+import threading
+from typing import Iterable, Iterator
+
+from clamav_large_archive_scanner.lib import fast_log
+
+_DONE = object()
+_POLL_INTERVAL_S = 0.1
+
+
+class _ProducerError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class BoundedPipeline:
+    def __init__(self, producer: Iterable, max_pending: int, name: str = 'producer'):
+        """
+        :param producer: An iterable that is only ever advanced from the producer thread
+        :param max_pending: How many produced items can be waiting for the consumer at once
+        :param name: Name of the producer thread, for logging
+        """
+        self._producer = producer
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, name=name, daemon=True)
+
+    def _put(self, item) -> bool:
+        # Wake up every so often, so that a stop request isn't stuck behind a full queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=_POLL_INTERVAL_S)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _produce(self) -> None:
+        try:
+            for item in self._producer:
+                if not self._put(item):
+                    break
+        except BaseException as e:
+            self._put(_ProducerError(e))
+        finally:
+            close = getattr(self._producer, 'close', None)
+            if close is not None:
+                # Generators get a chance to run their cleanup, on this thread, since it is the one that ran them
+                close()
+            self._put(_DONE)
+
+    def start(self) -> 'BoundedPipeline':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """
+        Ask the producer to stop after the item it is working on, and wait for it to do so
+        """
+        if not self._stop.is_set():
+            fast_log.debug(f'Stopping {self._thread.name}')
+
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def __iter__(self) -> Iterator:
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+
+            if isinstance(item, _ProducerError):
+                raise item.error
+
+            yield item
+
+    def __enter__(self) -> 'BoundedPipeline':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
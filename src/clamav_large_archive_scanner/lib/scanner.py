@@ -27,19 +27,51 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 # A wrapper around calling clamdscan with a bit of validation thrown in
+# If clamd's socket is known, we talk to clamd directly instead, which saves a process launch per scan
 
+import functools
+import itertools
+import os
+import socket
 import subprocess
-from typing import List, Tuple
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
 
+import clamav_large_archive_scanner.lib.clamd as clamd
+import clamav_large_archive_scanner.lib.discovery as discovery
 from clamav_large_archive_scanner.lib import fast_log
 from clamav_large_archive_scanner.lib.contexts import UnpackContext
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
+
+# Set through use_scan_pool, when several archives are being scanned in the same process
+_scan_pool = None  # type: Executor | None
 
 
 class ScanResult:
-    def __init__(self, path: str, return_code: int):
+    def __init__(self, path: str, return_code: int, aliases: Optional[List[str]] = None):
         self.path = path
         self.clamdscan_rv = return_code
 
+        # Identical copies of this archive, which got the same result without being scanned themselves
+        self._aliases = aliases if aliases is not None else []  # type: list[str]
+        self._u_ctx = None  # type: UnpackContext | None
+
+    @classmethod
+    def for_ctx(cls, u_ctx: UnpackContext, return_code: int) -> 'ScanResult':
+        result = cls(u_ctx.nice_filename(), return_code)
+
+        # The aliases are looked up when they're needed, as copies of it, or of an archive it's in, can still be found
+        # after it was scanned
+        result._u_ctx = u_ctx
+        return result
+
+    @property
+    def aliases(self) -> List[str]:
+        if self._u_ctx is not None:
+            return self._u_ctx.all_aliases()
+        return self._aliases
+
     def _get_scancode_str(self) -> str:
         if self.clamdscan_rv == 0:
             return 'No virus found.'
@@ -51,7 +83,10 @@ class ScanResult:
             return 'Unknown return code.'
 
     def __str__(self):
-        return f'{self.path}: {self._get_scancode_str()}'
+        rv = f'{self.path}: {self._get_scancode_str()}'
+        for alias in self.aliases:
+            rv += f'\n    Identical copy: {alias}'
+        return rv
 
     def __repr__(self):
         return self.__str__()
@@ -60,6 +95,14 @@ class ScanResult:
         return self.path == other.path and self.clamdscan_rv == other.clamdscan_rv
 
 
+def use_scan_pool(pool: Optional[Executor]) -> None:
+    """
+    :param pool: If set, every scan is run on this pool, instead of each call to clamdscan starting its own workers
+    """
+    global _scan_pool
+    _scan_pool = pool
+
+
 def validate_clamdscan() -> bool:
     """
     :return: True if clamdscan is available, False otherwise
@@ -73,10 +116,80 @@ def validate_clamdscan() -> bool:
     return True
 
 
-def _run_clamdscan(path: str, all_match: bool) -> Tuple[int, str]:
+def validate_clamd(clamd_socket: str) -> bool:
+    """
+    :param clamd_socket: Path to clamd's LocalSocket, or HOST:PORT of its TCPSocket
+    :return: True if clamd answers a PING, False otherwise
+    """
+
+    try:
+        return clamd.ClamdClient(clamd_socket).ping()
+    except ClamdException as e:
+        fast_log.debug(f'Unable to ping clamd: {e}')
+        return False
+
+
+def validate_fdpass(clamd_socket: Optional[str]) -> bool:
+    """
+    :param clamd_socket: Path to clamd's LocalSocket, or HOST:PORT of its TCPSocket, None if using clamdscan
+    :return: True if files can be passed to clamd by descriptor, which only works over a LocalSocket
+    """
+
+    # clamdscan picks the socket from clamd.conf, and will complain by itself if it's not a LocalSocket
+    if not clamd_socket:
+        return True
+
+    try:
+        family, _ = clamd.parse_address(clamd_socket)
+    except ClamdException:
+        return False
+
+    return family == socket.AF_UNIX
+
+
+class _ScanCanceller:
+    """
+    Keeps track of the scans in flight, so that --fail-fast can stop them instead of waiting for them to finish
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._aborts = set()
+        self.cancelled = False
+
+    def start(self, abort: Callable[[], None]) -> bool:
+        """
+        :param abort: Called from another thread to stop the scan
+        :return: False if everything was already cancelled, in which case the scan should not run
+        """
+        with self._lock:
+            if self.cancelled:
+                return False
+
+            self._aborts.add(abort)
+            return True
+
+    def finish(self, abort: Callable[[], None]) -> None:
+        with self._lock:
+            self._aborts.discard(abort)
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            aborts = list(self._aborts)
+            self._aborts.clear()
+
+        for abort in aborts:
+            abort()
+
+
+def _run_clamdscan(path: str, all_match: bool, canceller: Optional[_ScanCanceller] = None,
+                   fdpass: bool = False) -> Tuple[int, str]:
     """
     :param path: A path to scan
     :param all_match: If true, will pass in --allmatch to clam
+    :param canceller: If set, the scan can be killed from another thread
+    :param fdpass: If true, will pass in --fdpass to clam, so that clamd doesn't need to be able to read the files
     :return: Returns the RV of clamdscan, which as per man page is this:
 
             Return Codes
@@ -88,39 +201,244 @@ def _run_clamdscan(path: str, all_match: bool) -> Tuple[int, str]:
     clam_args = ['clamdscan', '-m', '--stdout']
     if all_match:
         clam_args.append('--allmatch')
+    if fdpass:
+        clam_args.append('--fdpass')
 
     clam_args.append(path)
 
-    result = subprocess.run(clam_args, capture_output=True, text=True)
-    return result.returncode, result.stdout
+    if canceller is None:
+        result = subprocess.run(clam_args, capture_output=True, text=True)
+        return result.returncode, result.stdout
 
+    # Popen instead of run, so that we have a handle to kill it with
+    proc = subprocess.Popen(clam_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if not canceller.start(proc.kill):
+        proc.kill()
 
-def clamdscan(u_ctxs: list[UnpackContext], fail_fast: bool, all_match: bool) -> List[ScanResult]:
+    try:
+        stdout, _ = proc.communicate()
+    finally:
+        canceller.finish(proc.kill)
+
+    return proc.returncode, stdout
+
+
+def _fildes_scan(client: clamd.ClamdClient, path: str) -> List[str]:
+    """
+    Passes every file under path to clamd by descriptor, instead of having clamd walk it
+    :return: Only the replies that aren't OK, or a single OK for path if everything is clean, same as MULTISCAN
+    """
+
+    if os.path.isdir(path):
+        paths = (a_path for a_path, _ in discovery.iter_files(path, 0))
+    else:
+        paths = [path]
+
+    reply = [line for line in client.fildes_scan(paths) if not line.endswith(clamd.REPLY_OK)]
+    if len(reply) == 0:
+        return [f'{path}:{clamd.REPLY_OK}']
+
+    return reply
+
+
+def _run_clamd(path: str, all_match: bool, clamd_socket: str,
+               canceller: Optional[_ScanCanceller] = None, fdpass: bool = False) -> Tuple[int, str]:
+    """
+    Same as _run_clamdscan, but talks to clamd over its socket instead of going through the clamdscan binary
+    MULTISCAN is what clamdscan -m uses, and ALLMATCHSCAN is what clamdscan --allmatch uses
+    With fdpass, we open the files and hand clamd the descriptors in one session, like clamdscan --fdpass
     """
-    :param u_ctxs: A list of UnpackContexts, containing the paths to scan
+
+    try:
+        client = clamd.ClamdClient(clamd_socket)
+        if canceller is not None and not canceller.start(client.abort):
+            client.abort()
+
+        try:
+            if fdpass:
+                reply = _fildes_scan(client, path)
+            elif all_match:
+                reply = client.allmatchscan(path)
+            else:
+                reply = client.multiscan(path)
+        finally:
+            if canceller is not None:
+                canceller.finish(client.abort)
+
+    except ClamdException as e:
+        return clamd.RV_ERROR, str(e)
+
+    return clamd.reply_to_rv(reply), '\n'.join(reply)
+
+
+def log_scan_result(nice_filename: str, clamdscan_rv: int, clamdscan_output: str) -> None:
+    if clamdscan_rv == 0:
+        return
+
+    fast_log.info('!' * 80)
+    if clamdscan_rv == 1:
+        # Virus Path
+        fast_log.warn(f'Malware found by clamdscan in file: {nice_filename}:')
+    elif clamdscan_rv == 2:
+        # Clamdscan error Path
+        fast_log.info(f'Error in clamdscan when scanning file: {nice_filename}:')
+    fast_log.info(clamdscan_output)
+    fast_log.info('!' * 80)
+
+
+def _log_scan_result(a_ctx: UnpackContext, clamdscan_rv: int, clamdscan_output: str) -> None:
+    log_scan_result(a_ctx.nice_filename(), clamdscan_rv, a_ctx.detmp_filepath(clamdscan_output))
+
+
+def _scan_ctx(a_ctx: UnpackContext, all_match: bool, clamd_socket: Optional[str],
+              canceller: Optional[_ScanCanceller] = None, fdpass: bool = False) -> Optional[Tuple[int, str]]:
+    """
+    :return: The RV and output of the scan, or None if it was cancelled before it could finish
+    """
+
+    if canceller is not None and canceller.cancelled:
+        return None
+
+    fast_log.info(f'Scanning {a_ctx.nice_filename()}')
+    if clamd_socket:
+        rv_and_output = _run_clamd(a_ctx.unpacked_dir_location, all_match, clamd_socket, canceller, fdpass)
+    else:
+        rv_and_output = _run_clamdscan(a_ctx.unpacked_dir_location, all_match, canceller, fdpass)
+
+    # Anything else that finished after the cancellation was most likely killed part way through, and so isn't a result
+    # A virus that was found is still a virus though, even if the scan was cancelled right after
+    if canceller is not None and canceller.cancelled and rv_and_output[0] != clamd.RV_VIRUS:
+        return None
+
+    return rv_and_output
+
+
+def _clamdscan_parallel(u_ctxs: Iterable[UnpackContext], fail_fast: bool, all_match: bool,
+                        clamd_socket: Optional[str], scan_jobs: int,
+                        on_scanned: Optional[Callable[[UnpackContext], None]], fdpass: bool) -> List[ScanResult]:
+    canceller = _ScanCanceller()
+    results = {}  # type: dict[int, ScanResult]
+    futures = []  # type: list[Future]
+    worker_errors = []  # type: list[BaseException]
+    lock = threading.Lock()
+
+    # The next context is only pulled once a worker is free, so that a producer feeding us stays bounded
+    free_workers = threading.Semaphore(scan_jobs)
+
+    def _cancel_all() -> None:
+        canceller.cancel()
+        with lock:
+            pending = list(futures)
+
+        for a_future in pending:
+            a_future.cancel()
+
+    def _on_scan_done(idx: int, a_ctx: UnpackContext, future: Future) -> None:
+        # Anything raised in a done callback would only be logged by the pool, it has to be handed back to the caller
+        try:
+            _record_scan(idx, a_ctx, future)
+        except BaseException as e:
+            with lock:
+                worker_errors.append(e)
+            _cancel_all()
+        finally:
+            free_workers.release()
+
+    def _record_scan(idx: int, a_ctx: UnpackContext, future: Future) -> None:
+        if future.cancelled():
+            return
+
+        if future.exception() is not None:
+            raise future.exception()
+
+        if future.result() is None:
+            return
+
+        clamdscan_rv, clamdscan_output = future.result()
+        with lock:
+            results[idx] = ScanResult.for_ctx(a_ctx, clamdscan_rv)
+            _log_scan_result(a_ctx, clamdscan_rv, clamdscan_output)
+
+        if on_scanned is not None:
+            on_scanned(a_ctx)
+
+        if clamdscan_rv == 0 or not fail_fast or canceller.cancelled:
+            return
+
+        fast_log.info('Fail fast: cancelling all remaining scans')
+        _cancel_all()
+
+    pool = _scan_pool
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=scan_jobs, thread_name_prefix='clamdscan')
+
+    a_ctxs = iter(u_ctxs)
+    try:
+        for idx in itertools.count():
+            # Before pulling the next context, not after
+            free_workers.acquire()
+            submitted = False
+            try:
+                a_ctx = None if canceller.cancelled else next(a_ctxs, None)
+                if a_ctx is None:
+                    break
+
+                future = pool.submit(_scan_ctx, a_ctx, all_match, clamd_socket, canceller, fdpass)
+                submitted = True
+            finally:
+                if not submitted:
+                    free_workers.release()
+
+            with lock:
+                futures.append(future)
+            future.add_done_callback(functools.partial(_on_scan_done, idx, a_ctx))
+    finally:
+        if pool is not _scan_pool:
+            pool.shutdown(wait=True)
+
+        # A shared pool keeps running, every worker slot being handed back is how we know our own scans are all done
+        # Also waited for if the contexts raised, so that nothing is still being scanned once we return
+        for _ in range(scan_jobs):
+            free_workers.acquire()
+
+    if len(worker_errors) > 0:
+        raise worker_errors[0]
+
+    # Keep the same order as the contexts, no matter which scans finished first
+    return [results[idx] for idx in sorted(results.keys())]
+
+
+def clamdscan(u_ctxs: Iterable[UnpackContext], fail_fast: bool, all_match: bool,
+              clamd_socket: Optional[str] = None, scan_jobs: int = 1,
+              on_scanned: Optional[Callable[[UnpackContext], None]] = None,
+              fdpass: bool = False) -> List[ScanResult]:
+    """
+    :param u_ctxs: UnpackContexts containing the paths to scan, this can be a generator that is still unpacking
     :param fail_fast: If true, will stop scanning after the first failure in the list of paths.
+                      With more than one scan job, scans that are queued or still running get cancelled.
     :param all_match: If true, will pass in --allmatch to clam, which will return all malware found
+    :param clamd_socket: If set, scan through this clamd socket instead of running clamdscan
+    :param scan_jobs: How many contexts to scan at the same time, with a shared pool set it can't use more than that
+    :param on_scanned: Called with each context once its scan is done, cancelled scans are skipped. Anything it raises
+                       is raised from here, once the scans that are still running are cancelled
+    :param fdpass: If true, we open the files and pass their descriptors to clamd, so clamd never needs read access
     :return: A list of tuples containing the path and the return code of clamdscan
     """
 
+    if scan_jobs > 1 or _scan_pool is not None:
+        return _clamdscan_parallel(u_ctxs, fail_fast, all_match, clamd_socket, scan_jobs, on_scanned, fdpass)
+
     results = []
 
     for a_ctx in u_ctxs:
-        fast_log.info(f'Scanning {a_ctx.nice_filename()}')
-        clamdscan_rv, clamdscan_output = _run_clamdscan(a_ctx.unpacked_dir_location, all_match)
-        results.append(ScanResult(a_ctx.nice_filename(), clamdscan_rv))
-        if clamdscan_rv != 0:
-            fast_log.info('!' * 80)
-            if clamdscan_rv == 1:
-                # Virus Path
-                fast_log.warn(f'Malware found by clamdscan in file: {a_ctx.nice_filename()}:')
-            elif clamdscan_rv == 2:
-                # Clamdscan error Path
-                fast_log.info(f'Error in clamdscan when scanning file: {a_ctx.nice_filename()}:')
-            fast_log.info(a_ctx.detmp_filepath(clamdscan_output))
-            fast_log.info('!' * 80)
-
-            if fail_fast:
-                return results
+        clamdscan_rv, clamdscan_output = _scan_ctx(a_ctx, all_match, clamd_socket, fdpass=fdpass)
+        results.append(ScanResult.for_ctx(a_ctx, clamdscan_rv))
+        _log_scan_result(a_ctx, clamdscan_rv, clamdscan_output)
+
+        if on_scanned is not None:
+            on_scanned(a_ctx)
+
+        if clamdscan_rv != 0 and fail_fast:
+            return results
 
     return results
@@ -0,0 +1,306 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# A small job server on a UNIX socket, so that archives can be handed to a process that is already warmed up
+# Requests and replies are JSON objects, one per line. Every request is a job, which gets a reply when it is queued,
+# when it starts running, and when it is done. A client can queue any number of jobs on the same connection:
+#
+#   > {"id": "a", "command": "scan", "path": "/data/image.vmdk"}
+#   < {"id": "a", "status": "queued", "ahead": 0}
+#   < {"id": "a", "status": "running"}
+#   < {"id": "a", "status": "done", ...whatever the command returned...}
+#
+# Jobs that fail reply with {"status": "error", "error": "..."} instead. The status command is answered straight away.
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import click
+
+from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.exceptions import JobException, MountException
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_ERROR = 'error'
+
+COMMAND_STATUS = 'status'
+
+# Longer requests are refused, rather than being read into memory
+MAX_REQUEST_SIZE = 64 * 1024
+
+# Only the user running the server can connect to it
+SOCKET_MODE = 0o600
+
+# Gets the request, without the id and the command, and returns what to add to the done reply
+JobHandler = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+class _Connection:
+    """
+    Replies to one client. Jobs keep running if the client goes away, their replies are just dropped
+    """
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def send(self, reply: Dict[str, Any]) -> None:
+        line = (json.dumps(reply) + '\n').encode()
+
+        with self._lock:
+            if self._closed:
+                return
+
+            try:
+                self._wfile.write(line)
+                self._wfile.flush()
+            except OSError as e:
+                fast_log.debug(f'Client went away, dropping its replies: {e}')
+                self._closed = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.job_server.handle_connection(self.rfile, self.wfile)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, job_server: 'JobServer'):
+        self.job_server = job_server
+        super().__init__(socket_path, _RequestHandler)
+
+
+def _is_listening(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+            return True
+        except OSError:
+            return False
+
+
+class JobServer:
+    """
+    Runs jobs from any number of clients, max_jobs at a time, in the order that they were received
+    """
+
+    def __init__(self, socket_path: str, handlers: Dict[str, JobHandler], max_jobs: int = 1,
+                 after_job: Optional[Callable[[], Any]] = None):
+        """
+        :param handlers: What runs each command, by name
+        :param max_jobs: How many jobs can run at the same time, the rest wait in the queue
+        :param after_job: Called once each job has been replied to, on the same worker
+        """
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self._handlers = handlers
+        self._after_job = after_job
+
+        self._pool = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='job')
+        self._server = None  # type: _UnixServer | None
+
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self.num_queued = 0
+        self.num_running = 0
+
+    def start(self) -> None:
+        """
+        Starts listening on the socket, replacing a stale one left behind by a server that is no longer running
+        """
+        try:
+            socket_stat = os.lstat(self.socket_path)
+        except FileNotFoundError:
+            socket_stat = None
+
+        if socket_stat is not None:
+            if not stat.S_ISSOCK(socket_stat.st_mode):
+                raise JobException(f'{self.socket_path} already exists, and is not a socket')
+
+            if _is_listening(self.socket_path):
+                raise JobException(f'Another server is already listening on {self.socket_path}')
+
+            os.unlink(self.socket_path)
+
+        # The socket is made with the umask's permissions, so there is no window where anyone else can connect
+        old_umask = os.umask(0o777 & ~SOCKET_MODE)
+        try:
+            self._server = _UnixServer(self.socket_path, self)
+        finally:
+            os.umask(old_umask)
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def shutdown(self) -> None:
+        """
+        Stops serve_forever, needs to be called from another thread
+        """
+        if self._server is not None:
+            self._server.shutdown()
+
+    def close(self) -> None:
+        """
+        Stops taking connections, waits for the jobs that are running, and cancels the ones that are still queued
+        """
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def handle_connection(self, rfile, wfile) -> None:
+        connection = _Connection(wfile)
+        jobs_replied = []  # type: list[threading.Event]
+
+        for line in iter(lambda: rfile.readline(MAX_REQUEST_SIZE + 1), b''):
+            if len(line) > MAX_REQUEST_SIZE:
+                # Skip the rest of it, the next request starts after the newline
+                while len(line) > 0 and not line.endswith(b'\n'):
+                    line = rfile.readline(MAX_REQUEST_SIZE)
+
+                connection.send({'status': STATUS_ERROR, 'error': f'Requests can be at most {MAX_REQUEST_SIZE} bytes'})
+                continue
+
+            if len(line.strip()) == 0:
+                continue
+
+            replied = self._submit(line, connection)
+            if replied is not None:
+                jobs_replied.append(replied)
+
+        # The client is done sending, but still gets the replies to everything it queued
+        for replied in jobs_replied:
+            replied.wait()
+
+    def _status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'queued': self.num_queued, 'running': self.num_running, 'max_jobs': self.max_jobs}
+
+    def _submit(self, line: bytes, connection: _Connection) -> Optional[threading.Event]:
+        """
+        :return: Set once the queued job has sent its last reply, or None if the request was answered straight away
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            connection.send({'status': STATUS_ERROR, 'error': f'Request is not valid JSON: {e}'})
+            return None
+
+        if not isinstance(request, dict):
+            connection.send({'status': STATUS_ERROR, 'error': 'Requests need to be JSON objects'})
+            return None
+
+        job_id = request.pop('id', None)
+        if job_id is None:
+            with self._lock:
+                job_id = self._next_id
+                self._next_id += 1
+
+        command = request.pop('command', None)
+        if command == COMMAND_STATUS:
+            connection.send({'id': job_id, 'status': STATUS_DONE, **self._status()})
+            return None
+
+        handler = self._handlers.get(command)
+        if handler is None:
+            commands = ', '.join(sorted(list(self._handlers.keys()) + [COMMAND_STATUS]))
+            connection.send({'id': job_id, 'status': STATUS_ERROR,
+                             'error': f'Unknown command: {command}, expected one of: {commands}'})
+            return None
+
+        # Replied to before it is queued, so that it can't start running first
+        with self._lock:
+            ahead = self.num_queued
+            self.num_queued += 1
+        connection.send({'id': job_id, 'status': STATUS_QUEUED, 'ahead': ahead})
+
+        # Futures cancelled by shutting down the pool never count as done to concurrent.futures.wait, so the job
+        # says when it's done by itself
+        replied = threading.Event()
+        try:
+            future = self._pool.submit(self._run, job_id, command, handler, request, connection, replied)
+        except RuntimeError:
+            # Shutting down
+            future = Future()
+            future.cancel()
+
+        future.add_done_callback(lambda a_future: self._on_cancelled(a_future, job_id, connection, replied))
+        return replied
+
+    def _on_cancelled(self, future: Future, job_id: Any, connection: _Connection, replied: threading.Event) -> None:
+        if not future.cancelled():
+            return
+
+        with self._lock:
+            self.num_queued -= 1
+        connection.send({'id': job_id, 'status': STATUS_ERROR, 'error': 'The server is shutting down'})
+        replied.set()
+
+    def _run(self, job_id: Any, command: str, handler: JobHandler, request: Dict[str, Any],
+             connection: _Connection, replied: threading.Event) -> None:
+        with self._lock:
+            self.num_queued -= 1
+            self.num_running += 1
+        connection.send({'id': job_id, 'status': STATUS_RUNNING})
+        fast_log.info(f'Running job {job_id}: {command} {request}')
+
+        try:
+            reply = {'id': job_id, 'status': STATUS_DONE, **handler(request)}
+        except click.ClickException as e:
+            reply = {'id': job_id, 'status': STATUS_ERROR, 'error': e.format_message()}
+        except (Exception, MountException) as e:
+            # Nothing a single job does should be able to take the whole server down
+            fast_log.error(f'Job {job_id} failed: {e!r}')
+            reply = {'id': job_id, 'status': STATUS_ERROR, 'error': str(e)}
+        finally:
+            with self._lock:
+                self.num_running -= 1
+
+        fast_log.info(f'Finished job {job_id}: {reply["status"]}')
+        connection.send(reply)
+        replied.set()
+
+        if self._after_job is not None:
+            self._after_job()
@@ -0,0 +1,685 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Scans tar and zip archives by streaming every member straight into clamd, instead of extracting everything to disk
+# Nested tars are streamed the same way, from inside the outer stream. Any other kind of nested archive that is big
+# enough to unpack is written out to disk on its way to clamd, and then goes through the usual unpack and scan
+#
+# Zip members can be read independently of each other, thanks to the central directory, so they are spread over a pool
+# of worker processes, each with its own handle on the zip and its own connection to clamd
+
+import multiprocessing
+import multiprocessing.util
+import os
+import resource
+import sqlite3
+import tarfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+import click
+import humanize
+
+from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.contexts import UnpackContext
+from clamav_large_archive_scanner.lib.exceptions import ClamdException, IsoException, MountException
+from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType
+from clamav_large_archive_scanner.lib.scanner import ScanResult
+
+# These imports are here to make mocking easier in UT
+import clamav_large_archive_scanner.lib.clamd as clamd
+import clamav_large_archive_scanner.lib.cleanup as cleanup
+import clamav_large_archive_scanner.lib.decompress as decompress
+import clamav_large_archive_scanner.lib.detect_cache as detect_cache
+import clamav_large_archive_scanner.lib.file_data as file_data
+import clamav_large_archive_scanner.lib.guestfs_appliance as guestfs_appliance
+import clamav_large_archive_scanner.lib.iso9660 as iso9660
+import clamav_large_archive_scanner.lib.scanner as scanner
+import clamav_large_archive_scanner.lib.tmp_files as tmp_files
+import clamav_large_archive_scanner.lib.tree_delete as tree_delete
+import clamav_large_archive_scanner.lib.unpack as unpack
+
+# Disk images are read through the libguestfs API, when its python bindings are installed
+GUESTFS_STREAMABLE_FILETYPES = (FileType.VMDK, FileType.QCOW2)
+STREAMABLE_FILETYPES = (FileType.TAR, FileType.TARGZ, FileType.ZIP, FileType.ISO) + GUESTFS_STREAMABLE_FILETYPES
+NESTED_STREAMABLE_FILETYPES = (FileType.TAR, FileType.TARGZ)
+
+# Used to drain whatever clamd didn't read of a member that is being spilled to disk
+_SPILL_CHUNK_SIZE = 1024 * 1024
+
+
+def _read_head(fileobj, size: int) -> bytes:
+    # Reads from a stream can come back short
+    head = b''
+    while len(head) < size:
+        data = fileobj.read(size - len(head))
+        if not data:
+            break
+        head += data
+
+    return head
+
+
+def _worse_rv(rv_a: int, rv_b: int) -> int:
+    # Same order as the return value of a whole scan, virus > error > clean
+    for rv in (clamd.RV_VIRUS, clamd.RV_ERROR):
+        if rv in (rv_a, rv_b):
+            return rv
+
+    return clamd.RV_CLEAN
+
+
+def _member_path(member_name: str) -> str:
+    # Same as the part of a nice filename that comes after the ::, without letting '..' escape a spill directory
+    # Absolute names are kept under it too, normpath would keep a leading '//' as is
+    path = os.path.normpath('/' + member_name.lstrip('/'))
+    return path if path != '/' else f'/{member_name}'
+
+
+class _ReplayReader:
+    """
+    Gives back the bytes that were already read to figure out the filetype, and then the rest of the member
+    Everything read can also be copied to another file on the way through
+    """
+
+    def __init__(self, head: bytes, rest, copy_to=None):
+        self._head = head
+        self._head_pos = 0
+        self._rest = rest
+        self._copy_to = copy_to
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if self._head_pos < len(self._head):
+            end = len(self._head) if size < 0 else self._head_pos + size
+            data = self._head[self._head_pos:end]
+            self._head_pos += len(data)
+        else:
+            data = self._rest.read(size)
+
+        if self._copy_to is not None:
+            self._copy_to.write(data)
+
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        if self._head_pos < len(self._head):
+            num_read = min(len(buffer), len(self._head) - self._head_pos)
+            buffer[:num_read] = self._head[self._head_pos:self._head_pos + num_read]
+            self._head_pos += num_read
+        elif hasattr(self._rest, 'readinto'):
+            num_read = self._rest.readinto(buffer)
+        else:
+            data = self._rest.read(len(buffer))
+            num_read = len(data)
+            buffer[:num_read] = data
+
+        if self._copy_to is not None:
+            self._copy_to.write(buffer[:num_read])
+
+        self.bytes_read += num_read
+        return num_read
+
+    def rewind(self) -> bool:
+        """
+        Starts over from the beginning, which is only possible if nothing past the head has been read yet
+        """
+        if self.bytes_read > len(self._head):
+            return False
+
+        self._head_pos = 0
+        self.bytes_read = 0
+        return True
+
+
+class _StreamedContext(UnpackContext):
+    """
+    Stands in for an archive that is being streamed rather than unpacked
+    Anything spilled to disk from inside of it goes in its temp dir, so that it gets the usual nice filenames
+    """
+
+    def __init__(self, nice_filename: str, file_meta: FileMetadata, tmp_dir: str):
+        super().__init__(file_meta, tmp_dir)
+        self._nice_filename = nice_filename
+
+        # Set if the members can be sent straight from the archive on disk, IE an uncompressed tar
+        self.source_fd = None  # type: int | None
+
+    def nice_filename(self) -> str:
+        return self._nice_filename
+
+
+class StreamScanner:
+    def __init__(self, clamd_socket: str, min_file_size: int, tmp_dir: str, fail_fast: bool = False,
+                 scan_jobs: int = 1, detect_jobs: int = 1, dedupe_archives: bool = False, stream_jobs: int = 1,
+                 fdpass: bool = False, chunk_size: int = clamd.INSTREAM_CHUNK_SIZE):
+        self.clamd_socket = clamd_socket
+        self.min_file_size = min_file_size
+        self.tmp_dir = tmp_dir
+        self.fail_fast = fail_fast
+        self.chunk_size = chunk_size
+
+        # Only used for zips
+        self.stream_jobs = stream_jobs
+
+        # Only used for archives that get spilled to disk
+        self.scan_jobs = scan_jobs
+        self.detect_jobs = detect_jobs
+        self.dedupe_archives = dedupe_archives
+        self.fdpass = fdpass
+
+        self._client = clamd.ClamdClient(clamd_socket)
+        self._root_meta = None  # type: FileMetadata | None
+        self._stopped = False
+
+        self.results = []  # type: List[ScanResult]
+        self.num_members = 0
+        self.bytes_streamed = 0
+
+    def _record(self, nice_filename: str, clamdscan_rv: int, output: str, listed: bool = True) -> int:
+        scanner.log_scan_result(nice_filename, clamdscan_rv, output)
+
+        if clamdscan_rv != 0 and listed:
+            # Clean members would drown out everything else, only the archive as a whole is listed for those
+            self.results.append(ScanResult(nice_filename, clamdscan_rv))
+
+        if clamdscan_rv != 0 and self.fail_fast:
+            self._stopped = True
+
+        return clamdscan_rv
+
+    def _record_reply(self, nice_filename: str, reply: List[str], num_bytes: int, listed: bool) -> int:
+        self.num_members += 1
+        self.bytes_streamed += num_bytes
+
+        # clamd calls everything that comes through INSTREAM 'stream'
+        output = '\n'.join(x.replace('stream:', f'{nice_filename}:', 1) for x in reply)
+        return self._record(nice_filename, clamd.reply_to_rv(reply), output, listed)
+
+    def _instream(self, nice_filename: str, reader: _ReplayReader, listed: bool = True) -> int:
+        try:
+            reply = self._client.instream(reader, chunk_size=self.chunk_size)
+        except ClamdException as e:
+            return self._record(nice_filename, clamd.RV_ERROR, f'{nice_filename}: {e}', listed)
+
+        return self._record_reply(nice_filename, reply, reader.bytes_read, listed)
+
+    def _instream_plain(self, archive_ctx: _StreamedContext, nice_filename: str, member_size: int,
+                        member_offset: Optional[int], head: bytes, member_file) -> int:
+        """
+        Streams a member that isn't going to be looked into, from the archive on disk if possible
+        """
+        if archive_ctx.source_fd is None or member_offset is None:
+            return self._instream(nice_filename, _ReplayReader(head, member_file))
+
+        try:
+            reply = self._client.instream_fd(archive_ctx.source_fd, member_offset, member_size,
+                                             chunk_size=self.chunk_size)
+        except ClamdException as e:
+            return self._record(nice_filename, clamd.RV_ERROR, f'{nice_filename}: {e}', True)
+
+        return self._record_reply(nice_filename, reply, member_size, True)
+
+    def _scan_nested_tar(self, nice_filename: str, member_name: str, member_size: int, filetype: FileType,
+                         head: bytes, member_file) -> int:
+        nested_meta = FileMetadata()
+        nested_meta.path = member_name
+        nested_meta.filetype = filetype
+        nested_meta.size_raw = member_size
+        nested_meta.root_meta = self._root_meta
+
+        reader = _ReplayReader(head, member_file)
+        try:
+            nested_tar = tarfile.open(fileobj=reader, mode='r|*')
+        except tarfile.TarError as e:
+            # Looked like a tar, but isn't one (IE a plain .gz), clamd can deal with it the same as any other file
+            fast_log.debug(f'Unable to stream {nice_filename} as a tar, scanning it as a whole instead: {e}')
+            if reader.rewind():
+                return self._instream(nice_filename, reader)
+            return self._record(nice_filename, clamd.RV_ERROR, f'{nice_filename}: Unable to read as a tar: {e}')
+
+        with nested_tar:
+            return self._scan_tar(nested_tar, _StreamedContext(nice_filename, nested_meta, self.tmp_dir))
+
+    def _spill(self, archive_ctx: _StreamedContext, nice_filename: str, member_name: str, head: bytes,
+               member_file) -> int:
+        if archive_ctx.unpacked_dir_location is None:
+            archive_ctx.create_tmp_dir()
+
+        spill_path = archive_ctx.unpacked_dir_location + _member_path(member_name)
+        os.makedirs(os.path.dirname(spill_path), exist_ok=True)
+        fast_log.debug(f'Spilling {nice_filename} to {spill_path}')
+
+        # Scanned as a whole on the way to disk, the same as it would have been as part of the unpacked directory
+        # Which is why it only counts towards the archive it came from, the unpacked results are listed under its name
+        with open(spill_path, 'wb') as spill_file:
+            reader = _ReplayReader(head, member_file, copy_to=spill_file)
+            worst_rv = self._instream(nice_filename, reader, listed=False)
+
+            # clamd can stop reading before the end (IE StreamMaxLength), the rest is still needed on disk
+            while reader.read(_SPILL_CHUNK_SIZE):
+                pass
+
+        if self._stopped:
+            return worst_rv
+
+        spilled_meta = file_data.file_meta_from_path(spill_path)
+        spilled_meta.root_meta = self._root_meta
+
+        u_ctxs = []
+        try:
+            for u_ctx in unpack.unpack_recursive(spilled_meta, self.min_file_size, self.tmp_dir,
+                                                 detect_jobs=self.detect_jobs, dedupe_archives=self.dedupe_archives,
+                                                 outer_ctx=archive_ctx):
+                fast_log.info(f'Unpacked {u_ctx}')
+                u_ctxs.append(u_ctx)
+
+            spilled_results = scanner.clamdscan(u_ctxs, self.fail_fast, False, clamd_socket=self.clamd_socket,
+                                                scan_jobs=self.scan_jobs, fdpass=self.fdpass)
+        except click.FileError as e:
+            spilled_results = [ScanResult(nice_filename, clamd.RV_ERROR)]
+            fast_log.warn(f'Unable to unpack {nice_filename}: {e.format_message()}')
+        finally:
+            # Children first, they can be mounted from inside their parents
+            for u_ctx in reversed(u_ctxs):
+                cleanup.cleanup_ctx(u_ctx)
+            os.remove(spill_path)
+
+        self.results.extend(spilled_results)
+        for result in spilled_results:
+            worst_rv = _worse_rv(worst_rv, result.clamdscan_rv)
+
+        if self.fail_fast and worst_rv != 0:
+            self._stopped = True
+
+        return worst_rv
+
+    def _scan_member(self, archive_ctx: _StreamedContext, member_name: str, member_size: int, member_file,
+                     member_offset: Optional[int] = None) -> int:
+        nice_filename = f'{archive_ctx.nice_filename()}::{_member_path(member_name)}'
+        fast_log.trace(f'Streaming {nice_filename}, {member_size} bytes')
+
+        head = _read_head(member_file, file_data.SNIFF_BUFFER_SIZE)
+
+        if member_size < self.min_file_size:
+            return self._instream_plain(archive_ctx, nice_filename, member_size, member_offset, head, member_file)
+
+        filetype = file_data.filetype_from_buffer(head)
+        if filetype in NESTED_STREAMABLE_FILETYPES:
+            fast_log.debug(f'Found archive {nice_filename}, streaming it')
+            return self._scan_nested_tar(nice_filename, member_name, member_size, filetype, head, member_file)
+
+        # Nested zips need to be seekable to get at the central directory, which a stream isn't
+        if filetype in unpack.HANDLED_FILE_TYPES:
+            fast_log.debug(f'Found archive {nice_filename}, it needs to be unpacked from disk')
+            return self._spill(archive_ctx, nice_filename, member_name, head, member_file)
+
+        # During recursive unpacking, we need to warn the user if we found a file that was not handled
+        # But meets the filesize requirement
+        fast_log.warn(f'Ignoring unhandled large file: {nice_filename}')
+        return self._instream_plain(archive_ctx, nice_filename, member_size, member_offset, head, member_file)
+
+    def _scan_tar(self, tar: tarfile.TarFile, archive_ctx: _StreamedContext) -> int:
+        worst_rv = 0
+
+        try:
+            for member in tar:
+                if self._stopped:
+                    break
+
+                # Links, directories and devices don't have any content of their own
+                if not member.isfile():
+                    continue
+
+                # Sparse members have holes that aren't in the archive, they have to go through tarfile
+                member_offset = None if member.issparse() else member.offset_data
+
+                rv = self._scan_member(archive_ctx, member.name, member.size, tar.extractfile(member), member_offset)
+                worst_rv = _worse_rv(worst_rv, rv)
+        except (tarfile.TarError, EOFError, OSError) as e:
+            # Corrupt or truncated part way through, anything before this point has still been scanned
+            worst_rv = self._record(archive_ctx.nice_filename(), clamd.RV_ERROR,
+                                    f'{archive_ctx.nice_filename()}: Unable to read the rest of the archive: {e}')
+        finally:
+            archive_ctx.cleanup_tmp()
+
+        return worst_rv
+
+    def scan_zip_member(self, archive_ctx: _StreamedContext, zip_file: zipfile.ZipFile, member_name: str) -> int:
+        nice_filename = f'{archive_ctx.nice_filename()}::{_member_path(member_name)}'
+
+        try:
+            member = zip_file.getinfo(member_name)
+            with zip_file.open(member) as member_file:
+                return self._scan_member(archive_ctx, member_name, member.file_size, member_file)
+        except (zipfile.BadZipFile, zlib.error, EOFError, OSError, RuntimeError, NotImplementedError) as e:
+            # RuntimeError is for encrypted members, and NotImplementedError for unsupported compression methods
+            return self._record(nice_filename, clamd.RV_ERROR, f'{nice_filename}: Unable to read: {e}')
+        finally:
+            archive_ctx.cleanup_tmp()
+
+    def _scan_zip(self, archive_ctx: _StreamedContext) -> int:
+        file_meta = archive_ctx.file_meta
+        try:
+            with zipfile.ZipFile(file_meta.path) as zip_file:
+                member_names = [x.filename for x in zip_file.infolist() if not x.is_dir()]
+        except (zipfile.BadZipFile, OSError) as e:
+            raise click.FileError(filename=file_meta.path, hint=f'Unable to stream {file_meta.path}: {e}')
+
+        worst_rv = 0
+
+        if self.stream_jobs == 1:
+            worker = _ZipMemberWorker(self, file_meta)
+            try:
+                for member_name in member_names:
+                    if self._stopped:
+                        break
+                    worst_rv = _worse_rv(worst_rv, worker.scan(member_name))
+            finally:
+                worker.close()
+
+            return worst_rv
+
+        # Every member is its own task, so that one huge member doesn't hold up a whole batch of others
+        # Results are collected in member order, and with --fail-fast, members that haven't been started are cancelled
+        # Workers are started by a fork server, rather than forked from here. A fork only copies the thread doing it, so
+        # any lock held by another thread at the time (EG the temp dir registries, with scan-batch or serve) would
+        # never be released in the worker
+        pool = ProcessPoolExecutor(max_workers=self.stream_jobs, mp_context=multiprocessing.get_context('forkserver'),
+                                   initializer=_init_zip_worker,
+                                   initargs=(_worker_settings(), self._worker_args(), file_meta))
+        try:
+            futures = [pool.submit(_scan_zip_member, x) for x in member_names]
+            for future in futures:
+                try:
+                    member_rv, member_results, num_members, bytes_streamed = future.result()
+                except BrokenProcessPool as e:
+                    # A worker was killed (IE by the OOM killer), every member that it hadn't finished is lost
+                    raise click.FileError(filename=file_meta.path, hint=f'Unable to stream {file_meta.path}: {e}')
+
+                worst_rv = _worse_rv(worst_rv, member_rv)
+                self.results.extend(member_results)
+                self.num_members += num_members
+                self.bytes_streamed += bytes_streamed
+
+                if self.fail_fast and member_rv != 0:
+                    break
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        return worst_rv
+
+    def _scan_iso(self, archive_ctx: _StreamedContext) -> int:
+        worst_rv = 0
+
+        with open(archive_ctx.file_meta.path, 'rb') as iso_file:
+            archive_ctx.source_fd = iso_file.fileno()
+
+            try:
+                for entry in iso9660.IsoImage(archive_ctx.source_fd).walk():
+                    if self._stopped:
+                        break
+
+                    if entry.is_dir:
+                        continue
+
+                    # Files in one piece are sent to clamd straight from the image
+                    member_offset = entry.extents[0][0] if len(entry.extents) == 1 else None
+
+                    rv = self._scan_member(archive_ctx, entry.path, entry.size,
+                                           iso9660.IsoFileReader(archive_ctx.source_fd, entry), member_offset)
+                    worst_rv = _worse_rv(worst_rv, rv)
+            except (IsoException, OSError) as e:
+                # Corrupt or truncated part way through, anything before this point has still been scanned
+                worst_rv = self._record(archive_ctx.nice_filename(), clamd.RV_ERROR,
+                                        f'{archive_ctx.nice_filename()}: Unable to read the rest of the image: {e}')
+            finally:
+                archive_ctx.cleanup_tmp()
+
+        return worst_rv
+
+    def _scan_guestfs_file(self, archive_ctx: _StreamedContext, image: guestfs_appliance.GuestFSImage, path: str,
+                           size: int) -> int:
+        nice_filename = f'{archive_ctx.nice_filename()}::{_member_path(path)}'
+
+        try:
+            return self._scan_member(archive_ctx, path, size, image.open(path, size))
+        except OSError as e:
+            return self._record(nice_filename, clamd.RV_ERROR, f'{nice_filename}: Unable to read: {e}')
+        finally:
+            archive_ctx.cleanup_tmp()
+
+    def _scan_guestfs(self, archive_ctx: _StreamedContext) -> int:
+        file_meta = archive_ctx.file_meta
+
+        # No mount, every file is listed and read through the API, straight from the appliance
+        try:
+            image = guestfs_appliance.GuestFSImage(file_meta.path)
+        except MountException as e:
+            raise click.FileError(filename=file_meta.path, hint=f'Unable to stream {file_meta.path}: {e}')
+
+        worst_rv = 0
+
+        with image:
+            for partition, error in image.failed.items():
+                fast_log.warn(f'Unable to mount the {partition} for {file_meta.path}, attempting to continue anyway')
+                fast_log.debug(f'Got the following error: {error}')
+
+            try:
+                for path, size in image.iter_files():
+                    if self._stopped:
+                        break
+
+                    worst_rv = _worse_rv(worst_rv, self._scan_guestfs_file(archive_ctx, image, path, size))
+            except RuntimeError as e:
+                worst_rv = self._record(archive_ctx.nice_filename(), clamd.RV_ERROR,
+                                        f'{archive_ctx.nice_filename()}: Unable to list the rest of the files: {e}')
+
+        return worst_rv
+
+    def _scan_top_level_tar(self, archive_ctx: _StreamedContext, fileobj, mode: str = 'r|') -> int:
+        file_meta = archive_ctx.file_meta
+        try:
+            tar = tarfile.open(fileobj=fileobj, mode=mode)
+        except (tarfile.TarError, OSError) as e:
+            raise click.FileError(filename=file_meta.path, hint=f'Unable to stream {file_meta.path}: {e}')
+
+        with tar:
+            return self._scan_tar(tar, archive_ctx)
+
+    def _worker_args(self) -> Tuple:
+        # Workers scan one member at a time, so they never need a pool of their own
+        return (self.clamd_socket, self.min_file_size, self.tmp_dir, self.fail_fast, self.scan_jobs, self.detect_jobs,
+                self.dedupe_archives, 1, self.fdpass, self.chunk_size)
+
+    def scan(self, file_meta: FileMetadata) -> List[ScanResult]:
+        """
+        :return: A result for the archive as a whole, followed by every member that wasn't clean, and the results for
+                 every archive that was unpacked from disk
+        """
+        self._root_meta = file_meta
+        archive_ctx = _StreamedContext(file_meta.get_filename(), file_meta, self.tmp_dir)
+
+        fast_log.info(f'Streaming {archive_ctx.nice_filename()} to clamd')
+        started = time.monotonic()
+        cpu_started = _cpu_seconds()
+
+        if file_meta.filetype == FileType.ZIP:
+            worst_rv = self._scan_zip(archive_ctx)
+        elif file_meta.filetype == FileType.ISO:
+            worst_rv = self._scan_iso(archive_ctx)
+        elif file_meta.filetype in GUESTFS_STREAMABLE_FILETYPES:
+            worst_rv = self._scan_guestfs(archive_ctx)
+        elif file_meta.filetype == FileType.TARGZ:
+            with decompress.GzipStream(file_meta.path) as gz_stream:
+                worst_rv = self._scan_top_level_tar(archive_ctx, gz_stream)
+        else:
+            # Seekable, so that members get skipped over instead of read, and clamd is sent them straight from disk
+            with open(file_meta.path, 'rb') as tar_file:
+                archive_ctx.source_fd = tar_file.fileno()
+                worst_rv = self._scan_top_level_tar(archive_ctx, tar_file, mode='r:')
+
+        self._log_throughput(archive_ctx, time.monotonic() - started, _cpu_seconds() - cpu_started)
+
+        return [ScanResult(archive_ctx.nice_filename(), worst_rv)] + self.results
+
+    def _log_throughput(self, archive_ctx: _StreamedContext, seconds: float, cpu_seconds: float) -> None:
+        gib_streamed = self.bytes_streamed / (1024 ** 3)
+        cpu_per_gib = f'{cpu_seconds / gib_streamed:.1f}s' if gib_streamed > 0 else 'n/a'
+
+        fast_log.info(f'Streamed {self.num_members} files from {archive_ctx.nice_filename()}, '
+                      f'{humanize.naturalsize(self.bytes_streamed, binary=True)} in total at '
+                      f'{humanize.naturalsize(self.bytes_streamed / max(seconds, 1e-9), binary=True)}/s, '
+                      f'using {cpu_seconds:.1f}s of CPU ({cpu_per_gib} per GiB)')
+
+
+def _cpu_seconds() -> float:
+    """
+    :return: The CPU time used by this process and every worker process that has finished, in seconds
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class _ZipMemberWorker:
+    """
+    Scans zip members one at a time, with its own handle on the zip
+    """
+
+    def __init__(self, stream_scanner: StreamScanner, file_meta: FileMetadata):
+        self.stream_scanner = stream_scanner
+        self.stream_scanner._root_meta = file_meta
+        self.archive_ctx = _StreamedContext(file_meta.get_filename(), file_meta, stream_scanner.tmp_dir)
+        self.zip_file = zipfile.ZipFile(file_meta.path)
+
+    def scan(self, member_name: str) -> int:
+        return self.stream_scanner.scan_zip_member(self.archive_ctx, self.zip_file, member_name)
+
+    def close(self):
+        self.zip_file.close()
+
+
+# Each worker process has its own, set up by _init_zip_worker
+_zip_worker = None  # type: _ZipMemberWorker | None
+
+
+def _worker_settings() -> Tuple:
+    # Workers don't start out as a copy of this process, so whatever the command set through the use_* functions, and
+    # logging, is handed to them. The shared pools aren't, a worker only ever scans one member at a time
+    cache = file_data.get_detect_cache()
+    return (fast_log.console_verbose(), decompress.decompressor(), cache.path if cache is not None else None,
+            *guestfs_appliance.appliance_settings(), tmp_files.private_dirs())
+
+
+def _apply_worker_settings(verbose: Optional[bool], decompressor: str, detect_cache_path: Optional[str],
+                           fixed_appliance: Optional[str], guestfs_cache_dir: Optional[str], private_dirs: bool) -> None:
+    if verbose is not None:
+        fast_log.log_start(verbose, False)
+
+    decompress.use_decompressor(decompressor)
+    guestfs_appliance.use_appliance(fixed_appliance, guestfs_cache_dir)
+    tmp_files.use_private_dirs(private_dirs)
+
+    if detect_cache_path is None:
+        return
+
+    # Its own connection to the same cache, which is saved when the worker exits
+    try:
+        cache = detect_cache.DetectCache(detect_cache_path)
+    except (OSError, sqlite3.Error) as e:
+        fast_log.warn(f'Unable to open the detection cache at {detect_cache_path}, continuing without it: {e}')
+        return
+
+    file_data.use_detect_cache(cache)
+    multiprocessing.util.Finalize(None, cache.close, exitpriority=0)
+
+
+def _init_zip_worker(settings: Tuple, worker_args: Tuple, file_meta: FileMetadata) -> None:
+    global _zip_worker
+    _apply_worker_settings(*settings)
+    _zip_worker = _ZipMemberWorker(StreamScanner(*worker_args), file_meta)
+
+
+def _scan_zip_member(member_name: str) -> Tuple[int, List[ScanResult], int, int]:
+    """
+    Runs in a worker process
+    :return: The RV for the member, any results to be listed, and how many files and bytes were streamed to clamd
+    """
+    stream_scanner = _zip_worker.stream_scanner
+
+    # Only what this member added needs to go back to the parent, which also takes care of --fail-fast
+    stream_scanner.results = []
+    stream_scanner.num_members = 0
+    stream_scanner.bytes_streamed = 0
+    stream_scanner._stopped = False
+
+    member_rv = _zip_worker.scan(member_name)
+
+    # Temp dirs are deleted in the background, which needs to be done before the worker can be shut down
+    tree_delete.wait_for_deletes()
+
+    return member_rv, stream_scanner.results, stream_scanner.num_members, stream_scanner.bytes_streamed
+
+
+def can_stream(file_meta: FileMetadata) -> bool:
+    """
+    :return: If file_meta can be streamed, instead of unpacked. Images that are UDF, rather than ISO 9660, can't be,
+             and neither can disk images without the libguestfs python bindings
+    """
+    if file_meta.filetype not in STREAMABLE_FILETYPES:
+        return False
+
+    if file_meta.filetype in GUESTFS_STREAMABLE_FILETYPES:
+        return guestfs_appliance.is_available()
+
+    if file_meta.filetype != FileType.ISO:
+        return True
+
+    try:
+        with open(file_meta.path, 'rb') as iso_file:
+            iso9660.IsoImage(iso_file.fileno())
+    except (IsoException, OSError) as e:
+        fast_log.debug(f'Unable to stream {file_meta.path}: {e}')
+        return False
+
+    return True
+
+
+def stream_scan(file_meta: FileMetadata, clamd_socket: str, min_file_size: int, tmp_dir: str,
+                fail_fast: bool = False, scan_jobs: int = 1, detect_jobs: int = 1,
+                dedupe_archives: bool = False, stream_jobs: int = 1, fdpass: bool = False,
+                chunk_size: int = clamd.INSTREAM_CHUNK_SIZE) -> List[ScanResult]:
+    stream_scanner = StreamScanner(clamd_socket, min_file_size, tmp_dir, fail_fast=fail_fast, scan_jobs=scan_jobs,
+                                   detect_jobs=detect_jobs, dedupe_archives=dedupe_archives, stream_jobs=stream_jobs,
+                                   fdpass=fdpass, chunk_size=chunk_size)
+    return stream_scanner.scan(file_meta)
@@ -28,29 +28,125 @@
 
 import glob
 import os
+import sqlite3
 import tempfile
+import threading
+from typing import Optional
 
+import clamav_large_archive_scanner.lib.tmp_registry as tmp_registry
+from clamav_large_archive_scanner.lib import fast_log
 from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType
 
 TMP_DIR_PREFIX = 'clam_unpacker'
 
+# One registry per tmp dir, opened the first time it's needed. None if it couldn't be opened
+_registries = {}  # type: dict[str, Optional[tmp_registry.TmpDirRegistry]]
+_registries_lock = threading.Lock()
+
+# Only clamd needs the temp dirs to be readable by others, and it doesn't if it is handed the open files instead
+_private_dirs = False
+
+
+def use_private_dirs(private: bool) -> None:
+    """
+    :param private: If true, temp dirs and everything unpacked into them are only readable by us
+    """
+    global _private_dirs
+    _private_dirs = private
+
+
+def private_dirs() -> bool:
+    return _private_dirs
+
+
+def _registry(tmp_dir: str, create: bool) -> Optional[tmp_registry.TmpDirRegistry]:
+    """
+    :param create: Make the registry if there isn't one yet. Otherwise, a tmp dir without one has no temp dirs of
+                   ours to find in it, at least not since the registry was added
+    """
+    tmp_dir = os.path.abspath(tmp_dir)
+    with _registries_lock:
+        if tmp_dir in _registries:
+            registry = _registries[tmp_dir]
+        else:
+            if not create and not os.path.exists(tmp_registry.registry_path(tmp_dir)):
+                return None
+
+            try:
+                registry = tmp_registry.TmpDirRegistry(tmp_dir)
+            except (OSError, sqlite3.Error) as e:
+                fast_log.warn(f'Unable to open the temp dir registry in {tmp_dir}, continuing without it: {e}')
+                registry = None
+            _registries[tmp_dir] = registry
+
+    if registry is None or not registry.is_usable():
+        return None
+
+    return registry
+
+
+def close_registries() -> None:
+    with _registries_lock:
+        for registry in _registries.values():
+            if registry is not None:
+                registry.close()
+        _registries.clear()
+
 
 # Makes a temporary directory for the file to be unpacked into, named base on filetype and filename
-def make_temp_dir(file_meta: FileMetadata, tmp_dir: str) -> str:
+def make_temp_dir(file_meta: FileMetadata, tmp_dir: str, root_path: Optional[str] = None,
+                  parent_dir: Optional[str] = None) -> str:
+    """
+    :param root_path: The archive given to us, that file_meta was found inside of. Defaults to its root_meta
+    :param parent_dir: The temp dir that file_meta was found in, if any
+    """
     if not file_meta.root_meta:
         prefix = f'{TMP_DIR_PREFIX}_{file_meta.filetype.get_filetype_short()}_{file_meta.get_filename()}_'
     else:
         prefix = f'{TMP_DIR_PREFIX}_{file_meta.filetype.get_filetype_short()}-p_{file_meta.root_meta.get_filename()}_p-{file_meta.get_filename()}_'
-    tmp_dir = tempfile.mkdtemp(prefix=prefix, dir=tmp_dir)
+    new_dir = tempfile.mkdtemp(prefix=prefix, dir=tmp_dir)
 
     # Need to make it readable by everyone, otherwise clam will throw a fit
-    os.chmod(tmp_dir, 0o755)
+    # mkdtemp already made it 0700, which is what we want if it's private
+    if not _private_dirs:
+        os.chmod(new_dir, 0o755)
 
-    return tmp_dir
+    registry = _registry(tmp_dir, create=True)
+    if registry is not None:
+        if root_path is None:
+            root_path = (file_meta.root_meta or file_meta).path
+        registry.add(new_dir, os.path.abspath(root_path), file_meta.filetype, parent_dir)
 
+    return new_dir
 
-# Determine the filetype based on the path, assuming that it was created by make_temp_dir
+
+def mark_mounted(path: str) -> None:
+    """
+    Records that something has been mounted in the temp dir, either on it or on a dir inside of it
+    """
+    registry = _registry(os.path.dirname(path), create=False)
+    if registry is not None:
+        registry.set_mounted(path)
+
+
+def forget_tmp_dir(path: str) -> None:
+    """
+    Called once the temp dir has been cleaned up
+    """
+    registry = _registry(os.path.dirname(path), create=False)
+    if registry is not None:
+        registry.remove(path)
+
+
+# Determine the filetype of a dir created by make_temp_dir
 def determine_tmp_dir_filetype(path: str) -> FileType:
+    registry = _registry(os.path.dirname(path), create=False)
+    if registry is not None:
+        entry = registry.get(path)
+        if entry is not None:
+            return entry.filetype
+
+    # Not in the registry, fall back to the name it was given
     for filetype in FileType:
         if os.path.basename(path).startswith(f'{TMP_DIR_PREFIX}_{filetype.get_filetype_short()}'):
             return filetype
@@ -58,7 +154,51 @@ def determine_tmp_dir_filetype(path: str) -> FileType:
     return FileType.UNKNOWN
 
 
+def _still_exists(path: str) -> bool:
+    try:
+        os.lstat(path)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # IE a FUSE mount that has lost its daemon, which still needs cleaning up
+        pass
+
+    return True
+
+
+def _is_tmp_dir_of(path: str, tmp_dir: str) -> bool:
+    """
+    :return: True if path could have been made by make_temp_dir in tmp_dir
+    """
+    return os.path.dirname(path) == os.path.abspath(tmp_dir) and \
+        os.path.basename(path).startswith(f'{TMP_DIR_PREFIX}_')
+
+
 # Find all the directories created by make_temp_dir that are associated with the given file
 def find_associated_dirs(filepath: str, tmp_dir: str) -> list[str]:
+    """
+    :return: The dirs, with anything unpacked from inside of a dir coming before it, if they're in the registry
+    """
+    registry = _registry(tmp_dir, create=False)
+    entries = None
+    if registry is not None:
+        entries = registry.find_by_root(os.path.abspath(filepath))
+
+    # Whatever the registry has is all there is. Names can't tell archives with the same name in different dirs apart,
+    # which could be unpacking into their own temp dirs right now (IE with scan-batch or serve)
+    if entries is not None:
+        dirs = []
+        for entry in entries:
+            # Everything listed gets deleted, so never anything that isn't one of our temp dirs
+            if not _is_tmp_dir_of(entry.path, tmp_dir):
+                fast_log.warn(f'Ignoring {entry.path} in the temp dir registry, it is not a temp dir in {tmp_dir}')
+            elif _still_exists(entry.path):
+                dirs.append(entry.path)
+            else:
+                # Removed by someone else
+                registry.remove(entry.path)
+        return dirs
+
+    # No registry, IE unpacked before there was one, or it can't be used, so match by name instead
     file_name = os.path.basename(filepath)
     return glob.glob(f'{tmp_dir}/{TMP_DIR_PREFIX}_*_{file_name}_*')
@@ -0,0 +1,186 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# A record of every temp dir made in a tmp dir, kept in a database next to them. Cleanup looks temp dirs up by the
+# archive they were unpacked from, instead of listing the whole tmp dir and matching on names
+
+import os
+import sqlite3
+import stat
+import threading
+from typing import Optional
+
+from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.file_data import FileType, FILETYPES_BY_SHORT
+
+REGISTRY_FILENAME = 'clam_unpacker_registry.sqlite'
+
+# How long to wait for another process that is using the same tmp dir
+LOCK_TIMEOUT_SECONDS = 5
+
+_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS tmp_dirs (
+        path TEXT PRIMARY KEY,
+        root_path TEXT NOT NULL,
+        filetype TEXT NOT NULL,
+        parent_path TEXT,
+        mounted INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS tmp_dirs_root_path ON tmp_dirs (root_path);
+'''
+
+
+# sqlite keeps these next to the database while it's in WAL mode, and replays the log when it is opened
+_SIDE_FILE_SUFFIXES = ['-wal', '-shm']
+
+
+def registry_path(tmp_dir: str) -> str:
+    return os.path.join(tmp_dir, REGISTRY_FILENAME)
+
+
+def _check_trusted(path: str) -> None:
+    """
+    Anyone can write to a shared tmp dir like /tmp, and cleanup deletes whatever the registry lists, so it is only
+    trusted if it's a plain file of ours that nobody else can write to
+    """
+    file_stat = os.lstat(path)
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise PermissionError(f'{path} is not a regular file')
+
+    if file_stat.st_uid != os.geteuid():
+        raise PermissionError(f'{path} is owned by uid {file_stat.st_uid}, not by us')
+
+    if file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f'{path} can be written to by others')
+
+
+class TmpDirEntry:
+    def __init__(self, path: str, root_path: str, filetype: FileType, parent_path: Optional[str], mounted: bool):
+        self.path = path
+
+        # The archive that was given to us, which this dir was unpacked from, directly or not
+        self.root_path = root_path
+        self.filetype = filetype
+
+        # The temp dir that the archive was found in, if it wasn't the root archive
+        self.parent_path = parent_path
+        self.mounted = mounted
+
+    def __repr__(self):
+        return f'TmpDirEntry({self.path!r}, {self.root_path!r}, {self.filetype}, {self.parent_path!r}, {self.mounted})'
+
+
+class TmpDirRegistry:
+    """
+    Safe to use from multiple threads, and from multiple processes sharing the same tmp dir
+    Every change is committed straight away, so that a crashed run still leaves behind a record of what to clean up
+    Raises PermissionError if the database is there already, but could have been written by someone else
+    If anything goes wrong with the database, the registry disables itself, and it's up to the caller to fall back
+    to looking at the tmp dir instead
+    """
+
+    def __init__(self, tmp_dir: str):
+        self.path = registry_path(tmp_dir)
+        self._lock = threading.Lock()
+
+        # Made by us, so that it's only writable by us no matter the umask. Never follows a link someone left there
+        os.close(os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600))
+        _check_trusted(self.path)
+        for suffix in _SIDE_FILE_SUFFIXES:
+            if os.path.lexists(self.path + suffix):
+                _check_trusted(self.path + suffix)
+
+        # isolation_level=None leaves it in autocommit mode
+        self._db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT_SECONDS, check_same_thread=False,
+                                   isolation_level=None)
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(_SCHEMA)
+        except sqlite3.Error:
+            self._db.close()
+            raise
+
+    def is_usable(self) -> bool:
+        return self._db is not None
+
+    def _disable(self, e: sqlite3.Error) -> None:
+        fast_log.warn(f'Unable to use the temp dir registry at {self.path}, continuing without it: {e}')
+        self._db.close()
+        self._db = None
+
+    def _execute(self, sql: str, params: tuple) -> Optional[list]:
+        with self._lock:
+            if self._db is None:
+                return None
+
+            try:
+                return self._db.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                self._disable(e)
+                return None
+
+    def add(self, path: str, root_path: str, filetype: FileType, parent_path: Optional[str] = None) -> None:
+        self._execute('INSERT OR REPLACE INTO tmp_dirs (path, root_path, filetype, parent_path, mounted) '
+                      'VALUES (?, ?, ?, ?, 0)', (path, root_path, filetype.get_filetype_short(), parent_path))
+
+    def set_mounted(self, path: str, mounted: bool = True) -> None:
+        self._execute('UPDATE tmp_dirs SET mounted=? WHERE path=?', (int(mounted), path))
+
+    def remove(self, path: str) -> None:
+        self._execute('DELETE FROM tmp_dirs WHERE path=?', (path,))
+
+    def get(self, path: str) -> Optional[TmpDirEntry]:
+        rows = self._execute('SELECT path, root_path, filetype, parent_path, mounted FROM tmp_dirs WHERE path=?',
+                             (path,))
+        if not rows:
+            return None
+
+        return self._to_entry(rows[0])
+
+    def find_by_root(self, root_path: str) -> Optional[list[TmpDirEntry]]:
+        """
+        :return: Every temp dir unpacked from the root archive, newest first, so that anything unpacked from inside of
+                 a temp dir comes before it. None if the registry is unusable
+        """
+        rows = self._execute('SELECT path, root_path, filetype, parent_path, mounted FROM tmp_dirs '
+                             'WHERE root_path=? ORDER BY rowid DESC', (root_path,))
+        if rows is None:
+            return None
+
+        return [self._to_entry(x) for x in rows]
+
+    @staticmethod
+    def _to_entry(row: tuple) -> TmpDirEntry:
+        path, root_path, filetype_short, parent_path, mounted = row
+        return TmpDirEntry(path, root_path, FILETYPES_BY_SHORT.get(filetype_short, FileType.UNKNOWN), parent_path, bool(mounted))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
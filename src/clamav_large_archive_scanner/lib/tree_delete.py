@@ -0,0 +1,374 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Deletes unpacked trees in the background, so that cleaning up doesn't hold up whatever comes next
+# Each tree is renamed into a trash dir next to it first, which takes no time at all, and then deleted by a pool of
+# threads, a directory at a time
+
+import os
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait as wait_futures
+from typing import Optional
+
+import humanize
+
+from clamav_large_archive_scanner.lib import fast_log
+
+# Each deleter makes its own trash dir next to what it deletes, with mkdtemp, so that it is always ours and 0700
+# A shared, fixed name in a tmp dir like /tmp could be made first by someone else, or be a link to anywhere
+TRASH_DIR_PREFIX = 'clam_unpacker_trash_'
+
+# Files are unlinked from this many directories at a time
+MAX_DELETE_JOBS = 8
+
+# Every error is counted, but only this many are kept to be reported
+MAX_REPORTED_ERRORS = 10
+
+
+class DeleteStats:
+    def __init__(self):
+        self.num_trees = 0
+        self.num_files = 0
+        self.num_dirs = 0
+        self.reclaimed_bytes = 0
+        self.elapsed_seconds = 0.0
+        self.num_errors = 0
+        self.errors = []  # type: list[str]
+
+    def add(self, other) -> None:
+        self.num_trees += other.num_trees
+        self.num_files += other.num_files
+        self.num_dirs += other.num_dirs
+        self.reclaimed_bytes += other.reclaimed_bytes
+        self.elapsed_seconds += other.elapsed_seconds
+        self.num_errors += other.num_errors
+        self.errors.extend(other.errors[:MAX_REPORTED_ERRORS - len(self.errors)])
+
+    def __str__(self):
+        return (f'{self.num_files} files and {self.num_dirs} dirs, '
+                f'{humanize.naturalsize(self.reclaimed_bytes, binary=True)} in {self.elapsed_seconds:.1f}s')
+
+
+class _TreeDeletion:
+    """
+    Deletes a single tree, sharing the pool with every other tree being deleted
+    Nothing outside of the tree is ever touched, symlinks are unlinked rather than followed, and anything mounted
+    inside of it is left alone
+    """
+
+    def __init__(self, path: str, pool: ThreadPoolExecutor):
+        self.path = path
+        self.stats = DeleteStats()
+        self.stats.num_trees = 1
+
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._root_dev = None  # type: int | None
+
+    def _error(self, path: str, error) -> None:
+        fast_log.debug(f'Unable to delete {path}: {error}')
+        with self._lock:
+            self.stats.num_errors += 1
+            if len(self.stats.errors) < MAX_REPORTED_ERRORS:
+                self.stats.errors.append(f'{path}: {error}')
+
+    def _submit(self, a_dir: str) -> Future:
+        try:
+            return self._pool.submit(self._empty_dir, a_dir)
+        except RuntimeError:
+            # The interpreter is shutting down, and won't start any more threads. Finish it off on this one
+            future = Future()
+            future.set_result(self._empty_dir(a_dir))
+            return future
+
+    @staticmethod
+    def _open_dir(a_dir: str) -> int:
+        flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+        try:
+            return os.open(a_dir, flags)
+        except PermissionError:
+            # Unpacked without read permission, which is ours to give ourselves
+            os.chmod(a_dir, stat.S_IRWXU)
+            return os.open(a_dir, flags)
+
+    def _empty_dir(self, a_dir: str) -> list[str]:
+        """
+        Unlinks everything in the directory, other than its subdirectories
+        :return: The subdirectories, which need emptying in turn
+        """
+        try:
+            dir_fd = self._open_dir(a_dir)
+        except OSError as e:
+            self._error(a_dir, e)
+            return []
+
+        subdirs = []
+        num_files = 0
+        reclaimed_bytes = 0
+        try:
+            dir_stat = os.fstat(dir_fd)
+            reclaimed_bytes += dir_stat.st_blocks * 512
+
+            # Without write permission on the dir, nothing in it can be unlinked
+            if stat.S_IMODE(dir_stat.st_mode) & stat.S_IRWXU != stat.S_IRWXU:
+                os.chmod(dir_fd, stat.S_IMODE(dir_stat.st_mode) | stat.S_IRWXU)
+
+            with os.scandir(dir_fd) as entries:
+                for entry in entries:
+                    entry_path = os.path.join(a_dir, entry.name)
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        if stat.S_ISDIR(entry_stat.st_mode):
+                            if entry_stat.st_dev != self._root_dev:
+                                self._error(entry_path, 'Is mounted from another filesystem, not deleting it')
+                            else:
+                                subdirs.append(entry_path)
+                            continue
+
+                        os.unlink(entry.name, dir_fd=dir_fd)
+                        num_files += 1
+
+                        # Hard links don't free anything up until the last one is gone
+                        if entry_stat.st_nlink <= 1:
+                            reclaimed_bytes += entry_stat.st_blocks * 512
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        self._error(entry_path, e)
+        except OSError as e:
+            self._error(a_dir, e)
+        finally:
+            os.close(dir_fd)
+
+        with self._lock:
+            self.stats.num_files += num_files
+            self.stats.reclaimed_bytes += reclaimed_bytes
+
+        return subdirs
+
+    def run(self) -> DeleteStats:
+        started = time.monotonic()
+
+        try:
+            self._root_dev = os.lstat(self.path).st_dev
+        except FileNotFoundError:
+            return self.stats
+        except OSError as e:
+            self._error(self.path, e)
+            return self.stats
+
+        # Every dir comes after the one it's in
+        dirs = [self.path]
+        pending = {self._submit(self.path)}
+        while len(pending) > 0:
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    dirs.append(subdir)
+                    pending.add(self._submit(subdir))
+
+        # So going backwards, every dir is empty by the time it's removed
+        for a_dir in reversed(dirs):
+            try:
+                os.rmdir(a_dir)
+                self.stats.num_dirs += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self._error(a_dir, e)
+
+        self.stats.elapsed_seconds = time.monotonic() - started
+        return self.stats
+
+
+class TreeDeleter:
+    """
+    delete() hands the tree off and returns straight away, wait() blocks until everything handed off is gone, and
+    wait_for() until a single tree is gone
+    Trees are deleted one after the other, each one using the whole pool
+    """
+
+    def __init__(self, max_jobs: int = MAX_DELETE_JOBS):
+        self._pool = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='delete')
+        self._trees = ThreadPoolExecutor(max_workers=1, thread_name_prefix='delete-tree')
+
+        self._lock = threading.Lock()
+        self._pending = []  # type: list[Future]
+        # The latest deletion of each tree, by the path it was handed off as
+        self._by_path = {}  # type: dict[str, Future]
+
+        # By the dir that they're in
+        self._trash_dirs = {}  # type: dict[str, str]
+
+    def _move_to_trash(self, path: str) -> Optional[str]:
+        """
+        :return: Where the tree should be deleted from, or None if there's nothing to delete
+        """
+        path = os.path.abspath(path)
+        parent_dir = os.path.dirname(path)
+
+        # A unique name in the trash, so that it can't clash with anything else in there
+        # Renaming a dir over an empty one replaces it, so it can be claimed with mkdtemp
+        # Done under the lock, so that wait() can't remove the trash dir in between
+        with self._lock:
+            try:
+                trash_dir = self._trash_dirs.get(parent_dir)
+                if trash_dir is None:
+                    trash_dir = tempfile.mkdtemp(prefix=TRASH_DIR_PREFIX, dir=parent_dir)
+                    self._trash_dirs[parent_dir] = trash_dir
+                trash_path = tempfile.mkdtemp(prefix=f'{os.path.basename(path)}_', dir=trash_dir)
+            except OSError as e:
+                fast_log.debug(f'Unable to make a dir in the trash next to {path}, deleting it where it is: {e}')
+                return path
+
+        try:
+            os.rename(path, trash_path)
+            return trash_path
+        except FileNotFoundError:
+            os.rmdir(trash_path)
+            return None
+        except OSError as e:
+            # IE it's a mount point, or the trash is on another filesystem
+            fast_log.debug(f'Unable to move {path} to {trash_dir}, deleting it where it is: {e}')
+            os.rmdir(trash_path)
+            return path
+
+    def _delete(self, original_path: str, path: str) -> DeleteStats:
+        stats = _TreeDeletion(path, self._pool).run()
+
+        fast_log.debug(f'Deleted {original_path}: {stats}')
+        if stats.num_errors > 0:
+            fast_log.warn(f'Unable to delete all of {original_path}, got {stats.num_errors} errors, '
+                          f'starting with: {stats.errors[0]}')
+
+        return stats
+
+    def delete(self, path: str) -> None:
+        to_delete = self._move_to_trash(path)
+        if to_delete is None:
+            fast_log.debug(f'{path} is already gone, nothing to delete')
+            return
+
+        with self._lock:
+            future = self._trees.submit(self._delete, path, to_delete)
+            self._pending.append(future)
+            self._by_path[os.path.abspath(path)] = future
+
+    def wait_for(self, path: str) -> Optional[DeleteStats]:
+        """
+        Blocks until the tree handed off as path is gone, it's still counted by the next wait()
+        :return: How deleting it went, or None if it wasn't handed off since the last wait
+        """
+        with self._lock:
+            future = self._by_path.pop(os.path.abspath(path), None)
+
+        if future is None:
+            return None
+        return future.result()
+
+    def wait(self) -> DeleteStats:
+        """
+        :return: The totals of everything that was deleted since the last wait
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._by_path.clear()
+
+        stats = DeleteStats()
+        for future in pending:
+            stats.add(future.result())
+
+        with self._lock:
+            for parent_dir, trash_dir in list(self._trash_dirs.items()):
+                try:
+                    os.rmdir(trash_dir)
+                    del self._trash_dirs[parent_dir]
+                except FileNotFoundError:
+                    del self._trash_dirs[parent_dir]
+                except OSError:
+                    # Still holds something that couldn't be deleted, or was handed off since the wait started
+                    pass
+
+        return stats
+
+
+# Made the first time anything is deleted
+_deleter = None  # type: TreeDeleter | None
+_deleter_lock = threading.Lock()
+
+
+def delete_tree(path: str) -> None:
+    """
+    Deletes the tree in the background, call wait_for_deletes() to make sure it's gone
+    """
+    global _deleter
+    with _deleter_lock:
+        if _deleter is None:
+            _deleter = TreeDeleter()
+        deleter = _deleter
+
+    deleter.delete(path)
+
+
+def wait_for_delete(path: str) -> Optional[DeleteStats]:
+    """
+    Waits for just the tree at path to be deleted, IE to get its space back before carrying on
+    :return: How deleting it went, or None if it isn't being deleted
+    """
+    with _deleter_lock:
+        deleter = _deleter
+
+    if deleter is None:
+        return None
+
+    return deleter.wait_for(path)
+
+
+def wait_for_deletes() -> Optional[DeleteStats]:
+    """
+    Waits for everything passed to delete_tree() to be deleted, and logs how it went
+    :return: The totals, or None if nothing has ever been deleted
+    """
+    with _deleter_lock:
+        deleter = _deleter
+
+    if deleter is None:
+        return None
+
+    stats = deleter.wait()
+    if stats.num_trees > 0:
+        fast_log.info(f'Deleted {stats.num_trees} temp dir(s), {stats}')
+    if stats.num_errors > 0:
+        fast_log.warn(f'Got {stats.num_errors} errors while deleting temp dirs, starting with:')
+        for error in stats.errors:
+            fast_log.warn(f'  {error}')
+
+    return stats
@@ -27,13 +27,21 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 
+import io
 import os
 import shutil
+import stat
+import struct
+import tarfile
+import zipfile
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Tuple
 
 import click
+import humanize
 
 from clamav_large_archive_scanner.lib import fast_log
-from clamav_large_archive_scanner.lib.exceptions import ArchiveException, MountException
+from clamav_large_archive_scanner.lib.exceptions import ArchiveException, IsoException, MountException
 from clamav_large_archive_scanner.lib.fast_log import trace
 
 # These imports are here to make mocking easier in UT
@@ -41,6 +49,112 @@ from clamav_large_archive_scanner.lib.fast_log import trace
 import clamav_large_archive_scanner.lib.file_data as file_data
 import clamav_large_archive_scanner.lib.mount_tools as mount_tools
 import clamav_large_archive_scanner.lib.contexts as contexts
+import clamav_large_archive_scanner.lib.discovery as discovery
+import clamav_large_archive_scanner.lib.dedupe as dedupe
+import clamav_large_archive_scanner.lib.decompress as decompress
+import clamav_large_archive_scanner.lib.guestfs_appliance as guestfs_appliance
+import clamav_large_archive_scanner.lib.iso9660 as iso9660
+import clamav_large_archive_scanner.lib.tmp_files as tmp_files
+import clamav_large_archive_scanner.lib.zero_copy as zero_copy
+
+
+# Everything unpacked needs to be readable by clamd, which usually runs as a different user
+READABLE_FILE_BITS = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+READABLE_DIR_BITS = READABLE_FILE_BITS | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+# Unless clamd is handed the open files, in which case only we need to be able to read them
+PRIVATE_READABLE_FILE_BITS = stat.S_IRUSR
+PRIVATE_READABLE_DIR_BITS = stat.S_IRUSR | stat.S_IXUSR
+
+
+def _current_umask() -> int:
+    # The only way to read it is to change it
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once at startup, while nothing else can be creating files
+_UMASK = _current_umask()
+
+
+def _readable_bits(is_dir: bool) -> int:
+    if tmp_files.private_dirs():
+        return PRIVATE_READABLE_DIR_BITS if is_dir else PRIVATE_READABLE_FILE_BITS
+
+    return READABLE_DIR_BITS if is_dir else READABLE_FILE_BITS
+
+
+def _created_modes() -> Tuple[bool, int, int]:
+    """
+    For archives that don't carry unix modes that we'd want to keep, where everything is created as per the umask
+    :return: If the umask takes away read access, and the modes for files and dirs that put it back
+    """
+    needs_chmod = _UMASK & _readable_bits(True) != 0
+    file_mode = 0o666 & ~_UMASK | _readable_bits(False)
+    dir_mode = 0o777 & ~_UMASK | _readable_bits(True)
+
+    return needs_chmod, file_mode, dir_mode
+
+
+# Every guestmount boots an appliance of its own, which takes seconds, so partitions are mounted this many at a time
+MAX_PARALLEL_MOUNTS = 8
+
+# Where the name and extra field lengths are in a zip's local file header
+_ZIP_HEADER_FILENAME_LENGTH = 10
+_ZIP_HEADER_EXTRA_FIELD_LENGTH = 11
+_ZIP_FLAG_ENCRYPTED = 0x1
+
+# Set through use_detect_pool, when several archives are being unpacked in the same process
+_detect_pool = None  # type: Executor | None
+
+
+def use_detect_pool(pool: Optional[Executor]) -> None:
+    """
+    :param pool: If set, recursive unpacking detects file types on this pool, instead of starting one of its own
+    """
+    global _detect_pool
+    _detect_pool = pool
+
+
+def _file_fd(fileobj) -> Optional[int]:
+    """
+    :return: The descriptor of fileobj if it is a plain file on disk (IE not something decompressing it), else None
+    """
+    if isinstance(fileobj, io.BufferedReader) and isinstance(fileobj.raw, io.FileIO):
+        return fileobj.fileno()
+
+    return None
+
+
+class _ReadableTarFile(tarfile.TarFile):
+    """
+    Makes every member readable as it is extracted, rather than going back over the whole tree afterwards
+    Members of an uncompressed tar on disk are copied straight from the archive by the kernel
+    """
+
+    num_unreadable = 0
+
+    def makefile(self, tarinfo, targetpath):
+        source_fd = _file_fd(self.fileobj)
+
+        # Sparse members have holes that aren't in the archive
+        if source_fd is None or tarinfo.sparse is not None:
+            return super().makefile(tarinfo, targetpath)
+
+        if zero_copy.copy_to_file(source_fd, tarinfo.offset_data, tarinfo.size, targetpath) < tarinfo.size:
+            raise tarfile.ReadError('unexpected end of data')
+
+    def chmod(self, tarinfo, targetpath):
+        # Filters can ask for the mode to be left alone
+        if tarinfo.mode is None:
+            return
+
+        try:
+            os.chmod(targetpath, tarinfo.mode | _readable_bits(tarinfo.isdir()))
+        except OSError as e:
+            fast_log.debug(f'Unable to make {targetpath} readable: {e}')
+            self.num_unreadable += 1
 
 
 class BaseFileUnpackHandler:
@@ -57,18 +171,31 @@ class ArchiveFileUnpackHandler(BaseFileUnpackHandler):
         super().__init__(u_ctx)
         self.format = file_format
 
+    def _extract(self) -> int:
+        """
+        :return: The number of files that couldn't be made readable
+        """
+        shutil.unpack_archive(self.u_ctx.file_meta.path, self.u_ctx.unpacked_dir_location, format=self.format)
+        return 0
+
+    def _extract_tar(self, tar: tarfile.TarFile) -> int:
+        with tar:
+            tar.extractall(self.u_ctx.unpacked_dir_location)
+            return tar.num_unreadable
+
     def unpack(self) -> contexts.UnpackContext:
         # This can sometimes fail if the archive is corrupt
         try:
-            shutil.unpack_archive(self.u_ctx.file_meta.path, self.u_ctx.unpacked_dir_location, format=self.format)
-
-            # Try to chmod -R a+r on the new directory so that it can be scanned
-            os.system(f'chmod -R a+r {self.u_ctx.unpacked_dir_location}')
+            num_unreadable = self._extract()
         except Exception as e:
             # Delete the temp dir since the unpacker created it
             self.u_ctx.cleanup_tmp()
             raise ArchiveException(e)
 
+        if num_unreadable > 0:
+            fast_log.warn(f'Unable to make {num_unreadable} file(s) unpacked from {self.u_ctx.file_meta.path} '
+                          f'readable, clamd may not be able to scan them. See the debug log for details')
+
         return self.u_ctx
 
 
@@ -76,13 +203,67 @@ class IsoFileUnpackHandler(BaseFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
         super().__init__(u_ctx)
 
-    def unpack(self) -> contexts.UnpackContext:
+    def _extract(self) -> int:
+        """
+        Copies every file straight out of the image, no mount (or root) needed
+        :return: The number of files that couldn't be made readable
+        """
+        num_unreadable = 0
+        needs_chmod, file_mode, dir_mode = _created_modes()
+
+        with open(self.u_ctx.file_meta.path, 'rb') as iso_file:
+            source_fd = iso_file.fileno()
+
+            for entry in iso9660.IsoImage(source_fd).walk():
+                target_path = os.path.join(self.u_ctx.unpacked_dir_location, entry.path)
+
+                if entry.is_dir:
+                    os.makedirs(target_path, exist_ok=True)
+                elif zero_copy.copy_ranges_to_file(source_fd, entry.extents, target_path) < entry.size:
+                    raise IsoException(f'Truncated data for {entry.path}')
+
+                if not needs_chmod:
+                    continue
+
+                try:
+                    os.chmod(target_path, dir_mode if entry.is_dir else file_mode)
+                except OSError as e:
+                    fast_log.debug(f'Unable to make {target_path} readable: {e}')
+                    num_unreadable += 1
+
+        return num_unreadable
+
+    def _clear_extracted(self) -> None:
+        # The directory itself stays, it's where the image gets mounted instead
+        for name in os.listdir(self.u_ctx.unpacked_dir_location):
+            path = os.path.join(self.u_ctx.unpacked_dir_location, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def _mount(self) -> None:
         try:
             mount_tools.mount_iso(self.u_ctx.file_meta.path, self.u_ctx.unpacked_dir_location)
+            tmp_files.mark_mounted(self.u_ctx.unpacked_dir_location)
         except MountException as e:
             fast_log.debug(f'Got MountException {e} when trying to mount {self.u_ctx.file_meta.path} to {self.u_ctx.unpacked_dir_location}')
             raise click.FileError(filename=self.u_ctx.file_meta.path, hint=f'Unable to mount {self.u_ctx.file_meta.path} to {self.u_ctx.unpacked_dir_location}')
 
+    def unpack(self) -> contexts.UnpackContext:
+        try:
+            num_unreadable = self._extract()
+        except (IsoException, OSError) as e:
+            # UDF images, and anything else we can't read ourselves, are left to the kernel
+            fast_log.debug(f'Unable to read {self.u_ctx.file_meta.path} as ISO 9660, mounting it instead: {e}')
+            self._clear_extracted()
+            self._mount()
+            return self.u_ctx
+
+        if num_unreadable > 0:
+            fast_log.warn(f'Unable to make {num_unreadable} file(s) unpacked from {self.u_ctx.file_meta.path} '
+                          f'readable, clamd may not be able to scan them. See the debug log for details')
+
         return self.u_ctx
 
 
@@ -90,23 +271,110 @@ class TarFileUnpackHandler(ArchiveFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
         super().__init__(u_ctx, 'tar')
 
+    def _extract(self) -> int:
+        return self._extract_tar(_ReadableTarFile.open(self.u_ctx.file_meta.path))
+
 
 class ZipFileUnpackHandler(ArchiveFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
         super().__init__(u_ctx, 'zip')
 
+    def _extract(self) -> int:
+        num_unreadable = 0
+
+        # There's only anything to fix if the umask takes away read access
+        needs_chmod, file_mode, dir_mode = _created_modes()
+
+        with zipfile.ZipFile(self.u_ctx.file_meta.path) as zip_file:
+            for member in zip_file.infolist():
+                if self._is_stored(member):
+                    extracted_path = self._extract_stored(zip_file, member)
+                else:
+                    extracted_path = zip_file.extract(member, self.u_ctx.unpacked_dir_location)
+
+                if not needs_chmod:
+                    continue
+
+                try:
+                    os.chmod(extracted_path, dir_mode if member.is_dir() else file_mode)
+                except OSError as e:
+                    fast_log.debug(f'Unable to make {extracted_path} readable: {e}')
+                    num_unreadable += 1
+
+        return num_unreadable
+
+    @staticmethod
+    def _is_stored(member: zipfile.ZipInfo) -> bool:
+        # Stored members are just the file as is, somewhere in the middle of the zip
+        return (member.compress_type == zipfile.ZIP_STORED and not member.is_dir() and
+                not member.flag_bits & _ZIP_FLAG_ENCRYPTED)
+
+    def _member_path(self, member: zipfile.ZipInfo) -> str:
+        # Same as ZipFile.extract, leading slashes, '.' and '..' are dropped so that nothing ends up outside of the dir
+        parts = [x for x in member.filename.split('/') if x not in ('', os.path.curdir, os.path.pardir)]
+        return os.path.normpath(os.path.join(self.u_ctx.unpacked_dir_location, *parts))
+
+    def _extract_stored(self, zip_file: zipfile.ZipFile, member: zipfile.ZipInfo) -> str:
+        """
+        Copies a stored member straight out of the zip, without going through zipfile (and so without a CRC check)
+        """
+        source_fd = zip_file.fp.fileno()
+
+        # The local header can have a different extra field to the central directory, so the data starts after it
+        header = os.pread(source_fd, zipfile.sizeFileHeader, member.header_offset)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f'Bad magic number for file header of {member.filename}')
+
+        header_fields = struct.unpack(zipfile.structFileHeader, header)
+        data_offset = (member.header_offset + zipfile.sizeFileHeader +
+                       header_fields[_ZIP_HEADER_FILENAME_LENGTH] + header_fields[_ZIP_HEADER_EXTRA_FIELD_LENGTH])
+
+        target_path = self._member_path(member)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+        if zero_copy.copy_to_file(source_fd, data_offset, member.compress_size, target_path) < member.compress_size:
+            raise zipfile.BadZipFile(f'Truncated data for {member.filename}')
+
+        return target_path
+
 
 class TarGzFileUnpackHandler(ArchiveFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
         super().__init__(u_ctx, 'gztar')
 
+    def _extract(self) -> int:
+        # Decompression happens on another thread (or process), while this one is busy writing out the files
+        with decompress.GzipStream(self.u_ctx.file_meta.path) as gz_stream:
+            return self._extract_tar(_ReadableTarFile.open(fileobj=gz_stream, mode='r|'))
+
 
 # Handles VMDK and QCOW2
 class GuestFSFileUnpackHandler(BaseFileUnpackHandler):
     def __init__(self, u_ctx: contexts.UnpackContext):
         super().__init__(u_ctx)
 
-    def unpack(self) -> contexts.UnpackContext:
+    def _unpack_appliance(self) -> bool:
+        # One appliance serves every partition, instead of guestmount booting one for each
+        try:
+            mounted, failed = guestfs_appliance.mount_image(self.u_ctx.file_meta.path,
+                                                            self.u_ctx.unpacked_dir_location)
+        except MountException as e:
+            fast_log.debug(f'Unable to launch an appliance for {self.u_ctx.file_meta.path}, aborting unpack')
+            fast_log.debug(f'Got the following error: {e}')
+
+            raise click.FileError(filename=self.u_ctx.file_meta.path,
+                                  hint=f'Unable to launch an appliance for {self.u_ctx.file_meta.path}, aborting unpack')
+
+        fast_log.debug(f'Mounted the following partitions to {self.u_ctx.unpacked_dir_location}:')
+        fast_log.debug('\n'.join(mounted))
+
+        for partition, error in failed.items():
+            fast_log.warn(f'Unable to mount the {partition} for {self.u_ctx.file_meta.path}, attempting to continue anyway')
+            fast_log.debug(f'Got the following error: {error}')
+
+        return len(mounted) > 0
+
+    def _unpack_guestmount(self) -> bool:
         try:
             # These VM Filesystem images can have multiple partitions
             # These need to be mounted individually
@@ -123,15 +391,37 @@ class GuestFSFileUnpackHandler(BaseFileUnpackHandler):
             raise click.FileError(filename=self.u_ctx.file_meta.path,
                                   hint=f'Unable to list partitions for {self.u_ctx.file_meta.path}, aborting unpack')
 
-        for partition in partitions:
-            try:
+        # The whole image takes about as long to mount as its slowest partition
+        with ThreadPoolExecutor(max_workers=max(1, min(len(partitions), MAX_PARALLEL_MOUNTS)),
+                                thread_name_prefix='guestmount') as mount_pool:
+            futures = {}
+            for partition in partitions:
                 fast_log.debug(f'attempting to mount {partition}')
-                mount_tools.mount_guestfs_partition(self.u_ctx.file_meta.path, partition, self.u_ctx.unpacked_dir_location)
+                futures[partition] = mount_pool.submit(mount_tools.mount_guestfs_partition, self.u_ctx.file_meta.path,
+                                                       partition, self.u_ctx.unpacked_dir_location)
+
+        any_mounted = False
+        for partition, future in futures.items():
+            try:
+                future.result()
                 fast_log.debug(f'Mounted {partition} to {self.u_ctx.unpacked_dir_location}')
+                any_mounted = True
             except MountException as e:
                 fast_log.warn(f'Unable to mount the {partition} for {self.u_ctx.file_meta.path}, attempting to continue anyway')
                 fast_log.debug(f'Got the following error: {e}')
 
+        return any_mounted
+
+    def unpack(self) -> contexts.UnpackContext:
+        # Without the libguestfs python bindings, guestmount is all there is
+        if guestfs_appliance.is_available():
+            any_mounted = self._unpack_appliance()
+        else:
+            any_mounted = self._unpack_guestmount()
+
+        # With nothing mounted, it's just an empty dir, which is deleted like any other
+        if any_mounted:
+            tmp_files.mark_mounted(self.u_ctx.unpacked_dir_location)
         return self.u_ctx
 
 
@@ -141,6 +431,8 @@ class DirFileUnpackHandler:
         self.u_ctx = u_ctx
 
     def unpack(self) -> contexts.UnpackContext:
+        # The directory itself is what gets walked and scanned
+        self.u_ctx.unpacked_dir_location = self.u_ctx.file_meta.path
         return self.u_ctx
 
 
@@ -185,39 +477,67 @@ def unpack(file: file_data.FileMetadata, tmp_dir: str) -> contexts.UnpackContext
         raise click.FileError(filename=file.path, hint=f'Unable to unpack {file.path}, got the following error: {e}')
 
 
-def unpack_recursive(parent_filemeta: file_data.FileMetadata, min_file_size: int, tmp_dir: str) -> list[contexts.UnpackContext]:
-    unpacked_ctx = list()  # type: list[contexts.UnpackContext]
+def _detect(found_file: Tuple[str, os.stat_result]) -> file_data.FileMetadata:
+    file_path, file_stat = found_file
+    trace(f'Looking at at {file_path}')
+    file_meta = file_data.file_meta_from_stat(file_path, file_stat)
+    trace(f'Got meta from at {file_path}, type is {file_meta.filetype}')
+
+    return file_meta
+
+
+def unpack_recursive(parent_filemeta: file_data.FileMetadata, min_file_size: int, tmp_dir: str,
+                     on_inspected: Optional[Callable[[contexts.UnpackContext], None]] = None,
+                     detect_jobs: int = 1, dedupe_archives: bool = False,
+                     outer_ctx: Optional[contexts.UnpackContext] = None) -> Iterator[contexts.UnpackContext]:
+    """
+    Unpacks the file, and every archive found inside it, recursively
+    This is a generator, every context is yielded as soon as it is unpacked, so that it can be scanned while the
+    rest of the tree is still being unpacked.
 
-    parent_ctx = contexts.UnpackContext(parent_filemeta, tmp_dir)
+    :param on_inspected: Called with each context once all the archives inside of it have been unpacked and yielded
+    :param detect_jobs: Number of files to detect the filetype of at the same time, ignored if a shared pool is set
+    :param dedupe_archives: Only unpack the first of any archives with identical content, the others are added to its
+                            aliases instead
+    :param outer_ctx: The context that parent_filemeta was found in, if it wasn't unpacked by this call
+    """
+
+    parent_ctx = contexts.UnpackContext(parent_filemeta, tmp_dir, parent_ctx=outer_ctx)
     parent_ctx = _do_unpack(parent_ctx)
 
-    unpacked_ctx.append(parent_ctx)
+    yield parent_ctx
 
     ctxs_to_inspect = [parent_ctx]  # type: list[contexts.UnpackContext]
 
-    # Now walk the unpacked directory and find all relevant archives
-    # Add found archives to inspection list
-    # Go until all archives are unpacked and inspected
-    while len(ctxs_to_inspect) > 0:
-        ctx_to_inspect = ctxs_to_inspect.pop()
-        fast_log.debug(f'Analyzing {ctx_to_inspect.nice_filename()} for additional archives')
-        for root, _, files in os.walk(ctx_to_inspect.unpacked_dir_location):
-            trace(f'Looking at {root}')
-            for file in files:
-                file_path = os.path.join(root, file)
-                trace(f'Looking at at {file_path}')
-                file_meta = file_data.file_meta_from_path(file_path)
-
-                a_new_ctx = contexts.UnpackContext(file_meta, tmp_dir, parent_ctx=ctx_to_inspect)
+    deduper = dedupe.ArchiveDeduper() if dedupe_archives else None
 
-                trace(f'Got meta from at {file_path}, type is {file_meta.filetype}')
+    detect_pool = _detect_pool
+    if detect_pool is None and detect_jobs > 1:
+        detect_pool = ThreadPoolExecutor(max_workers=detect_jobs, thread_name_prefix='detect')
 
-                if not is_handled_filetype(file_meta) or file_meta.size_raw < min_file_size:
-                    trace('File too small or not handled, moving on')
+    try:
+        # Now walk the unpacked directory and find all relevant archives
+        # Add found archives to inspection list
+        # Go until all archives are unpacked and inspected
+        while len(ctxs_to_inspect) > 0:
+            ctx_to_inspect = ctxs_to_inspect.pop()
+            fast_log.debug(f'Analyzing {ctx_to_inspect.nice_filename()} for additional archives')
+
+            # Files below min_file_size are dropped based on their stat alone, without ever being opened
+            found_files = discovery.iter_files(ctx_to_inspect.unpacked_dir_location, min_file_size)
+
+            # map hands back the results in the order of the walk, no matter which detection finishes first
+            if detect_pool is not None:
+                found_metas = detect_pool.map(_detect, found_files)
+            else:
+                found_metas = map(_detect, found_files)
+
+            for file_meta in found_metas:
+                if not is_handled_filetype(file_meta):
+                    trace('File not handled, moving on')
                     # During recursive unpacking, we need to warn the user if we found a file that was not handled
                     # But meets the filesize requirement
-                    if file_meta.size_raw >= min_file_size:
-                        fast_log.warn(f'Ignoring unhandled large file: {file_path}')
+                    fast_log.warn(f'Ignoring unhandled large file: {file_meta.path}')
                     continue
 
                 # Current is a valid unpackable archive
@@ -225,12 +545,33 @@ def unpack_recursive(parent_filemeta: file_data.FileMetadata, min_file_size: int
                 fast_log.debug(str(file_meta))
                 file_meta.root_meta = parent_filemeta
 
-                try:
+                a_new_ctx = contexts.UnpackContext(file_meta, tmp_dir, parent_ctx=ctx_to_inspect)
 
+                if deduper is not None:
+                    original_ctx = deduper.find_original(a_new_ctx)
+                    if original_ctx is not None:
+                        fast_log.info(f'Not unpacking {a_new_ctx.nice_filename()}, '
+                                      f'it is identical to {original_ctx.nice_filename()}')
+                        original_ctx.aliases.append(a_new_ctx.nice_filename())
+                        continue
+
+                try:
                     a_new_ctx = _do_unpack(a_new_ctx)
-                    unpacked_ctx.append(a_new_ctx)
-                    ctxs_to_inspect.append(a_new_ctx)
                 except ArchiveException as e:
-                    fast_log.warn(f'Unable to unpack {file_path}, got the following error: {e}. Continuing anyway')
+                    fast_log.warn(f'Unable to unpack {file_meta.path}, got the following error: {e}. Continuing anyway')
+                    if deduper is not None:
+                        deduper.forget(a_new_ctx)
+                    continue
+
+                ctxs_to_inspect.append(a_new_ctx)
+                yield a_new_ctx
+
+            if on_inspected is not None:
+                on_inspected(ctx_to_inspect)
+    finally:
+        if detect_pool is not None and detect_pool is not _detect_pool:
+            detect_pool.shutdown(wait=True, cancel_futures=True)
 
-    return unpacked_ctx
+    if deduper is not None and deduper.num_duplicates > 0:
+        fast_log.info(f'Skipped {deduper.num_duplicates} duplicate archive(s), '
+                      f'{humanize.naturalsize(deduper.bytes_saved, binary=True)} in total')
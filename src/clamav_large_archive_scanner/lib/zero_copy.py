@@ -0,0 +1,132 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Copies a range of one file into another without the data ever coming up into python
+# An uncompressed tar member, or a zip member that is only stored, is a single contiguous range of the archive (and a
+# file in an ISO is one or a few), so the kernel can copy it directly, or even just share the blocks on filesystems
+# that support reflinks
+
+import errno
+import os
+from typing import List, Tuple
+
+from clamav_large_archive_scanner.lib.fast_log import trace
+
+# Reserving the space up front only pays off for files big enough to fragment
+PREALLOCATE_MIN_SIZE = 1024 * 1024  # 1MiB
+
+# The most to ask for in one call, the kernel won't do more than just under 2GiB per call anyway
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # 64MiB
+
+# Errors that mean copy_file_range can't be used here (old kernel, across filesystems, or odd files)
+_COPY_FILE_RANGE_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM)
+
+# Flipped off the first time copy_file_range turns out not to work, every copy after that goes straight to sendfile
+_use_copy_file_range = hasattr(os, 'copy_file_range')
+
+
+def preallocate(fd: int, size: int) -> None:
+    """
+    Reserves size bytes for fd, so that the filesystem can lay it out in one go instead of growing it as it is written
+    """
+    if size < PREALLOCATE_MIN_SIZE:
+        return
+
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        # Only a hint, the copy still works without it (IE not enough space left is found out the normal way)
+        trace(f'Unable to preallocate {size} bytes: {e}')
+
+
+def _copy_chunk(src_fd: int, src_offset: int, dst_fd: int, dst_offset: int, size: int) -> int:
+    global _use_copy_file_range
+
+    if _use_copy_file_range:
+        try:
+            return os.copy_file_range(src_fd, dst_fd, size, src_offset, dst_offset)
+        except OSError as e:
+            if e.errno not in _COPY_FILE_RANGE_UNSUPPORTED:
+                raise
+            trace(f'copy_file_range is not usable, falling back to sendfile: {e}')
+            _use_copy_file_range = False
+
+    # sendfile only takes an offset for the source, the destination is written at its current position
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, src_offset, size)
+
+
+def copy_range(src_fd: int, src_offset: int, dst_fd: int, size: int, dst_offset: int = 0) -> int:
+    """
+    Copies size bytes of src_fd starting at src_offset to dst_fd at dst_offset, the position of src_fd is left alone
+    :return: The number of bytes copied, which is less than size if src_fd ended first
+    """
+
+    copied = 0
+    while copied < size:
+        num_copied = _copy_chunk(src_fd, src_offset + copied, dst_fd, dst_offset + copied,
+                                 min(size - copied, COPY_CHUNK_SIZE))
+        if num_copied == 0:
+            break
+        copied += num_copied
+
+    return copied
+
+
+def copy_ranges_to_file(src_fd: int, ranges: List[Tuple[int, int]], target_path: str) -> int:
+    """
+    Creates target_path, containing every (offset, size) range of src_fd one after another
+    :return: The number of bytes copied, which is less than the total size if src_fd ended first
+    """
+
+    total_size = sum(size for _, size in ranges)
+
+    with open(target_path, 'wb') as target:
+        preallocate(target.fileno(), total_size)
+
+        copied = 0
+        for src_offset, size in ranges:
+            num_copied = copy_range(src_fd, src_offset, target.fileno(), size, dst_offset=copied)
+            copied += num_copied
+            if num_copied < size:
+                break
+
+        # Don't leave any preallocated space past the end
+        if copied < total_size:
+            target.truncate(copied)
+
+    return copied
+
+
+def copy_to_file(src_fd: int, src_offset: int, size: int, target_path: str) -> int:
+    """
+    Creates target_path, containing size bytes of src_fd starting at src_offset
+    :return: The number of bytes copied, which is less than size if src_fd ended first
+    """
+
+    return copy_ranges_to_file(src_fd, [(src_offset, size)], target_path)
@@ -25,7 +25,15 @@
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
+import contextlib
+import functools
+import os
+import signal
+import sqlite3
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
 
 import click
 import humanize
@@ -35,13 +43,28 @@ import clamav_large_archive_scanner.lib.file_data as detect
 import clamav_large_archive_scanner.lib.unpack as unpacker
 import clamav_large_archive_scanner.lib.scanner as scanner
 import clamav_large_archive_scanner.lib.contexts as Contexts
+import clamav_large_archive_scanner.lib.pipeline as pipeline
+import clamav_large_archive_scanner.lib.detect_cache as detect_cache
+import clamav_large_archive_scanner.lib.stream_scan as stream_scan
+import clamav_large_archive_scanner.lib.decompress as decompress
+import clamav_large_archive_scanner.lib.guestfs_appliance as guestfs_appliance
+import clamav_large_archive_scanner.lib.tmp_files as tmp_files
+import clamav_large_archive_scanner.lib.tree_delete as tree_delete
+import clamav_large_archive_scanner.lib.serve as server
 
 from clamav_large_archive_scanner.lib import fast_log
+from clamav_large_archive_scanner.lib.exceptions import ArchiveException, IsoException, JobException, MountException
 from clamav_large_archive_scanner.lib.filesize import convert_human_to_machine_bytes
+from clamav_large_archive_scanner.lib.scanner import ScanResult
 
 DEFAULT_MIN_SIZE_THRESHOLD_BYTES = 2 * 1024 * 1024 * 1024  # 2GB
 DEFAULT_MIN_SIZE_HUMAN = humanize.naturalsize(DEFAULT_MIN_SIZE_THRESHOLD_BYTES, binary=True)
 
+DEFAULT_STREAM_CHUNK_SIZE = '1M'
+
+DEFAULT_DETECT_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                    'clamav_large_archive_scanner', 'detect_cache.sqlite')
+
 
 # You'll notice that several functions here are duplicated with _ in front of them
 # This is to make UT easier, as trying to test some of the filesystem interactions is a bit tricky
@@ -60,27 +83,80 @@ def cli(trace, trace_file, verbose, quiet):
         fast_log.log_start(verbose, trace, trace_file)
 
 
+@contextlib.contextmanager
+def _detect_cache(cache_path: Optional[str]):
+    """
+    Uses the detection cache at cache_path for everything done inside the with block
+    :param cache_path: Path of the cache, or None to not use one
+    """
+    if cache_path is None:
+        yield
+        return
+
+    try:
+        cache = detect_cache.DetectCache(cache_path)
+    except (OSError, sqlite3.Error) as e:
+        fast_log.warn(f'Unable to open the detection cache at {cache_path}, continuing without it: {e}')
+        yield
+        return
+
+    detect.use_detect_cache(cache)
+    try:
+        yield
+    finally:
+        detect.use_detect_cache(None)
+        cache.close()
+
+
+def _use_decompressor(gzip_decompressor: str) -> None:
+    if not decompress.is_available(gzip_decompressor):
+        raise click.BadParameter(f'{gzip_decompressor} was not found on the PATH', param_hint='--gzip-decompressor')
+
+    decompress.use_decompressor(gzip_decompressor)
+
+
+def _min_file_size(min_size: str, ignore_size: bool) -> int:
+    if ignore_size:
+        return 0
+
+    try:
+        return convert_human_to_machine_bytes(min_size)
+    except ValueError as e:
+        raise click.BadParameter(f'Unable to parse min-size: {e}')
+
+
+def _stream_chunk_size(chunk_size: str) -> int:
+    try:
+        chunk_size_bytes = int(convert_human_to_machine_bytes(chunk_size))
+    except ValueError as e:
+        raise click.BadParameter(f'Unable to parse stream-chunk-size: {e}')
+
+    if chunk_size_bytes <= 0:
+        raise click.BadParameter(f'stream-chunk-size needs to be at least 1 byte')
+
+    return chunk_size_bytes
+
+
 # Since this is used multiple times, logic is held here
-def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_dir: str) -> list[Contexts.UnpackContext]:
+def _iter_unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_dir: str,
+                 eager_cleaner: Optional[cleaner.EagerCleaner] = None, detect_jobs: int = 1,
+                 dedupe_archives: bool = False) -> Iterator[Contexts.UnpackContext]:
     """
     :param path: Path to unpack
     :param recursive: Whether to recursively unpack
     :param min_size: Minimum file size to unpack
     :param tmp_dir: Temporary directory to unpack to
-    :return: A list of unpacked directories
+    :param eager_cleaner: If set, is told about every context unpacked, and when each was fully inspected
+    :param detect_jobs: Number of files to detect the filetype of at the same time during recursive unpacking
+    :param dedupe_archives: Only unpack one copy of identical archives during recursive unpacking
+    :return: Every unpacked context, as soon as it has been unpacked
     """
 
     file_meta = detect.file_meta_from_path(path)
 
     fast_log.debug(f'Got file metadata: \n{file_meta}')
 
-    if ignore_size:
-        min_file_size = 0
-    else:
-        try:
-            min_file_size = convert_human_to_machine_bytes(min_size)
-        except ValueError as e:
-            raise click.BadParameter(f'Unable to parse min-size: {e}')
+    min_file_size = _min_file_size(min_size, ignore_size)
 
     # In the special case where a directory is specified, we're just going to do recursive unpack on the dir
     if file_meta.filetype == detect.FileType.DIR:
@@ -92,20 +168,32 @@ def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_di
         if file_meta.size_raw < min_file_size:
             fast_log.warn(
                 f'File size is below the threshold of {humanize.naturalsize(min_file_size)}, not unpacking. See help for options')
-            return []
+            return
 
-    unpack_ctxs = []
+    on_inspected = eager_cleaner.inspected if eager_cleaner else None
 
     if recursive:
-        unpack_ctxs = unpacker.unpack_recursive(file_meta, min_file_size, tmp_dir)
-        fast_log.info('Found and unpacked the following:')
-        fast_log.info('\n'.join([str(u_ctx) for u_ctx in unpack_ctxs]))
+        for u_ctx in unpacker.unpack_recursive(file_meta, min_file_size, tmp_dir, on_inspected=on_inspected,
+                                               detect_jobs=detect_jobs, dedupe_archives=dedupe_archives):
+            fast_log.info(f'Unpacked {u_ctx}')
+            if eager_cleaner:
+                eager_cleaner.unpacked(u_ctx)
+            yield u_ctx
     else:
         u_ctx = unpacker.unpack(file_meta, tmp_dir)
         fast_log.info(f'Unpacked {u_ctx}')
-        unpack_ctxs.append(u_ctx)
+        yield u_ctx
 
-    return unpack_ctxs
+
+def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_dir: str,
+            detect_jobs: int = 1, dedupe_archives: bool = False) -> list[Contexts.UnpackContext]:
+    """
+    Same as _iter_unpack, but only returns once everything has been unpacked
+    :return: A list of unpacked directories
+    """
+
+    return list(_iter_unpack(path, recursive, min_size, ignore_size, tmp_dir, detect_jobs=detect_jobs,
+                             dedupe_archives=dedupe_archives))
 
 
 @cli.command()
@@ -118,8 +206,31 @@ def _unpack(path: str, recursive: bool, min_size: str, ignore_size: bool, tmp_di
               help='Ignore file size lower limit (equivalent to --min-size=0).')
 @click.option('--tmp-dir', default='/tmp', type=click.Path(resolve_path=True),
               help='Directory to unpack files to (default: /tmp).')
-def unpack(path, recursive, min_size, ignore_size, tmp_dir):
-    _unpack(path, recursive, min_size, ignore_size, tmp_dir)
+@click.option('--detect-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of files to detect the type of at the same time when unpacking recursively (default: 1).')
+@click.option('--detect-cache', 'detect_cache_path', default=DEFAULT_DETECT_CACHE, type=click.Path(resolve_path=True),
+              help='File to cache detected file types in, for files that have not changed since the last run '
+                   '(default: clamav_large_archive_scanner/detect_cache.sqlite in $XDG_CACHE_HOME or ~/.cache).')
+@click.option('--no-detect-cache', default=False, is_flag=True, help='Do not use the detection cache.')
+@click.option('--dedupe', 'dedupe_archives', default=False, is_flag=True,
+              help='Only unpack the first of any nested archives with identical content.')
+@click.option('--gzip-decompressor', default=decompress.DECOMPRESSOR_AUTO,
+              type=click.Choice(decompress.DECOMPRESSOR_CHOICES),
+              help='What decompresses tar.gz archives, auto picks the first of igzip and pigz that is installed, '
+                   'before falling back to python (default: auto).')
+@click.option('--guestfs-appliance', 'guestfs_appliance_path', default=None,
+              type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help='Directory with a fixed libguestfs appliance in it, used for VMDK and QCOW2 images instead of '
+                   'building one with supermin (default: $LIBGUESTFS_PATH, if set).')
+@click.option('--guestfs-cache-dir', default=None, type=click.Path(file_okay=False, resolve_path=True),
+              help='Where the libguestfs appliance built by supermin is cached between runs '
+                   '(default: $LIBGUESTFS_CACHEDIR, or $TMPDIR).')
+def unpack(path, recursive, min_size, ignore_size, tmp_dir, detect_jobs, detect_cache_path, no_detect_cache,
+           dedupe_archives, gzip_decompressor, guestfs_appliance_path, guestfs_cache_dir):
+    _use_decompressor(gzip_decompressor)
+    guestfs_appliance.use_appliance(guestfs_appliance_path, guestfs_cache_dir)
+    with _detect_cache(None if no_detect_cache else detect_cache_path):
+        _unpack(path, recursive, min_size, ignore_size, tmp_dir, detect_jobs, dedupe_archives)
 
 
 def _cleanup(path, is_file, tmp_dir):
@@ -130,6 +241,7 @@ def _cleanup(path, is_file, tmp_dir):
     else:
         cleaner.cleanup_path(path)
 
+    tree_delete.wait_for_deletes()
     fast_log.info(f'Cleaned up  {path}')
 
 
@@ -142,64 +254,640 @@ def cleanup(path, is_file, tmp_dir):
     _cleanup(path, is_file, tmp_dir)
 
 
-def _scan(path, min_size, ignore_size, fail_fast, all_match, tmp_dir) -> int:
-    if not scanner.validate_clamdscan():
+def _scan_unpacked(path, unpacked_ctxs, fail_fast, all_match, tmp_dir, clamd_socket, scan_jobs,
+                   fdpass=False) -> List[ScanResult]:
+    # scan the unpacked dirs
+    if len(unpacked_ctxs) == 0:
+        # Nothing was unpacked, just run a single clamdscan on the file
+        single_ctx = Contexts.UnpackContext(detect.file_meta_from_path(path), tmp_dir)
+        single_ctx.unpacked_dir_location = path
+        unpacked_ctxs = [single_ctx]
+
+    return scanner.clamdscan(unpacked_ctxs, fail_fast, all_match, clamd_socket=clamd_socket, scan_jobs=scan_jobs,
+                             fdpass=fdpass)
+
+
+def _pipelined_scan(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, clamd_socket, scan_jobs,
+                    pipeline_depth, eager_cleanup=False, detect_jobs=1, dedupe_archives=False,
+                    fdpass=False) -> List[ScanResult]:
+    eager_cleaner = cleaner.EagerCleaner(tmp_dir) if eager_cleanup else None
+    on_scanned = eager_cleaner.scanned if eager_cleaner else None
+
+    # Unpacking runs on its own thread, and never gets more than pipeline_depth archives ahead of the scanner
+    unpack_stage = _iter_unpack(path, True, min_size, ignore_size, tmp_dir, eager_cleaner, detect_jobs,
+                                dedupe_archives)
+
+    with pipeline.BoundedPipeline(unpack_stage, pipeline_depth, name='unpacker') as unpacked_ctxs:
+        scan_results = scanner.clamdscan(unpacked_ctxs, fail_fast, all_match, clamd_socket=clamd_socket,
+                                         scan_jobs=scan_jobs, on_scanned=on_scanned, fdpass=fdpass)
+
+    if eager_cleaner:
+        eager_cleaner.log_peak_usage()
+
+    if len(scan_results) > 0:
+        return scan_results
+
+    # Either nothing was unpacked, or the file is too small to be unpacked
+    return _scan_unpacked(path, [], fail_fast, all_match, tmp_dir, clamd_socket, scan_jobs, fdpass)
+
+
+def _stream_scan(path, min_size, ignore_size, fail_fast, tmp_dir, clamd_socket, scan_jobs, detect_jobs,
+                 dedupe_archives, stream_jobs, fdpass=False,
+                 stream_chunk_size=DEFAULT_STREAM_CHUNK_SIZE) -> Optional[List[ScanResult]]:
+    """
+    :return: The scan results, or None if the file can't be streamed and needs to be scanned the usual way
+    """
+
+    chunk_size = _stream_chunk_size(stream_chunk_size)
+
+    file_meta = detect.file_meta_from_path(path)
+    if not stream_scan.can_stream(file_meta):
+        fast_log.info(f'Only tar and zip archives, ISO 9660 images, and disk images when the libguestfs python bindings '
+                      f'are installed can be streamed, falling back to unpacking {path}')
+        return None
+
+    min_file_size = _min_file_size(min_size, ignore_size)
+    if file_meta.size_raw < min_file_size:
+        return None
+
+    return stream_scan.stream_scan(file_meta, clamd_socket, min_file_size, tmp_dir, fail_fast=fail_fast,
+                                   scan_jobs=scan_jobs, detect_jobs=detect_jobs, dedupe_archives=dedupe_archives,
+                                   stream_jobs=stream_jobs, fdpass=fdpass, chunk_size=chunk_size)
+
+
+def _validate_scanner(clamd_socket) -> None:
+    if clamd_socket:
+        if not scanner.validate_clamd(clamd_socket):
+            raise click.ClickException(f'Unable to reach clamd at {clamd_socket}, please check that it is running')
+    elif not scanner.validate_clamdscan():
         raise click.ClickException(f'Unable to find clamdscan, please install it and try again')
 
+
+def _validate_scan_options(fail_fast, all_match, clamd_socket, stream, fdpass) -> None:
     # all-match and ff cannot be both active
     if all_match and fail_fast:
         raise click.ClickException(f'Cannot specify both --allmatch and --fail-fast')
 
-    # recursively unpack the file
-    unpacked_ctxs = _unpack(path, True, min_size, ignore_size, tmp_dir)
+    if stream and not clamd_socket:
+        raise click.ClickException(f'--stream needs --clamd-socket, clamdscan can only scan files on disk')
 
-    # scan the unpacked dirs
-    if len(unpacked_ctxs) == 0:
-        # Nothing was unpacked, just run a single clamdscan on the file
-        single_ctx = Contexts.UnpackContext(detect.file_meta_from_path(path), tmp_dir)
-        single_ctx.unpacked_dir_location = path
-        scan_results = scanner.clamdscan([single_ctx], fail_fast, all_match)
+    # Streamed files are scanned by INSTREAM, which has no equivalent of --allmatch
+    if stream and all_match:
+        raise click.ClickException(f'Cannot specify both --allmatch and --stream')
+
+    if fdpass and not scanner.validate_fdpass(clamd_socket):
+        raise click.ClickException(f'--fdpass needs clamd\'s LocalSocket, descriptors can\'t be passed over TCP')
+
+    # FILDES has no equivalent of --allmatch either
+    if fdpass and all_match:
+        raise click.ClickException(f'Cannot specify both --allmatch and --fdpass')
+
+    # clamd gets handed the open files, so nobody else needs to be able to read what we unpack
+    if fdpass:
+        tmp_files.use_private_dirs(True)
+
+
+def _validate_scan(fail_fast, all_match, clamd_socket, stream, fdpass) -> None:
+    """
+    Everything that only needs to be checked once, no matter how many archives get scanned
+    """
+    _validate_scanner(clamd_socket)
+    _validate_scan_options(fail_fast, all_match, clamd_socket, stream, fdpass)
+
+
+def _scan_archive(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, clamd_socket=None, scan_jobs=1,
+                  pipeline_depth=0, eager_cleanup=False, detect_jobs=1, dedupe_archives=False, stream=False,
+                  stream_jobs=1, fdpass=False, stream_chunk_size=DEFAULT_STREAM_CHUNK_SIZE) -> List[ScanResult]:
+    """
+    Scans a single path, and cleans up everything unpacked from it. Expects _validate_scan to have been called
+    """
+
+    # Eager cleanup only makes sense if scanning starts before everything is unpacked
+    if eager_cleanup and pipeline_depth == 0:
+        pipeline_depth = 1
+
+    scan_results = None
+    if stream:
+        scan_results = _stream_scan(path, min_size, ignore_size, fail_fast, tmp_dir, clamd_socket, scan_jobs,
+                                    detect_jobs, dedupe_archives, stream_jobs, fdpass, stream_chunk_size)
+
+    if scan_results is not None:
+        # Streamed, nothing to unpack
+        pass
+    elif pipeline_depth > 0:
+        scan_results = _pipelined_scan(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, clamd_socket,
+                                       scan_jobs, pipeline_depth, eager_cleanup, detect_jobs, dedupe_archives, fdpass)
     else:
-        scan_results = scanner.clamdscan(unpacked_ctxs, fail_fast, all_match)
+        # recursively unpack the file
+        unpacked_ctxs = _unpack(path, True, min_size, ignore_size, tmp_dir, detect_jobs, dedupe_archives)
+        scan_results = _scan_unpacked(path, unpacked_ctxs, fail_fast, all_match, tmp_dir, clamd_socket, scan_jobs,
+                                      fdpass)
 
     # Cleanup
     cleaner.cleanup_recursive(path, tmp_dir)
 
-    # Log scan results
+    return scan_results
+
+
+def _log_scan_results(scan_results: List[ScanResult]) -> None:
     fast_log.info('=' * 80)
     fast_log.info('Scan Results, showing path and clamdscan return code')
     for result in scan_results:
         fast_log.info(str(result))
     fast_log.info('=' * 80)
 
-    # return value of scan is the "worst" result of the scan, virus > error > clean
-    has_virus = any([result.clamdscan_rv == 1 for result in scan_results])
-    if has_virus:
+
+def _worst_rv(rvs: Iterable[int]) -> int:
+    """
+    :return: The "worst" of the return codes, virus > error > clean
+    """
+    rvs = set(rvs)
+
+    if 1 in rvs:
         return 1
 
-    has_error = any([result.clamdscan_rv == 2 for result in scan_results])
-    if has_error:
+    if 2 in rvs:
         return 2
 
     return 0
 
 
+def _scan(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, clamd_socket=None, scan_jobs=1,
+          pipeline_depth=0, eager_cleanup=False, detect_jobs=1, dedupe_archives=False, stream=False,
+          stream_jobs=1, fdpass=False, stream_chunk_size=DEFAULT_STREAM_CHUNK_SIZE) -> int:
+    _validate_scan(fail_fast, all_match, clamd_socket, stream, fdpass)
+
+    scan_results = _scan_archive(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, clamd_socket, scan_jobs,
+                                 pipeline_depth, eager_cleanup, detect_jobs, dedupe_archives, stream, stream_jobs,
+                                 fdpass, stream_chunk_size)
+
+    # Log scan results
+    _log_scan_results(scan_results)
+
+    # Only wait for the temp dirs to be deleted once the results are out
+    tree_delete.wait_for_deletes()
+
+    # return value of scan is the "worst" result of the scan, virus > error > clean
+    return _worst_rv(result.clamdscan_rv for result in scan_results)
+
+
+# Shared by scan and scan-batch, everything but what is being scanned
+_SCAN_OPTIONS = [
+    click.option('--min-size', default=DEFAULT_MIN_SIZE_THRESHOLD_BYTES,
+                 help=f'Minimum file size to unpack (default: {DEFAULT_MIN_SIZE_HUMAN}).', type=str),
+    click.option('--ignore-size', default=False, is_flag=True,
+                 help='Ignore file size lower limit (equivalent to --min-size=0).'),
+    click.option('--tmp-dir', default='/tmp', type=click.Path(resolve_path=True),
+                 help='Temporary working directory (default: /tmp).'),
+    click.option('-ff', '--fail-fast', default=False, is_flag=True,
+                 help='Stop scanning after the first failure, cancelling any scans still in flight.'),
+    click.option('--allmatch', default=False, is_flag=True,
+                 help='Continue scanning if a signature match occurs.'),
+    click.option('--clamd-socket', default=None, envvar='CLAMD_SOCKET',
+                 help='Talk to clamd directly through this LocalSocket path or TCPSocket HOST:PORT '
+                      '(default: run clamdscan).'),
+    click.option('--scan-jobs', default=1, type=click.IntRange(min=1),
+                 help='Number of unpacked archives to scan at the same time (default: 1).'),
+    click.option('--pipeline-depth', default=0, type=click.IntRange(min=0),
+                 help='Start scanning while unpacking continues, with at most this many unpacked archives waiting '
+                      'to be scanned (default: 0, unpack everything before scanning).'),
+    click.option('--eager-cleanup', default=False, is_flag=True,
+                 help='Clean up each unpacked archive as soon as it and everything inside it has been scanned, '
+                      'and report the peak temp usage. Implies --pipeline-depth=1 if not set.'),
+    click.option('--detect-jobs', default=1, type=click.IntRange(min=1),
+                 help='Number of files to detect the type of at the same time when unpacking (default: 1).'),
+    click.option('--detect-cache', 'detect_cache_path', default=DEFAULT_DETECT_CACHE,
+                 type=click.Path(resolve_path=True),
+                 help='File to cache detected file types in, for files that have not changed since the last run '
+                      '(default: clamav_large_archive_scanner/detect_cache.sqlite in $XDG_CACHE_HOME or ~/.cache).'),
+    click.option('--no-detect-cache', default=False, is_flag=True, help='Do not use the detection cache.'),
+    click.option('--dedupe', 'dedupe_archives', default=False, is_flag=True,
+                 help='Only unpack and scan the first of any nested archives with identical content, the results '
+                      'list the others as identical copies.'),
+    click.option('--stream', default=False, is_flag=True,
+                 help='Stream the members of tar and zip archives, ISO images, and VMDK and QCOW2 images (through '
+                      'the libguestfs python bindings, without mounting them) straight to clamd instead of unpacking '
+                      'them to disk, needs --clamd-socket. Other kinds of files are unpacked as usual.'),
+    click.option('--stream-jobs', default=1, type=click.IntRange(min=1),
+                 help='Number of processes streaming zip members to clamd at the same time (default: 1).'),
+    click.option('--stream-chunk-size', default=DEFAULT_STREAM_CHUNK_SIZE, type=str,
+                 help=f'Size of the chunks streamed to clamd, larger chunks take fewer system calls. The total '
+                      f'streamed per file is still limited by clamd\'s StreamMaxLength '
+                      f'(default: {DEFAULT_STREAM_CHUNK_SIZE}).'),
+    click.option('--gzip-decompressor', default=decompress.DECOMPRESSOR_AUTO,
+                 type=click.Choice(decompress.DECOMPRESSOR_CHOICES),
+                 help='What decompresses tar.gz archives, auto picks the first of igzip and pigz that is installed, '
+                      'before falling back to python (default: auto).'),
+    click.option('--fdpass', default=False, is_flag=True,
+                 help='Open the files to scan ourselves and pass them to clamd, so that clamd does not need to be '
+                      'able to read them and nothing unpacked is made readable by others. Needs clamd\'s '
+                      'LocalSocket.'),
+    click.option('--guestfs-appliance', 'guestfs_appliance_path', default=None,
+                 type=click.Path(exists=True, file_okay=False, resolve_path=True),
+                 help='Directory with a fixed libguestfs appliance in it, used for VMDK and QCOW2 images instead of '
+                      'building one with supermin (default: $LIBGUESTFS_PATH, if set).'),
+    click.option('--guestfs-cache-dir', default=None, type=click.Path(file_okay=False, resolve_path=True),
+                 help='Where the libguestfs appliance built by supermin is cached between runs '
+                      '(default: $LIBGUESTFS_CACHEDIR, or $TMPDIR).'),
+]
+
+
+def _scan_options(func):
+    for option in reversed(_SCAN_OPTIONS):
+        func = option(func)
+    return func
+
+
 @cli.command()
 @click.argument('path', type=click.Path(exists=True, resolve_path=True))
-@click.option('--min-size', default=DEFAULT_MIN_SIZE_THRESHOLD_BYTES,
-              help=f'Minimum file size to unpack (default: {DEFAULT_MIN_SIZE_HUMAN}).', type=str)
-@click.option('--ignore-size', default=False, is_flag=True,
-              help='Ignore file size lower limit (equivalent to --min-size=0).')
-@click.option('--tmp-dir', default='/tmp', type=click.Path(resolve_path=True),
-              help='Temporary working directory (default: /tmp).')
-@click.option('-ff', '--fail-fast', default=False, is_flag=True,
-              help='Stop scanning after the first failure.')
-@click.option('--allmatch', default=False, is_flag=True,
-              help='Continue scanning if a signature match occurs.')
-def scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir):
-    rv = _scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir)
+@_scan_options
+def scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir, clamd_socket, scan_jobs, pipeline_depth,
+         eager_cleanup, detect_jobs, detect_cache_path, no_detect_cache, dedupe_archives, stream, stream_jobs,
+         stream_chunk_size, gzip_decompressor, fdpass, guestfs_appliance_path, guestfs_cache_dir):
+    _use_decompressor(gzip_decompressor)
+    guestfs_appliance.use_appliance(guestfs_appliance_path, guestfs_cache_dir)
+    with _detect_cache(None if no_detect_cache else detect_cache_path):
+        rv = _scan(path, min_size, ignore_size, fail_fast, allmatch, tmp_dir, clamd_socket, scan_jobs, pipeline_depth,
+                   eager_cleanup, detect_jobs, dedupe_archives, stream, stream_jobs, fdpass, stream_chunk_size)
     sys.exit(rv)
 
 
+# What scanning a single archive can fail with, without it being a bug
+_ARCHIVE_ERRORS = (click.ClickException, ArchiveException, IsoException, MountException, OSError)
+
+
+def _read_manifest(manifest: BinaryIO, null_separated: bool) -> Iterator[str]:
+    """
+    :param manifest: One path per line, or separated by NUL bytes, like find -print0 writes them
+    :param null_separated: If true, paths are separated by NUL bytes, so they can contain newlines
+    """
+
+    separator = b'\0' if null_separated else b'\n'
+    for entry in manifest.read().split(separator):
+        if not null_separated:
+            entry = entry.rstrip(b'\r')
+
+        if len(entry) > 0:
+            yield os.fsdecode(entry)
+
+
+def _batch_paths(paths: Iterable[str], manifest: Optional[BinaryIO], null_separated: bool) -> List[str]:
+    """
+    :return: The paths to scan, in the order given, each only once. Two scans of the same file would clean up
+             each other's temp dirs
+    """
+
+    all_paths = list(paths)
+    if manifest is not None:
+        all_paths += [os.path.realpath(a_path) for a_path in _read_manifest(manifest, null_separated)]
+
+    return list(dict.fromkeys(all_paths))
+
+
+@contextlib.contextmanager
+def _shared_pools(scan_jobs: int, detect_jobs: int):
+    """
+    Every archive scanned inside the with block shares the same scan_jobs scanning and detect_jobs detection workers
+    """
+    scan_pool = ThreadPoolExecutor(max_workers=scan_jobs, thread_name_prefix='clamdscan')
+    detect_pool = None
+    if detect_jobs > 1:
+        detect_pool = ThreadPoolExecutor(max_workers=detect_jobs, thread_name_prefix='detect')
+
+    scanner.use_scan_pool(scan_pool)
+    unpacker.use_detect_pool(detect_pool)
+    try:
+        yield
+    finally:
+        scanner.use_scan_pool(None)
+        unpacker.use_detect_pool(None)
+        scan_pool.shutdown(wait=True, cancel_futures=True)
+        if detect_pool is not None:
+            detect_pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _scan_batch_archive(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, *scan_args) -> int:
+    """
+    Same as _scan, but failing to scan path is only an error for path, and doesn't stop the rest of the batch
+    """
+
+    # Paths from the command line were checked by click, but not the ones from the manifest
+    if not os.path.exists(path):
+        fast_log.error(f'{path} does not exist, not scanning it')
+        return 2
+
+    try:
+        scan_results = _scan_archive(path, min_size, ignore_size, fail_fast, all_match, tmp_dir, *scan_args)
+    except _ARCHIVE_ERRORS as e:
+        message = e.format_message() if isinstance(e, click.ClickException) else str(e)
+        fast_log.error(f'Unable to scan {path}: {message}')
+        cleaner.cleanup_recursive(path, tmp_dir)
+        return 2
+
+    _log_scan_results(scan_results)
+
+    return _worst_rv(result.clamdscan_rv for result in scan_results)
+
+
+def _scan_batch(paths, batch_jobs, min_size, ignore_size, fail_fast, all_match, tmp_dir, clamd_socket=None,
+                scan_jobs=1, pipeline_depth=0, eager_cleanup=False, detect_jobs=1, dedupe_archives=False, stream=False,
+                stream_jobs=1, fdpass=False, stream_chunk_size=DEFAULT_STREAM_CHUNK_SIZE) -> int:
+    """
+    Scans every path in the same process, batch_jobs archives at a time. Every archive shares the same scan_jobs
+    scanning workers and detect_jobs detection workers, so that they are limits for the whole batch
+    Each archive's return code is printed as soon as it is done, as the code, a tab, and the path
+    :return: The "worst" return code of all the archives, same as _scan
+    """
+
+    _validate_scan(fail_fast, all_match, clamd_socket, stream, fdpass)
+
+    # Bad sizes would otherwise fail every archive one by one
+    _min_file_size(min_size, ignore_size)
+    if stream:
+        _stream_chunk_size(stream_chunk_size)
+
+    if len(paths) == 0:
+        fast_log.warn('No paths to scan')
+        return 0
+
+    rvs = {}  # type: dict[str, int]
+    with _shared_pools(scan_jobs, detect_jobs):
+        with ThreadPoolExecutor(max_workers=batch_jobs, thread_name_prefix='scan-batch') as batch_pool:
+            futures = {batch_pool.submit(_scan_batch_archive, a_path, min_size, ignore_size, fail_fast, all_match,
+                                         tmp_dir, clamd_socket, scan_jobs, pipeline_depth, eager_cleanup,
+                                         detect_jobs, dedupe_archives, stream, stream_jobs, fdpass,
+                                         stream_chunk_size): a_path
+                       for a_path in paths}
+
+            for future in as_completed(futures):
+                a_path = futures[future]
+                rvs[a_path] = future.result()
+                click.echo(f'{rvs[a_path]}\t{a_path}')
+
+    fast_log.info('=' * 80)
+    fast_log.info(f'Batch Results, scanned {len(rvs)} path(s)')
+    for rv, description in [(1, 'with virus(es) found'), (2, 'with errors'), (0, 'clean')]:
+        fast_log.info(f'{len([a_rv for a_rv in rvs.values() if a_rv == rv])} {description}')
+    fast_log.info('=' * 80)
+
+    tree_delete.wait_for_deletes()
+
+    return _worst_rv(rvs.values())
+
+
+@cli.command(name='scan-batch')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, resolve_path=True))
+@click.option('--manifest', default=None, type=click.File('rb'),
+              help='File listing more paths to scan, one per line, - for stdin. With no paths and no manifest, '
+                   'the paths are read from stdin.')
+@click.option('-0', '--null', 'null_separated', default=False, is_flag=True,
+              help='Paths in the manifest are separated by NUL bytes instead of newlines, like find -print0.')
+@click.option('--batch-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of paths to unpack and scan at the same time, all of them sharing the --scan-jobs and '
+                   '--detect-jobs workers (default: 1).')
+@_scan_options
+def scan_batch(paths, manifest, null_separated, batch_jobs, min_size, ignore_size, fail_fast, allmatch, tmp_dir,
+               clamd_socket, scan_jobs, pipeline_depth, eager_cleanup, detect_jobs, detect_cache_path,
+               no_detect_cache, dedupe_archives, stream, stream_jobs, stream_chunk_size, gzip_decompressor, fdpass,
+               guestfs_appliance_path, guestfs_cache_dir):
+    if len(paths) == 0 and manifest is None:
+        stdin = click.get_binary_stream('stdin')
+        if stdin.isatty():
+            raise click.UsageError('No paths to scan, pass them as arguments, with --manifest, or on stdin')
+        manifest = stdin
+
+    batch_paths = _batch_paths(paths, manifest, null_separated)
+
+    _use_decompressor(gzip_decompressor)
+    guestfs_appliance.use_appliance(guestfs_appliance_path, guestfs_cache_dir)
+    with _detect_cache(None if no_detect_cache else detect_cache_path):
+        rv = _scan_batch(batch_paths, batch_jobs, min_size, ignore_size, fail_fast, allmatch, tmp_dir, clamd_socket,
+                         scan_jobs, pipeline_depth, eager_cleanup, detect_jobs, dedupe_archives, stream, stream_jobs,
+                         fdpass, stream_chunk_size)
+    sys.exit(rv)
+
+
+# What each command of the serve protocol can be given, along with its default. Anything that needs to be the same
+# for every job, like the tmp dir and the number of workers, is only set when starting the server
+_SERVE_SCAN_OPTIONS = {
+    'min_size': DEFAULT_MIN_SIZE_THRESHOLD_BYTES,
+    'ignore_size': False,
+    'fail_fast': False,
+    'allmatch': False,
+    'pipeline_depth': 0,
+    'eager_cleanup': False,
+    'dedupe': False,
+    'stream': False,
+}
+
+_SERVE_UNPACK_OPTIONS = {
+    'recursive': False,
+    'min_size': DEFAULT_MIN_SIZE_THRESHOLD_BYTES,
+    'ignore_size': False,
+    'dedupe': False,
+}
+
+_SERVE_CLEANUP_OPTIONS = {
+    'file': False,
+}
+
+# Paths that a job is running on, two jobs on the same path would clean up each other's temp dirs
+_busy_paths = set()  # type: set[str]
+_busy_paths_changed = threading.Condition()
+
+
+@contextlib.contextmanager
+def _path_lock(path: str):
+    """
+    Waits for any other job on path to finish first
+    """
+    with _busy_paths_changed:
+        while path in _busy_paths:
+            _busy_paths_changed.wait()
+        _busy_paths.add(path)
+
+    try:
+        yield
+    finally:
+        with _busy_paths_changed:
+            _busy_paths.discard(path)
+            _busy_paths_changed.notify_all()
+
+
+def _job_request(request: dict, defaults: dict) -> Tuple[str, dict]:
+    """
+    :return: The path from a serve request, and its options, with the defaults filled in
+    """
+
+    path = request.get('path')
+    if not isinstance(path, str) or not os.path.isabs(path):
+        raise click.ClickException('path needs to be an absolute path')
+
+    path = os.path.realpath(path)
+    if not os.path.exists(path):
+        raise click.ClickException(f'{path} does not exist')
+
+    options = dict(defaults)
+    for name, value in request.items():
+        if name == 'path':
+            continue
+
+        if name not in defaults:
+            raise click.ClickException(f'Unknown option: {name}, expected one of: {", ".join(defaults.keys())}')
+
+        # bool is a subclass of int, so it has to be ruled out by hand
+        if isinstance(defaults[name], bool):
+            is_valid = isinstance(value, bool)
+        elif name == 'min_size':
+            # Either a number of bytes, or the same as on the command line
+            is_valid = isinstance(value, (int, str)) and not isinstance(value, bool)
+        else:
+            is_valid = isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+        if not is_valid:
+            raise click.ClickException(f'Invalid value for {name}: {value!r}')
+
+        options[name] = value
+
+    if 'min_size' in options:
+        options['min_size'] = str(options['min_size'])
+
+    return path, options
+
+
+def _serve_scan(tmp_dir, clamd_socket, scan_jobs, detect_jobs, stream_jobs, fdpass, stream_chunk_size,
+                request: dict) -> dict:
+    path, options = _job_request(request, _SERVE_SCAN_OPTIONS)
+    _validate_scan_options(options['fail_fast'], options['allmatch'], clamd_socket, options['stream'], fdpass)
+
+    with _path_lock(path):
+        try:
+            scan_results = _scan_archive(path, options['min_size'], options['ignore_size'], options['fail_fast'],
+                                         options['allmatch'], tmp_dir, clamd_socket, scan_jobs,
+                                         options['pipeline_depth'], options['eager_cleanup'], detect_jobs,
+                                         options['dedupe'], options['stream'], stream_jobs, fdpass, stream_chunk_size)
+        except _ARCHIVE_ERRORS:
+            # Whatever was unpacked before it failed would otherwise be left behind
+            cleaner.cleanup_recursive(path, tmp_dir)
+            raise
+
+    _log_scan_results(scan_results)
+
+    return {
+        'rv': _worst_rv(result.clamdscan_rv for result in scan_results),
+        'results': [{'path': result.path, 'rv': result.clamdscan_rv, 'aliases': result.aliases}
+                    for result in scan_results],
+    }
+
+
+def _serve_unpack(tmp_dir, detect_jobs, request: dict) -> dict:
+    path, options = _job_request(request, _SERVE_UNPACK_OPTIONS)
+
+    with _path_lock(path):
+        unpacked_ctxs = _unpack(path, options['recursive'], options['min_size'], options['ignore_size'], tmp_dir,
+                                detect_jobs, options['dedupe'])
+
+    return {'unpacked': [{'path': u_ctx.nice_filename(), 'dir': u_ctx.unpacked_dir_location}
+                         for u_ctx in unpacked_ctxs]}
+
+
+def _serve_cleanup(tmp_dir, request: dict) -> dict:
+    path, options = _job_request(request, _SERVE_CLEANUP_OPTIONS)
+
+    with _path_lock(path):
+        _cleanup(path, options['file'], tmp_dir)
+
+    return {}
+
+
+def _after_serve_job() -> None:
+    tree_delete.wait_for_deletes()
+    cache = detect.get_detect_cache()
+    if cache is not None:
+        cache.flush()
+
+
+def _serve(socket_path, max_jobs, tmp_dir, clamd_socket=None, scan_jobs=1, detect_jobs=1, stream_jobs=1,
+           fdpass=False, stream_chunk_size=DEFAULT_STREAM_CHUNK_SIZE) -> None:
+    _validate_scanner(clamd_socket)
+    _validate_scan_options(False, False, clamd_socket, False, fdpass)
+    _stream_chunk_size(stream_chunk_size)
+
+    handlers = {
+        'scan': functools.partial(_serve_scan, tmp_dir, clamd_socket, scan_jobs, detect_jobs, stream_jobs, fdpass,
+                                  stream_chunk_size),
+        'unpack': functools.partial(_serve_unpack, tmp_dir, detect_jobs),
+        'cleanup': functools.partial(_serve_cleanup, tmp_dir),
+    }
+
+    # Deleting temp dirs is waited on after each job, so that the server's disk usage doesn't creep up under load,
+    # and what the job added to the detection cache is written out for other processes using it
+    job_server = server.JobServer(socket_path, handlers, max_jobs, after_job=_after_serve_job)
+    try:
+        job_server.start()
+    except (JobException, OSError) as e:
+        raise click.ClickException(f'Unable to listen on {socket_path}: {e}')
+
+    # shutdown() waits for serve_forever() to return, so it can't be called from the signal handler's thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=job_server.shutdown).start())
+
+    with _shared_pools(scan_jobs, detect_jobs):
+        fast_log.info(f'Listening on {socket_path}, running up to {max_jobs} job(s) at a time')
+        try:
+            job_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fast_log.info('Shutting down, waiting for the running jobs to finish')
+            job_server.close()
+
+    tree_delete.wait_for_deletes()
+
+
+@cli.command()
+@click.argument('socket_path', type=click.Path(dir_okay=False, resolve_path=True))
+@click.option('--jobs', 'max_jobs', default=1, type=click.IntRange(min=1),
+              help='Number of jobs to run at the same time, the rest are queued (default: 1).')
+@click.option('--tmp-dir', default='/tmp', type=click.Path(resolve_path=True),
+              help='Temporary working directory, for every job (default: /tmp).')
+@click.option('--clamd-socket', default=None, envvar='CLAMD_SOCKET',
+              help='Talk to clamd directly through this LocalSocket path or TCPSocket HOST:PORT '
+                   '(default: run clamdscan).')
+@click.option('--scan-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of unpacked archives to scan at the same time, shared by every job (default: 1).')
+@click.option('--detect-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of files to detect the type of at the same time, shared by every job (default: 1).')
+@click.option('--detect-cache', 'detect_cache_path', default=DEFAULT_DETECT_CACHE, type=click.Path(resolve_path=True),
+              help='File to cache detected file types in, for files that have not changed since the last run '
+                   '(default: clamav_large_archive_scanner/detect_cache.sqlite in $XDG_CACHE_HOME or ~/.cache).')
+@click.option('--no-detect-cache', default=False, is_flag=True, help='Do not use the detection cache.')
+@click.option('--stream-jobs', default=1, type=click.IntRange(min=1),
+              help='Number of processes streaming zip members to clamd at the same time, for each job that '
+                   'streams (default: 1).')
+@click.option('--stream-chunk-size', default=DEFAULT_STREAM_CHUNK_SIZE, type=str,
+              help=f'Size of the chunks streamed to clamd (default: {DEFAULT_STREAM_CHUNK_SIZE}).')
+@click.option('--gzip-decompressor', default=decompress.DECOMPRESSOR_AUTO,
+              type=click.Choice(decompress.DECOMPRESSOR_CHOICES),
+              help='What decompresses tar.gz archives, auto picks the first of igzip and pigz that is installed, '
+                   'before falling back to python (default: auto).')
+@click.option('--fdpass', default=False, is_flag=True,
+              help='Open the files to scan ourselves and pass them to clamd, so that clamd does not need to be able '
+                   'to read them and nothing unpacked is made readable by others. Needs clamd\'s LocalSocket.')
+@click.option('--guestfs-appliance', 'guestfs_appliance_path', default=None,
+              type=click.Path(exists=True, file_okay=False, resolve_path=True),
+              help='Directory with a fixed libguestfs appliance in it, used for VMDK and QCOW2 images instead of '
+                   'building one with supermin (default: $LIBGUESTFS_PATH, if set).')
+@click.option('--guestfs-cache-dir', default=None, type=click.Path(file_okay=False, resolve_path=True),
+              help='Where the libguestfs appliance built by supermin is cached between runs '
+                   '(default: $LIBGUESTFS_CACHEDIR, or $TMPDIR).')
+def serve(socket_path, max_jobs, tmp_dir, clamd_socket, scan_jobs, detect_jobs, detect_cache_path, no_detect_cache,
+          stream_jobs, stream_chunk_size, gzip_decompressor, fdpass, guestfs_appliance_path, guestfs_cache_dir):
+    _use_decompressor(gzip_decompressor)
+    guestfs_appliance.use_appliance(guestfs_appliance_path, guestfs_cache_dir)
+    with _detect_cache(None if no_detect_cache else detect_cache_path):
+        _serve(socket_path, max_jobs, tmp_dir, clamd_socket, scan_jobs, detect_jobs, stream_jobs, fdpass,
+               stream_chunk_size)
+
+
 if __name__ == "__main__":
     cli()
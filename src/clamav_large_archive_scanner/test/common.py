@@ -26,6 +26,9 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import struct
+from typing import Callable, Dict, List, Tuple
+
 from clamav_large_archive_scanner.lib import fast_log
 from clamav_large_archive_scanner.lib.contexts import UnpackContext
 from clamav_large_archive_scanner.lib.file_data import FileMetadata
@@ -48,3 +51,125 @@ def make_basic_unpack_ctx(unpack_dir: str, file_path: str) -> UnpackContext:
     ctx.unpacked_dir_location = unpack_dir
 
     return ctx
+
+
+ISO_SECTOR_SIZE = 2048
+
+
+def _iso_dir_record(name: bytes, lba: int, size: int, flags: int, system_use: bytes = b'') -> bytes:
+    record = bytearray(33 + len(name) + (1 - len(name) % 2)) + system_use
+    if len(record) % 2 != 0:
+        record += b'\x00'
+
+    record[0] = len(record)
+    struct.pack_into('<I', record, 2, lba)
+    struct.pack_into('>I', record, 6, lba)
+    struct.pack_into('<I', record, 10, size)
+    struct.pack_into('>I', record, 14, size)
+    record[25] = flags
+    struct.pack_into('<H', record, 28, 1)
+    record[32] = len(name)
+    record[33:33 + len(name)] = name
+
+    return bytes(record)
+
+
+def _iso_rock_ridge_name(name: str) -> bytes:
+    encoded = name.encode()
+    return b'NM' + bytes([5 + len(encoded), 1, 0]) + encoded
+
+
+def _iso_volume_descriptor(descriptor_type: int, descriptor_id: bytes = b'CD001') -> bytearray:
+    descriptor = bytearray(ISO_SECTOR_SIZE)
+    descriptor[0] = descriptor_type
+    descriptor[1:6] = descriptor_id
+    descriptor[6] = 1
+    struct.pack_into('<H', descriptor, 128, ISO_SECTOR_SIZE)
+    struct.pack_into('>H', descriptor, 130, ISO_SECTOR_SIZE)
+    return descriptor
+
+
+def make_iso(path: str, tree: Dict, joliet: bool = False, rock_ridge: bool = False, udf: bool = False) -> None:
+    """
+    Writes a minimal ISO 9660 image
+    :param tree: Maps names to the contents of a file, a list of contents for a file in several extents, or a dict for
+                 a directory. Names get mapped to upper case ISO 9660 names, the originals are in Joliet or Rock Ridge
+    """
+    descriptors = [_iso_volume_descriptor(1)]
+    if joliet:
+        descriptors.append(_iso_volume_descriptor(2))
+        descriptors[-1][88:91] = b'%/E'
+    descriptors.append(_iso_volume_descriptor(255))
+    if udf:
+        descriptors += [_iso_volume_descriptor(0, x) for x in (b'BEA01', b'NSR02', b'TEA01')]
+
+    next_lba = 16 + len(descriptors)
+    sectors = {}  # type: Dict[int, bytes]
+
+    def _allocate(data: bytes) -> int:
+        nonlocal next_lba
+        lba = next_lba
+        sectors[lba] = data
+        next_lba += max(1, -(-len(data) // ISO_SECTOR_SIZE))
+        return lba
+
+    # Files are shared by both trees
+    file_extents = {}  # type: Dict[Tuple[str, ...], List[Tuple[int, int]]]
+
+    def _allocate_files(sub_tree: Dict, dir_path: Tuple[str, ...]) -> None:
+        for name, contents in sub_tree.items():
+            if isinstance(contents, dict):
+                _allocate_files(contents, dir_path + (name,))
+                continue
+            chunks = contents if isinstance(contents, list) else [contents]
+            file_extents[dir_path + (name,)] = [(_allocate(x), len(x)) for x in chunks]
+
+    _allocate_files(tree, ())
+
+    def _write_dir(sub_tree: Dict, dir_path: Tuple[str, ...], encode_name: Callable[[str, bool], bytes],
+                   with_rock_ridge: bool) -> Tuple[int, int]:
+        children = []
+        for name, contents in sub_tree.items():
+            system_use = _iso_rock_ridge_name(name) if with_rock_ridge else b''
+            if isinstance(contents, dict):
+                lba, size = _write_dir(contents, dir_path + (name,), encode_name, with_rock_ridge)
+                children.append(_iso_dir_record(encode_name(name, True), lba, size, 0x02, system_use))
+                continue
+            extents = file_extents[dir_path + (name,)]
+            for i, (lba, size) in enumerate(extents):
+                flags = 0x80 if i < len(extents) - 1 else 0
+                children.append(_iso_dir_record(encode_name(name, False), lba, size, flags, system_use))
+
+        self_use = b'SP\x07\x01\xbe\xef\x00' if with_rock_ridge and dir_path == () else b''
+        # The real location and size of '.' and '..' don't matter to the reader
+        records = [_iso_dir_record(b'\x00', 0, 0, 0x02, self_use), _iso_dir_record(b'\x01', 0, 0, 0x02)] + children
+
+        data = bytearray()
+        for record in records:
+            if len(data) % ISO_SECTOR_SIZE + len(record) > ISO_SECTOR_SIZE:
+                data += bytes(ISO_SECTOR_SIZE - len(data) % ISO_SECTOR_SIZE)
+            data += record
+        data += bytes(-len(data) % ISO_SECTOR_SIZE)
+
+        return _allocate(bytes(data)), len(data)
+
+    def _iso_name(name: str, is_dir: bool) -> bytes:
+        return (name.upper() if is_dir else name.upper() + ';1').encode()
+
+    def _joliet_name(name: str, is_dir: bool) -> bytes:
+        return (name if is_dir else name + ';1').encode('utf-16-be')
+
+    root_lba, root_size = _write_dir(tree, (), _iso_name, rock_ridge)
+    descriptors[0][156:190] = _iso_dir_record(b'\x00', root_lba, root_size, 0x02)
+    if joliet:
+        root_lba, root_size = _write_dir(tree, (), _joliet_name, False)
+        descriptors[1][156:190] = _iso_dir_record(b'\x00', root_lba, root_size, 0x02)
+
+    image = bytearray(next_lba * ISO_SECTOR_SIZE)
+    for i, descriptor in enumerate(descriptors):
+        image[(16 + i) * ISO_SECTOR_SIZE:(17 + i) * ISO_SECTOR_SIZE] = descriptor
+    for lba, data in sectors.items():
+        image[lba * ISO_SECTOR_SIZE:lba * ISO_SECTOR_SIZE + len(data)] = data
+
+    with open(path, 'wb') as iso_file:
+        iso_file.write(image)
@@ -0,0 +1,308 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import socket
+from unittest.mock import MagicMock
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
+
+EXPECTED_UNIX_SOCKET = '/run/clamav/clamd.ctl'
+EXPECTED_SCAN_PATH = '/tmp/some_unpacked_dir'
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def mock_sock():
+    mock_sock = MagicMock()
+
+    # What was sent has to be copied as it is sent, buffers get reused
+    mock_sock.sent = []
+    mock_sock.sendall.side_effect = lambda data: mock_sock.sent.append(bytes(data))
+    return mock_sock
+
+
+@pytest.fixture(scope='function', autouse=True)
+def setup_and_teardown(mocker: MockerFixture, mock_sock):
+    # Before logic
+    # These are re-mocked for every single test
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.ClamdClient._connect', return_value=mock_sock)
+
+    yield
+    # After logic
+    # print('--AFTER--')
+    pass
+
+
+def _set_reply(mock_sock, reply: bytes):
+    # clamd closes the connection after the reply, which shows up as an empty recv
+    mock_sock.recv.side_effect = [reply, b'']
+
+
+def _sent_bytes(mock_sock) -> bytes:
+    return b''.join(mock_sock.sent)
+
+
+def _make_client(terminator='z'):
+    from clamav_large_archive_scanner.lib.clamd import ClamdClient
+    return ClamdClient(EXPECTED_UNIX_SOCKET, terminator=terminator)
+
+
+def test_parse_address():
+    from clamav_large_archive_scanner.lib.clamd import parse_address
+
+    assert parse_address(EXPECTED_UNIX_SOCKET) == (socket.AF_UNIX, EXPECTED_UNIX_SOCKET)
+    assert parse_address(f'unix://{EXPECTED_UNIX_SOCKET}') == (socket.AF_UNIX, EXPECTED_UNIX_SOCKET)
+    assert parse_address('clamd.sock') == (socket.AF_UNIX, 'clamd.sock')
+    assert parse_address('127.0.0.1:3310') == (socket.AF_INET, ('127.0.0.1', 3310))
+    assert parse_address('tcp://clamd-host:3310') == (socket.AF_INET, ('clamd-host', 3310))
+    assert parse_address(':3310') == (socket.AF_INET, ('localhost', 3310))
+
+    with pytest.raises(ClamdException):
+        parse_address('clamd-host:not_a_port')
+
+
+def test_reply_to_rv():
+    from clamav_large_archive_scanner.lib.clamd import reply_to_rv
+
+    assert reply_to_rv([f'{EXPECTED_SCAN_PATH}: OK']) == 0
+    assert reply_to_rv([f'{EXPECTED_SCAN_PATH}/a: Eicar-Signature FOUND']) == 1
+    assert reply_to_rv([f'{EXPECTED_SCAN_PATH}/a: lstat() failed: No such file or directory. ERROR']) == 2
+
+    # Virus > Error
+    assert reply_to_rv([f'{EXPECTED_SCAN_PATH}/a: Eicar-Signature FOUND',
+                        f'{EXPECTED_SCAN_PATH}/b: Access denied. ERROR']) == 1
+
+    # No reply at all is an error
+    assert reply_to_rv([]) == 2
+
+
+def test_ping(mock_sock):
+    _set_reply(mock_sock, b'PONG\0')
+
+    assert _make_client().ping()
+    mock_sock.sendall.assert_called_once_with(b'zPING\0')
+    mock_sock.close.assert_called_once()
+
+
+def test_ping_newline_terminated(mock_sock):
+    _set_reply(mock_sock, b'PONG\n')
+
+    assert _make_client('n').ping()
+    mock_sock.sendall.assert_called_once_with(b'nPING\n')
+
+
+def test_version(mock_sock):
+    _set_reply(mock_sock, b'ClamAV 1.3.0/27200/Tue Mar  5 08:38:46 2024\0')
+
+    assert _make_client().version() == 'ClamAV 1.3.0/27200/Tue Mar  5 08:38:46 2024'
+    mock_sock.sendall.assert_called_once_with(b'zVERSION\0')
+
+
+def test_unknown_terminator():
+    with pytest.raises(ClamdException):
+        _make_client('x')
+
+
+@pytest.mark.parametrize('method, command', [
+    ('scan', 'SCAN'),
+    ('contscan', 'CONTSCAN'),
+    ('multiscan', 'MULTISCAN'),
+    ('allmatchscan', 'ALLMATCHSCAN'),
+])
+def test_scan_commands(mock_sock, method, command):
+    _set_reply(mock_sock, f'{EXPECTED_SCAN_PATH}/a: Eicar-Signature FOUND\0{EXPECTED_SCAN_PATH}/b: Other FOUND\0'.encode())
+
+    reply = getattr(_make_client(), method)(EXPECTED_SCAN_PATH)
+
+    assert reply == [f'{EXPECTED_SCAN_PATH}/a: Eicar-Signature FOUND', f'{EXPECTED_SCAN_PATH}/b: Other FOUND']
+    mock_sock.sendall.assert_called_once_with(f'z{command} {EXPECTED_SCAN_PATH}\0'.encode())
+
+
+def test_scan_connection_lost(mock_sock):
+    mock_sock.recv.side_effect = ConnectionResetError('Connection reset by peer')
+
+    with pytest.raises(ClamdException):
+        _make_client().multiscan(EXPECTED_SCAN_PATH)
+
+    mock_sock.close.assert_called_once()
+
+
+def test_instream(mock_sock):
+    _set_reply(mock_sock, b'stream: OK\0')
+
+    reply = _make_client().instream(io.BytesIO(b'0123456789'), chunk_size=4)
+
+    assert reply == ['stream: OK']
+    assert _sent_bytes(mock_sock) == (b'zINSTREAM\0' +
+                                      b'\x00\x00\x00\x040123' +
+                                      b'\x00\x00\x00\x044567' +
+                                      b'\x00\x00\x00\x0289' +
+                                      b'\x00\x00\x00\x00')
+
+
+def test_instream_size_limit(mock_sock):
+    # clamd hangs up once StreamMaxLength is exceeded, the reply still needs to be read
+    mock_sock.sendall.side_effect = [None, BrokenPipeError()]
+    _set_reply(mock_sock, b'INSTREAM size limit exceeded. ERROR\0')
+
+    reply = _make_client().instream(io.BytesIO(b'0123456789'), chunk_size=4)
+
+    assert reply == ['INSTREAM size limit exceeded. ERROR']
+
+
+def _make_scan_files(tmp_path, num_files: int) -> list:
+    paths = []
+    for idx in range(num_files):
+        a_path = tmp_path / f'file_{idx}'
+        a_path.write_bytes(b'some content')
+        paths.append(str(a_path))
+
+    return paths
+
+
+def test_fildes_scan(mock_sock, tmp_path):
+    paths = _make_scan_files(tmp_path, 2)
+    mock_sock.recv.side_effect = [b'2: fd[11]: Eicar-Signature FOUND\0', b'1: fd[10]: OK\0', b'']
+
+    reply = _make_client().fildes_scan(paths + [str(tmp_path / 'does_not_exist')])
+
+    # Replies come back in whatever order clamd finishes them
+    assert reply == [f'{tmp_path}/does_not_exist: No such file or directory. ERROR',
+                     f'{paths[1]}: Eicar-Signature FOUND',
+                     f'{paths[0]}: OK']
+    assert _sent_bytes(mock_sock) == b'zIDSESSION\0zFILDES\0zFILDES\0zEND\0'
+
+    # One descriptor per file that could be opened
+    assert mock_sock.sendmsg.call_count == 2
+    mock_sock.close.assert_called_once()
+
+
+def test_fildes_scan_max_in_flight(mock_sock, tmp_path):
+    paths = _make_scan_files(tmp_path, 3)
+    mock_sock.recv.side_effect = [b'1: fd[10]: OK\0', b'2: fd[10]: OK\0', b'3: fd[10]: OK\0', b'']
+
+    reply = _make_client().fildes_scan(paths, max_in_flight=1)
+
+    assert reply == [f'{a_path}: OK' for a_path in paths]
+
+    # Every reply was read before END was sent
+    assert mock_sock.recv.call_count == 3
+
+
+def test_fildes_scan_closed_early(mock_sock, tmp_path):
+    mock_sock.recv.side_effect = [b'']
+
+    with pytest.raises(ClamdException):
+        _make_client().fildes_scan(_make_scan_files(tmp_path, 1))
+
+    mock_sock.close.assert_called_once()
+
+
+def test_fildes_scan_tcp_socket(mock_sock, tmp_path):
+    from clamav_large_archive_scanner.lib.clamd import ClamdClient
+
+    with pytest.raises(ClamdException):
+        ClamdClient('localhost:3310').fildes_scan(_make_scan_files(tmp_path, 1))
+
+    mock_sock.sendall.assert_not_called()
+
+
+class _ReadOnly:
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    def read(self, size: int) -> bytes:
+        return self._data.read(size)
+
+
+def test_instream_read_only(mock_sock):
+    # Anything without readinto still works, it just gets copied
+    _set_reply(mock_sock, b'stream: OK\0')
+
+    reply = _make_client().instream(_ReadOnly(b'012345'), chunk_size=4)
+
+    assert reply == ['stream: OK']
+    assert _sent_bytes(mock_sock) == b'zINSTREAM\0\x00\x00\x00\x040123\x00\x00\x00\x0245\x00\x00\x00\x00'
+
+
+def test_instream_fd(mocker: MockerFixture, tmp_path):
+    client_sock, clamd_sock = socket.socketpair()
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.ClamdClient._connect', return_value=client_sock)
+
+    # Already waiting for the client, once it has sent everything
+    clamd_sock.sendall(b'stream: OK\0')
+    clamd_sock.shutdown(socket.SHUT_WR)
+
+    scan_file = tmp_path / 'some_file'
+    scan_file.write_bytes(b'skipped0123456789')
+
+    with open(scan_file, 'rb') as f:
+        reply = _make_client().instream_fd(f.fileno(), 7, 10, chunk_size=4)
+
+        # Left where it was
+        assert f.tell() == 0
+
+    assert reply == ['stream: OK']
+
+    sent = b''
+    while True:
+        chunk = clamd_sock.recv(4096)
+        if not chunk:
+            break
+        sent += chunk
+    clamd_sock.close()
+
+    assert sent == (b'zINSTREAM\0' +
+                    b'\x00\x00\x00\x040123' +
+                    b'\x00\x00\x00\x044567' +
+                    b'\x00\x00\x00\x0289' +
+                    b'\x00\x00\x00\x00')
+
+
+def test_instream_fd_short_file(mocker: MockerFixture, tmp_path):
+    client_sock, clamd_sock = socket.socketpair()
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.ClamdClient._connect', return_value=client_sock)
+
+    scan_file = tmp_path / 'some_file'
+    scan_file.write_bytes(b'0123')
+
+    with open(scan_file, 'rb') as f:
+        with pytest.raises(ClamdException):
+            _make_client().instream_fd(f.fileno(), 0, 10)
+
+    clamd_sock.close()
@@ -56,6 +56,11 @@ def mock_shutil():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_tree_delete():
+    return MagicMock()
+
+
 @pytest.fixture(scope='function')
 def mock_mount_tools():
     return MagicMock()
@@ -67,10 +72,11 @@ def mock_tmp_files():
 
 
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_shutil, mock_mount_tools, mock_tmp_files):
+def setup_and_teardown(mocker: MockerFixture, mock_shutil, mock_tree_delete, mock_mount_tools, mock_tmp_files):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.cleanup.shutil', mock_shutil)
+    mocker.patch('clamav_large_archive_scanner.lib.cleanup.tree_delete', mock_tree_delete)
     mocker.patch('clamav_large_archive_scanner.lib.cleanup.mount_tools', mock_mount_tools)
     mocker.patch('clamav_large_archive_scanner.lib.cleanup.tmp_files', mock_tmp_files)
 
@@ -80,46 +86,47 @@ def setup_and_teardown(mocker: MockerFixture, mock_shutil, mock_mount_tools, moc
     # print('--AFTER--')
 
 
-def _assert_base_cleanup_behavior(mock_shutil, handler=None, expected_path=EXPECTED_ARCHIVE_PATH):
+def _assert_base_cleanup_behavior(mock_tree_delete, handler=None, expected_path=EXPECTED_ARCHIVE_PATH):
     if handler:
         handler.cleanup()
 
-    mock_shutil.rmtree.assert_called_once_with(path=expected_path, ignore_errors=True)
+    mock_tree_delete.delete_tree.assert_called_once_with(expected_path)
+    clamav_large_archive_scanner.lib.cleanup.tmp_files.forget_tmp_dir.assert_called_once_with(expected_path)
 
 
-def test_base_cleanup_handler(mock_shutil):
+def test_base_cleanup_handler(mock_tree_delete):
     # For test output formatting... don't remove
     print()
 
     handler = clamav_large_archive_scanner.lib.cleanup.BaseCleanupHandler(EXPECTED_ARCHIVE_PATH)
-    _assert_base_cleanup_behavior(mock_shutil, handler)
+    _assert_base_cleanup_behavior(mock_tree_delete, handler)
 
 
-def test_tar_cleanup_handler(mock_shutil):
+def test_tar_cleanup_handler(mock_tree_delete):
     # Tar has the same logic as base
     print()
 
     handler = clamav_large_archive_scanner.lib.cleanup.TarCleanupHandler(EXPECTED_ARCHIVE_PATH)
-    _assert_base_cleanup_behavior(mock_shutil, handler)
+    _assert_base_cleanup_behavior(mock_tree_delete, handler)
 
 
-def test_targz_cleanup_handler(mock_shutil):
+def test_targz_cleanup_handler(mock_tree_delete):
     # Tar has the same logic as base
     print()
 
     handler = clamav_large_archive_scanner.lib.cleanup.TarGzCleanupHandler(EXPECTED_ARCHIVE_PATH)
-    _assert_base_cleanup_behavior(mock_shutil, handler)
+    _assert_base_cleanup_behavior(mock_tree_delete, handler)
 
 
-def test_zip_cleanup_handler(mock_shutil):
+def test_zip_cleanup_handler(mock_tree_delete):
     # Zip has the same logic as base
     print()
 
     handler = clamav_large_archive_scanner.lib.cleanup.ZipCleanupHandler(EXPECTED_ARCHIVE_PATH)
-    _assert_base_cleanup_behavior(mock_shutil, handler)
+    _assert_base_cleanup_behavior(mock_tree_delete, handler)
 
 
-def test_iso_cleanup_handler(mock_shutil, mock_mount_tools):
+def test_iso_cleanup_handler(mock_tree_delete, mock_mount_tools):
     # For test output formatting... don't remove
     print()
 
@@ -127,10 +134,10 @@ def test_iso_cleanup_handler(mock_shutil, mock_mount_tools):
     handler.cleanup()
 
     mock_mount_tools.umount_iso.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
-    mock_shutil.rmtree.assert_called_once_with(path=EXPECTED_ARCHIVE_PATH, ignore_errors=True)
+    mock_tree_delete.delete_tree.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
 
 
-def test_iso_cleanup_handler_mount_error(mock_shutil, mock_mount_tools):
+def test_iso_cleanup_handler_mount_error(mock_tree_delete, mock_mount_tools):
     # For test output formatting... don't remove
     print()
 
@@ -142,7 +149,23 @@ def test_iso_cleanup_handler_mount_error(mock_shutil, mock_mount_tools):
         handler.cleanup()
 
     assert str(e.value) == f'Unable to un-mount from {EXPECTED_ARCHIVE_PATH}'
-    mock_shutil.rmtree.assert_not_called()
+    mock_tree_delete.delete_tree.assert_not_called()
+
+
+def test_iso_cleanup_handler_not_mounted(mock_tree_delete, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    # Copied out of the image, instead of mounted
+    mock_mount_tools.is_mount_point.return_value = False
+
+    handler = clamav_large_archive_scanner.lib.cleanup.IsoCleanupHandler(EXPECTED_ARCHIVE_PATH)
+    handler.cleanup()
+
+    mock_mount_tools.is_mount_point.assert_called_once_with(EXPECTED_ARCHIVE_PATH,
+                                                             mock_mount_tools.read_mount_table.return_value)
+    mock_mount_tools.umount_iso.assert_not_called()
+    mock_tree_delete.delete_tree.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
 
 
 GUESTFS_PARTITIONS = ['/tmp/some_test_path/some_partition_1',
@@ -150,50 +173,97 @@ GUESTFS_PARTITIONS = ['/tmp/some_test_path/some_partition_1',
                       '/tmp/some_test_path/some_partition_3']
 
 
-def _assert_umount_has_calls(mock_umount):
-    mock_umount.assert_has_calls([call(x) for x in GUESTFS_PARTITIONS], any_order=True)
+def _assert_umount_has_calls(mock_mount_tools):
+    # Every partition is checked against the same mount table, which is only read the once
+    mock_mount_tools.read_mount_table.assert_called_once()
+    mount_table = mock_mount_tools.read_mount_table.return_value
+    mock_mount_tools.umount_guestfs_partition.assert_has_calls([call(x, mount_table) for x in GUESTFS_PARTITIONS],
+                                                               any_order=True)
+
+
+def test_guestfs_cleanup_handler(mock_tree_delete, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    # Mounted by guestmount, one partition at a time
+    mock_mount_tools.is_mount_point.return_value = False
+    mock_mount_tools.list_top_level_dirs.return_value = GUESTFS_PARTITIONS
+
+    handler = clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler(EXPECTED_ARCHIVE_PATH)
+    handler.cleanup()
+
+    _assert_umount_has_calls(mock_mount_tools)
+
+    mock_tree_delete.delete_tree.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
+
 
+def test_guestfs_cleanup_handler_parallel(mock_tree_delete, mock_mount_tools):
+    import threading
 
-def test_guestfs_cleanup_handler(mock_shutil, mock_mount_tools):
     # For test output formatting... don't remove
     print()
 
+    mock_mount_tools.is_mount_point.return_value = False
     mock_mount_tools.list_top_level_dirs.return_value = GUESTFS_PARTITIONS
 
+    # Only gets through if every partition is being un-mounted at the same time
+    all_unmounting = threading.Barrier(len(GUESTFS_PARTITIONS), timeout=5)
+    mock_mount_tools.umount_guestfs_partition.side_effect = lambda x, mount_table: all_unmounting.wait()
+
+    handler = clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler(EXPECTED_ARCHIVE_PATH)
+    handler.cleanup()
+
+    _assert_umount_has_calls(mock_mount_tools)
+    mock_tree_delete.delete_tree.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
+
+
+def test_guestfs_cleanup_handler_appliance(mock_tree_delete, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    # Every partition is served from a single appliance, mounted at the dir itself
+    mock_mount_tools.is_mount_point.return_value = True
+
     handler = clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler(EXPECTED_ARCHIVE_PATH)
     handler.cleanup()
 
-    _assert_umount_has_calls(mock_mount_tools.umount_guestfs_partition)
+    mock_mount_tools.umount_guestfs_partition.assert_called_once_with(EXPECTED_ARCHIVE_PATH,
+                                                                       mock_mount_tools.read_mount_table.return_value)
+    mock_mount_tools.list_top_level_dirs.assert_not_called()
 
-    mock_shutil.rmtree.assert_called_once_with(path=EXPECTED_ARCHIVE_PATH, ignore_errors=True)
+    mock_tree_delete.delete_tree.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
 
 
 # Raises an exception on the second partition
-def _umount_exception_thrower(dir_name: str):
+def _umount_exception_thrower(dir_name: str, mount_table):
     if dir_name == GUESTFS_PARTITIONS[1]:
         raise clamav_large_archive_scanner.lib.exceptions.MountException('some test error')
 
 
-def test_guestfs_cleanup_handler_umount_error(mock_shutil, mock_mount_tools):
+def test_guestfs_cleanup_handler_umount_error(mock_tree_delete, mock_mount_tools, mock_tmp_files):
     # For test output formatting... don't remove
     print()
 
+    mock_mount_tools.is_mount_point.return_value = False
     mock_mount_tools.list_top_level_dirs.return_value = GUESTFS_PARTITIONS
     mock_mount_tools.umount_guestfs_partition.side_effect = _umount_exception_thrower
 
     handler = clamav_large_archive_scanner.lib.cleanup.GuestFSCleanupHandler(EXPECTED_ARCHIVE_PATH)
     handler.cleanup()
 
-    _assert_umount_has_calls(mock_mount_tools.umount_guestfs_partition)
+    _assert_umount_has_calls(mock_mount_tools)
 
     # Even in case of errors, it should still continue
-    mock_shutil.rmtree.assert_not_called()
+    mock_tree_delete.delete_tree.assert_not_called()
+
+    # Still needs cleaning up
+    mock_tmp_files.forget_tmp_dir.assert_not_called()
 
 
 ASSOCIATED_DIRS = ['/tmp/ut_a_dir_1', '/tmp/ut_a_dir_2', '/tmp/ut_a_dir_3']
 
 
-def test_cleanup_path(mock_tmp_files, mock_shutil):
+def test_cleanup_path(mock_tmp_files, mock_tree_delete):
     # For test output formatting... don't remove
     print()
 
@@ -201,10 +271,10 @@ def test_cleanup_path(mock_tmp_files, mock_shutil):
 
     clamav_large_archive_scanner.lib.cleanup.cleanup_path(EXPECTED_ARCHIVE_PATH)
 
-    _assert_base_cleanup_behavior(mock_shutil)
+    _assert_base_cleanup_behavior(mock_tree_delete)
 
 
-def test_cleanup_path_unknown_type(mock_tmp_files, mock_shutil):
+def test_cleanup_path_unknown_type(mock_tmp_files, mock_tree_delete):
     # For test output formatting... don't remove
     print()
 
@@ -215,10 +285,10 @@ def test_cleanup_path_unknown_type(mock_tmp_files, mock_shutil):
 
     assert str(e.value) == f'Unhandled file type: {FileType.UNKNOWN}'
 
-    mock_shutil.rmtree.assert_not_called()
+    mock_tree_delete.delete_tree.assert_not_called()
 
 
-def test_cleanup_single_file(mock_tmp_files, mock_shutil):
+def test_cleanup_single_file(mock_tmp_files, mock_tree_delete):
     # For test output formatting... don't remove
     print()
 
@@ -228,10 +298,10 @@ def test_cleanup_single_file(mock_tmp_files, mock_shutil):
     clamav_large_archive_scanner.lib.cleanup.cleanup_file(EXPECTED_ARCHIVE_PATH, EXPECTED_ARCHIVE_PARENT_DIR)
 
     mock_tmp_files.find_associated_dirs.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_ARCHIVE_PARENT_DIR)
-    _assert_base_cleanup_behavior(mock_shutil, expected_path=ASSOCIATED_DIRS[0])
+    _assert_base_cleanup_behavior(mock_tree_delete, expected_path=ASSOCIATED_DIRS[0])
 
 
-def test_cleanup_recursive(mock_tmp_files, mock_shutil):
+def test_cleanup_recursive(mock_tmp_files, mock_tree_delete):
     # For test output formatting... don't remove
     print()
 
@@ -241,10 +311,27 @@ def test_cleanup_recursive(mock_tmp_files, mock_shutil):
     clamav_large_archive_scanner.lib.cleanup.cleanup_recursive(EXPECTED_ARCHIVE_PATH, EXPECTED_ARCHIVE_PARENT_DIR)
 
     mock_tmp_files.find_associated_dirs.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_ARCHIVE_PARENT_DIR)
-    mock_shutil.rmtree.assert_has_calls([call(path=x, ignore_errors=True) for x in ASSOCIATED_DIRS], any_order=True)
+    mock_tree_delete.delete_tree.assert_has_calls([call(x) for x in ASSOCIATED_DIRS], any_order=True)
 
 
-def test_cleanup_no_files(mock_tmp_files, mock_shutil):
+def test_cleanup_recursive_shares_mount_table(mock_tmp_files, mock_mount_tools):
+    # For test output formatting... don't remove
+    print()
+
+    mock_tmp_files.determine_tmp_dir_filetype.side_effect = [FileType.ISO, FileType.VMDK, FileType.ISO]
+    mock_tmp_files.find_associated_dirs.return_value = ASSOCIATED_DIRS
+    mock_mount_tools.is_mount_point.return_value = True
+
+    clamav_large_archive_scanner.lib.cleanup.cleanup_recursive(EXPECTED_ARCHIVE_PATH, EXPECTED_ARCHIVE_PARENT_DIR)
+
+    # Read once for the whole pass, and handed to every handler
+    mock_mount_tools.read_mount_table.assert_called_once()
+    mount_table = mock_mount_tools.read_mount_table.return_value
+    mock_mount_tools.is_mount_point.assert_has_calls([call(x, mount_table) for x in ASSOCIATED_DIRS])
+    mock_mount_tools.umount_guestfs_partition.assert_called_once_with(ASSOCIATED_DIRS[1], mount_table)
+
+
+def test_cleanup_no_files(mock_tmp_files, mock_tree_delete):
     # For test output formatting... don't remove
     print()
 
@@ -252,7 +339,7 @@ def test_cleanup_no_files(mock_tmp_files, mock_shutil):
 
     clamav_large_archive_scanner.lib.cleanup.cleanup_recursive(EXPECTED_ARCHIVE_PATH, EXPECTED_ARCHIVE_PARENT_DIR)
 
-    mock_shutil.assert_not_called()
+    mock_tree_delete.delete_tree.assert_not_called()
 
 
 def test_filetype_handlers():
@@ -271,3 +358,92 @@ def test_filetype_handlers():
     }
 
     assert clamav_large_archive_scanner.lib.cleanup.FILETYPE_HANDLERS == expected_filetype_handlers
+
+
+def _make_eager_ctx(unpack_dir: str, filetype: FileType, parent_ctx=None):
+    u_ctx = common.make_basic_unpack_ctx(unpack_dir, f'{unpack_dir}.archive')
+    u_ctx.file_meta.filetype = filetype
+    u_ctx.parent_ctx = parent_ctx
+    return u_ctx
+
+
+def test_cleanup_ctx(mock_tree_delete, mock_mount_tools):
+    from clamav_large_archive_scanner.lib.cleanup import cleanup_ctx
+
+    cleanup_ctx(_make_eager_ctx('/tmp/tar_dir', FileType.TAR))
+    mock_tree_delete.delete_tree.assert_called_once_with('/tmp/tar_dir')
+    # The space has to be free before carrying on
+    mock_tree_delete.wait_for_delete.assert_called_once_with('/tmp/tar_dir')
+
+    # Never unpacked, or not ours to delete
+    cleanup_ctx(_make_eager_ctx(None, FileType.TAR))
+    cleanup_ctx(_make_eager_ctx('/some/users/dir', FileType.DIR))
+    mock_tree_delete.delete_tree.assert_called_once()
+
+
+def _make_eager_cleaner(mock_shutil, usages: list):
+    mock_shutil.disk_usage.side_effect = [MagicMock(used=x) for x in usages]
+    return clamav_large_archive_scanner.lib.cleanup.EagerCleaner(EXPECTED_ARCHIVE_PARENT_DIR)
+
+
+def test_eager_cleaner_waits_for_children(mock_shutil, mock_tree_delete):
+    # For test output formatting... don't remove
+    print()
+
+    eager_cleaner = _make_eager_cleaner(mock_shutil, [1000, 1500, 3000])
+    parent_ctx = _make_eager_ctx('/tmp/parent_dir', FileType.TAR)
+    child_ctx = _make_eager_ctx('/tmp/child_dir', FileType.TAR, parent_ctx)
+
+    eager_cleaner.unpacked(parent_ctx)
+    eager_cleaner.unpacked(child_ctx)
+
+    # The parent is scanned and inspected, but the child still needs it
+    eager_cleaner.scanned(parent_ctx)
+    eager_cleaner.inspected(parent_ctx)
+    mock_tree_delete.delete_tree.assert_not_called()
+
+    eager_cleaner.scanned(child_ctx)
+    mock_tree_delete.delete_tree.assert_not_called()
+
+    # Once the child is done, both go, child first
+    eager_cleaner.inspected(child_ctx)
+    assert mock_tree_delete.delete_tree.call_args_list == [call('/tmp/child_dir'),
+                                                 call('/tmp/parent_dir')]
+    assert mock_tree_delete.wait_for_delete.call_args_list == [call('/tmp/child_dir'),
+                                                     call('/tmp/parent_dir')]
+
+    assert eager_cleaner.peak_usage == 2000
+
+
+def test_eager_cleaner_never_deletes_dirs(mock_shutil, mock_tree_delete):
+    # For test output formatting... don't remove
+    print()
+
+    eager_cleaner = _make_eager_cleaner(mock_shutil, [0, 0])
+    dir_ctx = _make_eager_ctx('/some/users/dir', FileType.DIR)
+
+    eager_cleaner.unpacked(dir_ctx)
+    eager_cleaner.scanned(dir_ctx)
+    eager_cleaner.inspected(dir_ctx)
+
+    mock_tree_delete.delete_tree.assert_not_called()
+
+
+def test_eager_cleaner_cleanup_error(mock_shutil, mock_mount_tools, mock_tree_delete):
+    # For test output formatting... don't remove
+    print()
+
+    mock_mount_tools.umount_iso.side_effect = clamav_large_archive_scanner.lib.exceptions.MountException('busy')
+
+    eager_cleaner = _make_eager_cleaner(mock_shutil, [0, 0])
+    iso_ctx = _make_eager_ctx('/tmp/iso_dir', FileType.ISO)
+
+    eager_cleaner.unpacked(iso_ctx)
+    eager_cleaner.scanned(iso_ctx)
+
+    # Errors are left for the final cleanup, they don't stop the scan
+    eager_cleaner.inspected(iso_ctx)
+
+    mock_mount_tools.umount_iso.assert_called_once_with('/tmp/iso_dir')
+    mock_tree_delete.delete_tree.assert_not_called()
+    mock_tree_delete.wait_for_delete.assert_not_called()
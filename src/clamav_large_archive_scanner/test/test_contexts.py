@@ -83,10 +83,30 @@ def test_unpack_ctx_create_tmp_dir(mock_tmp_files):
 
     u_ctx.create_tmp_dir()
 
-    mock_tmp_files.make_temp_dir.assert_called_once_with(EXPECTED_FILE_META, EXPECTED_TMP_DIR_PARENT)
+    mock_tmp_files.make_temp_dir.assert_called_once_with(EXPECTED_FILE_META, EXPECTED_TMP_DIR_PARENT,
+                                                         root_path=EXPECTED_FILE_PATH, parent_dir=None)
 
 
-def test_unpack_ctx_cleanup_tmp(mock_shutil):
+def test_unpack_ctx_create_tmp_dir_nested(mock_tmp_files):
+    from clamav_large_archive_scanner.lib.contexts import UnpackContext
+
+    root_ctx = _create_default_u_ctx()
+    root_ctx.create_tmp_dir()
+
+    nested_ctx = UnpackContext(common.make_file_meta(f'{EXPECTED_TMP_DIR}/nested.tar'), EXPECTED_TMP_DIR_PARENT,
+                               parent_ctx=root_ctx)
+    nested_ctx.create_tmp_dir()
+
+    nested_nested_ctx = UnpackContext(common.make_file_meta(f'{EXPECTED_TMP_DIR}/nested_nested.zip'),
+                                      EXPECTED_TMP_DIR_PARENT, parent_ctx=nested_ctx)
+    nested_nested_ctx.create_tmp_dir()
+
+    # Registered under the archive we were given, and the dir it was found in
+    mock_tmp_files.make_temp_dir.assert_called_with(nested_nested_ctx.file_meta, EXPECTED_TMP_DIR_PARENT,
+                                                    root_path=EXPECTED_FILE_PATH, parent_dir=EXPECTED_TMP_DIR)
+
+
+def test_unpack_ctx_cleanup_tmp(mock_shutil, mock_tmp_files):
     u_ctx = _create_default_u_ctx()
 
     u_ctx.create_tmp_dir()
@@ -94,6 +114,12 @@ def test_unpack_ctx_cleanup_tmp(mock_shutil):
     u_ctx.cleanup_tmp()
 
     mock_shutil.rmtree.assert_called_once_with(EXPECTED_TMP_DIR, ignore_errors=True)
+    mock_tmp_files.forget_tmp_dir.assert_called_once_with(EXPECTED_TMP_DIR)
+    assert u_ctx.unpacked_dir_location is None
+
+    # Cleaning up twice does nothing
+    u_ctx.cleanup_tmp()
+    mock_shutil.rmtree.assert_called_once()
 
 
 def test_unpack_ctx_cleanup_tmp_no_create(mock_shutil):
@@ -130,6 +156,28 @@ def test_unpack_ctx_nice_filename_with_parent():
     assert u_ctx.nice_filename() == f'{EXPECTED_FILE_META.get_filename()}::{EXPECTED_FILE_PATH}'
 
 
+def test_unpack_ctx_all_aliases():
+    from clamav_large_archive_scanner.lib.contexts import UnpackContext
+
+    outer_ctx = UnpackContext(common.make_file_meta('/some/path/outer.tar'), EXPECTED_TMP_DIR_PARENT)
+    outer_ctx.unpacked_dir_location = '/tmp/outer_unpacked'
+    middle_ctx = UnpackContext(common.make_file_meta('/tmp/outer_unpacked/middle.tar'), EXPECTED_TMP_DIR_PARENT,
+                               parent_ctx=outer_ctx)
+    middle_ctx.unpacked_dir_location = '/tmp/middle_unpacked'
+    inner_ctx = UnpackContext(common.make_file_meta('/tmp/middle_unpacked/inner.tar'), EXPECTED_TMP_DIR_PARENT,
+                              parent_ctx=middle_ctx)
+
+    outer_ctx.aliases.append('outer_copy.tar')
+    middle_ctx.aliases.append('outer.tar::/middle_copy.tar')
+    inner_ctx.aliases.append('outer.tar::/other.tar::/inner_copy.tar')
+
+    # A copy of an archive has copies of everything in it too
+    assert inner_ctx.all_aliases() == ['outer.tar::/other.tar::/inner_copy.tar',
+                                       'outer.tar::/middle_copy.tar::/inner.tar',
+                                       'outer_copy.tar::/middle.tar::/inner.tar']
+    assert outer_ctx.all_aliases() == ['outer_copy.tar']
+
+
 def test_unpack_ctx_str_no_unpack_dir():
     u_ctx = _create_default_u_ctx()
 
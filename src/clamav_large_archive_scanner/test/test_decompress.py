@@ -0,0 +1,215 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import gzip
+import os
+import shutil
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+
+SOME_CONTENT = os.urandom(3 * 1024 * 1024) + b'x' * (3 * 1024 * 1024)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _read_all(gz_stream, size: int = 10240) -> bytes:
+    chunks = []
+    while True:
+        chunk = gz_stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+    return b''.join(chunks)
+
+
+def _write_gz(tmp_path, content: bytes):
+    gz_path = tmp_path / 'some_file.gz'
+    gz_path.write_bytes(content)
+    return str(gz_path)
+
+
+def test_gzip_stream(tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    gz_path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT))
+
+    with GzipStream(gz_path, 'python') as gz_stream:
+        assert _read_all(gz_stream) == SOME_CONTENT
+        assert gz_stream.read() == b''
+
+    assert gz_stream.bytes_decompressed == len(SOME_CONTENT)
+    assert gz_stream.bytes_read == len(SOME_CONTENT)
+
+
+def test_gzip_stream_read_all_at_once(tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    gz_path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT))
+
+    with GzipStream(gz_path, 'python') as gz_stream:
+        assert gz_stream.read() == SOME_CONTENT
+
+
+def test_gzip_stream_multiple_members(tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    # Like the output of bgzip, or of concatenating gz files, with padding at the end
+    content = gzip.compress(SOME_CONTENT[:100]) + gzip.compress(SOME_CONTENT[100:]) + b'\0' * 10
+    gz_path = _write_gz(tmp_path, content)
+
+    with GzipStream(gz_path, 'python') as gz_stream:
+        assert _read_all(gz_stream) == SOME_CONTENT
+
+
+def test_gzip_stream_truncated(tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    gz_path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT)[:-100])
+
+    with GzipStream(gz_path, 'python') as gz_stream:
+        with pytest.raises(OSError):
+            _read_all(gz_stream)
+
+
+def test_gzip_stream_closed_early(tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    gz_path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT))
+
+    # The decompressor is blocked on full buffers, and has to notice that it isn't needed anymore
+    gz_stream = GzipStream(gz_path, 'python')
+    assert gz_stream.read(10) == SOME_CONTENT[:10]
+    gz_stream.close()
+
+    assert not gz_stream._thread.is_alive()
+
+
+@pytest.mark.skipif(shutil.which('gzip') is None, reason='gzip is not installed')
+def test_gzip_stream_external(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    # Any external decompressor works the same way, gzip is just the one that is always there
+    mocker.patch.dict('clamav_large_archive_scanner.lib.decompress.EXTERNAL_DECOMPRESSORS',
+                      {'gzip': ['gzip', '-d', '-c']})
+
+    gz_path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT))
+    with GzipStream(gz_path, 'gzip') as gz_stream:
+        assert _read_all(gz_stream) == SOME_CONTENT
+
+    truncated_gz_path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT)[:-100])
+    with GzipStream(truncated_gz_path, 'gzip') as gz_stream:
+        with pytest.raises(OSError):
+            _read_all(gz_stream)
+
+    # Killed, rather than left running
+    gz_stream = GzipStream(gz_path, 'gzip')
+    gz_stream.read(10)
+    gz_stream.close()
+    assert gz_stream._process.returncode is not None
+
+
+@pytest.mark.skipif(shutil.which('gzip') is None, reason='gzip is not installed')
+def test_gzip_stream_external_stderr(mocker: MockerFixture, tmp_path):
+    import threading
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    # More than a pipe holds, written to stderr before anything is written to stdout
+    mocker.patch.dict('clamav_large_archive_scanner.lib.decompress.EXTERNAL_DECOMPRESSORS', {
+        'noisy': ['sh', '-c', 'head -c 1000000 /dev/zero | tr "\\0" x >&2; exec gzip -d -c "$0"'],
+        'failing': ['sh', '-c', 'echo some decompress error >&2; exit 1'],
+    })
+
+    gz_path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT))
+    read = []
+    with GzipStream(gz_path, 'noisy') as gz_stream:
+        reader = threading.Thread(target=lambda: read.append(_read_all(gz_stream)), daemon=True)
+        reader.start()
+        reader.join(timeout=30)
+        assert not reader.is_alive()
+
+    assert read == [SOME_CONTENT]
+
+    with GzipStream(gz_path, 'failing') as gz_stream:
+        with pytest.raises(OSError) as e:
+            _read_all(gz_stream)
+
+    assert 'some decompress error' in str(e.value)
+
+
+@pytest.mark.skipif(shutil.which('gzip') is None, reason='gzip is not installed')
+def test_gzip_stream_external_chunks_closed_early(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream
+
+    mocker.patch.dict('clamav_large_archive_scanner.lib.decompress.EXTERNAL_DECOMPRESSORS',
+                      {'gzip': ['gzip', '-d', '-c']})
+
+    # Without the thread, so that only the chunks are closed, like tarfile stopping part way through would
+    gz_stream = GzipStream.__new__(GzipStream)
+    gz_stream.path = _write_gz(tmp_path, gzip.compress(SOME_CONTENT))
+    gz_stream.decompressor = 'gzip'
+
+    chunks = gz_stream._external_chunks()
+    assert len(next(chunks)) > 0
+    chunks.close()
+
+    # Killed and reaped
+    assert gz_stream._process.returncode is not None
+
+
+def test_resolve_decompressor(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.decompress import resolve_decompressor
+
+    mock_shutil = mocker.patch('clamav_large_archive_scanner.lib.decompress.shutil')
+
+    mock_shutil.which.side_effect = lambda x: '/usr/bin/pigz' if x == 'pigz' else None
+    assert resolve_decompressor('auto') == 'pigz'
+
+    mock_shutil.which.side_effect = lambda x: None
+    assert resolve_decompressor('auto') == 'python'
+
+    # Asked for by name, so availability is checked up front instead
+    assert resolve_decompressor('igzip') == 'igzip'
+
+
+def test_use_decompressor(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.decompress import GzipStream, use_decompressor
+
+    mocker.patch('clamav_large_archive_scanner.lib.decompress._decompressor', 'auto')
+    use_decompressor('python')
+
+    with GzipStream(_write_gz(tmp_path, gzip.compress(b'abc'))) as gz_stream:
+        assert gz_stream.decompressor == 'python'
+        assert gz_stream.read() == b'abc'
@@ -0,0 +1,129 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _make_ctx(tmp_path, name: str, content: bytes):
+    file_path = tmp_path / name
+    file_path.write_bytes(content)
+
+    u_ctx = common.make_basic_unpack_ctx(None, str(file_path))
+    u_ctx.file_meta.size_raw = len(content)
+    return u_ctx
+
+
+SOME_CONTENT = os.urandom(512 * 1024)
+
+
+def test_find_original(tmp_path):
+    from clamav_large_archive_scanner.lib.dedupe import ArchiveDeduper
+
+    deduper = ArchiveDeduper()
+    original = _make_ctx(tmp_path, 'original.tar', SOME_CONTENT)
+    copy_1 = _make_ctx(tmp_path, 'copy_1.tar', SOME_CONTENT)
+    copy_2 = _make_ctx(tmp_path, 'copy_2.tar', SOME_CONTENT)
+
+    assert deduper.find_original(original) is None
+    assert deduper.find_original(copy_1) is original
+    assert deduper.find_original(copy_2) is original
+
+    assert deduper.num_duplicates == 2
+    assert deduper.bytes_saved == 2 * len(SOME_CONTENT)
+
+
+def test_find_original_same_samples(tmp_path):
+    from clamav_large_archive_scanner.lib.dedupe import ArchiveDeduper
+
+    # Only differs in between the sampled blocks, so the full hash has to tell them apart
+    changed_content = bytearray(SOME_CONTENT)
+    changed_content[100 * 1024] ^= 0xff
+
+    deduper = ArchiveDeduper()
+    original = _make_ctx(tmp_path, 'original.tar', SOME_CONTENT)
+    different = _make_ctx(tmp_path, 'different.tar', bytes(changed_content))
+    copy_of_different = _make_ctx(tmp_path, 'copy_of_different.tar', bytes(changed_content))
+
+    assert deduper.find_original(original) is None
+    assert deduper.find_original(different) is None
+    assert deduper.find_original(copy_of_different) is different
+
+
+def test_find_original_different_size(tmp_path):
+    from clamav_large_archive_scanner.lib.dedupe import ArchiveDeduper
+
+    deduper = ArchiveDeduper()
+    original = _make_ctx(tmp_path, 'original.tar', SOME_CONTENT)
+    longer = _make_ctx(tmp_path, 'longer.tar', SOME_CONTENT + b'\x00')
+
+    assert deduper.find_original(original) is None
+    assert deduper.find_original(longer) is None
+    assert deduper.num_duplicates == 0
+
+
+def test_find_original_unreadable(tmp_path):
+    from clamav_large_archive_scanner.lib.dedupe import ArchiveDeduper
+
+    deduper = ArchiveDeduper()
+    original = _make_ctx(tmp_path, 'original.tar', SOME_CONTENT)
+    copy_1 = _make_ctx(tmp_path, 'copy_1.tar', SOME_CONTENT)
+    copy_2 = _make_ctx(tmp_path, 'copy_2.tar', SOME_CONTENT)
+
+    assert deduper.find_original(original) is None
+
+    # IE the original was already cleaned up, the next copy becomes the original instead
+    os.remove(original.file_meta.path)
+    assert deduper.find_original(copy_1) is None
+    assert deduper.find_original(copy_2) is copy_1
+
+    # And a copy that can't be read is just unique
+    missing = _make_ctx(tmp_path, 'missing.tar', SOME_CONTENT)
+    os.remove(missing.file_meta.path)
+    assert deduper.find_original(missing) is None
+
+
+def test_forget(tmp_path):
+    from clamav_large_archive_scanner.lib.dedupe import ArchiveDeduper
+
+    deduper = ArchiveDeduper()
+    original = _make_ctx(tmp_path, 'original.tar', SOME_CONTENT)
+    copy_1 = _make_ctx(tmp_path, 'copy_1.tar', SOME_CONTENT)
+
+    assert deduper.find_original(original) is None
+    deduper.forget(original)
+    assert deduper.find_original(copy_1) is None
@@ -0,0 +1,209 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sqlite3
+import threading
+from unittest.mock import MagicMock
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def cache_path(tmp_path) -> str:
+    return str(tmp_path / 'some_cache_dir' / 'detect_cache.sqlite')
+
+
+def _make_stat(ino: int, size: int = 1234, mtime_ns: int = 5678, ctime_ns: int = 9012) -> MagicMock:
+    file_stat = MagicMock()
+    file_stat.st_dev = 1
+    file_stat.st_ino = ino
+    file_stat.st_size = size
+    file_stat.st_mtime_ns = mtime_ns
+    file_stat.st_ctime_ns = ctime_ns
+    return file_stat
+
+
+def test_get_put(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    cache = DetectCache(cache_path)
+
+    assert cache.get(_make_stat(1)) is None
+
+    cache.put(_make_stat(1), 'tar', 'POSIX tar archive')
+    cache.put(_make_stat(2), 'zip', None)
+
+    assert cache.get(_make_stat(1)) == ('tar', 'POSIX tar archive')
+    assert cache.get(_make_stat(2)) == ('zip', None)
+    assert cache.hits == 2
+    assert cache.misses == 1
+
+    cache.close()
+
+
+def test_persisted(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    cache = DetectCache(cache_path)
+    cache.put(_make_stat(1), 'tar', 'POSIX tar archive')
+    cache.close()
+
+    cache = DetectCache(cache_path)
+    assert cache.get(_make_stat(1)) == ('tar', 'POSIX tar archive')
+    cache.close()
+
+
+def test_changed_file_misses(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    cache = DetectCache(cache_path)
+    cache.put(_make_stat(1), 'tar', 'POSIX tar archive')
+
+    assert cache.get(_make_stat(1, size=1)) is None
+    assert cache.get(_make_stat(1, mtime_ns=1)) is None
+    # Same inode, size and mtime, but a different file (IE re-extracted with the mtime preserved)
+    assert cache.get(_make_stat(1, ctime_ns=1)) is None
+
+    cache.close()
+
+
+def test_lru_eviction(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    cache = DetectCache(cache_path, max_entries=2)
+    cache.put(_make_stat(1), 'tar', None)
+    cache.put(_make_stat(2), 'tar', None)
+    cache.put(_make_stat(3), 'tar', None)
+
+    # 1 becomes the most recently used, so 2 is evicted instead
+    cache.get(_make_stat(1))
+    cache.close()
+
+    cache = DetectCache(cache_path, max_entries=2)
+    assert cache.get(_make_stat(1)) is not None
+    assert cache.get(_make_stat(2)) is None
+    assert cache.get(_make_stat(3)) is not None
+    cache.close()
+
+
+def test_eviction_while_open(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    # IE for as long as serve is running
+    cache = DetectCache(cache_path, max_entries=2)
+    for ino in range(5):
+        cache.put(_make_stat(ino), 'tar', None)
+    cache.flush()
+
+    assert cache._db.execute('SELECT COUNT(*) FROM detect_cache').fetchone()[0] == 2
+    cache.close()
+
+
+def test_shared_between_processes(mocker, cache_path):
+    import time
+    import clamav_large_archive_scanner.lib.detect_cache as detect_cache
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    mocker.patch.object(detect_cache, 'LOCK_TIMEOUT_SECONDS', 1)
+    first = DetectCache(cache_path)
+    second = DetectCache(cache_path)
+
+    first.put(_make_stat(1), 'tar', None)
+    first.flush()
+    first.put(_make_stat(2), 'tar', None)
+    assert first.get(_make_stat(1)) == ('tar', None)
+
+    # Neither one keeps the database locked while it carries on, so the other never has to wait
+    started = time.monotonic()
+    second.put(_make_stat(3), 'zip', None)
+    assert second.get(_make_stat(1)) == ('tar', None)
+    second.flush()
+    first.flush()
+    assert time.monotonic() - started < 1
+
+    assert first._db is not None and second._db is not None
+    assert first.get(_make_stat(3)) == ('zip', None)
+    assert second.get(_make_stat(2)) == ('tar', None)
+
+    first.close()
+    second.close()
+
+
+def test_threads(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    cache = DetectCache(cache_path)
+
+    def _use_cache(start: int):
+        for ino in range(start, start + 100):
+            cache.put(_make_stat(ino), 'tar', None)
+            assert cache.get(_make_stat(ino)) == ('tar', None)
+
+    threads = [threading.Thread(target=_use_cache, args=(x * 100,)) for x in range(4)]
+    for a_thread in threads:
+        a_thread.start()
+    for a_thread in threads:
+        a_thread.join()
+
+    assert cache.hits == 400
+    cache.close()
+
+
+def test_disabled_on_error(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    cache = DetectCache(cache_path)
+    cache.put(_make_stat(1), 'tar', None)
+    cache.flush()
+
+    # Something breaks the database underneath us
+    cache._db.execute('DROP TABLE detect_cache')
+
+    assert cache.get(_make_stat(1)) is None
+    cache.put(_make_stat(1), 'tar', None)
+    cache.close()
+
+
+def test_corrupt_cache(cache_path):
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+
+    os.makedirs(os.path.dirname(cache_path))
+    with open(cache_path, 'wb') as f:
+        f.write(b'this is not a database' * 100)
+
+    with pytest.raises(sqlite3.Error):
+        DetectCache(cache_path)
@@ -0,0 +1,122 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+def _make_file(path, size: int):
+    with open(path, 'wb') as f:
+        f.write(b'a' * size)
+
+
+# This walks a real directory, since mocking os.scandir and DirEntry would test nothing but the mocks
+#
+# (tmp_path)
+#     |- big_1 (100 bytes)
+#     |- small_1 (1 byte)
+#     |- link_to_big_1 (symlink)
+#     |- (subdir_1)
+#         |- big_2 (100 bytes)
+#         |- (subdir_2)
+#             |- big_3 (100 bytes)
+#             |- small_2 (1 byte)
+#     |- link_to_subdir_1 (symlink)
+@pytest.fixture(scope='function')
+def test_tree(tmp_path):
+    subdir_1 = tmp_path / 'subdir_1'
+    subdir_2 = subdir_1 / 'subdir_2'
+    subdir_2.mkdir(parents=True)
+
+    _make_file(tmp_path / 'big_1', 100)
+    _make_file(tmp_path / 'small_1', 1)
+    _make_file(subdir_1 / 'big_2', 100)
+    _make_file(subdir_2 / 'big_3', 100)
+    _make_file(subdir_2 / 'small_2', 1)
+
+    os.symlink(tmp_path / 'big_1', tmp_path / 'link_to_big_1')
+    os.symlink(subdir_1, tmp_path / 'link_to_subdir_1')
+
+    return tmp_path
+
+
+def test_iter_files_min_size(test_tree):
+    from clamav_large_archive_scanner.lib.discovery import iter_files
+
+    found = {path: file_stat.st_size for path, file_stat in iter_files(str(test_tree), 10)}
+
+    assert found == {
+        f'{test_tree}/big_1': 100,
+        f'{test_tree}/subdir_1/big_2': 100,
+        f'{test_tree}/subdir_1/subdir_2/big_3': 100,
+    }
+
+
+def test_iter_files_no_min_size(test_tree):
+    from clamav_large_archive_scanner.lib.discovery import iter_files
+
+    found = {path for path, _ in iter_files(str(test_tree), 0)}
+
+    # Symlinks are never followed or returned
+    assert found == {
+        f'{test_tree}/big_1',
+        f'{test_tree}/small_1',
+        f'{test_tree}/subdir_1/big_2',
+        f'{test_tree}/subdir_1/subdir_2/big_3',
+        f'{test_tree}/subdir_1/subdir_2/small_2',
+    }
+
+
+def test_iter_files_order(test_tree):
+    from clamav_large_archive_scanner.lib.discovery import iter_files
+
+    found = [path for path, _ in iter_files(str(test_tree), 0)]
+
+    # Same as os.walk, a directory's files come before anything in its sub directories, and always in name order
+    assert found == [
+        f'{test_tree}/big_1',
+        f'{test_tree}/small_1',
+        f'{test_tree}/subdir_1/big_2',
+        f'{test_tree}/subdir_1/subdir_2/big_3',
+        f'{test_tree}/subdir_1/subdir_2/small_2',
+    ]
+
+
+def test_iter_files_missing_dir(tmp_path):
+    from clamav_large_archive_scanner.lib.discovery import iter_files
+
+    assert list(iter_files(str(tmp_path / 'does_not_exist'), 0)) == []
@@ -27,6 +27,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import stat
+import threading
 from unittest.mock import MagicMock
 
 # noinspection PyPackageRequirements
@@ -59,6 +60,8 @@ def setup_and_teardown(mocker: MockerFixture, mock_os, mock_magic):
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.file_data.os', mock_os)
     mocker.patch('clamav_large_archive_scanner.lib.file_data.magic', mock_magic)
+    # Handles are cached per thread, make sure every test gets one from its own mock
+    mocker.patch('clamav_large_archive_scanner.lib.file_data._magic_handles', threading.local())
 
     yield
     # After logic
@@ -127,13 +130,13 @@ def _mock_is_dir(mock_os, is_dir):
 def _assert_handled_file_calls(mock_os, mock_magic, expected_path):
     mock_os.path.exists.assert_called_once_with(expected_path)
     mock_os.path.getsize.assert_called_once_with(expected_path)
-    mock_magic.from_file.assert_called_once_with(expected_path, mime=False)
+    mock_magic.Magic.return_value.from_file.assert_called_once_with(expected_path)
 
 
 def _assert_unhandled_file_calls(mock_os, mock_magic, expected_path):
     mock_os.path.exists.assert_called_once_with(expected_path)
     mock_os.path.getsize.assert_not_called()
-    mock_magic.from_file.assert_not_called()
+    mock_magic.Magic.return_value.from_file.assert_not_called()
 
 
 def test_file_meta_from_path(mock_os, mock_magic):
@@ -141,7 +144,7 @@ def test_file_meta_from_path(mock_os, mock_magic):
     _mock_file_type_regular(mock_os, True)
     _mock_path_exists(mock_os, True)
 
-    mock_magic.from_file.return_value = 'QEMU QCOW2 Image (v3),'
+    mock_magic.Magic.return_value.from_file.return_value = 'QEMU QCOW2 Image (v3),'
 
     expected_file_size = 1234
     mock_os.path.getsize.return_value = expected_file_size
@@ -179,7 +182,7 @@ def test_file_meta_from_path_unknown(mock_os, mock_magic):
     _mock_is_dir(mock_os, False)
     _mock_path_exists(mock_os, True)
 
-    mock_magic.from_file.return_value = 'Some unknown file type'
+    mock_magic.Magic.return_value.from_file.return_value = 'Some unknown file type'
 
     file_meta = file_meta_from_path(EXPECTED_TEST_PATH)
 
@@ -202,3 +205,176 @@ def test_file_meta_from_path_does_not_exist(mock_os, mock_magic):
     assert file_meta.desc == 'File does not exist'
 
     _assert_unhandled_file_calls(mock_os, mock_magic, EXPECTED_TEST_PATH)
+
+
+def test_file_meta_from_stat(mock_os, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import file_meta_from_stat
+
+    mock_magic.Magic.return_value.from_file.return_value = 'POSIX tar archive (GNU)'
+
+    file_stat = MagicMock()
+    file_stat.st_size = 1234
+
+    file_meta = file_meta_from_stat(EXPECTED_TEST_PATH, file_stat)
+
+    assert file_meta.path == EXPECTED_TEST_PATH
+    assert file_meta.desc == 'POSIX tar archive (GNU)'
+    assert file_meta.size_raw == 1234
+    assert file_meta.filetype == FileType.TAR
+
+    # The stat result is all we need, so none of the existence/type checks should happen
+    mock_magic.Magic.return_value.from_file.assert_called_once_with(EXPECTED_TEST_PATH)
+    mock_os.path.exists.assert_not_called()
+    mock_os.path.isdir.assert_not_called()
+    mock_os.lstat.assert_not_called()
+    mock_os.path.getsize.assert_not_called()
+
+
+def _zip_header(first_member: bytes) -> bytes:
+    return b'PK\x03\x04' + b'\x00' * 22 + len(first_member).to_bytes(2, 'little') + b'\x00\x00' + first_member
+
+
+def _iso_header() -> bytes:
+    return b'\x00' * 32769 + b'CD001' + b'\x01'
+
+
+@pytest.mark.parametrize('header, expected_filetype', [
+    (b'a.txt'.ljust(257, b'\x00') + b'ustar\x0000', FileType.TAR),
+    (b'a.txt'.ljust(257, b'\x00') + b'ustar  \x00', FileType.TAR),
+    (_zip_header(b'a.txt'), FileType.ZIP),
+    (b'PK\x05\x06' + b'\x00' * 18, FileType.ZIP),
+    (_iso_header(), FileType.ISO),
+    (b'KDMV\x01\x00\x00\x00', FileType.VMDK),
+    # A descriptor without its extents isn't an image, libmagic says it is 'ASCII text'
+    (b'# Disk DescriptorFile\nversion=1\n', FileType.UNKNOWN),
+    (b'\x1f\x8b\x08\x00', FileType.TARGZ),
+    (b'QFI\xfb\x00\x00\x00\x02', FileType.QCOW2),
+    (b'QFI\xfb\x00\x00\x00\x03', FileType.QCOW2),
+    (b'QFI\xfb\x00\x00\x00\x01', FileType.UNKNOWN),
+    (b'a.txt'.ljust(512, b'\x00'), FileType.UNKNOWN),
+    (b'', FileType.UNKNOWN),
+    # Not conclusive, these have to go to libmagic
+    (_zip_header(b'[Content_Types].xml'), None),
+    (_zip_header(b'mimetype'), None),
+])
+def test_sniff_filetype(tmp_path, header, expected_filetype):
+    from clamav_large_archive_scanner.lib.file_data import _sniff_filetype
+
+    test_file = tmp_path / 'some_file'
+    test_file.write_bytes(header)
+
+    assert _sniff_filetype(str(test_file)) == expected_filetype
+
+
+def test_filetype_from_buffer(mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import filetype_from_buffer
+
+    assert filetype_from_buffer(b'a.txt'.ljust(257, b'\x00') + b'ustar\x0000') == FileType.TAR
+    assert filetype_from_buffer(_iso_header()) == FileType.ISO
+    assert filetype_from_buffer(b'a.txt'.ljust(512, b'\x00')) == FileType.UNKNOWN
+    mock_magic.Magic.return_value.from_buffer.assert_not_called()
+
+    # Not conclusive, so it goes to libmagic
+    mock_magic.Magic.return_value.from_buffer.return_value = 'Microsoft Word 2007+'
+    assert filetype_from_buffer(_zip_header(b'[Content_Types].xml')) == FileType.UNKNOWN
+    mock_magic.Magic.return_value.from_buffer.assert_called_once_with(_zip_header(b'[Content_Types].xml'))
+
+
+def test_sniff_filetype_does_not_exist(tmp_path):
+    from clamav_large_archive_scanner.lib.file_data import _sniff_filetype
+
+    assert _sniff_filetype(str(tmp_path / 'does_not_exist')) is None
+
+
+def test_file_meta_from_stat_sniffed(tmp_path, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import file_meta_from_stat
+
+    test_file = tmp_path / 'some_file'
+    test_file.write_bytes(_iso_header())
+
+    file_stat = MagicMock()
+    file_stat.st_size = 1234
+    mock_magic.Magic.return_value.from_file.return_value = 'ISO 9660 CD-ROM filesystem data'
+
+    file_meta = file_meta_from_stat(str(test_file), file_stat)
+
+    assert file_meta.filetype == FileType.ISO
+    assert file_meta.size_raw == 1234
+
+    # libmagic is only used once something asks for the description, which logging it doesn't
+    assert 'Description: Not looked up' in str(file_meta)
+    mock_magic.Magic.return_value.from_file.assert_not_called()
+
+    assert file_meta.desc == 'ISO 9660 CD-ROM filesystem data'
+    assert file_meta.desc == 'ISO 9660 CD-ROM filesystem data'
+    mock_magic.Magic.return_value.from_file.assert_called_once_with(str(test_file))
+
+
+def test_magic_handle_per_thread(mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import _magic_from_file
+
+    mock_magic.Magic.side_effect = lambda mime: MagicMock()
+
+    _magic_from_file(EXPECTED_TEST_PATH)
+    _magic_from_file(EXPECTED_TEST_PATH)
+
+    # Reused by the same thread
+    mock_magic.Magic.assert_called_once_with(mime=False)
+
+    a_thread = threading.Thread(target=_magic_from_file, args=(EXPECTED_TEST_PATH,))
+    a_thread.start()
+    a_thread.join()
+
+    # But never shared with another one
+    assert mock_magic.Magic.call_count == 2
+
+
+def test_file_meta_from_stat_cache_hit(mocker: MockerFixture, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import file_meta_from_stat
+
+    mock_cache = MagicMock()
+    mock_cache.get.return_value = ('iso', 'ISO 9660 CD-ROM filesystem data')
+    mocker.patch('clamav_large_archive_scanner.lib.file_data._detect_cache', mock_cache)
+    mock_sniff = mocker.patch('clamav_large_archive_scanner.lib.file_data._sniff_filetype')
+
+    file_stat = MagicMock()
+    file_meta = file_meta_from_stat(EXPECTED_TEST_PATH, file_stat)
+
+    assert file_meta.filetype == FileType.ISO
+    assert file_meta.desc == 'ISO 9660 CD-ROM filesystem data'
+
+    # The file is never opened
+    mock_cache.get.assert_called_once_with(file_stat)
+    mock_sniff.assert_not_called()
+    mock_magic.Magic.return_value.from_file.assert_not_called()
+    mock_cache.put.assert_not_called()
+
+
+def test_file_meta_from_stat_cache_miss(mocker: MockerFixture, tmp_path, mock_magic):
+    from clamav_large_archive_scanner.lib.file_data import file_meta_from_stat
+
+    mock_cache = MagicMock()
+    mock_cache.get.return_value = None
+    mocker.patch('clamav_large_archive_scanner.lib.file_data._detect_cache', mock_cache)
+
+    test_file = tmp_path / 'some_file'
+    test_file.write_bytes(b'\x1f\x8b\x08\x00')
+
+    file_stat = MagicMock()
+    file_meta = file_meta_from_stat(str(test_file), file_stat)
+
+    assert file_meta.filetype == FileType.TARGZ
+    # Sniffed, so there's no description to store yet
+    mock_cache.put.assert_called_once_with(file_stat, 'tgz', None)
+
+
+def test_use_detect_cache():
+    import clamav_large_archive_scanner.lib.file_data as file_data
+
+    mock_cache = MagicMock()
+
+    file_data.use_detect_cache(mock_cache)
+    assert file_data._detect_cache is mock_cache
+
+    file_data.use_detect_cache(None)
+    assert file_data._detect_cache is None
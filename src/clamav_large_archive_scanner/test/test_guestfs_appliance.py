@@ -0,0 +1,312 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import json
+import sys
+from unittest.mock import MagicMock
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+from clamav_large_archive_scanner.lib.exceptions import MountException
+
+EXPECTED_IMAGE_PATH = '/tmp/some_image.qcow2'
+EXPECTED_MOUNT_POINT = '/tmp/some_mount_point'
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def mock_subprocess():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def setup_and_teardown(mocker: MockerFixture, mock_subprocess):
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_appliance.subprocess', mock_subprocess)
+
+    yield
+
+    from clamav_large_archive_scanner.lib.guestfs_appliance import use_appliance
+    use_appliance()
+
+
+def _set_server_status(mock_subprocess, status_line: str, rv: int = 0, stderr: bytes = b'') -> MagicMock:
+    server = MagicMock()
+    server.stdout = io.StringIO(status_line)
+    server.wait.return_value = rv
+
+    def _popen(cmd, **kwargs):
+        kwargs['stderr'].write(stderr)
+        return server
+
+    mock_subprocess.Popen.side_effect = _popen
+    return server
+
+
+def test_mount_image(mock_subprocess):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import mount_image
+
+    status = {'mounted': ['/dev/sda1', '/dev/vg/root'], 'failed': {'/dev/sda2': 'some mount error'}}
+    server = _set_server_status(mock_subprocess, json.dumps(status) + '\n')
+
+    assert mount_image(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT) == (status['mounted'], status['failed'])
+
+    cmd = mock_subprocess.Popen.call_args.args[0]
+    assert cmd == [sys.executable, '-m', 'clamav_large_archive_scanner.lib.guestfs_appliance', EXPECTED_IMAGE_PATH,
+                   EXPECTED_MOUNT_POINT]
+    assert mock_subprocess.Popen.call_args.kwargs['start_new_session']
+
+    # Left running, until it's un-mounted
+    server.wait.assert_not_called()
+
+
+def test_mount_image_appliance_settings(mock_subprocess):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import mount_image, use_appliance
+
+    _set_server_status(mock_subprocess, json.dumps({'mounted': [], 'failed': {}}) + '\n')
+
+    use_appliance('/some/fixed/appliance', '/some/cache/dir')
+    mount_image(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT)
+
+    cmd = mock_subprocess.Popen.call_args.args[0]
+    assert cmd[-4:] == ['--fixed-appliance', '/some/fixed/appliance', '--cache-dir', '/some/cache/dir']
+
+
+def test_mount_image_launch_error(mock_subprocess):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import mount_image
+
+    server = _set_server_status(mock_subprocess, json.dumps({'error': 'some launch error'}) + '\n', 1)
+
+    with pytest.raises(MountException) as e:
+        mount_image(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT)
+
+    assert str(e.value) == 'some launch error'
+    server.wait.assert_called_once()
+
+
+def test_mount_image_server_died(mock_subprocess):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import mount_image
+
+    _set_server_status(mock_subprocess, '', 1)
+
+    with pytest.raises(MountException) as e:
+        mount_image(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT)
+
+    assert str(e.value) == f'Appliance for {EXPECTED_IMAGE_PATH} exited with 1 before mounting anything'
+
+
+def test_mount_image_stderr(mock_subprocess):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import mount_image
+
+    _set_server_status(mock_subprocess, json.dumps({'error': 'some launch error'}) + '\n', 1,
+                       stderr=b'libguestfs: error: some detail\n')
+
+    with pytest.raises(MountException) as e:
+        mount_image(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT)
+
+    assert str(e.value) == 'some launch error, the appliance said: libguestfs: error: some detail'
+
+
+def test_mount_image_server_died_stderr(mock_subprocess):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import mount_image
+
+    _set_server_status(mock_subprocess, '', 1, stderr=b'Traceback (most recent call last):\n  ImportError: guestfs\n')
+
+    with pytest.raises(MountException) as e:
+        mount_image(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT)
+
+    assert str(e.value).endswith('before mounting anything, the appliance said: Traceback (most recent call last):\n'
+                                 '  ImportError: guestfs')
+
+
+@pytest.mark.parametrize('status_line', ['not json at all\n', '[1, 2]\n', '{"mounted": []}\n'])
+def test_mount_image_bad_status(mock_subprocess, status_line):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import mount_image
+
+    server = _set_server_status(mock_subprocess, status_line, stderr=b'some warning')
+
+    with pytest.raises(MountException) as e:
+        mount_image(EXPECTED_IMAGE_PATH, EXPECTED_MOUNT_POINT)
+
+    assert str(e.value) == (f'Appliance for {EXPECTED_IMAGE_PATH} reported something unexpected: '
+                            f'{status_line.strip()}, the appliance said: some warning')
+    server.kill.assert_called_once()
+    server.wait.assert_called_once()
+
+
+def test_mount_filesystems():
+    from clamav_large_archive_scanner.lib.guestfs_appliance import _mount_filesystems
+
+    g = MagicMock()
+    g.list_filesystems.return_value = {'/dev/sda1': 'ext4', '/dev/sda2': 'swap', '/dev/sda3': 'unknown',
+                                       '/dev/sdb1': 'xfs', '/dev/vg/root': 'ext4'}
+
+    def _mount_ro(partition, inner_dir):
+        if partition == '/dev/sdb1':
+            raise RuntimeError('some mount error')
+
+    g.mount_ro.side_effect = _mount_ro
+
+    mounted, failed = _mount_filesystems(g)
+
+    assert mounted == ['/dev/sda1', '/dev/vg/root']
+    assert failed == {'/dev/sdb1': 'some mount error'}
+
+    # Named the same as guestmount'ed partitions
+    g.mount_ro.assert_any_call('/dev/vg/root', '/++dev++vg++root')
+    g.rmmountpoint.assert_called_once_with('/++dev++sdb1')
+
+
+class _FakeGuestFS:
+    """
+    An appliance with a single filesystem mounted at /++dev++sda1, holding the given files
+    """
+
+    def __init__(self, files: dict):
+        self.files = files
+        self.closed = False
+        self.preads = []
+        self.lstat_batches = []
+
+    def find0(self, top_dir, list_path):
+        names = set()
+        for path in self.files.keys():
+            parts = path.split('/')
+            for i in range(1, len(parts) + 1):
+                names.add('/'.join(parts[:i]))
+
+        with open(list_path, 'wb') as f:
+            for name in sorted(names):
+                f.write(name.encode('utf-8', errors='surrogateescape') + b'\0')
+
+    def lstatnslist(self, dir_path, names):
+        self.lstat_batches.append((dir_path, len(names)))
+        prefix = dir_path[len('/++dev++sda1/'):]
+        results = []
+        for name in names:
+            path = f'{prefix}/{name}' if prefix else name
+            if path in self.files:
+                results.append({'st_mode': 0o100644, 'st_size': len(self.files[path])})
+            else:
+                results.append({'st_mode': 0o040755, 'st_size': 4096})
+        return results
+
+    def pread(self, path, count, offset):
+        self.preads.append(count)
+        return self.files[path[len('/++dev++sda1/'):]][offset:offset + count]
+
+    def shutdown(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def _mock_image(mocker: MockerFixture, files: dict) -> _FakeGuestFS:
+    fake_g = _FakeGuestFS(files)
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_appliance._launch', return_value=fake_g)
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_appliance._mount_filesystems',
+                 return_value=(['/dev/sda1'], {}))
+    return fake_g
+
+
+def test_guestfs_image(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import GuestFSImage
+
+    fake_g = _mock_image(mocker, {'etc/passwd': b'root', 'top': b'abcd', 'etc/empty': b''})
+
+    with GuestFSImage(EXPECTED_IMAGE_PATH) as image:
+        assert sorted(image.iter_files()) == [('/++dev++sda1/etc/empty', 0), ('/++dev++sda1/etc/passwd', 4),
+                                              ('/++dev++sda1/top', 4)]
+
+        assert image.open('/++dev++sda1/etc/passwd', 4).read() == b'root'
+
+    assert fake_g.closed
+
+
+def test_guestfs_image_many_files(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import GuestFSImage, _LSTAT_BATCH_SIZE
+
+    # Names split across many reads of the list
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_appliance._FILE_LIST_READ_SIZE', 7)
+    mock_warn = mocker.patch('clamav_large_archive_scanner.lib.guestfs_appliance.fast_log.warn')
+
+    files = {f'big/{i:05}': b'x' for i in range(_LSTAT_BATCH_SIZE + 5)}
+    files.update({'a/b/c': b'abc', 'a/d': b'd', 'not_utf8_\udcff': b'bad'})
+    fake_g = _mock_image(mocker, files)
+
+    with GuestFSImage(EXPECTED_IMAGE_PATH) as image:
+        found = dict(image.iter_files())
+
+    assert len(found) == _LSTAT_BATCH_SIZE + 7
+    assert found['/++dev++sda1/a/b/c'] == 3
+    assert found['/++dev++sda1/big/01004'] == 1
+
+    # Never more than fits in a single reply
+    assert max(size for _, size in fake_g.lstat_batches) == _LSTAT_BATCH_SIZE
+    assert ('/++dev++sda1/big', 5) in fake_g.lstat_batches
+
+    mock_warn.assert_called_once()
+    assert 'not UTF-8' in mock_warn.call_args.args[0]
+
+
+def test_guestfs_image_launch_error(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import GuestFSImage
+
+    mocker.patch('clamav_large_archive_scanner.lib.guestfs_appliance._launch',
+                 side_effect=RuntimeError('some launch error'))
+
+    with pytest.raises(MountException) as e:
+        GuestFSImage(EXPECTED_IMAGE_PATH)
+
+    assert str(e.value) == 'some launch error'
+
+
+def test_guestfs_file_reader(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.guestfs_appliance import GuestFSImage, READ_SIZE
+
+    content = b'x' * (READ_SIZE * 2 + 10)
+    fake_g = _mock_image(mocker, {'big': content})
+
+    with GuestFSImage(EXPECTED_IMAGE_PATH) as image:
+        reader = image.open('/++dev++sda1/big', len(content))
+
+        # Never asks for more than fits in a single message, or past the end
+        assert reader.read() == content[:READ_SIZE]
+        assert reader.read(READ_SIZE * 4) == content[READ_SIZE:READ_SIZE * 2]
+        assert reader.read() == b'x' * 10
+        assert reader.read() == b''
+
+    assert fake_g.preads == [READ_SIZE, READ_SIZE, 10]
@@ -0,0 +1,171 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+from clamav_large_archive_scanner.lib.exceptions import IsoException
+
+SOME_TREE = {
+    'Some File.txt': b'abcd' * 1000,
+    'Some Dir': {
+        'Nested File.bin': b'efgh',
+        'Empty Dir': {},
+    },
+}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+# These read real images, built by common.make_iso
+def _open_iso(tmp_path, tree, **kwargs) -> int:
+    iso_path = tmp_path / 'some.iso'
+    common.make_iso(str(iso_path), tree, **kwargs)
+    return os.open(iso_path, os.O_RDONLY)
+
+
+def _walk(fd: int) -> dict:
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage, IsoFileReader
+
+    return {x.path: None if x.is_dir else IsoFileReader(fd, x).read() for x in IsoImage(fd).walk()}
+
+
+def test_plain_names(tmp_path):
+    fd = _open_iso(tmp_path, SOME_TREE)
+
+    # Mapped the same as a mount would, lower case without the version
+    assert _walk(fd) == {
+        'some file.txt': b'abcd' * 1000,
+        'some dir': None,
+        'some dir/nested file.bin': b'efgh',
+        'some dir/empty dir': None,
+    }
+    os.close(fd)
+
+
+@pytest.mark.parametrize('kwargs', [{'joliet': True}, {'rock_ridge': True}, {'joliet': True, 'rock_ridge': True}])
+def test_long_names(tmp_path, kwargs):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    fd = _open_iso(tmp_path, SOME_TREE, **kwargs)
+
+    assert _walk(fd) == {
+        'Some File.txt': b'abcd' * 1000,
+        'Some Dir': None,
+        'Some Dir/Nested File.bin': b'efgh',
+        'Some Dir/Empty Dir': None,
+    }
+
+    # Rock Ridge wins, when there's both
+    iso_image = IsoImage(fd)
+    assert iso_image.has_rock_ridge == kwargs.get('rock_ridge', False)
+    assert iso_image.has_joliet == kwargs.get('joliet', False)
+    os.close(fd)
+
+
+def test_multi_extent(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    fd = _open_iso(tmp_path, {'big': [b'a' * 3000, b'b' * 10], 'after': b'c'})
+
+    entries = list(IsoImage(fd).walk())
+    assert [x.path for x in entries] == ['big', 'after']
+    assert entries[0].size == 3010
+    assert len(entries[0].extents) == 2
+
+    assert _walk(fd)['big'] == b'a' * 3000 + b'b' * 10
+    os.close(fd)
+
+
+def test_reader_readinto(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage, IsoFileReader
+
+    fd = _open_iso(tmp_path, {'big': [b'a' * 3000, b'b' * 10]})
+    entry = next(IsoImage(fd).walk())
+
+    reader = IsoFileReader(fd, entry)
+    buffer = bytearray(4096)
+
+    # Never more than one extent at a time
+    assert reader.readinto(buffer) == 3000
+    assert reader.readinto(buffer) == 10
+    assert buffer[:10] == b'b' * 10
+    assert reader.readinto(buffer) == 0
+    os.close(fd)
+
+
+def test_udf(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    fd = _open_iso(tmp_path, SOME_TREE, udf=True)
+
+    with pytest.raises(IsoException) as e:
+        IsoImage(fd)
+
+    assert 'UDF' in str(e.value)
+    os.close(fd)
+
+
+def test_not_an_iso(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    not_iso = tmp_path / 'not.iso'
+    not_iso.write_bytes(b'\x00' * 64 * 1024)
+    fd = os.open(not_iso, os.O_RDONLY)
+
+    with pytest.raises(IsoException) as e:
+        IsoImage(fd)
+
+    assert str(e.value) == 'No primary volume descriptor found'
+    os.close(fd)
+
+
+def test_truncated(tmp_path):
+    from clamav_large_archive_scanner.lib.iso9660 import IsoImage
+
+    iso_path = tmp_path / 'some.iso'
+    common.make_iso(str(iso_path), SOME_TREE)
+    os.truncate(iso_path, os.path.getsize(iso_path) - common.ISO_SECTOR_SIZE)
+
+    fd = os.open(iso_path, os.O_RDONLY)
+    with pytest.raises(IsoException):
+        list(IsoImage(fd).walk())
+    os.close(fd)
+
+
+def test_unsafe_names(tmp_path):
+    fd = _open_iso(tmp_path, {'..': b'a', 'a/b': b'b', 'ok': b'c'}, rock_ridge=True)
+
+    assert _walk(fd) == {'a_b': b'b', 'ok': b'c'}
+    os.close(fd)
@@ -25,8 +25,11 @@
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
+import os
+import sqlite3
+import threading
 from typing import List
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, call
 
 import click
 # noinspection PyPackageRequirements
@@ -43,6 +46,7 @@ EXPECTED_MIN_SIZE_BYTES = 100 * 1024 * 1024
 EXPECTED_TMP_DIR = '/tmp'
 EXPECTED_UNPACKED_DIRS = ['/tmp/some_dir_1', '/tmp/some_dir_2', '/tmp/some_dir_3']
 EXPECTED_UNPACKED_DIR = '/tmp/some_dir_4'
+EXPECTED_CLAMD_SOCKET = '/run/clamav/clamd.ctl'
 
 GOOD_SCAN_RESULT = ScanResult(EXPECTED_PATH, 0)
 VIRUS_SCAN_RESULT = ScanResult(EXPECTED_PATH, 1)
@@ -91,6 +95,7 @@ def setup_and_teardown(mocker: MockerFixture, mock_cleaner, mock_detect, mock_un
     mocker.patch('clamav_large_archive_scanner.main.detect', mock_detect)
     mocker.patch('clamav_large_archive_scanner.main.unpacker', mock_unpacker)
     mocker.patch('clamav_large_archive_scanner.main.scanner', mock_scanner)
+    mocker.patch('clamav_large_archive_scanner.main.tree_delete')
 
     yield
     # After logic
@@ -121,11 +126,13 @@ def _set_clamdscan_rv(mock_scanner, results: List[ScanResult]):
 
 
 def _assert_unpack_logic(mock_detect, mock_unpacker, expected_path, expected_recursive, expected_min_size_bytes,
-                         expected_tmp_dir, expected_file_meta):
+                         expected_tmp_dir, expected_file_meta, expected_detect_jobs=1, expected_dedupe=False):
     mock_detect.file_meta_from_path.assert_called_once_with(expected_path)
     if expected_recursive:
         mock_unpacker.unpack_recursive.assert_called_once_with(expected_file_meta, expected_min_size_bytes,
-                                                               expected_tmp_dir)
+                                                               expected_tmp_dir, on_inspected=None,
+                                                               detect_jobs=expected_detect_jobs,
+                                                               dedupe_archives=expected_dedupe)
     else:
         mock_unpacker.unpack.assert_called_once_with(expected_file_meta, expected_tmp_dir)
 
@@ -153,6 +160,35 @@ def test_scan_no_clamdscan(mock_scanner):
     mock_scanner.validate_clamdscan.assert_called_once_with()
 
 
+def test_scan_clamd_socket(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET)
+    assert scan_rv == 0
+
+    # The clamdscan binary isn't needed when talking to clamd directly
+    mock_scanner.validate_clamd.assert_called_once_with(EXPECTED_CLAMD_SOCKET)
+    mock_scanner.validate_clamdscan.assert_not_called()
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False,
+                                                   clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=1, fdpass=False)
+
+
+def test_scan_clamd_socket_unreachable(mock_scanner, mock_cleaner, mock_unpacker, mock_detect):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = False
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET)
+
+    assert e.value.message == f'Unable to reach clamd at {EXPECTED_CLAMD_SOCKET}, please check that it is running'
+
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    _assert_no_cleanup(mock_cleaner)
+
+
 def test_scan_happy_path(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
     from clamav_large_archive_scanner.main import _scan
     _set_clamdscan_present(mock_scanner, True)
@@ -166,7 +202,8 @@ def test_scan_happy_path(mock_scanner, mock_cleaner, mock_unpacker, mock_detect,
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
                          testcase_file_meta)
 
-    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False, clamd_socket=None, scan_jobs=1,
+                                                   fdpass=False)
     mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
 
 
@@ -183,7 +220,8 @@ def test_scan_happy_path_all_match(mock_scanner, mock_cleaner, mock_unpacker, mo
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
                          testcase_file_meta)
 
-    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, True)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, True, clamd_socket=None, scan_jobs=1,
+                                                   fdpass=False)
     mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
 
 
@@ -200,10 +238,338 @@ def test_scan_virus_fail_fast(mock_scanner, mock_cleaner, mock_unpacker, mock_de
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
                          testcase_file_meta)
 
-    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, True, False)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, True, False, clamd_socket=None, scan_jobs=1,
+                                                   fdpass=False)
+    mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
+
+
+def test_scan_jobs(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, True, False, EXPECTED_TMP_DIR, scan_jobs=4)
+
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, True, False, clamd_socket=None,
+                                                   scan_jobs=4, fdpass=False)
+
+
+def test_detect_cache(mocker: MockerFixture, mock_detect):
+    from clamav_large_archive_scanner.main import _detect_cache
+
+    mock_detect_cache = mocker.patch('clamav_large_archive_scanner.main.detect_cache')
+    mock_cache = mock_detect_cache.DetectCache.return_value
+
+    with _detect_cache('/some/cache.sqlite'):
+        mock_detect.use_detect_cache.assert_called_once_with(mock_cache)
+
+    mock_detect_cache.DetectCache.assert_called_once_with('/some/cache.sqlite')
+    mock_detect.use_detect_cache.assert_called_with(None)
+    mock_cache.close.assert_called_once()
+
+
+def test_detect_cache_disabled(mocker: MockerFixture, mock_detect):
+    from clamav_large_archive_scanner.main import _detect_cache
+
+    mock_detect_cache = mocker.patch('clamav_large_archive_scanner.main.detect_cache')
+
+    with _detect_cache(None):
+        pass
+
+    mock_detect_cache.DetectCache.assert_not_called()
+    mock_detect.use_detect_cache.assert_not_called()
+
+
+def test_detect_cache_unusable(mocker: MockerFixture, mock_detect):
+    from clamav_large_archive_scanner.main import _detect_cache
+
+    mock_detect_cache = mocker.patch('clamav_large_archive_scanner.main.detect_cache')
+    mock_detect_cache.DetectCache.side_effect = sqlite3.DatabaseError('file is not a database')
+
+    # Carries on without a cache
+    with _detect_cache('/some/cache.sqlite'):
+        pass
+
+    mock_detect.use_detect_cache.assert_not_called()
+
+
+def test_use_decompressor(mocker: MockerFixture):
+    from clamav_large_archive_scanner.main import _use_decompressor
+
+    mock_decompress = mocker.patch('clamav_large_archive_scanner.main.decompress')
+    mock_decompress.is_available.return_value = True
+
+    _use_decompressor('pigz')
+
+    mock_decompress.is_available.assert_called_once_with('pigz')
+    mock_decompress.use_decompressor.assert_called_once_with('pigz')
+
+
+def test_use_decompressor_not_installed(mocker: MockerFixture):
+    from clamav_large_archive_scanner.main import _use_decompressor
+
+    mock_decompress = mocker.patch('clamav_large_archive_scanner.main.decompress')
+    mock_decompress.is_available.return_value = False
+
+    with pytest.raises(click.BadParameter):
+        _use_decompressor('igzip')
+
+    mock_decompress.use_decompressor.assert_not_called()
+
+
+def test_scan_detect_jobs(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, detect_jobs=4)
+
+    _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
+                         testcase_file_meta, expected_detect_jobs=4)
+
+
+def test_scan_dedupe(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, dedupe_archives=True)
+
+    _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
+                         testcase_file_meta, expected_dedupe=True)
+
+
+@pytest.fixture(scope='function')
+def mock_stream_scan(mocker: MockerFixture):
+    mock_stream_scan = MagicMock()
+    mock_stream_scan.can_stream.side_effect = lambda x: x.filetype in (FileType.TAR, FileType.TARGZ, FileType.ZIP)
+    mocker.patch('clamav_large_archive_scanner.main.stream_scan', mock_stream_scan)
+    return mock_stream_scan
+
+
+def test_scan_stream(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_stream_scan, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    _set_detect_file_meta_from_path(mock_detect, testcase_file_meta)
+    mock_stream_scan.stream_scan.return_value = [GOOD_SCAN_RESULT, VIRUS_SCAN_RESULT]
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET,
+                    stream=True)
+    assert scan_rv == 1
+
+    mock_stream_scan.stream_scan.assert_called_once_with(testcase_file_meta, EXPECTED_CLAMD_SOCKET,
+                                                         EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR, fail_fast=False,
+                                                         scan_jobs=1, detect_jobs=1, dedupe_archives=False,
+                                                         stream_jobs=1, fdpass=False, chunk_size=1024 * 1024)
+    mock_unpacker.unpack_recursive.assert_not_called()
+    mock_scanner.clamdscan.assert_not_called()
     mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
 
 
+def test_scan_stream_jobs(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_stream_scan,
+                          testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    testcase_file_meta.filetype = FileType.ZIP
+    _set_detect_file_meta_from_path(mock_detect, testcase_file_meta)
+    mock_stream_scan.stream_scan.return_value = [GOOD_SCAN_RESULT]
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, True, False, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET,
+                    stream=True, stream_jobs=8, stream_chunk_size='4M')
+    assert scan_rv == 0
+
+    mock_stream_scan.stream_scan.assert_called_once_with(testcase_file_meta, EXPECTED_CLAMD_SOCKET,
+                                                         EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR, fail_fast=True,
+                                                         scan_jobs=1, detect_jobs=1, dedupe_archives=False,
+                                                         stream_jobs=8, fdpass=False, chunk_size=4 * 1024 * 1024)
+
+
+def test_scan_stream_bad_chunk_size(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_stream_scan):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+
+    for chunk_size in ['lots', '0']:
+        with pytest.raises(click.BadParameter):
+            _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET,
+                  stream=True, stream_chunk_size=chunk_size)
+
+    mock_stream_scan.stream_scan.assert_not_called()
+
+
+def test_scan_stream_not_a_tar(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_stream_scan,
+                               testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    testcase_file_meta.filetype = FileType.VMDK
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET,
+                    stream=True)
+    assert scan_rv == 0
+
+    # Unpacked as usual instead
+    mock_stream_scan.stream_scan.assert_not_called()
+    mock_unpacker.unpack_recursive.assert_called_once()
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False,
+                                                   clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=1, fdpass=False)
+
+
+def test_scan_stream_needs_clamd_socket(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_stream_scan):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, stream=True)
+
+    assert e.value.message == '--stream needs --clamd-socket, clamdscan can only scan files on disk'
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_stream_scan.assert_not_called()
+
+
+def test_scan_stream_all_match(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_stream_scan):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, True, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET,
+              stream=True)
+
+    assert e.value.message == 'Cannot specify both --allmatch and --stream'
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_stream_scan.assert_not_called()
+
+
+@pytest.fixture(scope='function')
+def mock_tmp_files(mocker: MockerFixture):
+    mock_tmp_files = MagicMock()
+    mocker.patch('clamav_large_archive_scanner.main.tmp_files', mock_tmp_files)
+    return mock_tmp_files
+
+
+def test_scan_fdpass(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_tmp_files, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    mock_scanner.validate_fdpass.return_value = True
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+    _set_clamdscan_rv(mock_scanner, [GOOD_SCAN_RESULT])
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET,
+                    fdpass=True)
+
+    assert scan_rv == 0
+    mock_scanner.validate_fdpass.assert_called_once_with(EXPECTED_CLAMD_SOCKET)
+    mock_tmp_files.use_private_dirs.assert_called_once_with(True)
+    mock_scanner.clamdscan.assert_called_once_with(EXPECTED_UNPACKED_DIRS, False, False,
+                                                   clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=1, fdpass=True)
+
+
+def test_scan_fdpass_tcp_socket(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_tmp_files):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    mock_scanner.validate_fdpass.return_value = False
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, 'localhost:3310', fdpass=True)
+
+    assert e.value.message == "--fdpass needs clamd's LocalSocket, descriptors can't be passed over TCP"
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_tmp_files.use_private_dirs.assert_not_called()
+
+
+def test_scan_fdpass_all_match(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, mock_tmp_files):
+    from clamav_large_archive_scanner.main import _scan
+    mock_scanner.validate_clamd.return_value = True
+    mock_scanner.validate_fdpass.return_value = True
+
+    with pytest.raises(click.ClickException) as e:
+        _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, True, EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET,
+              fdpass=True)
+
+    assert e.value.message == 'Cannot specify both --allmatch and --fdpass'
+    _assert_no_unpack(mock_detect, mock_unpacker)
+    mock_tmp_files.use_private_dirs.assert_not_called()
+
+
+def _consume_ctxs_side_effect(consumed: list, results: List[ScanResult]):
+    def _side_effect(u_ctxs, *args, **kwargs):
+        consumed.extend(u_ctxs)
+        return results
+
+    return _side_effect
+
+
+def test_scan_pipelined(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+
+    scanned_ctxs = []
+    mock_scanner.clamdscan.side_effect = _consume_ctxs_side_effect(scanned_ctxs, [GOOD_SCAN_RESULT, VIRUS_SCAN_RESULT])
+
+    scan_rv = _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, pipeline_depth=1)
+    assert scan_rv == 1
+
+    _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, True, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
+                         testcase_file_meta)
+
+    # Everything that was unpacked got handed to the scanner, in order
+    mock_scanner.clamdscan.assert_called_once()
+    assert scanned_ctxs == EXPECTED_UNPACKED_DIRS
+    mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
+
+
+def test_scan_eager_cleanup(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
+
+    scanned_ctxs = []
+    mock_scanner.clamdscan.side_effect = _consume_ctxs_side_effect(scanned_ctxs, [GOOD_SCAN_RESULT])
+    mock_eager_cleaner = mock_cleaner.EagerCleaner.return_value
+
+    # Eager cleanup turns on the pipeline by itself
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, eager_cleanup=True)
+
+    mock_cleaner.EagerCleaner.assert_called_once_with(EXPECTED_TMP_DIR)
+    mock_unpacker.unpack_recursive.assert_called_once_with(testcase_file_meta, EXPECTED_MIN_SIZE_BYTES,
+                                                           EXPECTED_TMP_DIR,
+                                                           on_inspected=mock_eager_cleaner.inspected, detect_jobs=1,
+                                                           dedupe_archives=False)
+
+    # Every context is registered before it is scanned
+    assert scanned_ctxs == EXPECTED_UNPACKED_DIRS
+    mock_eager_cleaner.unpacked.assert_has_calls([call(x) for x in EXPECTED_UNPACKED_DIRS])
+    assert mock_scanner.clamdscan.call_args.kwargs['on_scanned'] == mock_eager_cleaner.scanned
+    mock_eager_cleaner.log_peak_usage.assert_called_once()
+
+    # The final cleanup still runs, to catch anything that couldn't be cleaned up early
+    mock_cleaner.cleanup_recursive.assert_called_once_with(EXPECTED_PATH, EXPECTED_TMP_DIR)
+
+
+def test_scan_pipelined_no_unpack(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
+    from clamav_large_archive_scanner.main import _scan
+    _set_clamdscan_present(mock_scanner, True)
+    too_small_meta = testcase_file_meta
+    too_small_meta.size_raw = 0
+    _set_detect_file_meta_from_path(mock_detect, too_small_meta)
+
+    scanned_ctxs = []
+    mock_scanner.clamdscan.side_effect = _consume_ctxs_side_effect(scanned_ctxs, [])
+
+    _scan(EXPECTED_PATH, EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, pipeline_depth=1)
+
+    mock_unpacker.unpack_recursive.assert_not_called()
+
+    # Falls back to scanning the file itself
+    assert mock_scanner.clamdscan.call_count == 2
+    assert len(scanned_ctxs) == 1
+    assert scanned_ctxs[0].unpacked_dir_location == EXPECTED_PATH
+
+
 def test_scan_rv_iterations(mock_scanner, mock_cleaner, mock_unpacker, mock_detect, testcase_file_meta):
     from clamav_large_archive_scanner.main import _scan
     _set_clamdscan_present(mock_scanner, True)
@@ -260,6 +626,106 @@ def test_deepscan_no_unpack(mock_scanner, mock_cleaner, mock_unpacker, mock_dete
 
 
 
+def test_worst_rv():
+    from clamav_large_archive_scanner.main import _worst_rv
+
+    assert _worst_rv([]) == 0
+    assert _worst_rv([0, 0]) == 0
+    assert _worst_rv([0, 2]) == 2
+    assert _worst_rv([2, 1, 0]) == 1
+
+
+def test_batch_paths(tmp_path):
+    import io
+    from clamav_large_archive_scanner.main import _batch_paths
+
+    first = str(tmp_path / 'first.tar')
+    newline = str(tmp_path / 'new\nline.tar')
+    os.symlink(first, tmp_path / 'link.tar')
+
+    manifest = io.BytesIO(f'{newline}\0{tmp_path}/link.tar\0\0'.encode())
+    assert _batch_paths([first], manifest, True) == [first, newline]
+
+    manifest = io.BytesIO(f'{first}\r\n\n{tmp_path}/other.tar\n'.encode())
+    assert _batch_paths([], manifest, False) == [first, str(tmp_path / 'other.tar')]
+
+    assert _batch_paths([first, first], None, False) == [first]
+
+
+def _make_batch_paths(tmp_path, names: List[str]) -> List[str]:
+    paths = []
+    for name in names:
+        (tmp_path / name).touch()
+        paths.append(str(tmp_path / name))
+    return paths
+
+
+def test_scan_batch(mocker: MockerFixture, mock_scanner, mock_unpacker, mock_cleaner, tmp_path, capsys):
+    from clamav_large_archive_scanner.main import _scan_batch
+    _set_clamdscan_present(mock_scanner, True)
+    clean_path, virus_path, error_path = _make_batch_paths(tmp_path, ['clean.tar', 'virus.tar', 'error.tar'])
+
+    results = {clean_path: [GOOD_SCAN_RESULT], virus_path: [GOOD_SCAN_RESULT, VIRUS_SCAN_RESULT],
+               error_path: [ERROR_SCAN_RESULT]}
+    mock_scan_archive = mocker.patch('clamav_large_archive_scanner.main._scan_archive',
+                                     side_effect=lambda path, *args: results[path])
+
+    scan_rv = _scan_batch([clean_path, virus_path, error_path], 2, EXPECTED_MIN_SIZE, False, False, False,
+                          EXPECTED_TMP_DIR, scan_jobs=3, detect_jobs=2)
+    assert scan_rv == 1
+
+    # Checked once for the whole batch
+    mock_scanner.validate_clamdscan.assert_called_once_with()
+    assert mock_scan_archive.call_count == 3
+    assert mock_scan_archive.call_args[0][1:8] == (EXPECTED_MIN_SIZE, False, False, False, EXPECTED_TMP_DIR, None, 3)
+
+    # Every archive shares the same pools, which are gone once the batch is done
+    shared_scan_pool = mock_scanner.use_scan_pool.call_args_list[0][0][0]
+    assert shared_scan_pool is not None
+    assert mock_scanner.use_scan_pool.call_args_list[-1] == call(None)
+    assert mock_unpacker.use_detect_pool.call_args_list[0][0][0] is not None
+    assert mock_unpacker.use_detect_pool.call_args_list[-1] == call(None)
+
+    printed = sorted(capsys.readouterr().out.splitlines())
+    assert printed == sorted([f'0\t{clean_path}', f'1\t{virus_path}', f'2\t{error_path}'])
+
+
+def test_scan_batch_archive_errors(mocker: MockerFixture, mock_scanner, mock_cleaner, tmp_path, capsys):
+    from clamav_large_archive_scanner.main import _scan_batch
+    _set_clamdscan_present(mock_scanner, True)
+    clean_path, broken_path = _make_batch_paths(tmp_path, ['clean.tar', 'broken.tar'])
+    missing_path = str(tmp_path / 'missing.tar')
+
+    def _scan_archive(path, *args):
+        if path == broken_path:
+            raise click.FileError(filename=path, hint='Unable to unpack')
+        return [GOOD_SCAN_RESULT]
+
+    mock_scan_archive = mocker.patch('clamav_large_archive_scanner.main._scan_archive', side_effect=_scan_archive)
+
+    # One bad archive doesn't stop the rest of the batch
+    scan_rv = _scan_batch([broken_path, missing_path, clean_path], 1, EXPECTED_MIN_SIZE, False, False, False,
+                          EXPECTED_TMP_DIR)
+    assert scan_rv == 2
+
+    assert mock_scan_archive.call_count == 2
+    mock_cleaner.cleanup_recursive.assert_called_once_with(broken_path, EXPECTED_TMP_DIR)
+
+    printed = capsys.readouterr().out.splitlines()
+    assert printed == [f'2\t{broken_path}', f'2\t{missing_path}', f'0\t{clean_path}']
+
+
+def test_scan_batch_bad_min_size(mocker: MockerFixture, mock_scanner, tmp_path):
+    from clamav_large_archive_scanner.main import _scan_batch
+    _set_clamdscan_present(mock_scanner, True)
+    mock_scan_archive = mocker.patch('clamav_large_archive_scanner.main._scan_archive')
+
+    with pytest.raises(click.BadParameter):
+        _scan_batch(_make_batch_paths(tmp_path, ['a.tar', 'b.tar']), 1, 'lots', False, False, False, EXPECTED_TMP_DIR)
+
+    mock_scan_archive.assert_not_called()
+
+
 def test_unpack_non_recursive(mock_unpacker, mock_detect, testcase_file_meta):
     from clamav_large_archive_scanner.main import _unpack
     _set_default_unpack_mocks(mock_unpacker, mock_detect, testcase_file_meta)
@@ -268,3 +734,120 @@ def test_unpack_non_recursive(mock_unpacker, mock_detect, testcase_file_meta):
 
     _assert_unpack_logic(mock_detect, mock_unpacker, EXPECTED_PATH, False, EXPECTED_MIN_SIZE_BYTES, EXPECTED_TMP_DIR,
                          testcase_file_meta)
+
+
+def test_job_request(tmp_path):
+    from clamav_large_archive_scanner.main import _job_request, _SERVE_SCAN_OPTIONS
+    archive = _make_batch_paths(tmp_path, ['some.tar'])[0]
+
+    path, options = _job_request({'path': archive, 'ignore_size': True, 'pipeline_depth': 2}, _SERVE_SCAN_OPTIONS)
+    assert path == archive
+    assert options['ignore_size'] is True
+    assert options['pipeline_depth'] == 2
+    assert options['fail_fast'] is False
+    assert options['min_size'] == str(_SERVE_SCAN_OPTIONS['min_size'])
+
+    _, options = _job_request({'path': archive, 'min_size': '100M'}, _SERVE_SCAN_OPTIONS)
+    assert options['min_size'] == '100M'
+
+    bad_requests = [
+        {},
+        {'path': 'relative/some.tar'},
+        {'path': str(tmp_path / 'missing.tar')},
+        {'path': archive, 'tmp_dir': '/elsewhere'},
+        {'path': archive, 'ignore_size': 'yes'},
+        {'path': archive, 'pipeline_depth': -1},
+        {'path': archive, 'pipeline_depth': True},
+        {'path': archive, 'min_size': None},
+    ]
+    for request in bad_requests:
+        with pytest.raises(click.ClickException):
+            _job_request(request, _SERVE_SCAN_OPTIONS)
+
+
+def test_serve_scan(mocker: MockerFixture, mock_scanner, tmp_path):
+    from clamav_large_archive_scanner.main import _serve_scan, DEFAULT_MIN_SIZE_THRESHOLD_BYTES
+    archive = _make_batch_paths(tmp_path, ['some.tar'])[0]
+
+    virus_with_copy = ScanResult('virus.tar', 1, ['copy.tar'])
+    mock_scan_archive = mocker.patch('clamav_large_archive_scanner.main._scan_archive',
+                                     return_value=[GOOD_SCAN_RESULT, virus_with_copy])
+
+    reply = _serve_scan(EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET, 4, 2, 1, False, '1M',
+                        {'path': archive, 'ignore_size': True, 'dedupe': True})
+
+    assert reply == {'rv': 1, 'results': [{'path': EXPECTED_PATH, 'rv': 0, 'aliases': []},
+                                          {'path': 'virus.tar', 'rv': 1, 'aliases': ['copy.tar']}]}
+    mock_scan_archive.assert_called_once_with(archive, str(DEFAULT_MIN_SIZE_THRESHOLD_BYTES), True, False, False,
+                                              EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET, 4, 0, False, 2, True, False, 1,
+                                              False, '1M')
+
+    # clamd was checked when the server started, not for every job
+    mock_scanner.validate_clamd.assert_not_called()
+    mock_scanner.validate_clamdscan.assert_not_called()
+
+
+def test_serve_scan_bad_options(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.main import _serve_scan
+    archive = _make_batch_paths(tmp_path, ['some.tar'])[0]
+    mock_scan_archive = mocker.patch('clamav_large_archive_scanner.main._scan_archive')
+
+    with pytest.raises(click.ClickException) as e:
+        _serve_scan(EXPECTED_TMP_DIR, None, 1, 1, 1, False, '1M', {'path': archive, 'stream': True})
+
+    assert e.value.message == '--stream needs --clamd-socket, clamdscan can only scan files on disk'
+    mock_scan_archive.assert_not_called()
+
+
+def test_serve_scan_failure_cleans_up(mocker: MockerFixture, mock_cleaner, tmp_path):
+    from clamav_large_archive_scanner.main import _serve_scan
+    archive = _make_batch_paths(tmp_path, ['some.tar'])[0]
+    mocker.patch('clamav_large_archive_scanner.main._scan_archive',
+                 side_effect=click.FileError(filename=archive, hint='Unable to unpack'))
+
+    with pytest.raises(click.FileError):
+        _serve_scan(EXPECTED_TMP_DIR, EXPECTED_CLAMD_SOCKET, 1, 1, 1, False, '1M', {'path': archive})
+
+    mock_cleaner.cleanup_recursive.assert_called_once_with(archive, EXPECTED_TMP_DIR)
+
+
+def test_serve_unpack_and_cleanup(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.main import _serve_unpack, _serve_cleanup
+    archive = _make_batch_paths(tmp_path, ['some.tar'])[0]
+
+    u_ctx = common.make_basic_unpack_ctx(EXPECTED_UNPACKED_DIR, archive)
+    mock_unpack = mocker.patch('clamav_large_archive_scanner.main._unpack', return_value=[u_ctx])
+    mock_cleanup = mocker.patch('clamav_large_archive_scanner.main._cleanup')
+
+    reply = _serve_unpack(EXPECTED_TMP_DIR, 3, {'path': archive, 'recursive': True, 'min_size': 0})
+    assert reply == {'unpacked': [{'path': 'some.tar', 'dir': EXPECTED_UNPACKED_DIR}]}
+    mock_unpack.assert_called_once_with(archive, True, '0', False, EXPECTED_TMP_DIR, 3, False)
+
+    assert _serve_cleanup(EXPECTED_TMP_DIR, {'path': archive, 'file': True}) == {}
+    mock_cleanup.assert_called_once_with(archive, True, EXPECTED_TMP_DIR)
+
+
+def test_path_lock():
+    from clamav_large_archive_scanner.main import _path_lock
+
+    events = []
+    first_locked = threading.Event()
+
+    def _second():
+        assert first_locked.wait(timeout=5)
+        with _path_lock(EXPECTED_PATH):
+            events.append('second')
+
+    second = threading.Thread(target=_second)
+    second.start()
+
+    # Other paths aren't held up
+    with _path_lock(EXPECTED_PATH):
+        first_locked.set()
+        with _path_lock('/some/other/path'):
+            pass
+        second.join(timeout=0.1)
+        events.append('first')
+
+    second.join(timeout=5)
+    assert events == ['first', 'second']
@@ -26,7 +26,8 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from unittest.mock import MagicMock
+import os
+from unittest.mock import MagicMock, call
 
 # noinspection PyPackageRequirements
 import pytest
@@ -70,7 +71,6 @@ GUESTFS_PARTITIONS = ['/dev/sda1', '/dev/sda2', '/dev/sda3']
 GUESTFS_PARTITIONS_STR = '\n'.join(GUESTFS_PARTITIONS)
 EXPECTED_GUESTFS_MOUNT_POINTS = ['++dev++sda1', '++dev++sda2', '++dev++sda3']
 EXPECTED_FUSE_MOUNTS = ['/tmp/some_parent/++dev++sda1', '/tmp/some_parent/++dev++sda2', '/tmp/some_parent/++dev++sda3']
-EXPECTED_FUSE_MOUNTS_STR = '\n'.join(EXPECTED_FUSE_MOUNTS)
 EXPECTED_PARENT_TMP_DIR = '/tmp/some_parent_tmp_dir'
 EXPECTED_ARCHIVE_PATH = '/tmp/some_archive_path.some_archive_format'
 
@@ -182,87 +182,169 @@ def test_mount_iso_error(mock_subprocess):
     assert str(e.value) == EXPECTED_STDOUT + '\n' + EXPECTED_STDERR
 
 
-class GuestfsUmountRunSideEffect:
-    def __init__(self, return_good_fuse_mounts: bool, umount_should_succeed: bool):
-        self.return_good_fuse_mounts = return_good_fuse_mounts
-        self.umount_should_succeed = umount_should_succeed
+def _mountinfo_line(mount_id: int, mount_point: str, fs_type: str, source: str, optional_fields: str = 'shared:1'):
+    return f'{mount_id} 1 0:{mount_id} / {mount_point} ro,nosuid,nodev,relatime {optional_fields} - {fs_type} {source} ro'
 
-    def __call__(self, *args, **kwargs):
-        if args[0] == ['mount', '-t', 'fuse']:
-            if self.return_good_fuse_mounts:
-                return _make_subprocess_result(EXPECTED_FUSE_MOUNTS_STR, '', 0)
-            else:
-                return _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
-        elif args[0][0] == 'guestunmount':
-            if self.umount_should_succeed:
-                return _make_subprocess_result('', '', 0)
-            else:
-                return _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
 
-        return _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
+EXPECTED_MOUNTINFO = '\n'.join([_mountinfo_line(20, '/', 'ext4', '/dev/vda')] +
+                               [_mountinfo_line(30 + i, x, 'fuse', '/dev/fuse') for i, x in enumerate(EXPECTED_FUSE_MOUNTS)])
 
 
-def _mock_guestfs_umount_run_actions(mock_subprocess, return_good_fuse_mounts: bool, umount_should_succeed: bool):
-    mock_subprocess.run.side_effect = GuestfsUmountRunSideEffect(return_good_fuse_mounts, umount_should_succeed)
-
+@pytest.fixture(scope='function')
+def use_mountinfo(mocker: MockerFixture, mock_os, tmp_path):
+    def _use_mountinfo(contents: str):
+        mountinfo_path = tmp_path / 'mountinfo'
+        mountinfo_path.write_text(contents + '\n')
+        mocker.patch('clamav_large_archive_scanner.lib.mount_tools.MOUNTINFO_PATH', str(mountinfo_path))
 
-def _assert_check_fuse_mounts_called(mock_subprocess):
-    mock_subprocess.run.assert_any_call(['mount', '-t', 'fuse'], capture_output=True, text=True)
+    # Looking up mount points works on real paths
+    mock_os.path = os.path
+    mock_os.fsdecode = os.fsdecode
+    return _use_mountinfo
 
 
-def _assert_guestunmount_called(mock_subprocess, mount_point):
-    mock_subprocess.run.assert_any_call(['guestunmount', '--no-retry', mount_point], capture_output=True)
+def _mock_guestunmount(mock_subprocess, umount_should_succeed: bool):
+    if umount_should_succeed:
+        mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
+    else:
+        mock_subprocess.run.return_value = _make_subprocess_result(EXPECTED_STDOUT, EXPECTED_STDERR, 1)
 
 
-def _assert_guestumount_not_called(mock_subprocess):
-    for call in mock_subprocess.run.mock_calls:
-        assert 'guestunmount' not in call.args[0]
+def _assert_guestunmount_called(mock_subprocess, mount_point):
+    # The mount table is read from /proc, instead of having to run mount to list it
+    mock_subprocess.run.assert_called_once_with(['guestunmount', '--no-retry', mount_point], capture_output=True)
 
 
-def _call_umount_guestfs_partition(directory):
+def _call_umount_guestfs_partition(directory, mount_table=None):
     from clamav_large_archive_scanner.lib.mount_tools import umount_guestfs_partition
-    umount_guestfs_partition(directory)
+    umount_guestfs_partition(directory, mount_table)
 
 
-def test_umount_guestfs_partition(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, True, True)
+def test_umount_guestfs_partition(mock_subprocess, use_mountinfo):
+    use_mountinfo(EXPECTED_MOUNTINFO)
+    _mock_guestunmount(mock_subprocess, True)
 
     _call_umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
     _assert_guestunmount_called(mock_subprocess, EXPECTED_FUSE_MOUNTS[0])
 
 
-def test_umount_guestfs_partition_no_fuse_mount(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, False, True)
+def test_umount_guestfs_partition_no_fuse_mount(mock_subprocess, use_mountinfo):
+    use_mountinfo(_mountinfo_line(20, '/', 'ext4', '/dev/vda'))
+    _mock_guestunmount(mock_subprocess, True)
 
     _call_umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
-    _assert_guestumount_not_called(mock_subprocess)
+    mock_subprocess.run.assert_not_called()
 
 
-def test_umount_guestfs_partition_wrong_fuse_mount(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, True, True)
+def test_umount_guestfs_partition_wrong_fuse_mount(mock_subprocess, use_mountinfo):
+    use_mountinfo(EXPECTED_MOUNTINFO)
+    _mock_guestunmount(mock_subprocess, True)
 
     _call_umount_guestfs_partition('/tmp/some_other_mount')
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
-    _assert_guestumount_not_called(mock_subprocess)
+    mock_subprocess.run.assert_not_called()
+
+
+def test_umount_guestfs_partition_prefix_of_fuse_mount(mock_subprocess, use_mountinfo):
+    use_mountinfo(EXPECTED_MOUNTINFO)
+    _mock_guestunmount(mock_subprocess, True)
+
+    # Only exact mount points count, not anything that happens to be a prefix of one
+    _call_umount_guestfs_partition('/tmp/some_parent/++dev++sda')
+    _call_umount_guestfs_partition('/tmp/some_parent')
+
+    mock_subprocess.run.assert_not_called()
 
 
-def test_umount_guestfs_partition_umount_error(mock_subprocess):
-    _mock_guestfs_umount_run_actions(mock_subprocess, True, False)
+def test_umount_guestfs_partition_not_fuse(mock_subprocess, use_mountinfo):
+    use_mountinfo(_mountinfo_line(20, EXPECTED_FUSE_MOUNTS[0], 'iso9660', '/dev/loop0'))
+    _mock_guestunmount(mock_subprocess, True)
+
+    _call_umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
+
+    mock_subprocess.run.assert_not_called()
+
+
+def test_umount_guestfs_partition_umount_error(mock_subprocess, use_mountinfo):
+    use_mountinfo(EXPECTED_MOUNTINFO)
+    _mock_guestunmount(mock_subprocess, False)
 
     with pytest.raises(MountException) as e:
         _call_umount_guestfs_partition(EXPECTED_FUSE_MOUNTS[0])
 
-    _assert_check_fuse_mounts_called(mock_subprocess)
     _assert_guestunmount_called(mock_subprocess, EXPECTED_FUSE_MOUNTS[0])
 
     assert str(e.value) == EXPECTED_STDOUT + '\n' + EXPECTED_STDERR
 
 
+def test_umount_guestfs_partition_shared_mount_table(mocker: MockerFixture, mock_subprocess, use_mountinfo):
+    from clamav_large_archive_scanner.lib.mount_tools import parse_mountinfo
+    _mock_guestunmount(mock_subprocess, True)
+    mock_read = mocker.patch('clamav_large_archive_scanner.lib.mount_tools.read_mount_table')
+
+    mount_table = parse_mountinfo(EXPECTED_MOUNTINFO.encode())
+    for partition in EXPECTED_FUSE_MOUNTS:
+        _call_umount_guestfs_partition(partition, mount_table)
+
+    mock_read.assert_not_called()
+    mock_subprocess.run.assert_has_calls(
+        [call(['guestunmount', '--no-retry', x], capture_output=True) for x in EXPECTED_FUSE_MOUNTS])
+
+
+def test_parse_mountinfo(use_mountinfo):
+    from clamav_large_archive_scanner.lib.mount_tools import parse_mountinfo
+
+    mount_table = parse_mountinfo('\n'.join([
+        _mountinfo_line(20, '/', 'ext4', '/dev/vda'),
+        # Spaces and backslashes are escaped
+        _mountinfo_line(21, '/tmp/some\\040dir\\134with', 'fuse', '/dev/fuse'),
+        # Any number of optional fields, including none
+        _mountinfo_line(22, '/tmp/no_optional', 'iso9660', '/dev/loop0', optional_fields=''),
+        _mountinfo_line(23, '/tmp/many_optional', 'fuse.sshfs', 'host:/', optional_fields='shared:2 master:1'),
+        # Stacked on top of each other, only the last one is visible
+        _mountinfo_line(24, '/tmp/stacked', 'tmpfs', 'tmpfs'),
+        _mountinfo_line(25, '/tmp/stacked', 'fuse', '/dev/fuse'),
+        'some garbage line',
+        '',
+    ]).encode())
+
+    assert mount_table.get('/').fs_type == 'ext4'
+    assert mount_table.get('/').source == '/dev/vda'
+    assert mount_table.is_fuse_mount('/tmp/some dir\\with')
+    assert mount_table.get('/tmp/no_optional').fs_type == 'iso9660'
+    assert mount_table.is_fuse_mount('/tmp/many_optional')
+    assert mount_table.is_fuse_mount('/tmp/stacked')
+
+    assert mount_table.is_mounted('/tmp/no_optional/')
+    assert not mount_table.is_mounted('/tmp/no_optional/sub_dir')
+    assert not mount_table.is_fuse_mount('/tmp/no_optional')
+    assert mount_table.get('/tmp') is None
+
+
+def test_read_mount_table_unreadable(mocker: MockerFixture, mock_os, tmp_path):
+    from clamav_large_archive_scanner.lib.mount_tools import read_mount_table
+    mocker.patch('clamav_large_archive_scanner.lib.mount_tools.MOUNTINFO_PATH', str(tmp_path / 'no_such_file'))
+
+    mount_table = read_mount_table()
+
+    # Without a mount table, every lookup has to go to the filesystem
+    mock_os.path.ismount.return_value = True
+    assert mount_table.is_mounted(EXPECTED_ARCHIVE_PATH)
+    assert mount_table.is_fuse_mount(EXPECTED_ARCHIVE_PATH)
+    mock_os.path.ismount.return_value = False
+    assert not mount_table.is_mounted(EXPECTED_ARCHIVE_PATH)
+
+
+def test_is_mount_point(use_mountinfo):
+    from clamav_large_archive_scanner.lib.mount_tools import is_mount_point
+    use_mountinfo(EXPECTED_MOUNTINFO)
+
+    assert is_mount_point(EXPECTED_FUSE_MOUNTS[1])
+    assert not is_mount_point(EXPECTED_ARCHIVE_PATH)
+
+
 def test_umount_iso(mock_subprocess):
     from clamav_large_archive_scanner.lib.mount_tools import umount_iso
     mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
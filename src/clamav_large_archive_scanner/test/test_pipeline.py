@@ -0,0 +1,100 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+class CountingProducer:
+    def __init__(self, count: int):
+        self.count = count
+        self.produced = 0
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for i in range(self.count):
+                self.produced += 1
+                yield i
+        finally:
+            self.closed = True
+
+
+def test_pipeline_in_order():
+    from clamav_large_archive_scanner.lib.pipeline import BoundedPipeline
+
+    producer = CountingProducer(20)
+    with BoundedPipeline(iter(producer), 3) as items:
+        assert list(items) == list(range(20))
+
+    assert producer.closed
+
+
+def test_pipeline_is_bounded():
+    from clamav_large_archive_scanner.lib.pipeline import BoundedPipeline
+
+    producer = CountingProducer(20)
+    with BoundedPipeline(iter(producer), 3) as items:
+        first = next(iter(items))
+        assert first == 0
+
+        # Give the producer plenty of time to run ahead, if it could
+        threading.Event().wait(0.3)
+
+        # 1 consumed, 3 waiting in the queue and 1 blocked trying to get into it
+        assert producer.produced <= 5
+
+    # Stopping the pipeline stops the producer early
+    assert producer.produced < 20
+    assert producer.closed
+
+
+def test_pipeline_producer_error():
+    from clamav_large_archive_scanner.lib.pipeline import BoundedPipeline
+
+    def _failing_producer():
+        yield 1
+        raise ValueError('some_producer_error')
+
+    with BoundedPipeline(_failing_producer(), 2) as items:
+        consumed = []
+        with pytest.raises(ValueError) as e:
+            for item in items:
+                consumed.append(item)
+
+    assert consumed == [1]
+    assert str(e.value) == 'some_producer_error'
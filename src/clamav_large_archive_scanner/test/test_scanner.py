@@ -27,6 +27,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import subprocess
+import threading
 from unittest.mock import MagicMock
 
 # noinspection PyPackageRequirements
@@ -48,11 +49,17 @@ def mock_subprocess():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_clamd_client():
+    return MagicMock()
+
+
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_subprocess):
+def setup_and_teardown(mocker: MockerFixture, mock_subprocess, mock_clamd_client):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.scanner.subprocess', mock_subprocess)
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.ClamdClient', MagicMock(return_value=mock_clamd_client))
 
     # Make devnull correct
     mock_subprocess.DEVNULL = subprocess.DEVNULL
@@ -179,3 +186,348 @@ def test_clamdsan_virus_and_errors(mock_subprocess):
     results = clamdscan(EXPECTED_CTXS, False, False)
 
     assert results == EXPECTED_SCAN_RESULTS
+
+
+EXPECTED_CLAMD_SOCKET = '/run/clamav/clamd.ctl'
+
+
+def test_validate_clamd(mock_clamd_client):
+    from clamav_large_archive_scanner.lib.scanner import validate_clamd
+    mock_clamd_client.ping.return_value = True
+
+    assert validate_clamd(EXPECTED_CLAMD_SOCKET)
+
+
+def test_validate_clamd_not_running(mock_clamd_client):
+    from clamav_large_archive_scanner.lib.exceptions import ClamdException
+    from clamav_large_archive_scanner.lib.scanner import validate_clamd
+    mock_clamd_client.ping.side_effect = ClamdException('Connection refused')
+
+    assert not validate_clamd(EXPECTED_CLAMD_SOCKET)
+
+
+def _clamd_side_effect(path: str):
+    rv = PATH_SCAN_VALUES[path]
+    if rv == 0:
+        return [f'{path}: OK']
+    elif rv == 1:
+        return [f'{path}/some_file: Eicar-Signature FOUND']
+
+    return [f'{path}: Access denied. ERROR']
+
+
+def test_clamdscan_clamd_socket(mock_subprocess, mock_clamd_client):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_clamd_client.multiscan.side_effect = _clamd_side_effect
+
+    results = clamdscan(EXPECTED_CTXS, False, False, clamd_socket=EXPECTED_CLAMD_SOCKET)
+
+    assert results == EXPECTED_SCAN_RESULTS
+    assert mock_clamd_client.multiscan.call_count == len(EXPECTED_CTXS)
+    mock_clamd_client.allmatchscan.assert_not_called()
+
+    # No need for the binary when clamd's socket is known
+    mock_subprocess.run.assert_not_called()
+
+
+def test_clamdscan_clamd_socket_all_match(mock_clamd_client):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_clamd_client.allmatchscan.side_effect = _clamd_side_effect
+
+    results = clamdscan(EXPECTED_CTXS, False, True, clamd_socket=EXPECTED_CLAMD_SOCKET)
+
+    assert results == EXPECTED_SCAN_RESULTS
+    mock_clamd_client.multiscan.assert_not_called()
+
+
+def test_clamdscan_clamd_socket_connection_error(mock_clamd_client):
+    from clamav_large_archive_scanner.lib.exceptions import ClamdException
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_clamd_client.multiscan.side_effect = ClamdException('Connection refused')
+
+    results = clamdscan(EXPECTED_CTXS, True, False, clamd_socket=EXPECTED_CLAMD_SOCKET)
+
+    # A broken connection is an error, same as clamdscan returning 2
+    assert len(results) == 1
+    assert results[0].clamdscan_rv == 2
+
+
+def test_validate_fdpass():
+    from clamav_large_archive_scanner.lib.scanner import validate_fdpass
+
+    assert validate_fdpass(EXPECTED_CLAMD_SOCKET)
+    assert validate_fdpass(None)
+    assert not validate_fdpass('localhost:3310')
+    assert not validate_fdpass('clamd-host:not_a_port')
+
+
+def test_clamdscan_clamd_socket_fdpass(mock_clamd_client, tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    (tmp_path / 'sub_dir').mkdir()
+    (tmp_path / 'sub_dir' / 'some_file').write_bytes(b'some content')
+    (tmp_path / 'other_file').write_bytes(b'some content')
+
+    def _fildes_side_effect(paths):
+        return [f'{a_path}: Eicar-Signature FOUND' if a_path.endswith('some_file') else f'{a_path}: OK'
+                for a_path in paths]
+
+    mock_clamd_client.fildes_scan.side_effect = _fildes_side_effect
+
+    u_ctx = common.make_basic_unpack_ctx(str(tmp_path), 'some_file_path_1')
+    results = clamdscan([u_ctx], False, False, clamd_socket=EXPECTED_CLAMD_SOCKET, fdpass=True)
+
+    assert results == [ScanResult('some_file_path_1', 1)]
+    mock_clamd_client.multiscan.assert_not_called()
+
+
+def test_clamdscan_clamd_socket_fdpass_clean(mock_clamd_client, tmp_path):
+    from clamav_large_archive_scanner.lib.scanner import _run_clamd
+
+    scan_file = tmp_path / 'some_file'
+    scan_file.write_bytes(b'some content')
+    mock_clamd_client.fildes_scan.return_value = [f'{scan_file}: OK']
+
+    # Same as MULTISCAN, a clean scan is a single OK for the path that was asked for
+    assert _run_clamd(str(scan_file), False, EXPECTED_CLAMD_SOCKET, fdpass=True) == (0, f'{scan_file}: OK')
+    assert list(mock_clamd_client.fildes_scan.call_args.args[0]) == [str(scan_file)]
+
+
+def test_clamdscan_fdpass(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
+
+    clamdscan(EXPECTED_CTXS[:1], False, False, fdpass=True)
+
+    mock_subprocess.run.assert_called_once_with(['clamdscan', '-m', '--stdout', '--fdpass', 'some_unpack_path_1'],
+                                                capture_output=True, text=True)
+
+
+def _make_popen(stdout: str, returncode: int):
+    proc = MagicMock()
+    proc.communicate.return_value = (stdout, '')
+    proc.returncode = returncode
+    return proc
+
+
+def _popen_side_effect(*args, **kwargs):
+    unpack_path = args[0][-1]
+    return _make_popen('', PATH_SCAN_VALUES[unpack_path])
+
+
+def test_clamdscan_parallel(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_subprocess.Popen.side_effect = _popen_side_effect
+
+    results = clamdscan(EXPECTED_CTXS, False, False, scan_jobs=3)
+
+    # Results come back in the same order as the contexts, regardless of which finished first
+    assert results == EXPECTED_SCAN_RESULTS
+    assert mock_subprocess.Popen.call_count == len(EXPECTED_CTXS)
+    mock_subprocess.run.assert_not_called()
+
+
+def test_clamdscan_parallel_clamd_socket(mock_clamd_client):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_clamd_client.multiscan.side_effect = _clamd_side_effect
+
+    results = clamdscan(EXPECTED_CTXS, False, False, clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=2)
+
+    assert results == EXPECTED_SCAN_RESULTS
+
+
+def test_clamdscan_shared_pool(mock_clamd_client):
+    from concurrent.futures import ThreadPoolExecutor
+    from clamav_large_archive_scanner.lib.scanner import clamdscan, use_scan_pool
+    mock_clamd_client.multiscan.side_effect = _clamd_side_effect
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        use_scan_pool(pool)
+        try:
+            # Even with a single job, the scans go through the shared pool
+            results = clamdscan(EXPECTED_CTXS, False, False, clamd_socket=EXPECTED_CLAMD_SOCKET)
+        finally:
+            use_scan_pool(None)
+
+        # The pool is left running for everyone else
+        assert pool.submit(lambda: 42).result() == 42
+
+    assert results == EXPECTED_SCAN_RESULTS
+
+
+def test_clamdscan_parallel_fail_fast_cancels_running(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.exceptions import ClamdException
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    started = threading.Barrier(len(EXPECTED_CTXS), timeout=5)
+    clients = []
+
+    def _make_client(*args, **kwargs):
+        # Every scan gets its own connection, and so its own abort
+        client = MagicMock()
+        aborted = threading.Event()
+
+        def _slow_unless_virus(path: str):
+            started.wait()
+            if PATH_SCAN_VALUES[path] == 1:
+                return _clamd_side_effect(path)
+
+            # Everything else hangs until fail-fast aborts it
+            assert aborted.wait(timeout=5)
+            raise ClamdException('aborted')
+
+        client.multiscan.side_effect = _slow_unless_virus
+        client.abort.side_effect = aborted.set
+        clients.append(client)
+        return client
+
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.ClamdClient', MagicMock(side_effect=_make_client))
+
+    results = clamdscan(EXPECTED_CTXS, True, False, clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=3)
+
+    # Only the virus is reported, the aborted scans are not errors
+    assert results == [ScanResult('some_file_path_2', 1)]
+    assert sum(client.abort.call_count for client in clients) == 2
+
+
+def test_clamdscan_aliases_nested(mock_subprocess):
+    from clamav_large_archive_scanner.lib.contexts import UnpackContext
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_subprocess.run.return_value = _make_subprocess_result('', '', 1)
+
+    outer_ctx = common.make_basic_unpack_ctx('some_unpack_path_1', 'some_file_path_1')
+    inner_ctx = UnpackContext(common.make_file_meta('some_unpack_path_1/inner.tar'), 'some_tmp_dir',
+                              parent_ctx=outer_ctx)
+    inner_ctx.unpacked_dir_location = 'some_unpack_path_2'
+
+    results = clamdscan([outer_ctx, inner_ctx], False, False)
+
+    # Found after the archive it's in was scanned, along with everything inside of it
+    outer_ctx.aliases.append('some_copy_1')
+
+    assert results[1].path == 'some_file_path_1::/inner.tar'
+    assert results[1].aliases == ['some_copy_1::/inner.tar']
+    assert str(results[1]) == ('some_file_path_1::/inner.tar: Virus(es) found.\n'
+                               '    Identical copy: some_copy_1::/inner.tar')
+
+
+def test_clamdscan_parallel_fail_fast_keeps_found(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    u_ctxs = [common.make_basic_unpack_ctx('some_unpack_path_a', 'some_file_path_a'),
+              common.make_basic_unpack_ctx('some_unpack_path_b', 'some_file_path_b')]
+    started = threading.Barrier(2, timeout=5)
+
+    def _make_client(*args, **kwargs):
+        client = MagicMock()
+        aborted = threading.Event()
+
+        def _virus(path: str):
+            started.wait()
+
+            # This one finds its virus just as fail-fast is cancelling everything, because of the other one
+            if path == 'some_unpack_path_b':
+                assert aborted.wait(timeout=5)
+
+            return [f'{path}/some_file: Eicar-Signature FOUND']
+
+        client.multiscan.side_effect = _virus
+        client.abort.side_effect = aborted.set
+        return client
+
+    mocker.patch('clamav_large_archive_scanner.lib.clamd.ClamdClient', MagicMock(side_effect=_make_client))
+
+    results = clamdscan(u_ctxs, True, False, clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=2)
+
+    assert results == [ScanResult('some_file_path_a', 1), ScanResult('some_file_path_b', 1)]
+
+
+def test_clamdscan_parallel_pulls_when_free(mock_clamd_client):
+    import time
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+
+    pulled = []
+    pulled_while_busy = []
+    both_running = threading.Barrier(2, timeout=5)
+
+    def _u_ctxs():
+        for u_ctx in EXPECTED_CTXS:
+            pulled.append(u_ctx)
+            yield u_ctx
+
+    def _scan(path: str):
+        if path != 'some_unpack_path_3':
+            both_running.wait()
+            time.sleep(0.1)
+            pulled_while_busy.append(len(pulled))
+
+        return _clamd_side_effect(path)
+
+    mock_clamd_client.multiscan.side_effect = _scan
+
+    results = clamdscan(_u_ctxs(), False, False, clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=2)
+
+    # The last context isn't taken until one of the workers is done
+    assert pulled_while_busy[0] == 2
+    assert results == EXPECTED_SCAN_RESULTS
+
+
+def test_clamdscan_parallel_on_scanned_error(mock_clamd_client):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_clamd_client.multiscan.side_effect = _clamd_side_effect
+
+    def _on_scanned(u_ctx: UnpackContext):
+        if u_ctx is EXPECTED_CTXS[1]:
+            raise OSError('some on_scanned error')
+
+    with pytest.raises(OSError) as e:
+        clamdscan(EXPECTED_CTXS, False, False, clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=2, on_scanned=_on_scanned)
+
+    assert str(e.value) == 'some on_scanned error'
+
+
+def test_clamdscan_parallel_contexts_error(mock_clamd_client):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from clamav_large_archive_scanner.lib.scanner import clamdscan, use_scan_pool
+
+    scanned = []
+
+    def _slow_scan(path: str):
+        time.sleep(0.1)
+        scanned.append(path)
+        return _clamd_side_effect(path)
+
+    mock_clamd_client.multiscan.side_effect = _slow_scan
+
+    def _u_ctxs():
+        yield EXPECTED_CTXS[0]
+        raise OSError('some unpack error')
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        use_scan_pool(pool)
+        try:
+            with pytest.raises(OSError):
+                clamdscan(_u_ctxs(), False, False, clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=2)
+        finally:
+            use_scan_pool(None)
+
+        # Not left running in the shared pool once the error is raised
+        assert scanned == ['some_unpack_path_1']
+
+
+def test_clamdscan_aliases(mock_subprocess):
+    from clamav_large_archive_scanner.lib.scanner import clamdscan
+    mock_subprocess.run.return_value = _make_subprocess_result('', '', 0)
+
+    u_ctx = common.make_basic_unpack_ctx('some_unpack_path_1', 'some_file_path_1')
+    results = clamdscan([u_ctx], False, False)
+
+    # Identical copies found after the scan still make it into the results
+    u_ctx.aliases.append('some_copy_1')
+    u_ctx.aliases.append('some_copy_2')
+
+    assert results[0].aliases == ['some_copy_1', 'some_copy_2']
+    assert str(results[0]) == ('some_file_path_1: No virus found.\n'
+                               '    Identical copy: some_copy_1\n'
+                               '    Identical copy: some_copy_2')
@@ -0,0 +1,268 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import json
+import os
+import socket
+import threading
+import time
+from typing import List
+from unittest.mock import MagicMock
+
+import click
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+from clamav_large_archive_scanner.lib.exceptions import JobException
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def socket_path(tmp_path) -> str:
+    # UNIX socket paths are limited to ~100 bytes, and tmp_path can get close to that
+    return os.path.relpath(tmp_path / 's.sock') if len(str(tmp_path)) > 90 else str(tmp_path / 's.sock')
+
+
+@pytest.fixture(scope='function')
+def make_server(socket_path):
+    from clamav_large_archive_scanner.lib.serve import JobServer
+    servers = []
+
+    def _make_server(handlers, max_jobs=1, after_job=None) -> JobServer:
+        job_server = JobServer(socket_path, handlers, max_jobs, after_job)
+        job_server.start()
+        threading.Thread(target=job_server.serve_forever, daemon=True).start()
+        servers.append(job_server)
+        return job_server
+
+    yield _make_server
+
+    for job_server in servers:
+        job_server.shutdown()
+        job_server.close()
+
+
+def _connect(socket_path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    sock.connect(socket_path)
+    return sock
+
+
+def _send(sock: socket.socket, *requests) -> None:
+    for request in requests:
+        line = request if isinstance(request, bytes) else json.dumps(request).encode()
+        sock.sendall(line + b'\n')
+
+
+def _read_all(sock: socket.socket) -> List[dict]:
+    """
+    Tells the server that we're done sending, and reads every reply until it hangs up
+    """
+    sock.shutdown(socket.SHUT_WR)
+    with sock.makefile('rb') as replies:
+        return [json.loads(line) for line in replies]
+
+
+def test_job(make_server, socket_path):
+    after_job = MagicMock()
+    make_server({'echo': lambda request: {'echoed': request}}, after_job=after_job)
+
+    with _connect(socket_path) as sock:
+        _send(sock, {'id': 'some_id', 'command': 'echo', 'path': '/some/path'})
+        replies = _read_all(sock)
+
+    assert replies == [
+        {'id': 'some_id', 'status': 'queued', 'ahead': 0},
+        {'id': 'some_id', 'status': 'running'},
+        # The handler doesn't get the id or the command
+        {'id': 'some_id', 'status': 'done', 'echoed': {'path': '/some/path'}},
+    ]
+    after_job.assert_called_once_with()
+
+    # Only the owner can connect
+    assert os.stat(socket_path).st_mode & 0o777 == 0o600
+
+
+def test_job_ids(make_server, socket_path):
+    make_server({'echo': lambda request: {}})
+
+    with _connect(socket_path) as sock:
+        _send(sock, {'command': 'echo'}, {'command': 'echo'})
+        replies = _read_all(sock)
+
+    assert sorted(set(reply['id'] for reply in replies)) == [1, 2]
+
+
+def test_bad_requests(make_server, socket_path):
+    make_server({'echo': lambda request: {}})
+
+    with _connect(socket_path) as sock:
+        _send(sock, b'{not json', b'[1, 2]', b'', {'id': 'x', 'command': 'nope'})
+        replies = _read_all(sock)
+
+    assert len(replies) == 3
+    assert replies[0]['status'] == 'error'
+    assert replies[0]['error'].startswith('Request is not valid JSON')
+    assert replies[1] == {'status': 'error', 'error': 'Requests need to be JSON objects'}
+    assert replies[2] == {'id': 'x', 'status': 'error',
+                          'error': 'Unknown command: nope, expected one of: echo, status'}
+
+
+def test_request_too_large(make_server, socket_path):
+    from clamav_large_archive_scanner.lib.serve import MAX_REQUEST_SIZE
+    make_server({'echo': lambda request: {}})
+
+    with _connect(socket_path) as sock:
+        _send(sock, b'x' * (MAX_REQUEST_SIZE + 10), {'command': 'echo'})
+        replies = _read_all(sock)
+
+    # The requests after it still go through
+    assert replies[0] == {'status': 'error', 'error': f'Requests can be at most {MAX_REQUEST_SIZE} bytes'}
+    assert replies[-1] == {'id': 1, 'status': 'done'}
+
+
+def test_job_errors(make_server, socket_path):
+    def _bad_option(request):
+        raise click.ClickException('Bad option')
+
+    def _bug(request):
+        raise KeyError('oops')
+
+    after_job = MagicMock()
+    make_server({'bad_option': _bad_option, 'bug': _bug}, after_job=after_job)
+
+    with _connect(socket_path) as sock:
+        _send(sock, {'id': 1, 'command': 'bad_option'}, {'id': 2, 'command': 'bug'})
+        replies = _read_all(sock)
+
+    assert [reply for reply in replies if reply['status'] == 'error'] == [
+        {'id': 1, 'status': 'error', 'error': 'Bad option'},
+        {'id': 2, 'status': 'error', 'error': "'oops'"},
+    ]
+    assert after_job.call_count == 2
+
+
+def test_max_jobs_and_status(make_server, socket_path):
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def _blocking(request):
+        started.release()
+        assert release.wait(timeout=5)
+        return {}
+
+    job_server = make_server({'block': _blocking}, max_jobs=2)
+
+    with _connect(socket_path) as sock:
+        _send(sock, *[{'id': job_id, 'command': 'block'} for job_id in range(3)])
+        assert started.acquire(timeout=5)
+        assert started.acquire(timeout=5)
+
+        # The last one may not have been read yet
+        deadline = time.monotonic() + 5
+        while job_server.num_queued < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # The status is answered straight away, even with every worker busy
+        with _connect(socket_path) as status_sock:
+            _send(status_sock, {'id': 'status', 'command': 'status'})
+            assert _read_all(status_sock) == [{'id': 'status', 'status': 'done', 'queued': 1, 'running': 2,
+                                               'max_jobs': 2}]
+
+        release.set()
+        replies = _read_all(sock)
+
+    assert len([reply for reply in replies if reply['status'] == 'done']) == 3
+
+
+def test_close_cancels_queued(make_server, socket_path):
+    started = threading.Event()
+    release = threading.Event()
+
+    def _blocking(request):
+        started.set()
+        assert release.wait(timeout=5)
+        return {}
+
+    job_server = make_server({'block': _blocking})
+
+    with _connect(socket_path) as sock:
+        _send(sock, {'id': 'running', 'command': 'block'}, {'id': 'queued', 'command': 'block'})
+        assert started.wait(timeout=5)
+
+        closer = threading.Thread(target=lambda: (job_server.shutdown(), job_server.close()))
+        closer.start()
+
+        # The running job gets to finish, the queued one never starts
+        deadline = time.monotonic() + 5
+        while job_server.num_queued > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        closer.join(timeout=5)
+        replies = _read_all(sock)
+
+    assert {'id': 'running', 'status': 'done'} in replies
+    assert {'id': 'queued', 'status': 'error', 'error': 'The server is shutting down'} in replies
+    assert {'id': 'queued', 'status': 'running'} not in replies
+    assert not os.path.exists(socket_path)
+
+
+def test_start_replaces_stale_socket(socket_path):
+    from clamav_large_archive_scanner.lib.serve import JobServer
+
+    # Left behind by a server that is gone
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+
+    job_server = JobServer(socket_path, {})
+    job_server.start()
+    try:
+        # But not one that is still in use
+        with pytest.raises(JobException):
+            JobServer(socket_path, {}).start()
+    finally:
+        job_server.close()
+
+
+def test_start_not_a_socket(socket_path):
+    from clamav_large_archive_scanner.lib.serve import JobServer
+
+    with open(socket_path, 'w') as f:
+        f.write('not a socket')
+
+    with pytest.raises(JobException):
+        JobServer(socket_path, {}).start()
+
+    # Left alone
+    assert os.path.isfile(socket_path)
@@ -0,0 +1,613 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import gzip
+import io
+import os
+import socketserver
+import stat
+import struct
+import tarfile
+import threading
+import zipfile
+from unittest.mock import MagicMock
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+from clamav_large_archive_scanner.lib.exceptions import ClamdException
+from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType
+from clamav_large_archive_scanner.lib.scanner import ScanResult
+from clamav_large_archive_scanner.lib.tmp_registry import REGISTRY_FILENAME
+
+EXPECTED_CLAMD_SOCKET = '/run/clamav/clamd.ctl'
+VIRUS_CONTENT = b'pretend this is EICAR'
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+class _FakeClamdClient:
+    """
+    Reads everything it is given, like clamd would, and finds a virus in anything containing VIRUS_CONTENT
+    """
+
+    def __init__(self):
+        self.streamed = []
+        self.num_from_fd = 0
+
+    def _reply(self, data: bytes):
+        self.streamed.append(data)
+        if VIRUS_CONTENT in data:
+            return ['stream: Eicar FOUND']
+        return ['stream: OK']
+
+    def instream(self, fileobj, chunk_size=7):
+        data = b''
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            data += chunk
+
+        return self._reply(data)
+
+    def instream_fd(self, fd, offset, size, chunk_size=7):
+        self.num_from_fd += 1
+        return self._reply(os.pread(fd, size, offset))
+
+
+@pytest.fixture(scope='function')
+def fake_client():
+    return _FakeClamdClient()
+
+
+class _FakeClamdHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = b''
+        while not command.endswith(b'\0'):
+            command += self.rfile.read(1)
+
+        verb, _, path = command[1:-1].decode().partition(' ')
+        if verb == 'INSTREAM':
+            data = b''
+            while True:
+                chunk_len, = struct.unpack('>I', self.rfile.read(4))
+                if chunk_len == 0:
+                    break
+                data += self.rfile.read(chunk_len)
+            found = VIRUS_CONTENT in data
+        else:
+            found = False
+            for root, _, names in os.walk(path):
+                for name in names:
+                    with open(os.path.join(root, name), 'rb') as f:
+                        found = found or VIRUS_CONTENT in f.read()
+
+        self.wfile.write(f'{path or "stream"}: {"Eicar FOUND" if found else "OK"}\0'.encode())
+
+
+@pytest.fixture(scope='function')
+def fake_clamd(tmp_path):
+    """
+    A clamd of sorts, on an actual socket, for scans that happen in other processes, where fake_client can't reach
+    """
+    socket_path = str(tmp_path / 'clamd.sock')
+    server = socketserver.ThreadingUnixStreamServer(socket_path, _FakeClamdHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield socket_path
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def setup_and_teardown(mocker: MockerFixture, fake_client):
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.clamd.ClamdClient', return_value=fake_client)
+
+    yield
+
+
+def _tar_bytes(members: dict, mode: str = 'w') -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+    return buf.getvalue()
+
+
+def _zip_bytes(members: dict) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+
+    return buf.getvalue()
+
+
+def _make_file_meta(tmp_path, content: bytes, filetype: FileType = FileType.TAR) -> FileMetadata:
+    archive_path = tmp_path / f'some_archive.{filetype.get_filetype_short()}'
+    archive_path.write_bytes(content)
+
+    file_meta = FileMetadata()
+    file_meta.path = str(archive_path)
+    file_meta.filetype = filetype
+    file_meta.size_raw = len(content)
+    return file_meta
+
+
+def _stream_scan(tmp_path, file_meta: FileMetadata, min_file_size: int = 0, fail_fast: bool = False,
+                 stream_jobs: int = 1, clamd_socket: str = EXPECTED_CLAMD_SOCKET):
+    from clamav_large_archive_scanner.lib.stream_scan import stream_scan
+
+    scan_tmp_dir = tmp_path / 'scan_tmp'
+    scan_tmp_dir.mkdir(exist_ok=True)
+
+    results = stream_scan(file_meta, clamd_socket, min_file_size, str(scan_tmp_dir), fail_fast=fail_fast,
+                          stream_jobs=stream_jobs)
+
+    # Nothing is ever left behind, other than the record of the temp dirs that were made
+    assert [x for x in scan_tmp_dir.iterdir() if not x.name.startswith(REGISTRY_FILENAME)] == []
+    return results
+
+
+def test_stream_scan_clean(tmp_path, fake_client):
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'a.txt': b'aaaa', 'dir/b.txt': b'bbbb'}))
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.tar', 0)]
+    assert fake_client.streamed == [b'aaaa', b'bbbb']
+
+    # Sent straight from the tar on disk
+    assert fake_client.num_from_fd == 2
+
+
+def test_stream_scan_virus(tmp_path, fake_client):
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'a.txt': b'aaaa', 'bad.txt': VIRUS_CONTENT, 'c.txt': b'cc'}))
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.tar', 1),
+                                                 ScanResult('some_archive.tar::/bad.txt', 1)]
+    assert len(fake_client.streamed) == 3
+
+
+def test_stream_scan_fail_fast(tmp_path, fake_client):
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'a.txt': b'aaaa', 'bad.txt': VIRUS_CONTENT, 'c.txt': b'cc'}))
+
+    assert _stream_scan(tmp_path, file_meta, fail_fast=True) == [ScanResult('some_archive.tar', 1),
+                                                                 ScanResult('some_archive.tar::/bad.txt', 1)]
+    assert fake_client.streamed == [b'aaaa', VIRUS_CONTENT]
+
+
+def test_stream_scan_nested_tars(tmp_path, fake_client):
+    inner_tar = _tar_bytes({'bad.txt': VIRUS_CONTENT}, mode='w:gz')
+    middle_tar = _tar_bytes({'inner.tar.gz': inner_tar, 'b.txt': b'bbbb'})
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'a.txt': b'aaaa', 'middle.tar': middle_tar}))
+
+    assert _stream_scan(tmp_path, file_meta) == [
+        ScanResult('some_archive.tar', 1),
+        ScanResult('some_archive.tar::/middle.tar::/inner.tar.gz::/bad.txt', 1),
+    ]
+
+    # The nested tars are never scanned as a whole, only what is in them
+    assert fake_client.streamed == [b'aaaa', VIRUS_CONTENT, b'bbbb']
+
+
+def test_stream_scan_nested_tar_below_min_size(tmp_path, fake_client):
+    middle_tar = _tar_bytes({'b.txt': b'bbbb'})
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'middle.tar': middle_tar}))
+
+    assert _stream_scan(tmp_path, file_meta, min_file_size=len(middle_tar) + 1) == [
+        ScanResult('some_archive.tar', 0)]
+    assert fake_client.streamed == [middle_tar]
+
+
+def test_stream_scan_gzip_not_a_tar(tmp_path, fake_client):
+    not_a_tar = gzip.compress(b'just some text ' * 100)
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'notes.txt.gz': not_a_tar}))
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.tar', 0)]
+
+    # Gets scanned as a whole instead
+    assert fake_client.streamed == [not_a_tar]
+
+
+def test_stream_scan_truncated(tmp_path, fake_client):
+    content = _tar_bytes({'a.txt': b'a' * 2048, 'b.txt': b'b' * 2048})
+    file_meta = _make_file_meta(tmp_path, content[:1024])
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.tar', 2),
+                                                 ScanResult('some_archive.tar', 2)]
+
+
+def test_stream_scan_clamd_error(tmp_path, fake_client):
+    fake_client.instream_fd = MagicMock(side_effect=ClamdException('Lost connection'))
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'a.txt': b'aaaa'}))
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.tar', 2),
+                                                 ScanResult('some_archive.tar::/a.txt', 2)]
+
+
+def test_stream_scan_not_a_tar(tmp_path):
+    import click
+    from clamav_large_archive_scanner.lib.stream_scan import stream_scan
+
+    file_meta = _make_file_meta(tmp_path, b'not a tar at all')
+
+    with pytest.raises(click.FileError):
+        stream_scan(file_meta, EXPECTED_CLAMD_SOCKET, 0, str(tmp_path))
+
+
+def test_stream_scan_spills_other_archives(mocker: MockerFixture, tmp_path, fake_client):
+    mock_unpack = MagicMock()
+    mock_unpack.HANDLED_FILE_TYPES = [FileType.ZIP]
+    mock_scanner = MagicMock()
+    mock_cleanup = MagicMock()
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.unpack', mock_unpack)
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.scanner', mock_scanner)
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.cleanup', mock_cleanup)
+
+    zip_content = _zip_bytes({'c.txt': b'cccc'})
+    file_meta = _make_file_meta(tmp_path, _tar_bytes({'a.txt': b'aaaa', 'dir/inner.zip': zip_content}))
+
+    spilled = {}
+
+    def _unpack_recursive_side_effect(spilled_meta, min_file_size, tmp_dir, detect_jobs, dedupe_archives, outer_ctx):
+        with open(spilled_meta.path, 'rb') as f:
+            spilled['content'] = f.read()
+
+        spilled['nice_filename'] = outer_ctx.nice_filename()
+        assert spilled_meta.filetype == FileType.ZIP
+        assert spilled_meta.root_meta is file_meta
+        return ['unpacked_ctx']
+
+    mock_unpack.unpack_recursive.side_effect = _unpack_recursive_side_effect
+    mock_scanner.clamdscan.return_value = [ScanResult('some_archive.tar::/dir/inner.zip', 1)]
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.tar', 1),
+                                                 ScanResult('some_archive.tar::/dir/inner.zip', 1)]
+
+    # Scanned as a whole on the way to disk, then unpacked like any other archive
+    assert fake_client.streamed == [b'aaaa', zip_content]
+    assert spilled == {'content': zip_content, 'nice_filename': 'some_archive.tar'}
+    mock_scanner.clamdscan.assert_called_once_with(['unpacked_ctx'], False, False,
+                                                   clamd_socket=EXPECTED_CLAMD_SOCKET, scan_jobs=1, fdpass=False)
+    mock_cleanup.cleanup_ctx.assert_called_once_with('unpacked_ctx')
+
+
+def test_stream_scan_spills_each_member_to_a_new_dir(mocker: MockerFixture, tmp_path, fake_client):
+    import clamav_large_archive_scanner.lib.tmp_files as tmp_files
+
+    mock_unpack = MagicMock()
+    mock_unpack.HANDLED_FILE_TYPES = [FileType.ZIP]
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.unpack', mock_unpack)
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.scanner', MagicMock())
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.cleanup', MagicMock())
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files._private_dirs', True)
+
+    file_meta = _make_file_meta(tmp_path, _zip_bytes({'one.zip': _zip_bytes({'a.txt': b'aaaa'}),
+                                                      'two.zip': _zip_bytes({'b.txt': b'bbbb'})}), FileType.ZIP)
+
+    spill_dirs = []
+
+    def _unpack_recursive_side_effect(spilled_meta, min_file_size, tmp_dir, detect_jobs, dedupe_archives, outer_ctx):
+        # The temp dir of the first spill is gone by the second, which gets one of its own, made like any other
+        spill_dir = os.path.dirname(spilled_meta.path)
+        assert spill_dir == outer_ctx.unpacked_dir_location
+        assert stat.S_IMODE(os.stat(spill_dir).st_mode) == 0o700
+        assert spill_dir in tmp_files.find_associated_dirs(file_meta.path, tmp_dir)
+
+        spill_dirs.append(spill_dir)
+        return []
+
+    mock_unpack.unpack_recursive.side_effect = _unpack_recursive_side_effect
+
+    _stream_scan(tmp_path, file_meta)
+
+    assert len(spill_dirs) == 2
+    assert spill_dirs[0] != spill_dirs[1]
+
+
+def test_stream_scan_zip(tmp_path, fake_client):
+    inner_tar = _tar_bytes({'bad.txt': VIRUS_CONTENT})
+    file_meta = _make_file_meta(tmp_path, _zip_bytes({'a.txt': b'aaaa', 'dir/inner.tar': inner_tar, 'c.txt': b'cc'}),
+                                FileType.ZIP)
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.zip', 1),
+                                                 ScanResult('some_archive.zip::/dir/inner.tar::/bad.txt', 1)]
+    assert fake_client.streamed == [b'aaaa', VIRUS_CONTENT, b'cc']
+
+
+def test_stream_scan_zip_fail_fast(tmp_path, fake_client):
+    file_meta = _make_file_meta(tmp_path, _zip_bytes({'bad.txt': VIRUS_CONTENT, 'b.txt': b'bbbb'}), FileType.ZIP)
+
+    assert _stream_scan(tmp_path, file_meta, fail_fast=True) == [ScanResult('some_archive.zip', 1),
+                                                                 ScanResult('some_archive.zip::/bad.txt', 1)]
+    assert fake_client.streamed == [VIRUS_CONTENT]
+
+
+def test_stream_scan_zip_bad_member(tmp_path, fake_client):
+    content = bytearray(_zip_bytes({'a.txt': b'aaaa', 'b.txt': b'bbbb'}))
+
+    # Breaks the CRC of a.txt, which is only noticed once all of it has been read
+    content[content.index(b'aaaa')] = ord('x')
+    file_meta = _make_file_meta(tmp_path, bytes(content), FileType.ZIP)
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.zip', 2),
+                                                 ScanResult('some_archive.zip::/a.txt', 2)]
+    assert fake_client.streamed == [b'bbbb']
+
+
+def test_stream_scan_zip_jobs(tmp_path, fake_clamd):
+    members = {f'file_{x}.txt': f'content {x}'.encode() for x in range(20)}
+    members['file_7.txt'] = VIRUS_CONTENT
+    members['file_13.txt'] = VIRUS_CONTENT
+    file_meta = _make_file_meta(tmp_path, _zip_bytes(members), FileType.ZIP)
+
+    # Results come back in member order, no matter which worker scanned them
+    assert _stream_scan(tmp_path, file_meta, stream_jobs=4,
+                        clamd_socket=fake_clamd) == [ScanResult('some_archive.zip', 1),
+                                                     ScanResult('some_archive.zip::/file_7.txt', 1),
+                                                     ScanResult('some_archive.zip::/file_13.txt', 1)]
+
+
+def test_stream_scan_zip_jobs_lock_held(tmp_path, fake_clamd):
+    import clamav_large_archive_scanner.lib.tmp_files as tmp_files
+
+    # Nested zips are spilled to a temp dir of their own, which is recorded in the registry under _registries_lock
+    members = {f'inner_{x}.zip': _zip_bytes({'bad.txt': VIRUS_CONTENT}) for x in range(4)}
+    file_meta = _make_file_meta(tmp_path, _zip_bytes(members), FileType.ZIP)
+
+    # Like another scan-batch or serve job would, in the middle of making a temp dir of its own
+    results = []
+    with tmp_files._registries_lock:
+        scan_thread = threading.Thread(
+            target=lambda: results.extend(_stream_scan(tmp_path, file_meta, stream_jobs=2, clamd_socket=fake_clamd)),
+            daemon=True)
+        scan_thread.start()
+
+        # A worker forked from here, while the lock is held, would wait for it forever
+        scan_thread.join(timeout=60)
+        assert not scan_thread.is_alive()
+
+    assert ScanResult('some_archive.zip', 1) in results
+    assert ScanResult('some_archive.zip::/inner_3.zip', 1) in results
+
+
+def test_stream_scan_zip_jobs_worker_died(mocker: MockerFixture, tmp_path):
+    import click
+    from concurrent.futures.process import BrokenProcessPool
+
+    mock_pool_class = mocker.patch('clamav_large_archive_scanner.lib.stream_scan.ProcessPoolExecutor')
+    mock_pool = mock_pool_class.return_value
+    mock_pool.submit.return_value.result.side_effect = BrokenProcessPool('A child process terminated abruptly')
+
+    file_meta = _make_file_meta(tmp_path, _zip_bytes({'a.txt': b'aaaa', 'b.txt': b'bbbb'}), FileType.ZIP)
+
+    with pytest.raises(click.FileError) as e:
+        _stream_scan(tmp_path, file_meta, stream_jobs=2)
+
+    assert e.value.filename == file_meta.path
+    mock_pool.shutdown.assert_called_once_with(wait=True, cancel_futures=True)
+
+
+def test_stream_scan_not_a_zip(tmp_path):
+    import click
+    from clamav_large_archive_scanner.lib.stream_scan import stream_scan
+
+    file_meta = _make_file_meta(tmp_path, b'not a zip at all', FileType.ZIP)
+
+    with pytest.raises(click.FileError):
+        stream_scan(file_meta, EXPECTED_CLAMD_SOCKET, 0, str(tmp_path))
+
+
+def _iso_bytes(tmp_path, tree: dict, **kwargs) -> bytes:
+    iso_path = tmp_path / 'built.iso'
+    common.make_iso(str(iso_path), tree, **kwargs)
+    content = iso_path.read_bytes()
+    iso_path.unlink()
+    return content
+
+
+def test_stream_scan_iso(tmp_path, fake_client):
+    inner_tar = _tar_bytes({'bad.txt': VIRUS_CONTENT})
+    iso_content = _iso_bytes(tmp_path, {'a.txt': b'aaaa', 'big': [b'x' * 3000, b'y'],
+                                        'Dir': {'bad.txt': VIRUS_CONTENT, 'inner.tar': inner_tar}}, rock_ridge=True)
+    file_meta = _make_file_meta(tmp_path, iso_content, FileType.ISO)
+
+    assert _stream_scan(tmp_path, file_meta) == [ScanResult('some_archive.iso', 1),
+                                                 ScanResult('some_archive.iso::/Dir/bad.txt', 1),
+                                                 ScanResult('some_archive.iso::/Dir/inner.tar::/bad.txt', 1)]
+    assert fake_client.streamed == [b'aaaa', b'x' * 3000 + b'y', VIRUS_CONTENT, VIRUS_CONTENT]
+
+    # Only files in a single extent are sent straight from the image
+    assert fake_client.num_from_fd == 2
+
+
+def test_stream_scan_iso_corrupt(tmp_path, fake_client):
+    iso_content = bytearray(_iso_bytes(tmp_path, {'a.txt': b'aaaa', 'Dir': {'b.txt': b'bbbb'}}))
+
+    # Breaks the first record of Dir, which is written just before the root directory at the end of the image
+    iso_content[-2 * common.ISO_SECTOR_SIZE] = 1
+    file_meta = _make_file_meta(tmp_path, bytes(iso_content), FileType.ISO)
+
+    results = _stream_scan(tmp_path, file_meta)
+    assert results[0] == ScanResult('some_archive.iso', 2)
+    assert fake_client.streamed == [b'aaaa']
+
+
+def test_can_stream(tmp_path):
+    from clamav_large_archive_scanner.lib.stream_scan import can_stream
+
+    assert can_stream(_make_file_meta(tmp_path, _tar_bytes({'a.txt': b'aaaa'})))
+    assert can_stream(_make_file_meta(tmp_path, _iso_bytes(tmp_path, {'a.txt': b'aaaa'}), FileType.ISO))
+    assert not can_stream(_make_file_meta(tmp_path, b'some vmdk', FileType.VMDK))
+
+    # UDF images need to be mounted
+    assert not can_stream(_make_file_meta(tmp_path, _iso_bytes(tmp_path, {'a.txt': b'aaaa'}, udf=True),
+                                          FileType.ISO))
+
+
+class _FakeGuestFSImage:
+    def __init__(self, files: dict):
+        self.files = files
+        self.failed = {'/dev/sda2': 'some mount error'}
+        self.closed = False
+
+    def iter_files(self):
+        return [(path, len(content or b'')) for path, content in self.files.items()]
+
+    def open(self, path, size):
+        if self.files[path] is None:
+            raise OSError('some read error')
+        return io.BytesIO(self.files[path])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.closed = True
+
+
+def test_stream_scan_guestfs(mocker: MockerFixture, tmp_path, fake_client):
+    inner_tar = _tar_bytes({'bad.txt': VIRUS_CONTENT})
+    image = _FakeGuestFSImage({'/++dev++sda1/etc/passwd': b'root', '/++dev++sda1/home/inner.tar': inner_tar,
+                               '/++dev++sda1/broken': None, '/++dev++sda1/z': b'zz'})
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.guestfs_appliance.GuestFSImage', return_value=image)
+
+    file_meta = _make_file_meta(tmp_path, b'some disk image', FileType.QCOW2)
+
+    # Nothing mounted, every file is read through the API
+    assert _stream_scan(tmp_path, file_meta) == [
+        ScanResult('some_archive.qcow2', 1),
+        ScanResult('some_archive.qcow2::/++dev++sda1/home/inner.tar::/bad.txt', 1),
+        ScanResult('some_archive.qcow2::/++dev++sda1/broken', 2)]
+    assert fake_client.streamed == [b'root', VIRUS_CONTENT, b'zz']
+    assert image.closed
+
+
+def test_stream_scan_guestfs_launch_error(mocker: MockerFixture, tmp_path):
+    import click
+    from clamav_large_archive_scanner.lib.exceptions import MountException
+
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.guestfs_appliance.GuestFSImage',
+                 side_effect=MountException('some launch error'))
+    file_meta = _make_file_meta(tmp_path, b'some disk image', FileType.VMDK)
+
+    with pytest.raises(click.FileError):
+        _stream_scan(tmp_path, file_meta)
+
+
+def test_can_stream_guestfs(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.stream_scan import can_stream
+
+    mock_is_available = mocker.patch('clamav_large_archive_scanner.lib.stream_scan.guestfs_appliance.is_available')
+    file_meta = _make_file_meta(tmp_path, b'some disk image', FileType.VMDK)
+
+    mock_is_available.return_value = True
+    assert can_stream(file_meta)
+
+    # Unpacked with guestmount instead
+    mock_is_available.return_value = False
+    assert not can_stream(file_meta)
+
+
+def test_replay_reader():
+    from clamav_large_archive_scanner.lib.stream_scan import _ReplayReader
+
+    copy_to = io.BytesIO()
+    reader = _ReplayReader(b'head', io.BytesIO(b'rest'), copy_to=copy_to)
+
+    assert reader.read(3) == b'hea'
+    assert reader.rewind()
+    assert reader.read(-1) == b'head'
+    assert reader.read(-1) == b'rest'
+    assert reader.read(-1) == b''
+
+    # Too late now
+    assert not reader.rewind()
+    assert copy_to.getvalue() == b'heahead' + b'rest'
+
+
+def test_replay_reader_readinto():
+    from clamav_large_archive_scanner.lib.stream_scan import _ReplayReader
+
+    copy_to = io.BytesIO()
+    reader = _ReplayReader(b'head', io.BytesIO(b'the rest'), copy_to=copy_to)
+    buffer = bytearray(6)
+
+    # Never more than what is left of the head, so that the rest can be read straight into the buffer
+    assert reader.readinto(memoryview(buffer)) == 4
+    assert buffer[:4] == b'head'
+    assert reader.readinto(memoryview(buffer)) == 6
+    assert buffer == b'the re'
+    assert reader.readinto(memoryview(buffer)) == 2
+    assert reader.readinto(memoryview(buffer)) == 0
+
+    assert reader.bytes_read == 12
+    assert copy_to.getvalue() == b'headthe rest'
+
+
+def test_zip_worker_settings(mocker: MockerFixture, tmp_path):
+    import clamav_large_archive_scanner.lib.decompress as decompress
+    import clamav_large_archive_scanner.lib.file_data as file_data
+    import clamav_large_archive_scanner.lib.guestfs_appliance as guestfs_appliance
+    import clamav_large_archive_scanner.lib.tmp_files as tmp_files
+    from clamav_large_archive_scanner.lib.detect_cache import DetectCache
+    from clamav_large_archive_scanner.lib.stream_scan import _apply_worker_settings, _worker_settings
+
+    cache = DetectCache(str(tmp_path / 'detect.db'))
+    mocker.patch.object(decompress, '_decompressor', decompress.DECOMPRESSOR_PYTHON)
+    mocker.patch.object(file_data, '_detect_cache', cache)
+    mocker.patch.object(guestfs_appliance, '_fixed_appliance', '/some/appliance')
+    mocker.patch.object(tmp_files, '_private_dirs', True)
+    settings = _worker_settings()
+    cache.close()
+
+    # What a worker starts out with
+    mocker.patch.object(decompress, '_decompressor', decompress.DECOMPRESSOR_AUTO)
+    mocker.patch.object(file_data, '_detect_cache', None)
+    mocker.patch.object(guestfs_appliance, '_fixed_appliance', None)
+    mocker.patch.object(tmp_files, '_private_dirs', False)
+    mocker.patch('clamav_large_archive_scanner.lib.stream_scan.multiprocessing.util.Finalize')
+
+    _apply_worker_settings(*settings)
+
+    assert decompress.decompressor() == decompress.DECOMPRESSOR_PYTHON
+    assert file_data.get_detect_cache().path == str(tmp_path / 'detect.db')
+    assert guestfs_appliance.appliance_settings() == ('/some/appliance', None)
+    assert tmp_files.private_dirs()
+    file_data.get_detect_cache().close()
@@ -27,6 +27,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import tempfile
 from unittest.mock import MagicMock
 
 # noinspection PyPackageRequirements
@@ -72,13 +73,22 @@ def mock_os():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_tmp_registry():
+    mock_tmp_registry = MagicMock()
+    mock_tmp_registry.registry_path.side_effect = lambda x: os.path.join(x, 'some_registry')
+    return mock_tmp_registry
+
+
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_glob, mock_tempfile, mock_os):
+def setup_and_teardown(mocker: MockerFixture, mock_glob, mock_tempfile, mock_os, mock_tmp_registry):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.tmp_files.glob', mock_glob)
     mocker.patch('clamav_large_archive_scanner.lib.tmp_files.tempfile', mock_tempfile)
     mocker.patch('clamav_large_archive_scanner.lib.tmp_files.os', mock_os)
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files.tmp_registry', mock_tmp_registry)
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files._registries', {})
 
     # Make os.path the real one
     mock_os.path = os.path
@@ -101,7 +111,7 @@ def _make_file_meta(include_parent: bool) -> FileMetadata:
     return file_meta
 
 
-def test_make_temp_dir_no_parent(mock_tempfile, mock_os):
+def test_make_temp_dir_no_parent(mock_tempfile, mock_os, mock_tmp_registry):
     from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir
 
     mock_tempfile.mkdtemp.return_value = EXPECTED_MKDTEMP_RV
@@ -113,19 +123,42 @@ def test_make_temp_dir_no_parent(mock_tempfile, mock_os):
     mock_tempfile.mkdtemp.assert_called_once_with(prefix=EXPECTED_MKDTEMP_PREFIX_NO_PARENT, dir=EXPECTED_TMP_DIR)
     mock_os.chmod.assert_called_once_with(EXPECTED_MKDTEMP_RV, 0o755)
 
+    mock_tmp_registry.TmpDirRegistry.assert_called_once_with(EXPECTED_TMP_DIR)
+    mock_tmp_registry.TmpDirRegistry.return_value.add.assert_called_once_with(
+        EXPECTED_MKDTEMP_RV, EXPECTED_ARCHIVE_PATH, EXPECTED_FILE_TYPE, None)
+
 
-def test_make_tmp_dir_with_parent(mock_tempfile, mock_os):
+def test_make_tmp_dir_with_parent(mock_tempfile, mock_os, mock_tmp_registry):
     from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir
 
     mock_tempfile.mkdtemp.return_value = EXPECTED_MKDTEMP_RV
 
     file_meta = _make_file_meta(True)
 
-    assert make_temp_dir(file_meta, EXPECTED_TMP_DIR) == EXPECTED_MKDTEMP_RV
+    assert make_temp_dir(file_meta, EXPECTED_TMP_DIR, parent_dir='/tmp/some_parent_dir') == EXPECTED_MKDTEMP_RV
 
     mock_tempfile.mkdtemp.assert_called_once_with(prefix=EXPECTED_MKDTEMP_PREFIX_WITH_PARENT, dir=EXPECTED_TMP_DIR)
     mock_os.chmod.assert_called_once_with(EXPECTED_MKDTEMP_RV, 0o755)
 
+    # Registered under the root archive, not the one it was unpacked from
+    mock_tmp_registry.TmpDirRegistry.return_value.add.assert_called_once_with(
+        EXPECTED_MKDTEMP_RV, EXPECTED_PARENT_PATH, EXPECTED_FILE_TYPE, '/tmp/some_parent_dir')
+
+
+def test_make_temp_dir_registry_error(mock_tempfile, mock_tmp_registry):
+    import sqlite3
+    from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir
+
+    mock_tempfile.mkdtemp.return_value = EXPECTED_MKDTEMP_RV
+    mock_tmp_registry.TmpDirRegistry.side_effect = sqlite3.OperationalError('unable to open database file')
+
+    # Carries on without it
+    assert make_temp_dir(_make_file_meta(False), EXPECTED_TMP_DIR) == EXPECTED_MKDTEMP_RV
+    assert make_temp_dir(_make_file_meta(False), EXPECTED_TMP_DIR) == EXPECTED_MKDTEMP_RV
+
+    # And doesn't keep trying
+    mock_tmp_registry.TmpDirRegistry.assert_called_once()
+
 
 HANDLED_FILE_TYPES = [FileType.TAR, FileType.TARGZ, FileType.ZIP, FileType.ISO, FileType.VMDK, FileType.QCOW2]
 
@@ -140,12 +173,136 @@ def test_detect_filetype():
     assert determine_tmp_dir_filetype(f'/tmp/someone_elses_file.tar') == FileType.UNKNOWN
 
 
-def test_find_associated_dirs(mock_glob):
+def test_find_associated_dirs(mock_glob, mock_tmp_registry):
     from clamav_large_archive_scanner.lib.tmp_files import find_associated_dirs
 
     expected_glob_return = [EXPECTED_ARCHIVE_PATH]
 
+    # Without a registry, they have to be found by name
     mock_glob.glob.return_value = expected_glob_return
     assert find_associated_dirs(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR) == expected_glob_return
 
     mock_glob.glob.assert_called_once_with(f'{EXPECTED_TMP_DIR}/{EXPECTED_TMP_FILE_PREFIX}_*_{EXPECTED_ARCHIVE_NAME}_*')
+    mock_tmp_registry.TmpDirRegistry.assert_not_called()
+
+
+@pytest.fixture(scope='function')
+def real_registry(mocker: MockerFixture, tmp_path):
+    import clamav_large_archive_scanner.lib.tmp_registry
+    from clamav_large_archive_scanner.lib.tmp_files import close_registries
+
+    # Actual temp dirs, in an actual registry
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files.os', os)
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files.tempfile', tempfile)
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files.tmp_registry', clamav_large_archive_scanner.lib.tmp_registry)
+
+    yield str(tmp_path)
+
+    close_registries()
+
+
+def _make_real_file_meta(path: str, filetype: FileType, root_meta=None) -> FileMetadata:
+    file_meta = FileMetadata()
+    file_meta.path = path
+    file_meta.filetype = filetype
+    file_meta.root_meta = root_meta
+    return file_meta
+
+
+def test_find_associated_dirs_registry(real_registry, mock_glob):
+    from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir, find_associated_dirs, forget_tmp_dir, \
+        determine_tmp_dir_filetype
+
+    archive_meta = _make_real_file_meta('/some/dir/archive.iso', FileType.ISO)
+    archive_dir = make_temp_dir(archive_meta, real_registry)
+    nested_dir = make_temp_dir(_make_real_file_meta(f'{archive_dir}/nested.vmdk', FileType.VMDK, archive_meta),
+                               real_registry, parent_dir=archive_dir)
+
+    # Same name, different archive
+    other_meta = _make_real_file_meta('/some/other_dir/archive.iso', FileType.ISO)
+    other_dir = make_temp_dir(other_meta, real_registry)
+
+    # Nested ones come first, so they're cleaned up before whatever they came from
+    assert find_associated_dirs(archive_meta.path, real_registry) == [nested_dir, archive_dir]
+    assert find_associated_dirs(other_meta.path, real_registry) == [other_dir]
+    mock_glob.glob.assert_not_called()
+
+    # Nothing in the registry, there is nothing to clean up, even for an archive with the same name as another one
+    mock_glob.glob.return_value = [archive_dir]
+    assert find_associated_dirs('/some/dir/never_unpacked.iso', real_registry) == []
+    assert find_associated_dirs('/some/third_dir/archive.iso', real_registry) == []
+    mock_glob.glob.assert_not_called()
+
+    assert determine_tmp_dir_filetype(nested_dir) == FileType.VMDK
+
+    # Once cleaned up, they're gone from the registry too
+    os.rmdir(nested_dir)
+    forget_tmp_dir(archive_dir)
+    assert find_associated_dirs(archive_meta.path, real_registry) == []
+
+
+def test_find_associated_dirs_registry_not_ours(real_registry, mock_glob):
+    from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir, find_associated_dirs, _registry
+
+    archive_meta = _make_real_file_meta('/some/dir/archive.tar', FileType.TAR)
+    archive_dir = make_temp_dir(archive_meta, real_registry)
+
+    # Rows pointing anywhere but at our own temp dirs are never handed to cleanup
+    registry = _registry(real_registry, create=False)
+    registry.add('/etc', archive_meta.path, FileType.TAR)
+    registry.add(os.path.join(real_registry, 'someone_elses_dir'), archive_meta.path, FileType.TAR)
+    registry.add(os.path.join(archive_dir, f'{EXPECTED_TMP_FILE_PREFIX}_tar_nested'), archive_meta.path, FileType.TAR)
+
+    assert find_associated_dirs(archive_meta.path, real_registry) == [archive_dir]
+
+
+def test_find_associated_dirs_untrusted_registry(real_registry, mock_glob):
+    from clamav_large_archive_scanner.lib.tmp_files import find_associated_dirs
+    from clamav_large_archive_scanner.lib.tmp_registry import registry_path, TmpDirRegistry
+
+    # Planted by another user
+    planted = TmpDirRegistry(real_registry)
+    planted.add('/etc', '/some/dir/archive.tar', FileType.TAR)
+    planted.close()
+    os.chmod(registry_path(real_registry), 0o666)
+
+    mock_glob.glob.return_value = []
+    assert find_associated_dirs('/some/dir/archive.tar', real_registry) == []
+    mock_glob.glob.assert_called_once()
+
+
+def test_find_associated_dirs_registry_stale(real_registry):
+    from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir, find_associated_dirs
+
+    archive_meta = _make_real_file_meta('/some/dir/archive.tar', FileType.TAR)
+    archive_dir = make_temp_dir(archive_meta, real_registry)
+    deleted_dir = make_temp_dir(archive_meta, real_registry)
+
+    # Deleted by someone else
+    os.rmdir(deleted_dir)
+
+    assert find_associated_dirs(archive_meta.path, real_registry) == [archive_dir]
+    assert find_associated_dirs(archive_meta.path, real_registry) == [archive_dir]
+
+
+def test_mark_mounted(real_registry):
+    from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir, mark_mounted, _registry
+
+    archive_dir = make_temp_dir(_make_real_file_meta('/some/dir/archive.iso', FileType.ISO), real_registry)
+    assert not _registry(real_registry, create=False).get(archive_dir).mounted
+
+    mark_mounted(archive_dir)
+    assert _registry(real_registry, create=False).get(archive_dir).mounted
+
+
+def test_make_temp_dir_private(mocker: MockerFixture, mock_tempfile, mock_os):
+    from clamav_large_archive_scanner.lib.tmp_files import make_temp_dir, use_private_dirs
+
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files._private_dirs', False)
+    mock_tempfile.mkdtemp.return_value = EXPECTED_MKDTEMP_RV
+
+    use_private_dirs(True)
+
+    # mkdtemp already makes it 0700
+    assert make_temp_dir(_make_file_meta(False), EXPECTED_TMP_DIR) == EXPECTED_MKDTEMP_RV
+    mock_os.chmod.assert_not_called()
@@ -0,0 +1,174 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sqlite3
+
+# noinspection PyPackageRequirements
+import pytest
+
+import common
+from clamav_large_archive_scanner.lib.file_data import FileType
+
+EXPECTED_ROOT_PATH = '/some/dir/some_archive.iso'
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def registry(tmp_path):
+    from clamav_large_archive_scanner.lib.tmp_registry import TmpDirRegistry
+
+    registry = TmpDirRegistry(str(tmp_path))
+    yield registry
+    registry.close()
+
+
+def _tmp_dir(tmp_path, name: str) -> str:
+    return str(tmp_path / name)
+
+
+def test_add_get(registry, tmp_path):
+    registry.add(_tmp_dir(tmp_path, 'iso_dir'), EXPECTED_ROOT_PATH, FileType.ISO)
+    registry.add(_tmp_dir(tmp_path, 'tar_dir'), EXPECTED_ROOT_PATH, FileType.TAR, _tmp_dir(tmp_path, 'iso_dir'))
+
+    entry = registry.get(_tmp_dir(tmp_path, 'tar_dir'))
+    assert entry.path == _tmp_dir(tmp_path, 'tar_dir')
+    assert entry.root_path == EXPECTED_ROOT_PATH
+    assert entry.filetype == FileType.TAR
+    assert entry.parent_path == _tmp_dir(tmp_path, 'iso_dir')
+    assert not entry.mounted
+
+    assert registry.get(_tmp_dir(tmp_path, 'iso_dir')).parent_path is None
+    assert registry.get(_tmp_dir(tmp_path, 'not_a_dir')) is None
+
+
+def test_set_mounted_remove(registry, tmp_path):
+    registry.add(_tmp_dir(tmp_path, 'iso_dir'), EXPECTED_ROOT_PATH, FileType.ISO)
+
+    registry.set_mounted(_tmp_dir(tmp_path, 'iso_dir'))
+    assert registry.get(_tmp_dir(tmp_path, 'iso_dir')).mounted
+
+    registry.remove(_tmp_dir(tmp_path, 'iso_dir'))
+    assert registry.get(_tmp_dir(tmp_path, 'iso_dir')) is None
+
+
+def test_find_by_root(registry, tmp_path):
+    registry.add(_tmp_dir(tmp_path, 'iso_dir'), EXPECTED_ROOT_PATH, FileType.ISO)
+    registry.add(_tmp_dir(tmp_path, 'other_dir'), '/some/other_dir/some_archive.iso', FileType.ISO)
+    registry.add(_tmp_dir(tmp_path, 'vmdk_dir'), EXPECTED_ROOT_PATH, FileType.VMDK, _tmp_dir(tmp_path, 'iso_dir'))
+    registry.add(_tmp_dir(tmp_path, 'tar_dir'), EXPECTED_ROOT_PATH, FileType.TAR, _tmp_dir(tmp_path, 'vmdk_dir'))
+
+    # Newest first
+    assert [x.path for x in registry.find_by_root(EXPECTED_ROOT_PATH)] == \
+           [_tmp_dir(tmp_path, 'tar_dir'), _tmp_dir(tmp_path, 'vmdk_dir'), _tmp_dir(tmp_path, 'iso_dir')]
+    assert registry.find_by_root('/some/dir/never_unpacked.iso') == []
+
+
+def test_shared(registry, tmp_path):
+    from clamav_large_archive_scanner.lib.tmp_registry import TmpDirRegistry
+
+    # IE another process using the same tmp dir, sees everything straight away
+    other_registry = TmpDirRegistry(str(tmp_path))
+    try:
+        registry.add(_tmp_dir(tmp_path, 'iso_dir'), EXPECTED_ROOT_PATH, FileType.ISO)
+        assert other_registry.get(_tmp_dir(tmp_path, 'iso_dir')).filetype == FileType.ISO
+
+        other_registry.remove(_tmp_dir(tmp_path, 'iso_dir'))
+        assert registry.find_by_root(EXPECTED_ROOT_PATH) == []
+    finally:
+        other_registry.close()
+
+
+def test_unusable(registry, tmp_path):
+    registry.add(_tmp_dir(tmp_path, 'iso_dir'), EXPECTED_ROOT_PATH, FileType.ISO)
+
+    registry._db.execute('DROP TABLE tmp_dirs')
+
+    # Disables itself, rather than erroring out
+    assert registry.find_by_root(EXPECTED_ROOT_PATH) is None
+    assert not registry.is_usable()
+
+    registry.add(_tmp_dir(tmp_path, 'tar_dir'), EXPECTED_ROOT_PATH, FileType.TAR)
+    assert registry.get(_tmp_dir(tmp_path, 'tar_dir')) is None
+
+
+def test_not_a_database(tmp_path):
+    from clamav_large_archive_scanner.lib.tmp_registry import TmpDirRegistry, registry_path
+
+    with open(registry_path(str(tmp_path)), 'w') as f:
+        f.write('definitely not a database' * 100)
+
+    with pytest.raises(sqlite3.DatabaseError):
+        TmpDirRegistry(str(tmp_path))
+
+
+def test_private(registry):
+    assert os.stat(registry.path).st_mode & 0o777 == 0o600
+
+
+def test_untrusted(tmp_path):
+    from clamav_large_archive_scanner.lib.tmp_registry import TmpDirRegistry, registry_path
+
+    path = registry_path(str(tmp_path))
+    TmpDirRegistry(str(tmp_path)).close()
+
+    # Writable by others
+    os.chmod(path, 0o664)
+    with pytest.raises(PermissionError):
+        TmpDirRegistry(str(tmp_path))
+
+    # Owned by someone else, which only root can set up
+    os.chmod(path, 0o600)
+    if os.geteuid() == 0:
+        os.chown(path, 12345, -1)
+        with pytest.raises(PermissionError):
+            TmpDirRegistry(str(tmp_path))
+
+    # A link to somewhere else
+    os.unlink(path)
+    os.symlink(str(tmp_path / 'elsewhere.sqlite'), path)
+    with pytest.raises(OSError):
+        TmpDirRegistry(str(tmp_path))
+    assert not (tmp_path / 'elsewhere.sqlite').exists()
+
+
+def test_untrusted_wal(tmp_path):
+    from clamav_large_archive_scanner.lib.tmp_registry import TmpDirRegistry, registry_path
+
+    # A write ahead log is replayed when the database is opened, so it needs to be ours too
+    wal_path = registry_path(str(tmp_path)) + '-wal'
+    with open(wal_path, 'w') as f:
+        f.write('planted')
+    os.chmod(wal_path, 0o666)
+
+    with pytest.raises(PermissionError):
+        TmpDirRegistry(str(tmp_path))
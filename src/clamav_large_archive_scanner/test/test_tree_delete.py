@@ -0,0 +1,262 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import os
+import threading
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+from clamav_large_archive_scanner.lib.tree_delete import TRASH_DIR_PREFIX
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function')
+def deleter():
+    from clamav_large_archive_scanner.lib.tree_delete import TreeDeleter
+    return TreeDeleter(max_jobs=4)
+
+
+def _make_tree(root) -> None:
+    (root / 'a' / 'aa').mkdir(parents=True)
+    (root / 'b').mkdir()
+    (root / 'top.txt').write_bytes(b'x' * 10000)
+    (root / 'a' / 'a.txt').write_bytes(b'a' * 5000)
+    (root / 'a' / 'aa' / 'aa.txt').write_bytes(b'aa')
+    (root / 'b' / 'b.txt').write_bytes(b'')
+
+
+def test_delete(tmp_path, deleter):
+    tree = tmp_path / 'some_tree'
+    _make_tree(tree)
+
+    deleter.delete(str(tree))
+
+    # Out of the way before anything is actually deleted
+    assert not tree.exists()
+
+    stats = deleter.wait()
+
+    assert stats.num_trees == 1
+    assert stats.num_files == 4
+    assert stats.num_dirs == 4
+    assert stats.reclaimed_bytes >= 15000
+    assert stats.num_errors == 0
+
+    # Nothing left over, including the trash
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_delete_symlinks(tmp_path, deleter):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (outside / 'keep.txt').write_bytes(b'keep')
+
+    tree = tmp_path / 'some_tree'
+    tree.mkdir()
+    (tree / 'link_to_dir').symlink_to(outside)
+    (tree / 'link_to_file').symlink_to(outside / 'keep.txt')
+    (tree / 'dangling').symlink_to(tmp_path / 'not_there')
+
+    deleter.delete(str(tree))
+    stats = deleter.wait()
+
+    # The links are gone, not what they point to
+    assert stats.num_files == 3
+    assert stats.num_errors == 0
+    assert not tree.exists()
+    assert (outside / 'keep.txt').read_bytes() == b'keep'
+
+
+def test_delete_no_permissions(tmp_path, deleter):
+    tree = tmp_path / 'some_tree'
+    _make_tree(tree)
+
+    # Extracted straight from an archive that didn't think anyone would want to delete them
+    os.chmod(tree / 'a' / 'aa', 0o500)
+    os.chmod(tree / 'b', 0o000)
+
+    deleter.delete(str(tree))
+    stats = deleter.wait()
+
+    assert stats.num_errors == 0
+    assert stats.num_files == 4
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_delete_missing(tmp_path, deleter):
+    deleter.delete(str(tmp_path / 'not_there'))
+
+    stats = deleter.wait()
+    assert stats.num_trees == 0
+    assert stats.num_errors == 0
+
+
+def test_delete_in_place(mocker: MockerFixture, tmp_path, deleter):
+    tree = tmp_path / 'some_tree'
+    _make_tree(tree)
+
+    # IE the tree is a mount point
+    mocker.patch('clamav_large_archive_scanner.lib.tree_delete.os.rename', side_effect=OSError(errno.EBUSY, 'Busy'))
+
+    deleter.delete(str(tree))
+    stats = deleter.wait()
+
+    assert stats.num_files == 4
+    assert stats.num_dirs == 4
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_delete_errors(mocker: MockerFixture, tmp_path, deleter):
+    from clamav_large_archive_scanner.lib import tree_delete
+
+    tree = tmp_path / 'some_tree'
+    _make_tree(tree)
+
+    real_unlink = os.unlink
+
+    def _unlink(name, dir_fd=None):
+        if name == 'a.txt':
+            raise PermissionError(errno.EPERM, 'Operation not permitted')
+        real_unlink(name, dir_fd=dir_fd)
+
+    mocker.patch.object(tree_delete.os, 'unlink', _unlink)
+    mock_warn = mocker.patch('clamav_large_archive_scanner.lib.tree_delete.fast_log.warn')
+
+    deleter.delete(str(tree))
+    stats = deleter.wait()
+
+    # The file, and every dir it's in, are left behind, and reported
+    assert stats.num_files == 3
+    assert stats.num_errors == 3
+    assert 'a.txt: [Errno 1] Operation not permitted' in stats.errors[0]
+    mock_warn.assert_called_once()
+    assert 'some_tree' in mock_warn.call_args.args[0]
+    trash_dir, = tmp_path.glob(f'{TRASH_DIR_PREFIX}*')
+    assert len(list(trash_dir.rglob('a.txt'))) == 1
+
+
+def test_delete_trash_is_ours(tmp_path, deleter):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+
+    # Something planted under the name a trash dir could have, pointing elsewhere
+    (tmp_path / f'{TRASH_DIR_PREFIX}planted').symlink_to(outside)
+
+    tree = tmp_path / 'some_tree'
+    _make_tree(tree)
+
+    deleter.delete(str(tree))
+
+    # Moved into a trash dir that this deleter made, which only it can use
+    trash_dirs = [p for p in tmp_path.glob(f'{TRASH_DIR_PREFIX}*') if not p.is_symlink()]
+    assert len(trash_dirs) == 1
+    assert trash_dirs[0].stat().st_mode & 0o777 == 0o700
+
+    stats = deleter.wait()
+
+    assert stats.num_errors == 0
+    assert list(outside.iterdir()) == []
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['clam_unpacker_trash_planted', 'outside']
+
+
+def test_delete_parallel(mocker: MockerFixture, tmp_path, deleter):
+    from clamav_large_archive_scanner.lib.tree_delete import _TreeDeletion
+
+    tree = tmp_path / 'some_tree'
+    _make_tree(tree)
+
+    # Only gets through if both subdirectories are being emptied at the same time
+    both_open = threading.Barrier(2, timeout=5)
+    real_open_dir = _TreeDeletion._open_dir
+
+    def _open_dir(a_dir: str) -> int:
+        if os.path.basename(a_dir) in ('a', 'b'):
+            both_open.wait()
+        return real_open_dir(a_dir)
+
+    mocker.patch.object(_TreeDeletion, '_open_dir', staticmethod(_open_dir))
+
+    deleter.delete(str(tree))
+    stats = deleter.wait()
+
+    assert stats.num_files == 4
+    assert stats.num_errors == 0
+
+
+def test_delete_tree(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.tree_delete import delete_tree, wait_for_deletes
+
+    mocker.patch('clamav_large_archive_scanner.lib.tree_delete._deleter', None)
+
+    # Nothing has been deleted yet
+    assert wait_for_deletes() is None
+
+    for name in ('tree_1', 'tree_2'):
+        _make_tree(tmp_path / name)
+        delete_tree(str(tmp_path / name))
+
+    stats = wait_for_deletes()
+    assert stats.num_trees == 2
+    assert stats.num_files == 8
+    assert list(tmp_path.iterdir()) == []
+
+    # Only counts what was deleted since the last wait
+    assert wait_for_deletes().num_trees == 0
+
+
+def test_wait_for_delete(mocker: MockerFixture, tmp_path):
+    from clamav_large_archive_scanner.lib.tree_delete import delete_tree, wait_for_delete, wait_for_deletes
+
+    mocker.patch('clamav_large_archive_scanner.lib.tree_delete._deleter', None)
+
+    assert wait_for_delete(str(tmp_path / 'tree_1')) is None
+
+    for name in ('tree_1', 'tree_2'):
+        _make_tree(tmp_path / name)
+        delete_tree(str(tmp_path / name))
+
+    stats = wait_for_delete(str(tmp_path / 'tree_2'))
+    assert stats.num_trees == 1
+    assert stats.num_files == 4
+    assert not (tmp_path / 'tree_2').exists()
+
+    # Already waited for, or never handed off
+    assert wait_for_delete(str(tmp_path / 'tree_2')) is None
+    assert wait_for_delete(str(tmp_path / 'tree_3')) is None
+
+    # Both are still counted by the next wait
+    assert wait_for_deletes().num_trees == 2
+    assert list(tmp_path.iterdir()) == []
@@ -26,7 +26,14 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import io
 import os
+import shutil
+import stat
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, call
 
 import click
@@ -36,7 +43,7 @@ from pytest_mock import MockerFixture
 
 import common
 
-from clamav_large_archive_scanner.lib.exceptions import ArchiveException, MountException
+from clamav_large_archive_scanner.lib.exceptions import ArchiveException, IsoException, MountException
 from clamav_large_archive_scanner.lib.file_data import FileMetadata, FileType
 
 EXPECTED_TMP_DIR_PARENT = '/tmp/some_tmp_dir_for_files_parent'
@@ -83,8 +90,33 @@ def mock_os():
     return MagicMock()
 
 
+@pytest.fixture(scope='function')
+def mock_discovery():
+    return MagicMock()
+
+
+@pytest.fixture(scope='function')
+def mock_tarfile():
+    mock_tarfile = MagicMock()
+    mock_tarfile.open.return_value.num_unreadable = 0
+    return mock_tarfile
+
+
+@pytest.fixture(scope='function')
+def mock_guestfs_appliance():
+    mock_guestfs_appliance = MagicMock()
+    mock_guestfs_appliance.is_available.return_value = False
+    return mock_guestfs_appliance
+
+
+@pytest.fixture(scope='function')
+def mock_mark_mounted(mocker: MockerFixture):
+    return mocker.patch('clamav_large_archive_scanner.lib.tmp_files.mark_mounted')
+
+
 @pytest.fixture(scope='function', autouse=True)
-def setup_and_teardown(mocker: MockerFixture, mock_mount_tools, mock_os, mock_file_data, mock_shutil, mock_contexts):
+def setup_and_teardown(mocker: MockerFixture, mock_mount_tools, mock_os, mock_file_data, mock_shutil, mock_contexts,
+                       mock_discovery, mock_tarfile, mock_guestfs_appliance, mock_mark_mounted):
     # Before logic
     # These are re-mocked for every single test
     mocker.patch('clamav_large_archive_scanner.lib.unpack.shutil', mock_shutil)
@@ -92,6 +124,9 @@ def setup_and_teardown(mocker: MockerFixture, mock_mount_tools, mock_os, mock_fi
     mocker.patch('clamav_large_archive_scanner.lib.unpack.os', mock_os)
     mocker.patch('clamav_large_archive_scanner.lib.unpack.file_data', mock_file_data)
     mocker.patch('clamav_large_archive_scanner.lib.unpack.contexts', mock_contexts)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.discovery', mock_discovery)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack._ReadableTarFile', mock_tarfile)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.guestfs_appliance', mock_guestfs_appliance)
 
     yield
 
@@ -147,7 +182,8 @@ def test_archive_file_unpacker(mock_shutil, mock_os):
     mock_shutil.unpack_archive.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR,
                                                        format=EXPECTED_TAR_FILE_FORMAT)
 
-    mock_os.system.assert_called_once_with(f'chmod -R a+r {EXPECTED_TMP_DIR}')
+    # No second pass over everything that was unpacked
+    mock_os.system.assert_not_called()
 
 
 def test_archive_file_unpacker_unpack_failed(mock_shutil):
@@ -167,9 +203,18 @@ def test_archive_file_unpacker_unpack_failed(mock_shutil):
     mock_u_ctx.cleanup_tmp.assert_called_once()
 
 
-def test_iso_unpacker(mock_mount_tools):
+def _mock_unreadable_iso(mocker: MockerFixture) -> MagicMock:
+    # As if the image were UDF, which has to be mounted
+    mock_iso9660 = mocker.patch('clamav_large_archive_scanner.lib.unpack.iso9660')
+    mock_iso9660.IsoImage.side_effect = IsoException('some_iso_exception')
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.open', mocker.mock_open(), create=True)
+    return mock_iso9660
+
+
+def test_iso_unpacker(mocker: MockerFixture, mock_mount_tools, mock_mark_mounted):
     from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
 
+    _mock_unreadable_iso(mocker)
     mock_u_ctx = _make_mock_u_ctx()
 
     unpacker = IsoFileUnpackHandler(mock_u_ctx)
@@ -179,11 +224,13 @@ def test_iso_unpacker(mock_mount_tools):
 
     assert unpack_ctx == mock_u_ctx
     mock_mount_tools.mount_iso.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR)
+    mock_mark_mounted.assert_called_once_with(EXPECTED_TMP_DIR)
 
 
-def test_iso_unpacker_mount_error(mock_mount_tools):
+def test_iso_unpacker_mount_error(mocker: MockerFixture, mock_mount_tools, mock_mark_mounted):
     from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
 
+    _mock_unreadable_iso(mocker)
     mock_u_ctx = _make_mock_u_ctx()
 
     mock_mount_tools.mount_iso.side_effect = MountException('some_mount_exception')
@@ -194,6 +241,7 @@ def test_iso_unpacker_mount_error(mock_mount_tools):
         unpacker.unpack()
 
     mock_mount_tools.mount_iso.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR)
+    mock_mark_mounted.assert_not_called()
 
     assert str(e.value) == f'Unable to mount {EXPECTED_ARCHIVE_PATH} to {EXPECTED_TMP_DIR}'
 
@@ -225,6 +273,282 @@ def test_targz_unpacker():
     _archive_unpacker_children_test_and_assert(TarGzFileUnpackHandler, EXPECTED_TGZ_FILE_FORMAT)
 
 
+def test_targz_unpacker_extract(mocker: MockerFixture, mock_shutil, mock_tarfile):
+    from clamav_large_archive_scanner.lib.unpack import TarGzFileUnpackHandler
+
+    mock_decompress = mocker.patch('clamav_large_archive_scanner.lib.unpack.decompress')
+    mock_gz_stream = mock_decompress.GzipStream.return_value.__enter__.return_value
+    mock_tar = mock_tarfile.open.return_value
+
+    mock_u_ctx = _make_mock_u_ctx()
+    TarGzFileUnpackHandler(mock_u_ctx).unpack()
+
+    # Read as a stream, so that the tar can be unpacked while the rest of it is being decompressed
+    mock_decompress.GzipStream.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
+    mock_tarfile.open.assert_called_once_with(fileobj=mock_gz_stream, mode='r|')
+    mock_tar.extractall.assert_called_once_with(EXPECTED_TMP_DIR)
+    mock_shutil.unpack_archive.assert_not_called()
+
+
+def test_targz_unpacker_decompress_failed(mocker: MockerFixture):
+    from clamav_large_archive_scanner.lib.unpack import TarGzFileUnpackHandler
+
+    mock_decompress = mocker.patch('clamav_large_archive_scanner.lib.unpack.decompress')
+    mock_decompress.GzipStream.side_effect = OSError('Unable to decompress')
+
+    mock_u_ctx = _make_mock_u_ctx()
+
+    with pytest.raises(ArchiveException):
+        TarGzFileUnpackHandler(mock_u_ctx).unpack()
+
+    mock_u_ctx.cleanup_tmp.assert_called_once()
+
+
+def _make_real_u_ctx(mocker: MockerFixture, mock_tarfile, tmp_path, archive_path) -> MagicMock:
+    # These unpack for real
+    mocker.stop(mock_tarfile)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.os', os)
+
+    unpacked_dir = tmp_path / 'unpacked'
+    unpacked_dir.mkdir()
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_u_ctx.file_meta.path = str(archive_path)
+    mock_u_ctx.unpacked_dir_location = str(unpacked_dir)
+    return mock_u_ctx
+
+
+def test_tar_unpacker_makes_readable(mocker: MockerFixture, mock_tarfile, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import TarFileUnpackHandler
+
+    archive_path = tmp_path / 'some_archive.tar'
+    with tarfile.open(archive_path, 'w') as tar:
+        dir_info = tarfile.TarInfo('private_dir')
+        dir_info.type = tarfile.DIRTYPE
+        dir_info.mode = 0o700
+        tar.addfile(dir_info)
+
+        file_info = tarfile.TarInfo('private_dir/private_file')
+        file_info.mode = 0o600
+        file_info.size = 4
+        tar.addfile(file_info, io.BytesIO(b'abcd'))
+
+        exec_info = tarfile.TarInfo('private_exec')
+        exec_info.mode = 0o700
+        tar.addfile(exec_info, io.BytesIO(b''))
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    TarFileUnpackHandler(mock_u_ctx).unpack()
+
+    unpacked_dir = tmp_path / 'unpacked'
+    assert stat.S_IMODE(os.stat(unpacked_dir / 'private_dir').st_mode) == 0o755
+    assert stat.S_IMODE(os.stat(unpacked_dir / 'private_dir' / 'private_file').st_mode) == 0o644
+    assert stat.S_IMODE(os.stat(unpacked_dir / 'private_exec').st_mode) == 0o744
+    assert (unpacked_dir / 'private_dir' / 'private_file').read_bytes() == b'abcd'
+
+
+def test_tar_unpacker_zero_copy(mocker: MockerFixture, mock_tarfile, tmp_path):
+    import clamav_large_archive_scanner.lib.zero_copy as zero_copy
+    from clamav_large_archive_scanner.lib.unpack import TarFileUnpackHandler
+
+    archive_path = tmp_path / 'some_archive.tar'
+    with tarfile.open(archive_path, 'w') as tar:
+        for name, content in [('a_file', b'abcd'), ('a_dir/another_file', b'efgh' * 1000), ('empty_file', b'')]:
+            file_info = tarfile.TarInfo(name)
+            file_info.size = len(content)
+            tar.addfile(file_info, io.BytesIO(content))
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    copy_spy = mocker.spy(zero_copy, 'copy_to_file')
+    TarFileUnpackHandler(mock_u_ctx).unpack()
+
+    unpacked_dir = tmp_path / 'unpacked'
+    assert (unpacked_dir / 'a_file').read_bytes() == b'abcd'
+    assert (unpacked_dir / 'a_dir' / 'another_file').read_bytes() == b'efgh' * 1000
+    assert (unpacked_dir / 'empty_file').read_bytes() == b''
+    assert copy_spy.call_count == 3
+
+
+def test_tar_unpacker_zero_copy_truncated(mocker: MockerFixture, mock_tarfile, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import TarFileUnpackHandler
+
+    content = io.BytesIO()
+    with tarfile.open(fileobj=content, mode='w') as tar:
+        file_info = tarfile.TarInfo('a_file')
+        file_info.size = 4096
+        tar.addfile(file_info, io.BytesIO(b'a' * 4096))
+
+    # Cut off part way through the member
+    archive_path = tmp_path / 'some_archive.tar'
+    archive_path.write_bytes(content.getvalue()[:1024])
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    with pytest.raises(ArchiveException):
+        TarFileUnpackHandler(mock_u_ctx).unpack()
+
+
+def test_tar_unpacker_private(mocker: MockerFixture, mock_tarfile, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import TarFileUnpackHandler
+
+    archive_path = tmp_path / 'some_archive.tar'
+    with tarfile.open(archive_path, 'w') as tar:
+        dir_info = tarfile.TarInfo('private_dir')
+        dir_info.type = tarfile.DIRTYPE
+        dir_info.mode = 0o300
+        tar.addfile(dir_info)
+
+        file_info = tarfile.TarInfo('unreadable_file')
+        file_info.mode = 0o200
+        tar.addfile(file_info, io.BytesIO(b''))
+
+    # clamd gets passed the open files, so only we need to be able to read them
+    mocker.patch('clamav_large_archive_scanner.lib.tmp_files._private_dirs', True)
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    TarFileUnpackHandler(mock_u_ctx).unpack()
+
+    unpacked_dir = tmp_path / 'unpacked'
+    assert stat.S_IMODE(os.stat(unpacked_dir / 'private_dir').st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(unpacked_dir / 'unreadable_file').st_mode) == 0o600
+
+
+def test_tar_unpacker_chmod_failed(mocker: MockerFixture, mock_tarfile, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import TarFileUnpackHandler
+
+    archive_path = tmp_path / 'some_archive.tar'
+    with tarfile.open(archive_path, 'w') as tar:
+        tar.addfile(tarfile.TarInfo('some_file'), io.BytesIO(b''))
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.os.chmod', side_effect=PermissionError('not allowed'))
+    mock_warn = mocker.patch('clamav_large_archive_scanner.lib.unpack.fast_log.warn')
+
+    # Still unpacked, but it gets reported
+    TarFileUnpackHandler(mock_u_ctx).unpack()
+
+    assert (tmp_path / 'unpacked' / 'some_file').exists()
+    mock_warn.assert_called_once()
+    assert 'Unable to make 1 file(s)' in mock_warn.call_args.args[0]
+
+
+def test_zip_unpacker_makes_readable(mocker: MockerFixture, mock_tarfile, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import ZipFileUnpackHandler
+
+    archive_path = tmp_path / 'some_archive.zip'
+    with zipfile.ZipFile(archive_path, 'w') as zip_file:
+        zip_file.writestr('some_dir/some_file', b'abcd')
+
+    # As if clamd wouldn't be able to read anything created as per the umask
+    mocker.patch('clamav_large_archive_scanner.lib.unpack._UMASK', 0o077)
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    ZipFileUnpackHandler(mock_u_ctx).unpack()
+
+    unpacked_file = tmp_path / 'unpacked' / 'some_dir' / 'some_file'
+    assert unpacked_file.read_bytes() == b'abcd'
+    assert stat.S_IMODE(os.stat(unpacked_file).st_mode) == 0o644
+
+
+def test_zip_unpacker_zero_copy(mocker: MockerFixture, mock_tarfile, tmp_path):
+    import clamav_large_archive_scanner.lib.zero_copy as zero_copy
+    from clamav_large_archive_scanner.lib.unpack import ZipFileUnpackHandler
+
+    archive_path = tmp_path / 'some_archive.zip'
+    with zipfile.ZipFile(archive_path, 'w') as zip_file:
+        zip_file.writestr('stored/file', b'abcd' * 1000, compress_type=zipfile.ZIP_STORED)
+        zip_file.writestr('deflated/file', b'efgh' * 1000, compress_type=zipfile.ZIP_DEFLATED)
+        zip_file.writestr('../../escaped', b'ijkl', compress_type=zipfile.ZIP_STORED)
+        zip_file.writestr('empty_dir/', b'')
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    copy_spy = mocker.spy(zero_copy, 'copy_to_file')
+    ZipFileUnpackHandler(mock_u_ctx).unpack()
+
+    unpacked_dir = tmp_path / 'unpacked'
+    assert (unpacked_dir / 'stored' / 'file').read_bytes() == b'abcd' * 1000
+    assert (unpacked_dir / 'deflated' / 'file').read_bytes() == b'efgh' * 1000
+    assert (unpacked_dir / 'empty_dir').is_dir()
+
+    # Same as zipfile, nothing gets out of the unpacked dir
+    assert (unpacked_dir / 'escaped').read_bytes() == b'ijkl'
+
+    # Only the stored members are copied straight out of the zip
+    assert copy_spy.call_count == 2
+
+
+def test_zip_unpacker_already_readable(mocker: MockerFixture, mock_tarfile, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import ZipFileUnpackHandler
+
+    archive_path = tmp_path / 'some_archive.zip'
+    with zipfile.ZipFile(archive_path, 'w') as zip_file:
+        zip_file.writestr('some_file', b'abcd')
+
+    mocker.patch('clamav_large_archive_scanner.lib.unpack._UMASK', 0o022)
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    mock_chmod = mocker.patch('clamav_large_archive_scanner.lib.unpack.os.chmod')
+
+    ZipFileUnpackHandler(mock_u_ctx).unpack()
+
+    assert (tmp_path / 'unpacked' / 'some_file').read_bytes() == b'abcd'
+    mock_chmod.assert_not_called()
+
+
+def test_iso_unpacker_userspace(mocker: MockerFixture, mock_tarfile, mock_mount_tools, tmp_path):
+    import clamav_large_archive_scanner.lib.zero_copy as zero_copy
+    from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
+
+    archive_path = tmp_path / 'some.iso'
+    common.make_iso(str(archive_path), {'Some Dir': {'Some File': b'abcd' * 1000, 'Empty Dir': {}},
+                                        'Big File': [b'a' * 3000, b'b' * 10]}, rock_ridge=True)
+
+    # As if clamd wouldn't be able to read anything created as per the umask
+    mocker.patch('clamav_large_archive_scanner.lib.unpack._UMASK', 0o077)
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    copy_spy = mocker.spy(zero_copy, 'copy_ranges_to_file')
+    IsoFileUnpackHandler(mock_u_ctx).unpack()
+
+    unpacked_dir = tmp_path / 'unpacked'
+    assert (unpacked_dir / 'Some Dir' / 'Some File').read_bytes() == b'abcd' * 1000
+    assert (unpacked_dir / 'Some Dir' / 'Empty Dir').is_dir()
+    assert (unpacked_dir / 'Big File').read_bytes() == b'a' * 3000 + b'b' * 10
+    assert stat.S_IMODE(os.stat(unpacked_dir / 'Some Dir').st_mode) == 0o755
+    assert stat.S_IMODE(os.stat(unpacked_dir / 'Big File').st_mode) == 0o644
+
+    assert copy_spy.call_count == 2
+    mock_mount_tools.mount_iso.assert_not_called()
+
+
+def test_iso_unpacker_udf_mounts(mocker: MockerFixture, mock_tarfile, mock_mount_tools, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
+
+    archive_path = tmp_path / 'some.iso'
+    common.make_iso(str(archive_path), {'Some Dir': {'Some File': b'abcd'}}, udf=True)
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    IsoFileUnpackHandler(mock_u_ctx).unpack()
+
+    assert os.listdir(tmp_path / 'unpacked') == []
+    mock_mount_tools.mount_iso.assert_called_once_with(str(archive_path), str(tmp_path / 'unpacked'))
+
+
+def test_iso_unpacker_truncated_mounts(mocker: MockerFixture, mock_tarfile, mock_mount_tools, tmp_path):
+    from clamav_large_archive_scanner.lib.unpack import IsoFileUnpackHandler
+
+    archive_path = tmp_path / 'some.iso'
+    common.make_iso(str(archive_path), {'Some Dir': {'Some File': b'abcd'}})
+
+    mock_u_ctx = _make_real_u_ctx(mocker, mock_tarfile, tmp_path, archive_path)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.zero_copy.copy_ranges_to_file', return_value=0)
+    mocker.patch('clamav_large_archive_scanner.lib.unpack.shutil', shutil)
+
+    IsoFileUnpackHandler(mock_u_ctx).unpack()
+
+    # Mounted over an empty dir, nothing copied before finding out is left behind
+    assert os.listdir(tmp_path / 'unpacked') == []
+    mock_mount_tools.mount_iso.assert_called_once_with(str(archive_path), str(tmp_path / 'unpacked'))
+
+
 def _mock_enumerate_guestfs_partitions(mock_mount_tools, return_value):
     mock_mount_tools.enumerate_guestfs_partitions.return_value = return_value
 
@@ -236,7 +560,7 @@ def _assert_guestfs_unpack_calls(mock_mount_tools, expected_tmp_dir, expected_pa
         [call(EXPECTED_ARCHIVE_PATH, x, expected_tmp_dir) for x in expected_partitions], any_order=True)
 
 
-def test_guestfs_unpacker(mock_mount_tools):
+def test_guestfs_unpacker(mock_mount_tools, mock_mark_mounted):
     from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
 
     # For test output formatting... don't remove
@@ -253,6 +577,7 @@ def test_guestfs_unpacker(mock_mount_tools):
     assert unpack_ctx == mock_u_ctx
 
     _assert_guestfs_unpack_calls(mock_mount_tools, EXPECTED_TMP_DIR, EXPECTED_GUESTFS_PARTITIONS)
+    mock_mark_mounted.assert_called_once_with(EXPECTED_TMP_DIR)
 
 
 def test_guestfs_unpacker_enumerate_error(mock_mount_tools):
@@ -276,7 +601,7 @@ def test_guestfs_unpacker_enumerate_error(mock_mount_tools):
     mock_mount_tools.mount_guestfs_partition.assert_not_called()
 
 
-def test_guestfs_unpacker_mount_error(mock_mount_tools):
+def test_guestfs_unpacker_mount_error(mock_mount_tools, mock_mark_mounted):
     from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
 
     # For test output formatting... don't remove
@@ -294,6 +619,97 @@ def test_guestfs_unpacker_mount_error(mock_mount_tools):
 
     _assert_guestfs_unpack_calls(mock_mount_tools, EXPECTED_TMP_DIR, EXPECTED_GUESTFS_PARTITIONS)
 
+    # Nothing was mounted, so nothing needs un-mounting
+    mock_mark_mounted.assert_not_called()
+
+
+def test_guestfs_unpacker_parallel(mock_mount_tools):
+    import threading
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    # For test output formatting... don't remove
+    print()
+
+    mock_u_ctx = _make_mock_u_ctx()
+    _mock_enumerate_guestfs_partitions(mock_mount_tools, EXPECTED_GUESTFS_PARTITIONS)
+
+    # Only gets through if every partition is being mounted at the same time
+    all_mounting = threading.Barrier(len(EXPECTED_GUESTFS_PARTITIONS), timeout=5)
+
+    def _mount(archive_path, partition, tmp_dir):
+        all_mounting.wait()
+        if partition == EXPECTED_GUESTFS_PARTITIONS[1]:
+            raise MountException('some_mount_exception')
+
+    mock_mount_tools.mount_guestfs_partition.side_effect = _mount
+
+    GuestFSFileUnpackHandler(mock_u_ctx).unpack()
+
+    assert mock_mount_tools.mount_guestfs_partition.call_count == len(EXPECTED_GUESTFS_PARTITIONS)
+
+
+def test_guestfs_unpacker_appliance(mocker: MockerFixture, mock_mount_tools, mock_guestfs_appliance,
+                                    mock_mark_mounted):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    # For test output formatting... don't remove
+    print()
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_guestfs_appliance.is_available.return_value = True
+    mock_guestfs_appliance.mount_image.return_value = (EXPECTED_GUESTFS_PARTITIONS[:2],
+                                                       {EXPECTED_GUESTFS_PARTITIONS[2]: 'some_mount_error'})
+    mock_warn = mocker.patch('clamav_large_archive_scanner.lib.unpack.fast_log.warn')
+
+    unpacker = GuestFSFileUnpackHandler(mock_u_ctx)
+    _assert_base_file_handler_init_behavior(mock_u_ctx)
+
+    assert unpacker.unpack() == mock_u_ctx
+
+    # One appliance for every partition, no guestmount at all
+    mock_guestfs_appliance.mount_image.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR)
+    mock_mount_tools.enumerate_guestfs_partitions.assert_not_called()
+    mock_mount_tools.mount_guestfs_partition.assert_not_called()
+    mock_mark_mounted.assert_called_once_with(EXPECTED_TMP_DIR)
+
+    # Partitions that can't be mounted don't stop the rest
+    mock_warn.assert_called_once()
+    assert EXPECTED_GUESTFS_PARTITIONS[2] in mock_warn.call_args.args[0]
+
+
+def test_guestfs_unpacker_appliance_nothing_mounted(mock_mount_tools, mock_guestfs_appliance, mock_mark_mounted):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    # For test output formatting... don't remove
+    print()
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_guestfs_appliance.is_available.return_value = True
+    mock_guestfs_appliance.mount_image.return_value = ([], {x: 'some_mount_error' for x in EXPECTED_GUESTFS_PARTITIONS})
+
+    assert GuestFSFileUnpackHandler(mock_u_ctx).unpack() == mock_u_ctx
+
+    mock_mark_mounted.assert_not_called()
+
+
+def test_guestfs_unpacker_appliance_error(mock_mount_tools, mock_guestfs_appliance):
+    from clamav_large_archive_scanner.lib.unpack import GuestFSFileUnpackHandler
+
+    # For test output formatting... don't remove
+    print()
+
+    mock_u_ctx = _make_mock_u_ctx()
+    mock_guestfs_appliance.is_available.return_value = True
+    mock_guestfs_appliance.mount_image.side_effect = MountException('some_launch_exception')
+
+    unpacker = GuestFSFileUnpackHandler(mock_u_ctx)
+
+    with pytest.raises(click.FileError) as e:
+        unpacker.unpack()
+
+    assert str(e.value) == f'Unable to launch an appliance for {EXPECTED_ARCHIVE_PATH}, aborting unpack'
+    mock_mount_tools.mount_guestfs_partition.assert_not_called()
+
 
 def test_dir_unpacker():
     from clamav_large_archive_scanner.lib.unpack import DirFileUnpackHandler
@@ -305,6 +721,7 @@ def test_dir_unpacker():
     unpack_ctx = unpacker.unpack()
 
     assert unpack_ctx == mock_u_ctx
+    assert unpack_ctx.unpacked_dir_location == EXPECTED_ARCHIVE_PATH
 
     mock_u_ctx.create_tmp_dir.assert_not_called()
 
@@ -321,7 +738,7 @@ def test_is_handled_filetype():
     assert not is_handled_filetype(meta)
 
 
-def test_unpack(mock_shutil, mock_contexts):
+def test_unpack(mock_tarfile, mock_contexts):
     from clamav_large_archive_scanner.lib.unpack import unpack
 
     expected_file_meta = _make_file_meta()
@@ -330,8 +747,8 @@ def test_unpack(mock_shutil, mock_contexts):
 
     unpack_ctx = unpack(expected_file_meta, EXPECTED_TMP_DIR_PARENT)
 
-    mock_shutil.unpack_archive.assert_called_once_with(EXPECTED_ARCHIVE_PATH, EXPECTED_TMP_DIR,
-                                                       format=EXPECTED_TAR_FILE_FORMAT)
+    mock_tarfile.open.assert_called_once_with(EXPECTED_ARCHIVE_PATH)
+    mock_tarfile.open.return_value.extractall.assert_called_once_with(EXPECTED_TMP_DIR)
 
     _assert_base_file_handler_init_behavior(unpack_ctx)
 
@@ -351,7 +768,7 @@ def test_unpack_unhandled_filetype(mock_contexts):
     assert str(e.value) == f'Unhandled file type: {FileType.DOES_NOT_EXIST}'
 
 
-def test_unpack_archive_exception(mock_shutil, mock_contexts):
+def test_unpack_archive_exception(mock_tarfile, mock_contexts):
     from clamav_large_archive_scanner.lib.unpack import unpack
 
     expected_archive_exception_str = 'some_archive_exception'
@@ -360,7 +777,7 @@ def test_unpack_archive_exception(mock_shutil, mock_contexts):
     mock_u_ctx = _make_mock_u_ctx()
     mock_contexts.UnpackContext.return_value = mock_u_ctx
 
-    mock_shutil.unpack_archive.side_effect = Exception(expected_archive_exception_str)
+    mock_tarfile.open.side_effect = Exception(expected_archive_exception_str)
 
     with pytest.raises(click.FileError) as e:
         unpack(expected_file_meta, EXPECTED_TMP_DIR_PARENT)
@@ -404,20 +821,21 @@ def _parent_archive_metadata() -> FileMetadata:
     return file_meta
 
 
-def _recursive_unpack_os_walk_side_effect(*args, **kwargs):
+def _recursive_unpack_iter_files_side_effect(*args, **kwargs):
     target_dir = args[0]
 
     if target_dir == PARENT_ARCHIVE_UNPACK_DIR:
         return [
-            (PARENT_ARCHIVE_UNPACK_DIR, [], [VALID_ARCHIVE_1, 'invalid_file_1']),
-            (PARENT_ARCHIVE_SUBDIR_1, [], [VALID_ARCHIVE_2])
+            (VALID_ARCHIVE_1, MagicMock()),
+            (f'{PARENT_ARCHIVE_UNPACK_DIR}/invalid_file_1', MagicMock()),
+            (VALID_ARCHIVE_2, MagicMock()),
         ]
 
     # Not a directory that we are mocking (likely valid_archive_1_dir or valid_archive_2_dir)
     return []
 
 
-def _recursive_unpack_file_meta_from_path_side_effect(*args, **kwargs):
+def _recursive_unpack_file_meta_from_stat_side_effect(*args, **kwargs):
     file_path = args[0]
 
     if file_path == VALID_ARCHIVE_1:
@@ -455,7 +873,7 @@ def _recursive_unpack_unpack_context_ctor_side_effect(*args, **kwargs):
     return u_ctx
 
 
-def test_unpack_recursive(mock_shutil, mock_contexts, mock_os, mock_file_data):
+def test_unpack_recursive(mock_shutil, mock_contexts, mock_discovery, mock_file_data):
     from clamav_large_archive_scanner.lib.unpack import unpack_recursive
 
     # For test output formatting... don't remove
@@ -464,18 +882,131 @@ def test_unpack_recursive(mock_shutil, mock_contexts, mock_os, mock_file_data):
     mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
 
     # mock_tmp_files.make_temp_dir.side_effect = _recursive_unpack_make_temp_dir_side_effect
-    mock_os.walk.side_effect = _recursive_unpack_os_walk_side_effect
-    mock_file_data.file_meta_from_path.side_effect = _recursive_unpack_file_meta_from_path_side_effect
-
-    # Use real join
-    mock_os.path.join = os.path.join
+    mock_discovery.iter_files.side_effect = _recursive_unpack_iter_files_side_effect
+    mock_file_data.file_meta_from_stat.side_effect = _recursive_unpack_file_meta_from_stat_side_effect
 
     parent_archive_meta = _parent_archive_metadata()
 
-    unpack_ctxs = unpack_recursive(parent_archive_meta, 0, EXPECTED_TMP_DIR_PARENT)
+    unpack_ctxs = list(unpack_recursive(parent_archive_meta, 0, EXPECTED_TMP_DIR_PARENT))
 
     unpack_dirs = {x.unpacked_dir_location for x in unpack_ctxs}
 
     assert unpack_dirs == EXPECTED_RECURSIVE_UNPACK_DIRS
     # There are no call assertions here, since the only way that these two match is if all the
     # mocks got called correctly
+
+
+def test_unpack_recursive_on_inspected(mock_shutil, mock_contexts, mock_discovery, mock_file_data):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
+    mock_discovery.iter_files.side_effect = _recursive_unpack_iter_files_side_effect
+    mock_file_data.file_meta_from_stat.side_effect = _recursive_unpack_file_meta_from_stat_side_effect
+
+    events = []
+    on_inspected = MagicMock(side_effect=lambda u_ctx: events.append(('inspected', u_ctx.unpacked_dir_location)))
+
+    for u_ctx in unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, on_inspected=on_inspected):
+        events.append(('yielded', u_ctx.unpacked_dir_location))
+
+    assert {x[1] for x in events if x[0] == 'inspected'} == EXPECTED_RECURSIVE_UNPACK_DIRS
+
+    # Every context is yielded before it is inspected, and the parent is only done once its children were yielded
+    for unpack_dir in EXPECTED_RECURSIVE_UNPACK_DIRS:
+        assert events.index(('yielded', unpack_dir)) < events.index(('inspected', unpack_dir))
+
+    parent_inspected = events.index(('inspected', PARENT_ARCHIVE_UNPACK_DIR))
+    assert events.index(('yielded', VALID_ARCHIVE_1_UNPACK_DIR)) < parent_inspected
+    assert events.index(('yielded', VALID_ARCHIVE_2_UNPACK_DIR)) < parent_inspected
+
+
+def test_unpack_recursive_detect_jobs(mock_shutil, mock_contexts, mock_discovery, mock_file_data):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
+    mock_discovery.iter_files.side_effect = _recursive_unpack_iter_files_side_effect
+
+    def _slow_first_file(*args, **kwargs):
+        # Make the first file finish detecting last
+        if args[0] == VALID_ARCHIVE_1:
+            time.sleep(0.1)
+        return _recursive_unpack_file_meta_from_stat_side_effect(*args, **kwargs)
+
+    mock_file_data.file_meta_from_stat.side_effect = _slow_first_file
+
+    unpack_ctxs = list(unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, detect_jobs=4))
+
+    # Still in the order that the files were found in
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR,
+                                                              VALID_ARCHIVE_2_UNPACK_DIR]
+    assert mock_file_data.file_meta_from_stat.call_count == 3
+
+
+def test_unpack_recursive_shared_detect_pool(mock_shutil, mock_contexts, mock_discovery, mock_file_data):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive, use_detect_pool
+
+    mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
+    mock_discovery.iter_files.side_effect = _recursive_unpack_iter_files_side_effect
+    mock_file_data.file_meta_from_stat.side_effect = _recursive_unpack_file_meta_from_stat_side_effect
+
+    shared_pool = MagicMock(wraps=ThreadPoolExecutor(max_workers=2))
+    use_detect_pool(shared_pool)
+    try:
+        unpack_ctxs = list(unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT))
+    finally:
+        use_detect_pool(None)
+
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR,
+                                                              VALID_ARCHIVE_2_UNPACK_DIR]
+
+    # Used even with a single detect job, and left running for the other archives
+    assert shared_pool.map.call_count > 0
+    shared_pool.shutdown.assert_not_called()
+    shared_pool.shutdown()
+
+
+def test_unpack_recursive_dedupe(mocker: MockerFixture, mock_tarfile, mock_contexts, mock_discovery, mock_file_data):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
+    mock_discovery.iter_files.side_effect = _recursive_unpack_iter_files_side_effect
+    mock_file_data.file_meta_from_stat.side_effect = _recursive_unpack_file_meta_from_stat_side_effect
+
+    mock_dedupe = mocker.patch('clamav_large_archive_scanner.lib.unpack.dedupe')
+    mock_deduper = mock_dedupe.ArchiveDeduper.return_value
+    mock_deduper.num_duplicates = 1
+    mock_deduper.bytes_saved = 1234
+
+    # valid_archive_2 has the same content as valid_archive_1
+    def _find_original(u_ctx):
+        if u_ctx.file_meta.path == VALID_ARCHIVE_2:
+            return archive_1_ctx[0]
+
+        archive_1_ctx.append(u_ctx)
+        return None
+
+    archive_1_ctx = []
+    mock_deduper.find_original.side_effect = _find_original
+
+    unpack_ctxs = list(unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT, dedupe_archives=True))
+
+    assert [x.unpacked_dir_location for x in unpack_ctxs] == [PARENT_ARCHIVE_UNPACK_DIR, VALID_ARCHIVE_1_UNPACK_DIR]
+    assert mock_deduper.find_original.call_count == 2
+
+    # Only the first copy gets unpacked, the second is added to its aliases
+    assert mock_tarfile.open.call_args_list == [call(PARENT_ARCHIVE), call(VALID_ARCHIVE_1)]
+    archive_1_ctx[0].aliases.append.assert_called_once()
+
+
+def test_unpack_recursive_no_dedupe(mocker: MockerFixture, mock_shutil, mock_contexts, mock_discovery, mock_file_data):
+    from clamav_large_archive_scanner.lib.unpack import unpack_recursive
+
+    mock_contexts.UnpackContext.side_effect = _recursive_unpack_unpack_context_ctor_side_effect
+    mock_discovery.iter_files.side_effect = _recursive_unpack_iter_files_side_effect
+    mock_file_data.file_meta_from_stat.side_effect = _recursive_unpack_file_meta_from_stat_side_effect
+
+    mock_dedupe = mocker.patch('clamav_large_archive_scanner.lib.unpack.dedupe')
+
+    list(unpack_recursive(_parent_archive_metadata(), 0, EXPECTED_TMP_DIR_PARENT))
+
+    mock_dedupe.ArchiveDeduper.assert_not_called()
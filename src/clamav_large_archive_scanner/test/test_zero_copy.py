@@ -0,0 +1,124 @@
+# Copyright (C) 2023-2024 Cisco Systems, Inc. and/or its affiliates. All rights reserved.
+#
+# Authors: Dave Zhu (yanbzhu@cisco.com)
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of mosquitto nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+from pytest_mock import MockerFixture
+
+import common
+
+SOURCE_CONTENT = b'skip this' + b'0123456789' * 10
+
+
+@pytest.fixture(scope='session', autouse=True)
+def init_logging():
+    common.init_logging()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def setup_and_teardown(mocker: MockerFixture):
+    # Every test starts out trying copy_file_range again
+    mocker.patch('clamav_large_archive_scanner.lib.zero_copy._use_copy_file_range', hasattr(os, 'copy_file_range'))
+
+    yield
+
+
+# These copy real files, since the whole point is what the kernel does with them
+@pytest.fixture(scope='function')
+def source_file(tmp_path):
+    source_path = tmp_path / 'source'
+    source_path.write_bytes(SOURCE_CONTENT)
+
+    with open(source_path, 'rb') as f:
+        yield f
+
+
+def test_copy_to_file(source_file, tmp_path):
+    from clamav_large_archive_scanner.lib.zero_copy import copy_to_file
+
+    target_path = tmp_path / 'target'
+
+    assert copy_to_file(source_file.fileno(), 9, 100, str(target_path)) == 100
+    assert target_path.read_bytes() == SOURCE_CONTENT[9:]
+
+    # The source is read from the offset given, not wherever it happens to be
+    assert source_file.tell() == 0
+
+
+def test_copy_to_file_chunks(mocker: MockerFixture, source_file, tmp_path):
+    from clamav_large_archive_scanner.lib.zero_copy import copy_to_file
+
+    mocker.patch('clamav_large_archive_scanner.lib.zero_copy.COPY_CHUNK_SIZE', 7)
+    target_path = tmp_path / 'target'
+
+    assert copy_to_file(source_file.fileno(), 9, 100, str(target_path)) == 100
+    assert target_path.read_bytes() == SOURCE_CONTENT[9:]
+
+
+def test_copy_to_file_source_too_short(mocker: MockerFixture, source_file, tmp_path):
+    from clamav_large_archive_scanner.lib.zero_copy import copy_to_file
+
+    # Big enough to be preallocated, which must not be left behind
+    mocker.patch('clamav_large_archive_scanner.lib.zero_copy.PREALLOCATE_MIN_SIZE', 0)
+    target_path = tmp_path / 'target'
+
+    assert copy_to_file(source_file.fileno(), 9, 200, str(target_path)) == 100
+    assert target_path.read_bytes() == SOURCE_CONTENT[9:]
+
+
+def test_copy_to_file_sendfile_fallback(mocker: MockerFixture, source_file, tmp_path):
+    import clamav_large_archive_scanner.lib.zero_copy as zero_copy
+
+    mocker.patch('clamav_large_archive_scanner.lib.zero_copy._use_copy_file_range', True)
+    mock_copy_file_range = mocker.patch('clamav_large_archive_scanner.lib.zero_copy.os.copy_file_range',
+                                        side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'),
+                                        create=True)
+    mocker.patch('clamav_large_archive_scanner.lib.zero_copy.COPY_CHUNK_SIZE', 40)
+
+    target_path = tmp_path / 'target'
+    assert zero_copy.copy_to_file(source_file.fileno(), 9, 100, str(target_path)) == 100
+    assert target_path.read_bytes() == SOURCE_CONTENT[9:]
+
+    # Only tried the once
+    mock_copy_file_range.assert_called_once()
+    assert not zero_copy._use_copy_file_range
+
+
+def test_copy_to_file_error(mocker: MockerFixture, source_file, tmp_path):
+    from clamav_large_archive_scanner.lib.zero_copy import copy_to_file
+
+    mocker.patch('clamav_large_archive_scanner.lib.zero_copy._use_copy_file_range', True)
+    mocker.patch('clamav_large_archive_scanner.lib.zero_copy.os.copy_file_range',
+                 side_effect=OSError(errno.ENOSPC, 'No space left on device'), create=True)
+
+    # Anything other than copy_file_range not being supported is a real error
+    with pytest.raises(OSError):
+        copy_to_file(source_file.fileno(), 9, 100, str(tmp_path / 'target'))